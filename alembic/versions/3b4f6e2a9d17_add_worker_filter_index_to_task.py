@@ -0,0 +1,24 @@
+"""add worker_filter index to task
+
+Revision ID: 3b4f6e2a9d17
+Revises: d4363025a58c
+Create Date: 2026-10-17 10:12:41.218306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b4f6e2a9d17'
+down_revision = 'd4363025a58c'
+
+from alembic import op
+
+
+def upgrade():
+    # Workaround of "CREATE INDEX CONCURRENTLY cannot run inside a transaction block" exception
+    op.execute('COMMIT')
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS task_worker_filter_idx ON task USING gin (worker_filter);')
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS task_worker_filter_idx;')
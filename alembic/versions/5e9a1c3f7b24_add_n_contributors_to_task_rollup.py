@@ -0,0 +1,32 @@
+"""add n_contributors to task_rollup
+
+Revision ID: 5e9a1c3f7b24
+Revises: 8c2d5a7e41b0
+Create Date: 2026-10-17 15:02:41.318406
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e9a1c3f7b24'
+down_revision = '8c2d5a7e41b0'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('task_rollup',
+                  sa.Column('n_contributors', sa.Integer, nullable=False,
+                            server_default='0'))
+    op.execute('''
+        UPDATE task_rollup SET n_contributors = agg.n_contributors
+        FROM (SELECT task_id,
+              COUNT(DISTINCT coalesce(user_id::text, user_ip))
+              AS n_contributors
+              FROM task_run GROUP BY task_id) AS agg
+        WHERE task_rollup.task_id = agg.task_id;
+        ''')
+
+
+def downgrade():
+    op.drop_column('task_rollup', 'n_contributors')
@@ -0,0 +1,37 @@
+"""add task_rollup table
+
+Revision ID: 8c2d5a7e41b0
+Revises: 3b4f6e2a9d17
+Create Date: 2026-10-17 13:40:07.552914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8c2d5a7e41b0'
+down_revision = '3b4f6e2a9d17'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'task_rollup',
+        sa.Column('task_id', sa.Integer,
+                  sa.ForeignKey('task.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('project_id', sa.Integer, nullable=False),
+        sa.Column('n_task_runs', sa.Integer, nullable=False, default=0),
+        sa.Column('finish_time', sa.Text)
+    )
+    op.execute('''
+        INSERT INTO task_rollup (task_id, project_id, n_task_runs, finish_time)
+        SELECT task_id, project_id, COUNT(id), MAX(finish_time)
+        FROM task_run GROUP BY task_id, project_id;
+        ''')
+    op.create_index('task_rollup_project_id_finish_time_idx', 'task_rollup',
+                    ['project_id', 'finish_time'])
+
+
+def downgrade():
+    op.drop_table('task_rollup')
@@ -0,0 +1,84 @@
+"""add project stats rollup tables
+
+Revision ID: a4d7c2e9f136
+Revises: 5e9a1c3f7b24
+Create Date: 2026-10-17 17:21:09.604117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a4d7c2e9f136'
+down_revision = '5e9a1c3f7b24'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+
+
+def upgrade():
+    op.create_table(
+        'project_stats_hourly',
+        sa.Column('project_id', sa.Integer,
+                  sa.ForeignKey('project.id', ondelete='CASCADE'),
+                  primary_key=True),
+        sa.Column('hour', TIMESTAMP, primary_key=True),
+        sa.Column('n_task_runs', sa.Integer, nullable=False, default=0),
+        sa.Column('n_auth', sa.Integer, nullable=False, default=0),
+        sa.Column('n_anon', sa.Integer, nullable=False, default=0)
+    )
+    op.create_table(
+        'project_stats_contributor',
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('project_id', sa.Integer,
+                  sa.ForeignKey('project.id', ondelete='CASCADE'),
+                  nullable=False),
+        sa.Column('day', sa.Date, nullable=False),
+        sa.Column('user_id', sa.Integer),
+        sa.Column('user_ip', sa.Text),
+        sa.Column('n_task_runs', sa.Integer, nullable=False, default=0)
+    )
+    # finish_time is text; rows that do not parse are left out of the stats
+    op.execute('''
+        CREATE OR REPLACE FUNCTION text_to_timestamp(value TEXT)
+        RETURNS TIMESTAMP AS $$
+        BEGIN
+            RETURN CAST(value AS TIMESTAMP);
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql STABLE;
+        ''')
+    op.execute('''
+        INSERT INTO project_stats_hourly (project_id, hour, n_task_runs,
+                                          n_auth, n_anon)
+        SELECT project_id, DATE_TRUNC('hour', finish_time) AS hour, COUNT(id),
+        COUNT(id) FILTER (WHERE user_ip IS NULL),
+        COUNT(id) FILTER (WHERE user_id IS NULL)
+        FROM (SELECT id, project_id, user_id, user_ip,
+              text_to_timestamp(finish_time) AS finish_time
+              FROM task_run) AS task_run
+        WHERE finish_time IS NOT NULL
+        GROUP BY project_id, hour;
+        ''')
+    op.execute('''
+        INSERT INTO project_stats_contributor (project_id, day, user_id,
+                                               user_ip, n_task_runs)
+        SELECT project_id, CAST(finish_time AS DATE) AS day, user_id, user_ip,
+        COUNT(id)
+        FROM (SELECT id, project_id, user_id, user_ip,
+              text_to_timestamp(finish_time) AS finish_time
+              FROM task_run) AS task_run
+        WHERE finish_time IS NOT NULL
+        AND (user_id IS NULL) != (user_ip IS NULL)
+        GROUP BY project_id, day, user_id, user_ip;
+        ''')
+    op.create_index('project_stats_contributor_key',
+                    'project_stats_contributor',
+                    ['project_id', 'day', sa.text('coalesce(user_id, 0)'),
+                     sa.text("coalesce(user_ip, '')")], unique=True)
+
+
+def downgrade():
+    op.drop_table('project_stats_contributor')
+    op.drop_table('project_stats_hourly')
+    op.execute('DROP FUNCTION IF EXISTS text_to_timestamp(TEXT);')
@@ -0,0 +1,74 @@
+"""add native timestamp columns to task and task_run
+
+Revision ID: b7e2d9c4a518
+Revises: a4d7c2e9f136
+Create Date: 2026-10-17 19:02:37.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2d9c4a518'
+down_revision = 'a4d7c2e9f136'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+COLUMNS = {
+    'task': ('created',),
+    'task_run': ('created', 'finish_time'),
+}
+
+INDEXES = (
+    'task_created_ts_idx ON task (created_ts)',
+    'task_project_id_created_ts_idx ON task (project_id, created_ts)',
+    'task_run_finish_time_ts_idx ON task_run (finish_time_ts)',
+    'task_run_project_id_finish_time_ts_idx ON task_run (project_id, finish_time_ts)',
+    'task_run_project_id_created_ts_idx ON task_run (project_id, created_ts)',
+)
+
+
+def upgrade():
+    # Nullable columns without a default are added without rewriting the
+    # tables; rows older than the triggers are filled by
+    # `python cli.py backfill_native_timestamps`
+    for table, columns in COLUMNS.items():
+        for column in columns:
+            op.add_column(table, sa.Column(column + '_ts', sa.TIMESTAMP))
+
+    # text_to_timestamp is created by a4d7c2e9f136
+    for table, columns in COLUMNS.items():
+        assignments = ''.join('NEW.{0}_ts := text_to_timestamp(NEW.{0});\n'
+                              .format(column) for column in columns)
+        op.execute('''
+            CREATE OR REPLACE FUNCTION {0}_native_timestamps()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                {1}RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            '''.format(table, assignments))
+        op.execute('''
+            CREATE TRIGGER {0}_native_timestamps
+            BEFORE INSERT OR UPDATE OF {1} ON {0}
+            FOR EACH ROW EXECUTE PROCEDURE {0}_native_timestamps();
+            '''.format(table, ', '.join(columns)))
+
+    # Workaround of "CREATE INDEX CONCURRENTLY cannot run inside a transaction block" exception
+    op.execute('COMMIT')
+    for index in INDEXES:
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {};'.format(index))
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for index in INDEXES:
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS {};'.format(
+            index.split()[0]))
+    for table, columns in COLUMNS.items():
+        op.execute('DROP TRIGGER IF EXISTS {0}_native_timestamps ON {0};'
+                   .format(table))
+        op.execute('DROP FUNCTION IF EXISTS {}_native_timestamps();'
+                   .format(table))
+        for column in columns:
+            op.drop_column(table, column + '_ts')
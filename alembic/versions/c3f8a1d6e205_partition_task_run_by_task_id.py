@@ -0,0 +1,91 @@
+"""partition task_run by ranges of task ids
+
+Revision ID: c3f8a1d6e205
+Revises: b7e2d9c4a518
+Create Date: 2026-10-17 21:14:52.604319
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3f8a1d6e205'
+down_revision = 'b7e2d9c4a518'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Defaults of TASK_RUN_PARTITION_SIZE and TASK_RUN_PARTITIONS_AHEAD
+PARTITION_SIZE = 1000000
+PARTITIONS_AHEAD = 2
+
+FOREIGN_KEYS = (
+    'task_run_project_id_fkey FOREIGN KEY (project_id) REFERENCES project (id)',
+    'task_run_task_id_fkey FOREIGN KEY (task_id) REFERENCES task (id) '
+    'ON DELETE CASCADE',
+    'task_run_user_id_fkey FOREIGN KEY (user_id) REFERENCES "user" (id)',
+)
+
+INDEXES = (
+    'task_run_task_id_idx ON task_run (task_id)',
+    'task_run_user_id_idx ON task_run (user_id)',
+    'task_run_project_id_idx ON task_run (project_id)',
+    'UNIQUE INDEX unique_user_id_task_id_idx ON task_run '
+    '(task_id, user_id, user_ip, external_uid)',
+    'task_run_finish_time_ts_idx ON task_run (finish_time_ts)',
+    'task_run_project_id_finish_time_ts_idx ON task_run (project_id, finish_time_ts)',
+    'task_run_project_id_created_ts_idx ON task_run (project_id, created_ts)',
+)
+
+
+def _replace_task_run(create, partitions, primary_key):
+    # The new table takes the sequence of the ids before the old one is
+    # dropped. The materialized views reading task_run are dropped with it;
+    # the dashboard and leaderboard jobs create them again on their next run.
+    op.execute('CREATE TABLE task_run_new (LIKE task_run INCLUDING DEFAULTS) '
+               '{};'.format(create))
+    for partition in partitions:
+        op.execute(partition)
+    op.execute('INSERT INTO task_run_new SELECT * FROM task_run;')
+    op.execute('ALTER SEQUENCE task_run_id_seq OWNED BY task_run_new.id;')
+    op.execute('ALTER TABLE task_run RENAME TO task_run_old;')
+    op.execute('ALTER TABLE task_run_new RENAME TO task_run;')
+    op.execute('DROP TABLE task_run_old CASCADE;')
+
+    op.execute('ALTER TABLE task_run ADD CONSTRAINT task_run_pkey '
+               'PRIMARY KEY ({});'.format(primary_key))
+    for foreign_key in FOREIGN_KEYS:
+        op.execute('ALTER TABLE task_run ADD CONSTRAINT {};'.format(foreign_key))
+    for index in INDEXES:
+        if not index.startswith('UNIQUE '):
+            index = 'INDEX ' + index
+        op.execute('CREATE {};'.format(index))
+    op.execute('''
+        CREATE TRIGGER task_run_native_timestamps
+        BEFORE INSERT OR UPDATE OF created, finish_time ON task_run
+        FOR EACH ROW EXECUTE PROCEDURE task_run_native_timestamps();
+        ''')
+
+
+def upgrade():
+    last_task = op.get_bind().execute(
+        sa.text('SELECT COALESCE(MAX(id), 0) FROM task')).scalar()
+    partitions = ['CREATE TABLE task_run_p{0} PARTITION OF task_run_new '
+                  'FOR VALUES FROM ({0}) TO ({1});'.format(
+                      start, start + PARTITION_SIZE)
+                  for start in range(0,
+                                     last_task + PARTITIONS_AHEAD * PARTITION_SIZE + 1,
+                                     PARTITION_SIZE)]
+    partitions.append('CREATE TABLE task_run_default PARTITION OF task_run_new '
+                      'DEFAULT;')
+    _replace_task_run('PARTITION BY RANGE (task_id)', partitions, 'id, task_id')
+
+    # Workaround of "CREATE INDEX CONCURRENTLY cannot run inside a transaction block" exception
+    op.execute('COMMIT')
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS task_project_id_id_idx '
+               'ON task (project_id, id);')
+
+
+def downgrade():
+    _replace_task_run('', [], 'id')
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS task_project_id_id_idx;')
@@ -0,0 +1,26 @@
+"""add task sort indexes
+
+Revision ID: e2b7c4d9a360
+Revises: c3f8a1d6e205
+Create Date: 2026-10-17 16:41:08.512730
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c4d9a360'
+down_revision = 'c3f8a1d6e205'
+
+from alembic import op
+
+
+def upgrade():
+    # Workaround of "CREATE INDEX CONCURRENTLY cannot run inside a transaction block" exception
+    op.execute('COMMIT')
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS task_project_id_priority_0_id_idx ON task (project_id, priority_0, id);')
+    op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS task_project_id_created_id_idx ON task (project_id, created, id);')
+
+
+def downgrade():
+    op.execute('COMMIT')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS task_project_id_created_id_idx;')
+    op.execute('DROP INDEX CONCURRENTLY IF EXISTS task_project_id_priority_0_id_idx;')
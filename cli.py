@@ -375,6 +375,7 @@ def clean_project(project_id, skip_tasks=False):
     """Remove everything from a project."""
     from pybossa.core import task_repo
     from pybossa.model import make_timestamp
+    from pybossa.cache.project_stats import reset_contributors
     n_tasks = 0
     if not skip_tasks:
         print("Deleting tasks")
@@ -386,8 +387,17 @@ def clean_project(project_id, skip_tasks=False):
         for row in result:
             n_tasks = row.n
 
+    sql = 'select distinct day from project_stats_contributor where project_id=%s' % project_id
+    days = [row.day for row in db.engine.execute(sql)]
     sql = 'delete from task_run where project_id=%s' % project_id
     db.engine.execute(sql)
+    sql = 'delete from task_rollup where project_id=%s' % project_id
+    db.engine.execute(sql)
+    sql = 'delete from project_stats_hourly where project_id=%s' % project_id
+    db.engine.execute(sql)
+    sql = 'delete from project_stats_contributor where project_id=%s' % project_id
+    db.engine.execute(sql)
+    reset_contributors(project_id, days)
     sql = 'delete from result where project_id=%s' % project_id
     db.engine.execute(sql)
     sql = 'delete from project_stats where project_id=%s' % project_id
@@ -402,6 +412,128 @@ def clean_project(project_id, skip_tasks=False):
     print("Project has been cleaned")
 
 
+def migrate_reserve_task_keys():
+    """Move task reservation string keys into the reservation index."""
+    from time import time
+    from pybossa.core import sentinel
+    from pybossa.redis_lock import LockManager
+
+    with app.app_context():
+        redis_conn = sentinel.master
+        lock_manager = LockManager(redis_conn, 0)
+        n_keys = 0
+        for key in redis_conn.scan_iter(
+                "reserve_task:project:*:category:*:user:*:task:*", count=1000):
+            expiration = float(redis_conn.get(key) or 0)
+            ttl = redis_conn.ttl(key)
+            if ttl > 0:
+                expiration = min(expiration, time() + ttl)
+            if expiration > time():
+                lock_manager.index_reserve_task_lock(key.decode(), expiration)
+                n_keys += 1
+            redis_conn.delete(key)
+        print("Migrated %s task reservations" % n_keys)
+
+
+def migrate_partial_answer_keys():
+    """Register the saved partial answers in the index of their user."""
+    from time import time
+    from pybossa.core import sentinel
+    from pybossa.util import PARTIAL_ANSWER_INDEX_KEY, PARTIAL_ANSWER_USERS_KEY
+
+    with app.app_context():
+        redis_conn = sentinel.master
+        n_keys = 0
+        for key in redis_conn.scan_iter(
+                "partial_answer:project:*:user:*:task:*", count=1000):
+            _, _, project_id, _, user_id, _, task_id = key.decode().split(':')
+            ttl = redis_conn.ttl(key)
+            if ttl <= 0:
+                continue
+            index_key = PARTIAL_ANSWER_INDEX_KEY.format(project_id=project_id,
+                                                        user_id=user_id)
+            users_key = PARTIAL_ANSWER_USERS_KEY.format(project_id=project_id)
+            redis_conn.zadd(index_key, {task_id: time() + ttl})
+            # the index lives as long as the last answer saved to it
+            if redis_conn.ttl(index_key) < ttl:
+                redis_conn.expire(index_key, ttl)
+            redis_conn.sadd(users_key, user_id)
+            if redis_conn.ttl(users_key) < ttl:
+                redis_conn.expire(users_key, ttl)
+            n_keys += 1
+        print("Migrated %s saved partial answers" % n_keys)
+
+
+def index_memoized_keys():
+    """Add the memoized keys cached before they were indexed to the index
+    of their prefixes, so that deleting them does not miss them."""
+    from pybossa.core import sentinel
+    from pybossa.cache import (REDIS_KEYPREFIX, get_memoized_key_prefixes,
+                               index_cached_key)
+
+    with app.app_context():
+        redis_conn = sentinel.master
+        n_keys = 0
+        for key in redis_conn.scan_iter("%s:*_args:*" % REDIS_KEYPREFIX,
+                                        count=1000):
+            key = key.decode()
+            prefixes = get_memoized_key_prefixes(key)
+            ttl = redis_conn.ttl(key)
+            if not prefixes or ttl <= 0:
+                continue
+            index_cached_key(key, prefixes, ttl)
+            n_keys += 1
+        print("Indexed %s memoized keys" % n_keys)
+
+
+def backfill_task_rollup(project_id=None):
+    """Rebuild the task_rollup aggregates from task_run."""
+    from pybossa.core import task_repo
+
+    with app.app_context():
+        n_rows = task_repo.refresh_task_rollup(
+            int(project_id) if project_id else None)
+        print("Backfilled %s task rollups" % n_rows)
+
+
+def backfill_project_stats(project_id=None):
+    """Rebuild the hourly and contributor project stats from task_run."""
+    from pybossa.core import project_stats_repo
+
+    with app.app_context():
+        n_rows = project_stats_repo.refresh_project_stats(
+            int(project_id) if project_id else None)
+        print("Backfilled %s project contributor stats" % n_rows)
+
+
+def backfill_native_timestamps(batch_size=10000):
+    """Copy the TEXT timestamps of tasks and task runs to their native
+    columns. Set NATIVE_TIMESTAMPS once it is done."""
+    from pybossa.core import task_repo
+
+    with app.app_context():
+        updated = task_repo.backfill_native_timestamps(int(batch_size))
+        for table, n_rows in updated.items():
+            print("Backfilled %s %s rows" % (n_rows, table))
+
+
+def check_task_rollup(project_id=None, repair=False):
+    """Report (and optionally repair) task_rollup rows out of sync with
+    task_run."""
+    from pybossa.core import task_repo
+
+    with app.app_context():
+        project_id = int(project_id) if project_id else None
+        repair = str(repair).lower() in ('1', 'true', 'yes')
+        task_ids = task_repo.find_task_rollup_mismatches(project_id)
+        print("Found %s task rollups out of sync" % len(task_ids))
+        for task_id in task_ids:
+            print("Task %s" % task_id)
+        if task_ids and repair:
+            task_repo.refresh_task_rollup(project_id)
+            print("Task rollups have been repaired")
+
+
 ## ==================================================
 ## Misc stuff for setting up a command line interface
 
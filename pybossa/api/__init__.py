@@ -40,7 +40,7 @@ from werkzeug.exceptions import NotFound
 from pybossa.exc.repository import DBIntegrityError
 from pybossa.util import jsonpify, get_user_id_or_ip, fuzzyboolean, \
     PARTIAL_ANSWER_KEY, SavedTaskPositionEnum, PARTIAL_ANSWER_POSITION_KEY, \
-    get_user_saved_partial_tasks
+    get_user_saved_partial_tasks, save_partial_answer, delete_partial_answers
 from pybossa.util import get_disqus_sso_payload, grant_access_with_api_key
 import dateutil.parser
 import pybossa.model as model
@@ -75,7 +75,8 @@ from .completed_task_run import CompletedTaskRunAPI
 from pybossa.cache.helpers import (n_available_tasks, n_available_tasks_for_user,
     n_unexpired_gold_tasks)
 from pybossa.sched import (get_scheduler_and_timeout, has_lock, release_lock, Schedulers,
-                           fetch_lock_for_user, release_reserve_task_lock_by_id)
+                           fetch_lock_for_user, release_reserve_task_lock_by_id,
+                           release_prefetched_tasks)
 from pybossa.api.project_by_name import ProjectByNameAPI, project_name_to_oid
 from pybossa.api.project_details import ProjectDetailsAPI
 from pybossa.api.project_locks import ProjectLocksAPI
@@ -93,6 +94,7 @@ from pybossa.cache.task_browse_helpers import get_searchable_columns
 from pybossa.cache.users import get_user_pref_metadata
 from pybossa.view.projects import get_locked_tasks, clone_project
 from pybossa.redis_lock import EXPIRE_LOCK_DELAY
+from pybossa.redis_batch import get_batch
 from pybossa.api.bulktasks import BulkTasksAPI
 from pybossa.util import admin_required
 from pybossa.jobs import send_mail
@@ -233,7 +235,11 @@ def new_task(project_id, task_id=None):
     saved_task_position = None
     if not current_user.is_anonymous:
         position_key = PARTIAL_ANSWER_POSITION_KEY.format(project_id=project_id, user_id=current_user.id)
-        saved_task_position = sentinel.master.get(position_key)
+        batch = get_batch()
+        saved_task_position = batch.queue('get', position_key)
+        # Read the scheduler state of the user in the same round trip
+        sched.prefetch_user_state(project_id, current_user.id)
+        saved_task_position = saved_task_position.value
         if saved_task_position:
             try:
                 saved_task_position = SavedTaskPositionEnum(saved_task_position.decode('utf-8'))
@@ -250,7 +256,8 @@ def new_task(project_id, task_id=None):
         user_id_or_ip = get_user_id_or_ip()
         # If there is a task for the user, return it
         if tasks is not None:
-            guard = ContributionsGuard(sentinel.master, timeout=timeout)
+            guard = ContributionsGuard(get_batch(), timeout=timeout)
+            guard.prefetch_presented_timestamps(tasks, user_id_or_ip)
             for task in tasks:
                 guard.stamp(task, user_id_or_ip)
                 if not guard.check_task_presented_timestamp(task, user_id_or_ip):
@@ -652,10 +659,14 @@ def cancel_task(task_id=None):
     if scheduler in (Schedulers.locked, Schedulers.user_pref, Schedulers.task_queue):
         task_locked_by_user = has_lock(task_id, user_id, timeout)
         if task_locked_by_user:
-            release_lock(task_id, user_id, timeout)
+            release_lock(task_id, user_id, timeout, project_id=project.id)
             current_app.logger.info(
                 'Project {} - user {} cancelled task {}'
                 .format(project.id, current_user.id, task_id))
+            # tasks locked in advance for the user are not needed anymore.
+            # They are released first, so that their category reservations
+            # are not kept as if the user still worked on them
+            release_prefetched_tasks(project.id, user_id, timeout)
             release_reserve_task_lock_by_id(project.id, task_id, current_user.id, timeout, expiry=EXPIRE_LOCK_DELAY, release_all_task=True)
             # presented time would reset only upon cancel task when reset is
             # configured under project settings. add an entry to the cache
@@ -916,12 +927,14 @@ def partial_answer(task_id=None, short_name=None):
 
             ttl = ONE_MONTH
             answer = json.dumps(request.json)
-            sentinel.master.setex(partial_answer_key, ttl, answer)
+            save_partial_answer(sentinel, project_id, current_user.id,
+                                task_id, answer, ttl)
         elif request.method == 'GET':
             data = sentinel.master.get(partial_answer_key)
             response['data'] = json.loads(data.decode('utf-8')) if data else ''
         elif request.method == 'DELETE':
-            sentinel.master.delete(partial_answer_key)
+            delete_partial_answers(sentinel, project_id, [current_user.id],
+                                   [task_id])
     except Exception as e:
         return error.format_exception(e, target='partial_answer', action=request.method)
     return Response(json.dumps(response), status=200, mimetype="application/json")
@@ -0,0 +1,366 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per project queue of the tasks available to the locked scheduler.
+
+Tasks still needing answers are kept in two Redis sorted sets per project, one
+for gold tasks and one for regular tasks, ordered the way locked_task_sql
+orders them: priority_0 descending, then id ascending. A hash holds the number
+of answers each task still needs. The task and task run event listeners keep
+the queue up to date, while rebuild() reconciles it with the database. A queue
+is rebuilt on first use and again once AVAILABLE_TASKS_RECONCILE_INTERVAL has
+elapsed, so drift caused by bulk SQL updates does not outlive that interval.
+Rebuilds run in a background job, the scheduler queries the database until
+the queue is built.
+"""
+import random
+from itertools import groupby
+
+from flask import current_app
+from sqlalchemy import text
+
+from pybossa.core import db, sentinel
+
+QUEUE_KEY = 'pybossa:available_tasks:project:{}:{}'
+REMAINING_KEY = 'pybossa:available_tasks:project:{}:remaining'
+BUILT_KEY = 'pybossa:available_tasks:project:{}:built'
+BUILD_LOCK_KEY = 'pybossa:available_tasks:project:{}:building'
+PROJECTS_KEY = 'pybossa:available_tasks:projects'
+GOLD = 'gold'
+REGULAR = 'tasks'
+UNAVAILABLE_STATES = ('completed', 'enrich')
+
+# Applies a change to a project queue, only when the queue has been built.
+#   KEYS: built marker, regular tasks, gold tasks, remaining answers hash
+#   ARGV: op, member, score, is gold, remaining answers (or delta), ttl
+#   op 'set' adds or moves the task with the given remaining answers.
+#   op 'incr' adds delta to the remaining answers and re-scores the task. It
+#   returns -1 for an unknown task, whose answer count the caller looks up
+#   to add it with op 'set'.
+#   op 'answer' records one more answer, dropping the task when completed.
+#   op 'remove' drops the task.
+UPDATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local op, member, score = ARGV[1], ARGV[2], ARGV[3]
+local target, other = KEYS[2], KEYS[3]
+if ARGV[4] == '1' then
+    target, other = KEYS[3], KEYS[2]
+end
+local remaining
+if op == 'remove' then
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZREM', KEYS[3], member)
+    redis.call('HDEL', KEYS[4], member)
+    return 1
+elseif op == 'answer' then
+    if redis.call('HEXISTS', KEYS[4], member) == 0 then
+        return 0
+    end
+    remaining = redis.call('HINCRBY', KEYS[4], member, -1)
+    if remaining <= 0 then
+        redis.call('ZREM', KEYS[2], member)
+    end
+    return 1
+elseif op == 'incr' then
+    if redis.call('HEXISTS', KEYS[4], member) == 0 then
+        return -1
+    end
+    remaining = redis.call('HINCRBY', KEYS[4], member, ARGV[5])
+else
+    remaining = tonumber(ARGV[5])
+    redis.call('HSET', KEYS[4], member, remaining)
+end
+redis.call('ZREM', other, member)
+if remaining > 0 or ARGV[4] == '1' then
+    redis.call('ZADD', target, score, member)
+else
+    redis.call('ZREM', target, member)
+end
+for i = 2, 4 do
+    if redis.call('TTL', KEYS[i]) == -1 then
+        redis.call('EXPIRE', KEYS[i], ARGV[6])
+    end
+end
+return 1
+"""
+
+
+def get_queue_key(project_id, kind):
+    return QUEUE_KEY.format(project_id, kind)
+
+
+def get_remaining_key(project_id):
+    return REMAINING_KEY.format(project_id)
+
+
+def get_built_key(project_id):
+    return BUILT_KEY.format(project_id)
+
+
+def _member(task_id):
+    # Zero padded so that tasks sharing a priority sort by ascending id
+    return '{:015d}'.format(int(task_id))
+
+
+def _score(priority_0):
+    return -float(priority_0 or 0)
+
+
+def _ttl():
+    return 2 * current_app.config.get('AVAILABLE_TASKS_RECONCILE_INTERVAL', 60 * 60)
+
+
+def is_enabled():
+    return current_app.config.get('AVAILABLE_TASKS_QUEUE', False)
+
+
+def _update(project_id, op, task_id, priority_0=0, calibration=False,
+            remaining=0):
+    keys = [get_built_key(project_id),
+            get_queue_key(project_id, REGULAR),
+            get_queue_key(project_id, GOLD),
+            get_remaining_key(project_id)]
+    args = [op, _member(task_id), _score(priority_0), int(bool(calibration)),
+            remaining, _ttl()]
+    script = sentinel.master.register_script(UPDATE_SCRIPT)
+    return script(keys=keys, args=args)
+
+
+def add_task(task):
+    """Add a new task to the queue of its project."""
+    if task.state in UNAVAILABLE_STATES:
+        return
+    _update(task.project_id, 'set', task.id, task.priority_0,
+            task.calibration, task.n_answers)
+
+
+def update_task(task, n_answers_delta=0, conn=None):
+    """Re-score a task after an update, dropping it when no longer available."""
+    if task.state in UNAVAILABLE_STATES:
+        remove_task(task.project_id, task.id)
+        return
+    if _update(task.project_id, 'incr', task.id, task.priority_0,
+               task.calibration, n_answers_delta) != -1:
+        return
+    # Not in the queue, e.g. it was completed before: add it with the
+    # answers it still needs
+    conn = conn or db.session
+    sql = text('SELECT n_task_runs FROM task_rollup WHERE task_id=:task_id')
+    n_task_runs = conn.execute(sql, dict(task_id=task.id)).scalar() or 0
+    _update(task.project_id, 'set', task.id, task.priority_0,
+            task.calibration, task.n_answers - n_task_runs)
+
+
+def remove_task(project_id, task_id):
+    _update(project_id, 'remove', task_id)
+
+
+def add_answer(project_id, task_id):
+    """Record a submitted answer for a regular task."""
+    _update(project_id, 'answer', task_id)
+
+
+def invalidate(project_id):
+    """Force a rebuild of the project queue on its next use."""
+    sentinel.master.delete(get_built_key(project_id))
+
+
+def rebuild(project_id, session=None):
+    """Rebuild the queue of a project from the database."""
+    session = session or db.session
+    redis_conn = sentinel.master
+    interval = current_app.config.get('AVAILABLE_TASKS_RECONCILE_INTERVAL', 60 * 60)
+    sql = text('''
+               SELECT task.id,
+               task.n_answers - coalesce(task_rollup.n_task_runs, 0) AS remaining,
+               task.calibration, task.priority_0
+               FROM task
+               LEFT JOIN task_rollup ON (task.id = task_rollup.task_id)
+               WHERE task.project_id=:project_id
+               AND ((task.expiration IS NULL) OR (task.expiration > (now() at time zone 'utc')::timestamp))
+               AND task.state !='completed'
+               AND task.state !='enrich';
+               ''')
+    rows = session.execute(sql, dict(project_id=project_id))
+
+    keys = [get_queue_key(project_id, REGULAR),
+            get_queue_key(project_id, GOLD),
+            get_remaining_key(project_id)]
+    tmp_keys = ['{}:tmp'.format(key) for key in keys]
+    pipeline = redis_conn.pipeline(transaction=False)
+    pipeline.delete(*tmp_keys)
+    written = set()
+    batch_size = current_app.config.get('DB_MAXIMUM_BATCH_SIZE', 10000)
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        tasks, gold, remaining = {}, {}, {}
+        for task_id, n_remaining, calibration, priority_0 in batch:
+            member = _member(task_id)
+            remaining[member] = n_remaining
+            if calibration:
+                gold[member] = _score(priority_0)
+            elif n_remaining > 0:
+                tasks[member] = _score(priority_0)
+        for key, mapping in zip(tmp_keys, (tasks, gold)):
+            if mapping:
+                pipeline.zadd(key, mapping)
+                written.add(key)
+        pipeline.hset(tmp_keys[2], mapping=remaining)
+        written.add(tmp_keys[2])
+        pipeline.execute()
+
+    pipeline = redis_conn.pipeline(transaction=True)
+    for key, tmp_key in zip(keys, tmp_keys):
+        if tmp_key in written:
+            pipeline.rename(tmp_key, key)
+            pipeline.expire(key, 2 * interval)
+        else:
+            pipeline.delete(key)
+    pipeline.setex(get_built_key(project_id), interval, 1)
+    pipeline.sadd(PROJECTS_KEY, project_id)
+    pipeline.execute()
+
+
+def build(project_id):
+    """Rebuild the queue of a project for ensure_built."""
+    try:
+        rebuild(project_id, db.slave_session)
+    finally:
+        sentinel.master.delete(BUILD_LOCK_KEY.format(project_id))
+
+
+def ensure_built(project_id):
+    """
+    Return whether the project queue is built. If it is not, a job building
+    it is enqueued unless one is already pending, and the caller should query
+    the database meanwhile.
+    """
+    from pybossa.jobs import enqueue_job, build_available_tasks
+    redis_conn = sentinel.master
+    if redis_conn.exists(get_built_key(project_id)):
+        return True
+    lock_key = BUILD_LOCK_KEY.format(project_id)
+    if redis_conn.set(lock_key, 1, nx=True, ex=5 * 60):
+        try:
+            enqueue_job(dict(name=build_available_tasks, args=[project_id],
+                             kwargs={}, timeout=current_app.config.get('TIMEOUT'),
+                             queue='high'))
+        except Exception:
+            redis_conn.delete(lock_key)
+            raise
+    return bool(redis_conn.exists(get_built_key(project_id)))
+
+
+def _queue_kinds(task_type):
+    return {
+        'gold': [GOLD],
+        'no_gold': [REGULAR],
+        'gold_first': [GOLD, REGULAR],
+    }.get(task_type, [REGULAR, GOLD])
+
+
+def _shuffle_within_priority(candidates):
+    shuffled = []
+    for _, group in groupby(candidates, key=lambda c: c[0]):
+        group = list(group)
+        random.shuffle(group)
+        shuffled.extend(group)
+    return shuffled
+
+
+def get_candidates(project_id, user_id, limit, task_type='gold_last',
+                   rand_within_priority=False, timeout=None):
+    """
+    Return up to limit rows of tasks available to the user, in the order and
+    format of the rows of locked_task_sql. Returns None when the queue can't
+    serve the request, in which case the caller should query the database.
+    """
+    if not ensure_built(project_id):
+        return None
+
+    redis_conn = sentinel.master
+    max_pages = current_app.config.get('AVAILABLE_TASKS_MAX_PAGES', 10)
+    page_size = max(limit, 1)
+    rows = []
+    for kind in _queue_kinds(task_type):
+        key = get_queue_key(project_id, kind)
+        page = 0
+        while len(rows) < limit:
+            if page == max_pages:
+                # Too many tasks already answered by the user at the top of
+                # the queue, let the database do the filtering.
+                return None
+            start = page * page_size
+            members = redis_conn.zrange(key, start, start + page_size - 1,
+                                        withscores=True)
+            if not members:
+                break
+            candidates = [(score, int(member)) for member, score in members]
+            if rand_within_priority:
+                candidates = _shuffle_within_priority(candidates)
+            task_ids = [task_id for _, task_id in candidates]
+            remaining = redis_conn.hmget(get_remaining_key(project_id),
+                                         [_member(t) for t in task_ids])
+            rows.extend(_filter_available(project_id, user_id, task_ids,
+                                          remaining, timeout))
+            page += 1
+    return rows[:limit]
+
+
+def _filter_available(project_id, user_id, task_ids, remaining, timeout):
+    sql = text('''
+               SELECT task.id, task.n_answers, task.calibration,
+               task.worker_filter, task.worker_pref,
+               ((task.expiration IS NULL) OR (task.expiration > (now() at time zone 'utc')::timestamp))
+               AND task.state !='completed'
+               AND task.state !='enrich' AS available,
+               EXISTS (SELECT 1 FROM task_run WHERE project_id=:project_id AND
+               user_id=:user_id AND task_id=task.id) AS answered
+               FROM task
+               WHERE task.project_id=:project_id
+               AND task.id = ANY(:task_ids);
+               ''')
+    results = db.slave_session.execute(sql, dict(project_id=project_id,
+                                                 user_id=user_id,
+                                                 task_ids=task_ids))
+    tasks = {row.id: row for row in results}
+    rows = []
+    for task_id, n_remaining in zip(task_ids, remaining):
+        task = tasks.get(task_id)
+        if not task or not task.available:
+            remove_task(project_id, task_id)
+            continue
+        if task.answered:
+            continue
+        taskcount = task.n_answers - int(n_remaining or 0)
+        rows.append((task.id, taskcount, task.n_answers, task.calibration,
+                     task.worker_filter, task.worker_pref, timeout))
+    return rows
+
+
+def get_projects():
+    """Return the ids of the projects having a queue."""
+    return [int(project_id) for project_id in sentinel.master.smembers(PROJECTS_KEY)]
+
+
+def forget_project(project_id):
+    sentinel.master.srem(PROJECTS_KEY, project_id)
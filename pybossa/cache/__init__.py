@@ -25,23 +25,38 @@ It exports:
     * delete_cached: to remove a cached value
     * delete_memoized: to remove a cached value from the memoize decorator
 
+The memoize decorators can opt into a process local tier in front of Redis
+with local_timeout. Locally cached values are also kept for the rest of the
+current request, and deleting a memoized value or a cache group broadcasts
+the deleted keys to every process over Redis pub/sub.
+
+Cached values are serialized by pybossa.cache.codecs. The decorators take
+the name of the codec to use for their values once CACHE_CODEC is set.
+
+With early_refresh, the decorators guard against cache stampedes: values are
+recomputed by a background job shortly before they expire (XFetch) and can
+be served stale while it runs. A missing value is computed by one process,
+and the others wait for it on Redis pub/sub.
+
 """
 import os
 import hashlib
+import json
+import math
+import pickle
+import re
+import threading
 import time
 from functools import wraps
-from random import randrange
+from random import random, randrange
 
-from flask import current_app
-from redis.exceptions import LockError
+from flask import current_app, g, has_app_context, has_request_context
+from redis.exceptions import LockError, RedisError
 
+from pybossa.cache.codecs import encode, decode
+from pybossa.cache.local import LocalCache, MISS
 from pybossa.core import sentinel
 
-try:
-    import pickle as pickle
-except ImportError:  # pragma: no cover
-    import pickle
-
 try:
     from pybossa.app_settings import config as settings
     REDIS_KEYPREFIX = settings['REDIS_KEYPREFIX']
@@ -60,8 +75,36 @@ ONE_WEEK = 7 * ONE_DAY
 ONE_MINUTE = 60
 L2_CACHE_TIMEOUT = ONE_DAY
 MUTEX_LOCK_TIMEOUT = ONE_MINUTE
+REFRESH_LOCK_TIMEOUT = ONE_MINUTE
+FILL_WAIT_TIMEOUT = 2
+EARLY_REFRESH_BETA = 1.0
 TWO_WEEKS = 14 * ONE_DAY
 ONE_MONTH = 30 * ONE_DAY
+LOCAL_CACHE_MAX_SIZE = 10000
+LOCAL_CACHE_CHANNEL = '%s:local_cache_invalidation' % REDIS_KEYPREFIX
+
+local_cache = LocalCache(LOCAL_CACHE_MAX_SIZE)
+_local_subscriber = dict(pid=None, thread=None)
+_local_subscriber_lock = threading.Lock()
+
+DELETE_BATCH_SIZE = 1000
+
+# Memoized keys: function prefix, essential arguments, md5 of all arguments
+# and the :l2 suffix of memoize_with_l2_cache
+MEMOIZED_KEY_REGEX = re.compile(r'^(.*?_args:)(.*):([0-9a-f]{32})(:l2)?$')
+
+# Adds a cached key to key prefix indexes, scored by when it expires. Expired
+# members are trimmed and each index expires along with its last member.
+#   KEYS: index keys
+#   ARGV: cached key, now, expiration
+INDEX_KEY_SCRIPT = """
+for _, index in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', index, '-inf', '(' .. ARGV[2])
+    redis.call('ZADD', index, ARGV[3], ARGV[1])
+    local last = redis.call('ZRANGE', index, -1, -1, 'WITHSCORES')
+    redis.call('EXPIREAT', index, math.ceil(tonumber(last[2])))
+end
+"""
 
 management_dashboard_stats = [
     'project_chart', 'category_chart', 'task_chart',
@@ -113,18 +156,289 @@ def add_key_to_cache_groups(key_to_add, cache_group_keys_arg, *args, **kwargs):
         sentinel.master.sadd(key, key_to_add)
 
 
+def get_memoize_prefix(function_name):
+    return "%s:%s_args:" % (REDIS_KEYPREFIX, function_name)
+
+
+def get_cache_index_key(prefix):
+    return '{}:memoize_index:{}'.format(REDIS_KEYPREFIX, prefix)
+
+
+def index_cached_key(key, prefixes, ttl):
+    """
+    Record a cached key in the index of each key prefix it can be deleted
+    by, so it is deleted without scanning the keyspace.
+    """
+    if not prefixes:
+        return
+    script = sentinel.master.register_script(INDEX_KEY_SCRIPT)
+    now = time.time()
+    script(keys=[get_cache_index_key(prefix) for prefix in prefixes],
+           args=[key, now, now + ttl])
+
+
+def get_memoized_key_prefixes(key):
+    """
+    Return the prefixes a memoized key is indexed under: its function prefix
+    and, for memoize_essentials, each leading subset of its essential
+    arguments. Returns an empty list for other keys.
+    """
+    if key.startswith(get_cache_index_key('')):
+        return []
+    match = MEMOIZED_KEY_REGEX.match(key)
+    if not match:
+        return []
+    prefix, essentials = match.group(1), match.group(2)
+    if essentials.endswith(':'):
+        essentials = essentials[:-1]
+    args = essentials.split(':')[1:]
+    return [prefix + ''.join(':' + arg for arg in args[:i])
+            for i in range(len(args) + 1)]
+
+
+def delete_indexed_keys(prefix):
+    """
+    Delete the cached keys in the index of a key prefix, and the index.
+    Returns True if any key was deleted.
+    """
+    index_key = get_cache_index_key(prefix)
+    keys = sentinel.master.zrange(index_key, 0, -1)
+    deleted = 0
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i:i + DELETE_BATCH_SIZE]
+        deleted += sentinel.master.unlink(*batch)
+        sentinel.master.unlink(*_refresh_lock_keys(batch))
+    sentinel.master.unlink(index_key)
+    return bool(deleted)
+
+
 def delete_cache_group(cache_group_key):
     key = get_cache_group_key(cache_group_key)
-    keys_to_delete = list(sentinel.slave.smembers(key)) + [key]
-    sentinel.master.delete(*keys_to_delete)
+    members = list(sentinel.slave.smembers(key))
+    keys_to_delete = members + [key]
+    sentinel.master.delete(*keys_to_delete + _refresh_lock_keys(members))
+    invalidate_local(keys=keys_to_delete)
+
 
+def _on_local_invalidation(message):
+    data = json.loads(message['data'])
+    local_cache.delete(data.get('keys', []), data.get('prefixes', []))
 
-def cache(key_prefix, timeout=300, cache_group_keys=None):
+
+def subscribe_local_invalidations():
+    """Listen for the keys deleted by other processes, once per process."""
+    if _local_subscriber['pid'] == os.getpid():
+        return
+    with _local_subscriber_lock:
+        if _local_subscriber['pid'] == os.getpid():
+            return
+        try:
+            pubsub = sentinel.master.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{LOCAL_CACHE_CHANNEL: _on_local_invalidation})
+            thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except RedisError:
+            current_app.logger.exception('Cannot subscribe to %s',
+                                         LOCAL_CACHE_CHANNEL)
+            return
+        # A forked process starts with an empty cache and its own listener
+        local_cache.clear()
+        _local_subscriber.update(pid=os.getpid(), thread=thread)
+
+
+def _request_cache():
+    """Return the map of the values read in the current request."""
+    if not has_request_context():
+        return None
+    if 'memoize_identity_map' not in g:
+        g.memoize_identity_map = {}
+    return g.memoize_identity_map
+
+
+def get_local(key):
+    """Return a value from the request or process local tier, or MISS."""
+    request_cache = _request_cache()
+    if request_cache is not None and key in request_cache:
+        return request_cache[key]
+    if _local_subscriber['pid'] != os.getpid():
+        return MISS
+    output = local_cache.get(key)
+    if output is not MISS and request_cache is not None:
+        request_cache[key] = output
+    return output
+
+
+def set_local(key, output, local_timeout):
+    # Keep a copy: the caller's value may be an ORM object bound to its
+    # session, or be changed by it, while the local tier is shared
+    output = pickle.loads(pickle.dumps(output))
+    subscribe_local_invalidations()
+    if _local_subscriber['pid'] == os.getpid():
+        local_cache.set(key, output, local_timeout)
+    request_cache = _request_cache()
+    if request_cache is not None:
+        request_cache[key] = output
+
+
+def invalidate_local(keys=(), prefixes=()):
+    """Drop keys from the local tier of this and every other process."""
+    keys = [k.decode() if isinstance(k, bytes) else k for k in keys]
+    prefixes = list(prefixes)
+    local_cache.delete(keys, prefixes)
+    request_cache = _request_cache()
+    if request_cache:
+        for key in list(request_cache):
+            if key in keys or key.startswith(tuple(prefixes)):
+                del request_cache[key]
+    sentinel.master.publish(LOCAL_CACHE_CHANNEL,
+                            json.dumps(dict(keys=keys, prefixes=prefixes)))
+
+
+def _fill_channel(key):
+    return '%s:filled' % key
+
+
+def _refresh_lock_key(key):
+    return '%s:refresh_lock' % key
+
+
+def _refresh_lock_keys(keys):
+    """Refresh locks of deleted cached keys, so that a refresh already
+    pending does not keep the next one from being scheduled."""
+    return [_refresh_lock_key(key.decode() if isinstance(key, bytes) else key)
+            for key in keys]
+
+
+def _wait_for_fill(key, timeout):
+    """
+    Wait for another process to set key, for up to timeout seconds, without
+    polling: setting a cached value is announced on the key's fill channel.
+
+    Returns the cached bytes, or None when the key is still missing.
+    """
+    pubsub = sentinel.master.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(_fill_channel(key))
+        # Read the master, as the key may have been set before subscribing
+        output_bytes = sentinel.master.get(key)
+        deadline = time.monotonic() + timeout
+        while output_bytes is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if pubsub.get_message(timeout=remaining) is not None:
+                output_bytes = sentinel.master.get(key)
+        return output_bytes
+    finally:
+        pubsub.close()
+
+
+def _load_entry(output_bytes, prefix):
+    """Decode a value cached with early_refresh. Values cached without it,
+    e.g. by an older release, are returned as already expired entries."""
+    entry = decode(output_bytes, prefix)
+    if isinstance(entry, dict) and entry.keys() == {'value', 'delta', 'expiry'}:
+        return entry
+    return dict(value=entry, delta=0, expiry=0)
+
+
+def _expires_early(entry, beta=EARLY_REFRESH_BETA):
+    """
+    Decide whether to refresh a cached entry ahead of its expiry (XFetch).
+
+    The probability grows as the expiry nears and with the time the value
+    took to compute, so one request usually refreshes it before the others
+    find it missing. Entries past their expiry, served stale, always refresh.
+    """
+    early = -entry['delta'] * beta * math.log(1.0 - random())
+    return time.time() + early >= entry['expiry']
+
+
+def schedule_refresh(function, key, *args, **kwargs):
+    """
+    Enqueue a job recomputing the value of function cached at key, unless
+    one is already pending. Returns True if the job was enqueued.
+    """
+    lock_key = _refresh_lock_key(key)
+    if not sentinel.master.set(lock_key, 1, nx=True, ex=REFRESH_LOCK_TIMEOUT):
+        return False
+    # Imported here as pybossa.jobs imports the cached modules
+    from pybossa.jobs import enqueue_job, refresh_cached_value
+    function_path = '%s.%s' % (function.__module__, function.__qualname__)
+    try:
+        enqueue_job(dict(name=refresh_cached_value,
+                         args=[function_path] + list(args), kwargs=kwargs,
+                         timeout=REFRESH_LOCK_TIMEOUT, queue='high'))
+    except Exception:
+        sentinel.master.delete(lock_key)
+        if has_app_context():
+            current_app.logger.exception('Cannot refresh %s', key)
+        return False
+    return True
+
+
+def _early_refresh_store(f, key, timeout, stale_ttl, cache_group_keys,
+                         prefix, codec, index_prefixes=()):
+    """
+    Return a function computing f and caching its value at key, together
+    with the time it took and its expiry. The key is kept stale_ttl seconds
+    past its expiry and processes waiting for it are notified.
+    """
+    def compute_and_store(*args, **kwargs):
+        start = time.monotonic()
+        output = f(*args, **kwargs)
+        entry = dict(value=output, delta=time.monotonic() - start,
+                     expiry=time.time() + timeout)
+        sentinel.master.setex(key, timeout + stale_ttl,
+                              encode(entry, prefix, codec))
+        add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+        index_cached_key(key, index_prefixes, timeout + stale_ttl)
+        sentinel.master.publish(_fill_channel(key), 1)
+        return output
+    return compute_and_store
+
+
+def _get_early_refresh(function, key, compute_and_store, prefix, *args,
+                       **kwargs):
+    """
+    Return a value cached by _early_refresh_store, refreshing it in the
+    background when it expires early or is stale. On a miss a single process
+    computes it, while the others wait up to FILL_WAIT_TIMEOUT seconds for it
+    to be set before computing it themselves.
+    """
+    output_bytes = sentinel.slave.get(key)
+    if not output_bytes:
+        lock_key = _refresh_lock_key(key)
+        if sentinel.master.set(lock_key, 1, nx=True, ex=REFRESH_LOCK_TIMEOUT):
+            try:
+                return compute_and_store(*args, **kwargs)
+            finally:
+                sentinel.master.delete(lock_key)
+        output_bytes = _wait_for_fill(key, FILL_WAIT_TIMEOUT)
+        if not output_bytes:
+            return compute_and_store(*args, **kwargs)
+    entry = _load_entry(output_bytes, prefix)
+    if _expires_early(entry):
+        schedule_refresh(function, key, *args, **kwargs)
+    return entry['value']
+
+
+def _refresh(compute_and_store, key, *args, **kwargs):
+    try:
+        return compute_and_store(*args, **kwargs)
+    finally:
+        sentinel.master.delete(_refresh_lock_key(key))
+
+
+def cache(key_prefix, timeout=300, cache_group_keys=None, codec=None,
+          early_refresh=False, stale_ttl=0):
     """
     Decorator for caching functions.
 
     Returns the function value from cache, or the function if cache disabled
 
+    With early_refresh, the value is recomputed by a background job shortly
+    before it expires, and is still served for stale_ttl seconds after.
+
     """
     if timeout is None:
         timeout = DEFAULT_TIMEOUT
@@ -142,30 +456,47 @@ def cache(key_prefix, timeout=300, cache_group_keys=None):
     timeout += randrange(30)
 
     def decorator(f):
+        key = "%s::%s" % (REDIS_KEYPREFIX, key_prefix)
+        compute_and_store = _early_refresh_store(
+            f, key, timeout, stale_ttl, cache_group_keys, key_prefix, codec)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            key = "%s::%s" % (REDIS_KEYPREFIX, key_prefix)
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+                if early_refresh:
+                    return _get_early_refresh(wrapper, key, compute_and_store,
+                                              key_prefix, *args, **kwargs)
                 output = sentinel.slave.get(key)
                 if output:
-                    return pickle.loads(output)
+                    return decode(output, key_prefix)
                 output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
+                sentinel.master.setex(key, timeout,
+                                      encode(output, key_prefix, codec))
                 add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
                 return output
             output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
+            sentinel.master.setex(key, timeout,
+                                  encode(output, key_prefix, codec))
             add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
             return output
+
+        def refresh(*args, **kwargs):
+            return _refresh(compute_and_store, key, *args, **kwargs)
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
 
-def memoize(timeout=300, cache_group_keys=None):
+def memoize(timeout=300, cache_group_keys=None, local_timeout=None,
+            codec=None, early_refresh=False, stale_ttl=0):
     """
     Decorator for caching functions using its arguments as part of the key.
 
-    Returns the cached value, or the function if the cache is disabled
+    Returns the cached value, or the function if the cache is disabled.
+    With local_timeout, values are also cached unpickled in the process for
+    that many seconds. With early_refresh, values are recomputed by a
+    background job shortly before they expire, and are still served for
+    stale_ttl seconds after.
 
     """
     if timeout is None:
@@ -176,28 +507,60 @@ def memoize(timeout=300, cache_group_keys=None):
     timeout += randrange(30)  # add a random jitter to reduce DB load
 
     def decorator(f):
+        index_prefixes = [get_memoize_prefix(f.__name__)]
+
+        def get_key(*args, **kwargs):
+            key = get_memoize_prefix(f.__name__)
+            key_to_hash = get_key_to_hash(*args, **kwargs)
+            return get_hash_key(key, key_to_hash)
+
+        def get_compute_and_store(key):
+            return _early_refresh_store(f, key, timeout, stale_ttl,
+                                        cache_group_keys, f.__name__, codec,
+                                        index_prefixes)
+
         @wraps(f)
         def wrapper(*args, **kwargs):
-            key = "%s:%s_args:" % (REDIS_KEYPREFIX, f.__name__)
-            key_to_hash = get_key_to_hash(*args, **kwargs)
-            key = get_hash_key(key, key_to_hash)
+            key = get_key(*args, **kwargs)
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-                output = sentinel.slave.get(key)
-                if output:
-                    return pickle.loads(output)
-                output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
-                add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+                if local_timeout:
+                    output = get_local(key)
+                    if output is not MISS:
+                        return output
+                if early_refresh:
+                    output = _get_early_refresh(
+                        wrapper, key, get_compute_and_store(key), f.__name__,
+                        *args, **kwargs)
+                else:
+                    output = sentinel.slave.get(key)
+                    if output:
+                        output = decode(output, f.__name__)
+                    else:
+                        output = f(*args, **kwargs)
+                        sentinel.master.setex(key, timeout,
+                                              encode(output, f.__name__, codec))
+                        add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+                        index_cached_key(key, index_prefixes, timeout)
+                if local_timeout:
+                    set_local(key, output, local_timeout)
                 return output
             output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
+            sentinel.master.setex(key, timeout,
+                                  encode(output, f.__name__, codec))
             add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+            index_cached_key(key, index_prefixes, timeout)
             return output
+
+        def refresh(*args, **kwargs):
+            key = get_key(*args, **kwargs)
+            return _refresh(get_compute_and_store(key), key, *args, **kwargs)
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
 
-def memoize_essentials(timeout=300, essentials=None, cache_group_keys=None):
+def memoize_essentials(timeout=300, essentials=None, cache_group_keys=None,
+                       codec=None, early_refresh=False, stale_ttl=0):
     """
     Decorator for caching functions using its arguments as part of the key.
 
@@ -205,6 +568,9 @@ def memoize_essentials(timeout=300, essentials=None, cache_group_keys=None):
 
     Returns the cached value, or the function if the cache is disabled
 
+    With early_refresh, values are recomputed by a background job shortly
+    before they expire, and are still served for stale_ttl seconds after.
+
     """
     if timeout is None:
         timeout = DEFAULT_TIMEOUT
@@ -216,26 +582,57 @@ def memoize_essentials(timeout=300, essentials=None, cache_group_keys=None):
     timeout += randrange(30)  # add a random jitter to reduce DB load
 
     def decorator(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            key = "%s:%s_args:" % (REDIS_KEYPREFIX, f.__name__)
+        def get_key(*args, **kwargs):
+            key = get_memoize_prefix(f.__name__)
             essential_args = [args[i] for i in essentials]
             key += get_key_to_hash(*essential_args) + ":"
             key_to_hash = get_key_to_hash(*args, **kwargs)
-            key = get_hash_key(key, key_to_hash)
+            return get_hash_key(key, key_to_hash)
+
+        def get_index_prefixes(*args):
+            """Prefixes of the key for the function and for each leading
+            subset of the essential arguments."""
+            essential_args = [args[i] for i in essentials]
+            return [get_memoize_prefix(f.__name__) +
+                    get_key_to_hash(*essential_args[:i])
+                    for i in range(len(essential_args) + 1)]
+
+        def get_compute_and_store(key, *args):
+            return _early_refresh_store(f, key, timeout, stale_ttl,
+                                        cache_group_keys, f.__name__, codec,
+                                        get_index_prefixes(*args))
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = get_key(*args, **kwargs)
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
+                if early_refresh:
+                    if kwargs.get("force_refresh"):
+                        return get_compute_and_store(key, *args)(*args, **kwargs)
+                    return _get_early_refresh(
+                        wrapper, key, get_compute_and_store(key, *args), f.__name__,
+                        *args, **kwargs)
                 if not kwargs.get("force_refresh"):
                     output = sentinel.slave.get(key)
                     if output:
-                        return pickle.loads(output)
+                        return decode(output, f.__name__)
                 output = f(*args, **kwargs)
-                sentinel.master.setex(key, timeout, pickle.dumps(output))
+                sentinel.master.setex(key, timeout,
+                                      encode(output, f.__name__, codec))
                 add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+                index_cached_key(key, get_index_prefixes(*args), timeout)
                 return output
             output = f(*args, **kwargs)
-            sentinel.master.setex(key, timeout, pickle.dumps(output))
+            sentinel.master.setex(key, timeout,
+                                  encode(output, f.__name__, codec))
             add_key_to_cache_groups(key, cache_group_keys, *args, **kwargs)
+            index_cached_key(key, get_index_prefixes(*args), timeout)
             return output
+
+        def refresh(*args, **kwargs):
+            key = get_key(*args, **kwargs)
+            return _refresh(get_compute_and_store(key, *args), key, *args, **kwargs)
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
@@ -244,13 +641,22 @@ def memoize_with_l2_cache(timeout=DEFAULT_TIMEOUT,
                           timeout_l2=L2_CACHE_TIMEOUT,
                           timeout_mutex_lock=MUTEX_LOCK_TIMEOUT,
                           cache_group_keys=None,
-                          key_prefix=None):
+                          key_prefix=None,
+                          local_timeout=None,
+                          codec=None,
+                          early_refresh=False):
     """
     Decorator for caching functions using its arguments as part of the key.
     Returns the cached value, or the function if the cache is disabled
     If l1 cache miss, it will try to read l2 cache, which has a longer TTL
     If l2 cache miss, it will try to obtain a mutex lock, read DB and
-    update l1 and l2 caches.
+    update l1 and l2 caches, while the other requests wait for the l2 cache
+    to be set.
+    With local_timeout, values are first looked up in the process local
+    tier, which keeps them for that many seconds.
+    With early_refresh, l1 values are recomputed by a background job shortly
+    before they expire, and l2 values are served while a background job
+    updates the caches.
     """
     if timeout is None:
         timeout = DEFAULT_TIMEOUT
@@ -260,14 +666,41 @@ def memoize_with_l2_cache(timeout=DEFAULT_TIMEOUT,
     timeout += randrange(30)  # add a random jitter to reduce DB load
 
     def decorator(f):
+        stats_prefix = key_prefix or f.__name__
+        # Keys with a fixed key_prefix are deleted by delete_cached
+        index_prefixes = [] if key_prefix else [get_memoize_prefix(f.__name__)]
+
+        def get_keys(*args, **kwargs):
+            if key_prefix is None:
+                key = get_memoize_prefix(f.__name__)
+                key_to_hash = get_key_to_hash(*args, **kwargs)
+                key = get_hash_key(key, key_to_hash)
+            else:
+                key = "%s::%s" % (REDIS_KEYPREFIX, key_prefix)
+            return key, f"{key}:l2"
+
+        def load(output_bytes):
+            if early_refresh:
+                return _load_entry(output_bytes, stats_prefix)['value']
+            return decode(output_bytes, stats_prefix)
+
         def update_cache(key_l1, key_l2, *args, **kwargs):
             """ Execute f and then update l1 and l2 cache """
+            start = time.monotonic()
             output = f(*args, **kwargs)
-            output_bytes = pickle.dumps(output)
+            if early_refresh:
+                entry = dict(value=output, delta=time.monotonic() - start,
+                             expiry=time.time() + timeout)
+                output_bytes = encode(entry, stats_prefix, codec)
+            else:
+                output_bytes = encode(output, stats_prefix, codec)
             sentinel.master.setex(key_l1, timeout, output_bytes)
             sentinel.master.setex(key_l2, timeout_l2, output_bytes)
             add_key_to_cache_groups(key_l1, cache_group_keys, *args, **kwargs)
             add_key_to_cache_groups(key_l2, cache_group_keys, *args, **kwargs)
+            index_cached_key(key_l1, index_prefixes, timeout)
+            index_cached_key(key_l2, index_prefixes, timeout_l2)
+            sentinel.master.publish(_fill_channel(key_l2), 1)
             return output
 
         def update_cache_sync(key_l1, key_l2, *args, **kwargs):
@@ -289,33 +722,34 @@ def memoize_with_l2_cache(timeout=DEFAULT_TIMEOUT,
                     return output
             return None
 
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            if key_prefix is None:
-                key = "%s:%s_args:" % (REDIS_KEYPREFIX, f.__name__)
-                key_to_hash = get_key_to_hash(*args, **kwargs)
-                key = get_hash_key(key, key_to_hash)
-            else:
-                key = "%s::%s" % (REDIS_KEYPREFIX, key_prefix)
-            key_l2 = f"{key}:l2"
-
+        def get_cached(key, key_l2, *args, **kwargs):
             if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
                 output_bytes = sentinel.slave.get(key)  # read l1 cache
                 if output_bytes:
-                    return pickle.loads(output_bytes)
+                    if not early_refresh:
+                        return decode(output_bytes, stats_prefix)
+                    entry = _load_entry(output_bytes, stats_prefix)
+                    if _expires_early(entry):
+                        schedule_refresh(wrapper, key, *args, **kwargs)
+                    return entry['value']
 
                 # If l1 cache miss, try to read from l2 cache
                 output_bytes = sentinel.slave.get(key_l2)
 
                 # If l2 cache has the data
                 if output_bytes:
+                    # Serve it while a background job updates the caches
+                    if early_refresh:
+                        schedule_refresh(wrapper, key, *args, **kwargs)
+                        return load(output_bytes)
+
                     # Try to keep the cache up-to-date
                     output = update_cache_sync(key, key_l2, *args, **kwargs)
                     if output:
                         return output
 
                     # return l2 cache data if the other request is updating data
-                    return pickle.loads(output_bytes)
+                    return load(output_bytes)
 
                 # If l1 and l2 cache miss: get a mutex lock, then update cache
                 output = update_cache_sync(key, key_l2, *args, **kwargs)
@@ -323,18 +757,34 @@ def memoize_with_l2_cache(timeout=DEFAULT_TIMEOUT,
                     return output
 
                 # output is None, meaning the other request is updating data.
-                # Then just keep querying the l2 cache until MUTEX_LOCK_TIMEOUT
-                total_retry_time = 0
-                while total_retry_time < timeout_mutex_lock:
-                    output_bytes = sentinel.slave.get(key_l2)
-                    if output_bytes:
-                        return pickle.loads(output_bytes)
-
-                    sleep_time = 0.1  # seconds
-                    total_retry_time += sleep_time
-                    time.sleep(sleep_time)
+                # Then wait for it to set the l2 cache, up to MUTEX_LOCK_TIMEOUT
+                output_bytes = _wait_for_fill(key_l2, timeout_mutex_lock)
+                if output_bytes:
+                    return load(output_bytes)
             output = update_cache(key, key_l2, *args, **kwargs)
             return output
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key, key_l2 = get_keys(*args, **kwargs)
+
+            if (local_timeout and
+                    os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None):
+                output = get_local(key)
+                if output is not MISS:
+                    return output
+                output = get_cached(key, key_l2, *args, **kwargs)
+                set_local(key, output, local_timeout)
+                return output
+            return get_cached(key, key_l2, *args, **kwargs)
+
+        def refresh(*args, **kwargs):
+            key, key_l2 = get_keys(*args, **kwargs)
+            try:
+                return update_cache(key, key_l2, *args, **kwargs)
+            finally:
+                sentinel.master.delete(_refresh_lock_key(key))
+        wrapper.refresh = refresh
         return wrapper
     return decorator
 
@@ -348,6 +798,7 @@ def delete_cached(key):
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
         key = "%s::%s" % (REDIS_KEYPREFIX, key)
+        sentinel.master.delete(_refresh_lock_key(key))
         return bool(sentinel.master.delete(key))
     return True
 
@@ -360,15 +811,15 @@ def delete_memoized(function, *args, **kwargs):
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-        key = "%s:%s_args:" % (REDIS_KEYPREFIX, function.__name__)
+        key = get_memoize_prefix(function.__name__)
         if args or kwargs:
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
+            invalidate_local(keys=[key])
+            sentinel.master.delete(_refresh_lock_key(key))
             return bool(sentinel.master.delete(key))
-        keys_to_delete = list(sentinel.slave.scan_iter(match=key + '*', count=10000))
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+        invalidate_local(prefixes=[key])
+        return delete_indexed_keys(key)
     return True
 
 
@@ -380,13 +831,10 @@ def delete_memoized_essential(function, *args, **kwargs):
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-        key = "%s:%s_args:" % (REDIS_KEYPREFIX, function.__name__)
+        key = get_memoize_prefix(function.__name__)
         if args or kwargs:
             key += get_key_to_hash(*args, **kwargs)
-        keys_to_delete = list(sentinel.slave.scan_iter(match=key + '*', count=10000))
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+        return delete_indexed_keys(key)
     return True
 
 
@@ -398,16 +846,16 @@ def delete_memoize_with_l2_cache(function, *args, **kwargs):
 
     """
     if os.environ.get('PYBOSSA_REDIS_CACHE_DISABLED') is None:
-        key = "%s:%s_args:" % (REDIS_KEYPREFIX, function.__name__)
+        key = get_memoize_prefix(function.__name__)
         if args or kwargs:
             key_to_hash = get_key_to_hash(*args, **kwargs)
             key = get_hash_key(key, key_to_hash)
             key_l2 = f"{key}:l2"
+            invalidate_local(keys=[key])
+            sentinel.master.delete(_refresh_lock_key(key))
             key_deleted = bool(sentinel.master.delete(key))
             key_l2_deleted = bool(sentinel.master.delete(key_l2))
             return key_deleted and key_l2_deleted
-        keys_to_delete = list(sentinel.slave.scan_iter(match=key + '*', count=10000))
-        if not keys_to_delete:
-            return False
-        return bool(sentinel.master.delete(*keys_to_delete))
+        invalidate_local(prefixes=[key])
+        return delete_indexed_keys(key)
     return True
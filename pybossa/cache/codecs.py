@@ -0,0 +1,236 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2015 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Codecs used by the cache decorators to serialize cached values.
+
+Encoded values start with a header made of MAGIC, the header version, the
+codec id and the compression id. Values without it are plain pickles, which
+is also what is written while CACHE_CODEC is not set, so every process can
+read the new formats before any of them writes one.
+
+The msgpack codec handles plain data: dicts, lists, tuples, strings, numbers
+and datetimes. Values holding anything else, e.g. ORM objects, are pickled.
+Compression, when configured, only applies to values larger than
+CACHE_COMPRESSION_MIN_SIZE bytes.
+"""
+import pickle
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import date, datetime
+
+import msgpack
+from flask import current_app, has_app_context
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+MAGIC = b'\x00PB'
+HEADER_VERSION = 1
+HEADER_SIZE = len(MAGIC) + 3
+DEFAULT_COMPRESSION_MIN_SIZE = 16 * 1024
+
+EXT_TUPLE = 1
+EXT_DATETIME = 2
+EXT_DATE = 3
+
+
+class PickleCodec(object):
+
+    """Serialize any picklable value."""
+
+    id = 1
+    name = 'pickle'
+
+    def dumps(self, value):
+        return pickle.dumps(value)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackCodec(object):
+
+    """Serialize plain data with msgpack. Raises TypeError on other types."""
+
+    id = 2
+    name = 'msgpack'
+
+    def _default(self, value):
+        if isinstance(value, tuple):
+            return msgpack.ExtType(EXT_TUPLE, self.dumps(list(value)))
+        if isinstance(value, datetime):
+            return msgpack.ExtType(EXT_DATETIME,
+                                   value.isoformat().encode('utf-8'))
+        if isinstance(value, date):
+            return msgpack.ExtType(EXT_DATE, value.isoformat().encode('utf-8'))
+        raise TypeError('Cannot serialize %r' % type(value))
+
+    def _ext_hook(self, code, data):
+        if code == EXT_TUPLE:
+            return tuple(self.loads(data))
+        if code == EXT_DATETIME:
+            return datetime.fromisoformat(data.decode('utf-8'))
+        if code == EXT_DATE:
+            return date.fromisoformat(data.decode('utf-8'))
+        return msgpack.ExtType(code, data)
+
+    def dumps(self, value):
+        # strict_types sends tuples and subclasses of the basic types to
+        # _default, so they are not silently turned into lists or dicts
+        return msgpack.packb(value, use_bin_type=True, strict_types=True,
+                             default=self._default)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False,
+                               ext_hook=self._ext_hook)
+
+
+class Compressor(object):
+
+    def __init__(self, id, name, compress, decompress):
+        self.id = id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+codecs = {}
+compressors = {}
+
+
+def register_codec(codec):
+    """Make a codec available by its name and id."""
+    codecs[codec.name] = codec
+    codecs[codec.id] = codec
+
+
+def register_compressor(compressor):
+    compressors[compressor.name] = compressor
+    compressors[compressor.id] = compressor
+
+
+register_codec(PickleCodec())
+register_codec(MsgpackCodec())
+register_compressor(Compressor(1, 'zlib', zlib.compress, zlib.decompress))
+if zstandard is not None:  # pragma: no cover
+    register_compressor(Compressor(2, 'zstd',
+                                   zstandard.ZstdCompressor().compress,
+                                   zstandard.ZstdDecompressor().decompress))
+if lz4_frame is not None:  # pragma: no cover
+    register_compressor(Compressor(3, 'lz4', lz4_frame.compress,
+                                   lz4_frame.decompress))
+
+
+class CodecStats(object):
+
+    """Encoded sizes and codec times of the cached values, per key prefix."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: dict(encoded=0, encoded_bytes=0,
+                                               encode_seconds=0.0, decoded=0,
+                                               decode_seconds=0.0))
+
+    def add_encoded(self, prefix, size, seconds):
+        with self._lock:
+            stats = self._stats[prefix]
+            stats['encoded'] += 1
+            stats['encoded_bytes'] += size
+            stats['encode_seconds'] += seconds
+
+    def add_decoded(self, prefix, seconds):
+        with self._lock:
+            stats = self._stats[prefix]
+            stats['decoded'] += 1
+            stats['decode_seconds'] += seconds
+
+    def get(self):
+        """Return the stats of this process by key prefix."""
+        with self._lock:
+            return {prefix: dict(stats) for prefix, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+stats = CodecStats()
+
+
+def _config(name, default=None):
+    if has_app_context():
+        return current_app.config.get(name, default)
+    return default
+
+
+def encode(value, prefix, codec=None):
+    """
+    Serialize a value to be cached under a key prefix.
+
+    The value is written as a plain pickle unless CACHE_CODEC is set. Then it
+    is encoded with codec, or CACHE_CODEC by default, falling back to pickle
+    for the values the codec does not support.
+    """
+    start = time.perf_counter()
+    default_codec = _config('CACHE_CODEC')
+    if default_codec is None:
+        data = pickle.dumps(value)
+    else:
+        codec = codecs[codec or default_codec]
+        try:
+            payload = codec.dumps(value)
+        except (TypeError, ValueError, OverflowError):
+            codec = codecs['pickle']
+            payload = codec.dumps(value)
+        compressor = compressors.get(_config('CACHE_COMPRESSION'))
+        min_size = _config('CACHE_COMPRESSION_MIN_SIZE',
+                           DEFAULT_COMPRESSION_MIN_SIZE)
+        if compressor and len(payload) > min_size:
+            payload = compressor.compress(payload)
+            compressor_id = compressor.id
+        else:
+            compressor_id = 0
+        data = MAGIC + bytes([HEADER_VERSION, codec.id, compressor_id]) + payload
+    stats.add_encoded(prefix, len(data), time.perf_counter() - start)
+    return data
+
+
+def decode(data, prefix):
+    """Deserialize a cached value, in any format written by encode."""
+    start = time.perf_counter()
+    if not data.startswith(MAGIC):
+        value = pickle.loads(data)
+    else:
+        version, codec_id, compressor_id = data[len(MAGIC):HEADER_SIZE]
+        if version != HEADER_VERSION:
+            raise ValueError('Unknown cache header version %d' % version)
+        payload = data[HEADER_SIZE:]
+        if compressor_id:
+            payload = compressors[compressor_id].decompress(payload)
+        value = codecs[codec_id].loads(payload)
+    stats.add_decoded(prefix, time.perf_counter() - start)
+    return value
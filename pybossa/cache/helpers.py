@@ -24,7 +24,6 @@ from pybossa.core import db
 from pybossa.cache import memoize, FIVE_MINUTES
 from pybossa.model.project_stats import ProjectStats
 from pybossa.cache import users as cached_users
-from pybossa.cache import task_browse_helpers as cached_task_browse_helpers
 from pybossa.sched import Schedulers, get_reserve_task_category_info
 from pybossa.contributions_guard import ContributionsGuard
 
@@ -171,7 +170,7 @@ def _has_no_tasks(project_id):
     return n_tasks == 0
 
 
-@memoize(timeout=FIVE_MINUTES)
+@memoize(timeout=FIVE_MINUTES, early_refresh=True)
 def n_available_tasks_for_user(project, user_id=None, user_ip=None):
     """Return the number of tasks for a given project a user can contribute to.
     based on the completion of the project tasks, previous task_runs
@@ -208,7 +207,7 @@ def n_available_tasks_for_user(project, user_id=None, user_ip=None):
         timeout = project_info.get("timeout", TIMEOUT)
         reserve_task_filter, _ = get_reserve_task_category_info(reserve_task_config, project_id, timeout, user_id, True)
         sql = '''
-               SELECT task.id, worker_filter FROM task
+               SELECT COUNT(*) AS n_tasks FROM task
                WHERE project_id=:project_id AND state !='completed'
                AND state !='enrich'
                {}
@@ -222,20 +221,9 @@ def n_available_tasks_for_user(project, user_id=None, user_ip=None):
     try:
         result = session.execute(sqltext, dict(project_id=project_id, user_id=user_id, assign_user=assign_user))
         current_app.logger.info("n_available_tasks_for_user making db request for project_id %d. user_id %d", project_id, user_id)
-        if scheduler not in [Schedulers.user_pref, Schedulers.task_queue]:
-            for row in result:
-                n_tasks = row.n_tasks
-                return n_tasks
-        else:
-            num_available_tasks = 0
-            user_profile = cached_users.get_user_profile_metadata(user_id)
-            user_profile = json.loads(user_profile) if user_profile else {}
-            for task_id, w_filter in result:
-                w_filter = w_filter or {}
-                num_available_tasks += int(
-                    cached_task_browse_helpers.user_meet_task_requirement(task_id, w_filter, user_profile)
-                )
-            return num_available_tasks
+        for row in result:
+            n_tasks = row.n_tasks
+            return n_tasks
 
     except Exception as e:
         current_app.logger.exception('Exception in n_available_tasks_for_user {0}, sql: {1}'.format(str(e), str(sqltext)))
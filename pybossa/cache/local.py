@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2015 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Process local cache tier used by the memoize decorators.
+
+Values are kept unpickled in a bounded least recently used map, and every
+entry expires after its own timeout. Callers share the cached objects, so
+the functions opting in must return values that are only read.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+MISS = object()
+
+
+class LocalCache(object):
+
+    """Thread safe LRU cache with a per entry timeout."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or MISS."""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISS
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISS
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, keys=(), prefixes=()):
+        """Drop the given keys and every key starting with a prefix."""
+        prefixes = tuple(prefixes)
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+            if prefixes:
+                for key in [k for k in self._data if k.startswith(prefixes)]:
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
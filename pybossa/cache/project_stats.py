@@ -15,16 +15,25 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
-"""Cache module for project stats."""
+"""Cache module for project stats.
+
+The stats are read from rollups kept up to date by the task run event
+listeners: the task runs per hour in project_stats_hourly, the task runs per
+user and day in project_stats_contributor and the last task run of each task
+in task_rollup. Distinct users are counted by a HyperLogLog per project and
+day, plus one since the project started.
+"""
+import calendar
+
 from flask import current_app
 from sqlalchemy.sql import text
 from pybossa.core import db
 from pybossa.cache import memoize, ONE_DAY, FIVE_MINUTES, ONE_HOUR
+from pybossa.redis_batch import get_batch
 import pybossa.cache.projects as cached_projects
 from pybossa.model.project_stats import ProjectStats
 from flask_babel import gettext
 
-import operator
 import time
 import datetime
 import os
@@ -33,6 +42,13 @@ import pybossa.app_settings as app_settings
 
 session = db.slave_session
 
+CONTRIBUTORS_KEY = 'pybossa:project:{}:contributors:{}'
+SEEDED_KEY = 'pybossa:project:{}:contributors:seeded'
+# Daily contributors are kept for longer than the longest stats period
+CONTRIBUTORS_TTL = 400 * ONE_DAY
+# First day of a period, matching TO_DATE(finish_time) >= NOW() - period
+PERIOD_START = "CAST(NOW() - :period ::INTERVAL AS DATE) + 1"
+
 
 @memoize(timeout=ONE_HOUR)
 def n_tasks(project_id):
@@ -44,104 +60,147 @@ def n_tasks(project_id):
     return projects.n_tasks(project_id)
 
 
-@memoize(timeout=ONE_HOUR)
+def get_contributors_key(project_id, kind, day=None):
+    """Return the key of the HyperLogLog counting the distinct auth or anon
+    contributors of a project, over a day or since the project started."""
+    key = CONTRIBUTORS_KEY.format(project_id, kind)
+    if day is None:
+        return key
+    return '{}:{}'.format(key, day.isoformat())
+
+
+def _contributor_kind(user_id, user_ip):
+    if user_ip is None:
+        return 'auth', user_id
+    return 'anon', user_ip
+
+
+def add_contributor(project_id, day, user_id, user_ip, conn=None):
+    """Count a contributor of a project in the HyperLogLogs of the day and
+    of the project."""
+    kind, member = _contributor_kind(user_id, user_ip)
+    conn = get_batch(conn)
+    conn.pfadd(get_contributors_key(project_id, kind), member)
+    key = get_contributors_key(project_id, kind, day)
+    conn.pfadd(key, member)
+    conn.expireat(key, calendar.timegm(day.timetuple()) + CONTRIBUTORS_TTL)
+
+
+def reset_contributors(project_id, days=(), conn=None):
+    """Delete the HyperLogLogs of a project, for the given days and since the
+    project started."""
+    conn = get_batch(conn)
+    conn.delete(SEEDED_KEY.format(project_id))
+    for kind in ('auth', 'anon'):
+        conn.delete(get_contributors_key(project_id, kind))
+        for day in days:
+            conn.delete(get_contributors_key(project_id, kind, day))
+
+
+def seed_contributors(project_id, conn=None):
+    """Count the contributors of the project_stats_contributor rows of a
+    project in its HyperLogLogs, once. The rows written before the
+    HyperLogLogs existed are only counted this way."""
+    conn = get_batch(conn)
+    key = SEEDED_KEY.format(project_id)
+    if conn.exists(key):
+        return
+    sql = text('''SELECT day, user_id, user_ip FROM project_stats_contributor
+               WHERE project_id=:project_id''')
+    # adding a contributor twice is harmless, so concurrent seeds are too
+    for row in session.execute(sql, dict(project_id=project_id)):
+        add_contributor(project_id, row.day, row.user_id, row.user_ip,
+                        conn=conn)
+    conn.set(key, 1)
+
+
+def remove_task_runs_sql(where):
+    """Return the statements uncounting the task runs matching where from
+    the hourly and contributor stats. They must run before the task runs are
+    deleted with raw SQL, which the after_delete listener does not see. The
+    distinct contributors counted by the HyperLogLogs are left as they are."""
+    return '''
+        UPDATE project_stats_hourly
+        SET n_task_runs = project_stats_hourly.n_task_runs - removed.n_task_runs,
+        n_auth = project_stats_hourly.n_auth - removed.n_auth,
+        n_anon = project_stats_hourly.n_anon - removed.n_anon
+        FROM (SELECT project_id,
+              DATE_TRUNC('hour', CAST(finish_time AS TIMESTAMP)) AS hour,
+              COUNT(id) AS n_task_runs,
+              COUNT(id) FILTER (WHERE user_ip IS NULL) AS n_auth,
+              COUNT(id) FILTER (WHERE user_id IS NULL) AS n_anon
+              FROM task_run WHERE finish_time IS NOT NULL AND ({0})
+              GROUP BY project_id, hour) AS removed
+        WHERE project_stats_hourly.project_id = removed.project_id
+        AND project_stats_hourly.hour = removed.hour;
+        UPDATE project_stats_contributor
+        SET n_task_runs = project_stats_contributor.n_task_runs - removed.n_task_runs
+        FROM (SELECT project_id, CAST(finish_time AS DATE) AS day,
+              user_id, user_ip, COUNT(id) AS n_task_runs
+              FROM task_run WHERE finish_time IS NOT NULL AND ({0})
+              GROUP BY project_id, day, user_id, user_ip) AS removed
+        WHERE project_stats_contributor.project_id = removed.project_id
+        AND project_stats_contributor.day = removed.day
+        AND coalesce(project_stats_contributor.user_id, 0) =
+            coalesce(removed.user_id, 0)
+        AND coalesce(project_stats_contributor.user_ip, '') =
+            coalesce(removed.user_ip, '');
+        DELETE FROM project_stats_contributor WHERE n_task_runs <= 0
+        AND project_id IN (SELECT DISTINCT project_id FROM task_run
+                           WHERE {0});
+        '''.format(where)
+
+
+def count_contributors(project_id, kind, days=None):
+    """Return the estimated number of distinct auth or anon contributors of
+    a project over the given days, or since the project started."""
+    if days is None:
+        keys = [get_contributors_key(project_id, kind)]
+    else:
+        keys = [get_contributors_key(project_id, kind, day) for day in days]
+    if not keys:
+        return 0
+    # read through the batch, after the contributors it is yet to add
+    return get_batch().pfcount(*keys)
+
+
+def _contributors(column, where, params):
+    sql = text('''SELECT {0}, SUM(n_task_runs) AS n_tasks
+               FROM project_stats_contributor
+               WHERE {1} AND {0} IS NOT NULL
+               GROUP BY {0} ORDER BY n_tasks DESC;'''.format(column, where))
+    return [[row[0], row.n_tasks] for row in session.execute(sql, params)]
+
+
+@memoize(timeout=ONE_HOUR, early_refresh=True, stale_ttl=FIVE_MINUTES)
 def stats_users(project_id, period=None):
-    """Return users's stats for a given project_id."""
+    """Return users's stats for a given project_id.
+
+    The task runs of each user are read from project_stats_contributor and
+    the distinct users are counted by the HyperLogLogs of the project.
+    """
     users = {}
-    auth_users = []
     anon_users = []
 
-    # Get Authenticated Users
-    params = dict(project_id=project_id)
-    sql = text('''SELECT task_run.user_id AS user_id,
-               COUNT(task_run.id) as n_tasks FROM task_run
-               WHERE task_run.user_id IS NOT NULL AND
-               task_run.user_ip IS NULL AND
-               task_run.project_id=:project_id
-               GROUP BY task_run.user_id
-               ORDER BY n_tasks DESC;''')\
-        .execution_options(stream=True)
+    params = dict(project_id=project_id, period=period)
+    where = 'project_id=:project_id'
+    days = None
     if period:
-        sql = text(r'''SELECT task_run.user_id AS user_id,
-                   COUNT(task_run.id) as n_tasks FROM task_run
-                   WHERE task_run.user_id IS NOT NULL AND
-                   task_run.user_ip IS NULL AND
-                   task_run.project_id=:project_id AND
-                   TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                   >= NOW() - :period ::INTERVAL
-                   GROUP BY task_run.user_id
-                   ORDER BY n_tasks DESC;''')\
-            .execution_options(stream=True)
-        params['period'] = period
+        where += ' AND day >= ' + PERIOD_START
+        sql = text('''SELECT DISTINCT day FROM project_stats_contributor
+                   WHERE {};'''.format(where))
+        days = [row.day for row in session.execute(sql, params)]
 
-    results = session.execute(sql, params)
-
-    for row in results:
-        auth_users.append([row.user_id, row.n_tasks])
-
-    sql = text('''SELECT count(distinct(task_run.user_id)) AS user_id
-               FROM task_run WHERE task_run.user_id IS NOT NULL AND
-               task_run.user_ip IS NULL AND
-               task_run.project_id=:project_id;''')
-    if period:
-        sql = text(r'''SELECT count(distinct(task_run.user_id)) AS user_id
-                   FROM task_run WHERE task_run.user_id IS NOT NULL AND
-                   task_run.user_ip IS NULL AND
-                   task_run.project_id=:project_id AND
-                   TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                   >= NOW() - :period ::INTERVAL
-                   ;''')
-
-    results = session.execute(sql, params)
-    for row in results:
-        users['n_auth'] = row[0]
+    seed_contributors(project_id)
+    auth_users = _contributors('user_id', where, params)
+    users['n_auth'] = count_contributors(project_id, 'auth', days)
 
     if app_settings.config.get('DISABLE_ANONYMOUS_ACCESS'):
         users['n_anon'] = 0
         return users, anon_users, auth_users
 
-    # Get all Anonymous Users
-    sql = text('''SELECT task_run.user_ip AS user_ip,
-               COUNT(task_run.id) as n_tasks FROM task_run
-               WHERE task_run.user_ip IS NOT NULL AND
-               task_run.user_id IS NULL AND
-               task_run.project_id=:project_id
-               GROUP BY task_run.user_ip ORDER BY n_tasks DESC;''')\
-        .execution_options(stream=True)
-
-    if period:
-        sql = text(r'''SELECT task_run.user_ip AS user_ip,
-                   COUNT(task_run.id) as n_tasks FROM task_run
-                   WHERE task_run.user_ip IS NOT NULL AND
-                   task_run.user_id IS NULL AND
-                   task_run.project_id=:project_id AND
-                   TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                   >= NOW() - :period ::INTERVAL
-                   GROUP BY task_run.user_ip ORDER BY n_tasks DESC;''')\
-            .execution_options(stream=True)
-
-    results = session.execute(sql, params)
-
-    for row in results:
-        anon_users.append([row.user_ip, row.n_tasks])
-
-    sql = text('''SELECT COUNT(DISTINCT(task_run.user_ip)) AS user_ip
-               FROM task_run WHERE task_run.user_ip IS NOT NULL AND
-               task_run.user_id IS NULL AND
-               task_run.project_id=:project_id;''')
-    if period:
-        sql = text(r'''SELECT COUNT(DISTINCT(task_run.user_ip)) AS user_ip
-                   FROM task_run WHERE task_run.user_ip IS NOT NULL AND
-                   task_run.user_id IS NULL AND
-                   task_run.project_id=:project_id AND
-                   TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                   >= NOW() - :period ::INTERVAL
-                   ;''')
-
-    results = session.execute(sql, params)
-
-    for row in results:
-        users['n_anon'] = row[0]
+    anon_users = _contributors('user_ip', where, params)
+    users['n_anon'] = count_contributors(project_id, 'anon', days)
 
     return users, anon_users, auth_users
 
@@ -175,20 +234,19 @@ def stats_dates(project_id, period='15 day'):
 
     params = dict(project_id=project_id, period=period)
 
-    # Get all tasks with at least 1 task run and its last finish time
-    sql = text(r'''
-               SELECT task_id as id, MAX(task_run.finish_time) AS day
-               FROM task_run
+    # Get the number of tasks per day of their last task run. finish_time
+    # is an ISO formatted string, so the range can be read from its index
+    sql = text('''
+               SELECT LEFT(finish_time, 10) AS day, COUNT(task_id) AS n_tasks
+               FROM task_rollup
                WHERE project_id=:project_id AND
-               TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-               >= NOW() - :period :: INTERVAL
-               GROUP BY task_id;
-               ''').execution_options(stream=True)
+               finish_time >= to_char({}, 'YYYY-MM-DD')
+               GROUP BY day;
+               '''.format(PERIOD_START))
 
     results = session.execute(sql, params)
     for row in results:
-        day = row.day[:10]
-        dates[day] = dates.get(day, 0) + 1
+        dates[row.day] = row.n_tasks
 
     # No completed tasks in the last period
     def _fill_empty_days(days, obj):
@@ -205,42 +263,23 @@ def stats_dates(project_id, period='15 day'):
         dates_auth = dates # all users are auth users
         return dates, dates_anon, dates_auth
 
-    # Get all answers per date for auth
-    sql = text(r'''
-                WITH myquery AS (
-                    SELECT TO_DATE(finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    as d, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_ip IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY d)
-                SELECT to_char(d, 'YYYY-MM-DD') as d, count from myquery;
-               ''').execution_options(stream=True)
+    # Get all answers per date for auth and anon
+    sql = text('''
+               SELECT to_char(hour, 'YYYY-MM-DD') AS d, SUM(n_auth) AS n_auth,
+               SUM(n_anon) AS n_anon
+               FROM project_stats_hourly
+               WHERE project_id=:project_id AND hour >= {}
+               GROUP BY d;
+               '''.format(PERIOD_START))
 
     results = session.execute(sql, params)
     for row in results:
-        dates_auth[row.d] = row.count
+        if row.n_auth:
+            dates_auth[row.d] = row.n_auth
+        if row.n_anon:
+            dates_anon[row.d] = row.n_anon
 
     dates_auth = _fill_empty_days(list(dates_auth.keys()), dates_auth)
-
-    # Get all answers per date for anon
-    sql = text(r'''
-                WITH myquery AS (
-                    SELECT TO_DATE(finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    as d, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_id IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY d)
-               SELECT to_char(d, 'YYYY-MM-DD') as d, count  from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, params)
-    for row in results:
-        dates_anon[row.d] = row.count
-
     dates_anon = _fill_empty_days(list(dates_anon.keys()), dates_anon)
 
     return dates, dates_anon, dates_auth
@@ -263,133 +302,37 @@ def stats_hours(project_id, period='2 week'):
         hours_auth[str(i).zfill(2)] = 0
 
     params = dict(project_id=project_id, period=period)
-    # Get hour stats for all users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
+    sql = text('''
+               SELECT to_char(hour, 'HH24') AS h,
+               SUM(n_task_runs) AS n_task_runs, SUM(n_auth) AS n_auth,
+               SUM(n_anon) AS n_anon
+               FROM project_stats_hourly
+               WHERE project_id=:project_id AND hour >= {}
+               GROUP BY h;
+               '''.format(PERIOD_START))
 
     results = session.execute(sql, params)
-
     for row in results:
-        hours[row.h] = row.count
-
-    # Get maximum stats for all users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id  AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
+        hours[row.h] = row.n_task_runs
+        hours_anon[row.h] = row.n_anon
+        hours_auth[row.h] = row.n_auth
 
-    results = session.execute(sql, params)
-    for row in results:
-        max_hours = row.max
+    def _max_hours(counts):
+        return max([count for count in counts.values() if count],
+                   default=None)
+
+    max_hours = _max_hours(hours)
 
     # with anonymous access disabled, auth users and aggr users counts would be same.
     # reuse aggr user counts for auth users.
     if app_settings.config.get('DISABLE_ANONYMOUS_ACCESS'):
+        hours_anon = dict.fromkeys(hours_anon, 0)
         hours_auth, max_hours_auth = hours.copy(), max_hours
         return hours, hours_anon, hours_auth, max_hours, max_hours_anon, \
             max_hours_auth
 
-    # Get hour stats for Anonymous users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_id IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, params)
-
-    for row in results:
-        hours_anon[row.h] = row.count
-
-    # Get maximum stats for Anonymous users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_id IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, params)
-    for row in results:
-        max_hours_anon = row.max
-
-    # Get hour stats for Auth users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_ip IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT h, count from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, params)
-
-    for row in results:
-        hours_auth[row.h] = row.count
-
-    # Get maximum stats for Auth users
-    sql = text(r'''
-               WITH myquery AS
-                (SELECT to_char(
-                    DATE_TRUNC('hour',
-                        TO_TIMESTAMP(finish_time, 'YYYY-MM-DD"T"HH24:MI:SS.US')
-                    ),
-                    'HH24') AS h, COUNT(id)
-                    FROM task_run WHERE project_id=:project_id
-                    AND user_ip IS NULL AND
-                    TO_DATE(task_run.finish_time, 'YYYY-MM-DD\THH24:MI:SS.US')
-                    >= NOW() - :period :: INTERVAL
-                    GROUP BY h)
-               SELECT max(count) from myquery;
-               ''').execution_options(stream=True)
-
-    results = session.execute(sql, params)
-    for row in results:
-        max_hours_auth = row.max
+    max_hours_anon = _max_hours(hours_anon)
+    max_hours_auth = _max_hours(hours_auth)
 
     return hours, hours_anon, hours_auth, max_hours, max_hours_anon, \
         max_hours_auth
@@ -521,18 +464,13 @@ def stats_format_users(project_id, users, anon_users, auth_users):
                 n_anon=users['n_anon'], n_auth=users['n_auth'])
 
 
-def update_stats(project_id, period='2 week'):
-    """Update the stats of a given project."""
+def get_period_stats(project_id, period='2 week'):
+    """Return the formatted dates, hours and users stats of a project."""
     hours, hours_anon, hours_auth, max_hours, \
         max_hours_anon, max_hours_auth = stats_hours(project_id, period)
     users, anon_users, auth_users = stats_users(project_id)
     dates, dates_anon, dates_auth = stats_dates(project_id, period)
 
-
-    sum(dates.values())
-
-    sorted(iter(dates.items()), key=operator.itemgetter(0))
-
     dates_stats = stats_format_dates(project_id, dates,
                                      dates_anon, dates_auth)
 
@@ -541,6 +479,14 @@ def update_stats(project_id, period='2 week'):
 
     users_stats = stats_format_users(project_id, users, anon_users, auth_users)
 
+    return dates_stats, hours_stats, users_stats
+
+
+def update_stats(project_id, period='2 week'):
+    """Update the stats of a given project."""
+    dates_stats, hours_stats, users_stats = get_period_stats(project_id,
+                                                             period)
+
     data = dict(dates_stats=dates_stats,
                 hours_stats=hours_stats,
                 users_stats=users_stats)
@@ -584,7 +530,13 @@ def update_stats(project_id, period='2 week'):
 
 
 def get_stats(project_id, period='2 week', full=False):
-    """Get project's stats."""
+    """Get project's stats.
+
+    The dates, hours and users stats are read from the rollups for the
+    given period, while full returns the stored ProjectStats of the project.
+    """
+    if not full:
+        return get_period_stats(project_id, period)
     ps = session.query(ProjectStats).filter_by(project_id=project_id).first()
     if not ps:
         update_stats(project_id, period)
@@ -595,7 +547,4 @@ def get_stats(project_id, period='2 week', full=False):
     ps.overall_progress = cached_projects.overall_progress(project_id)
     ps.n_tasks = cached_projects.n_tasks(project_id)
     # end
-    if full:
-        return ps
-    else:
-        return ps.info['dates_stats'], ps.info['hours_stats'], ps.info['users_stats']
+    return ps
@@ -26,12 +26,14 @@ from pybossa.util import pretty_date, static_vars, convert_utc_to_est, \
     get_user_saved_partial_tasks
 from pybossa.cache import memoize, cache, delete_memoized, delete_cached, \
     memoize_essentials, delete_memoized_essential, delete_cache_group, ONE_DAY, \
-    ONE_HOUR, memoize_with_l2_cache, delete_memoize_with_l2_cache
-from pybossa.cache.task_browse_helpers import get_task_filters, allowed_fields, user_meet_task_requirement, get_task_preference_score
+    ONE_HOUR, ONE_MINUTE, memoize_with_l2_cache, delete_memoize_with_l2_cache
+from pybossa.cache.task_browse_helpers import get_task_filters, allowed_fields, TaskMatcher, \
+    get_sort_keys, get_seek_key, get_seek_filters
 import pybossa.app_settings as app_settings
 from pybossa.redis_lock import get_locked_tasks_project
 from pybossa.util import get_taskrun_date_range_sql_clause_params
 from pybossa.cache.task_browse_helpers import get_users_fullnames_from_emails
+from pybossa.model.task_run_partitions import PROJECT_TASK_IDS
 
 import heapq
 
@@ -65,7 +67,8 @@ def get_top(n=4):
 
 
 @memoize_essentials(timeout=timeouts.get('BROWSE_TASKS_TIMEOUT'), essentials=[0],
-                    cache_group_keys=[[0]])
+                    cache_group_keys=[[0]], codec='msgpack',
+                    early_refresh=True)
 @static_vars(allowed_fields=allowed_fields)
 def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwargs):
     """Cache browse tasks view for a project."""
@@ -176,22 +179,19 @@ def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwar
     if filter_user_prefs:
         # construct task list for worker view
         sql = """ SELECT task.id,
-                (
-                    SELECT COUNT(id) as ct FROM task_run
-                    WHERE task_id = task.id
-                ) as n_task_runs,
+                coalesce(ct, 0) as n_task_runs,
                 task.n_answers,
-                (
-                    SELECT MAX(finish_time) as ft FROM task_run
-                    WHERE task_id = task.id
-                ) as ft,
+                ft,
                 priority_0,
                 task.created,
                 task.calibration,
                 task.user_pref,
                 task.worker_filter,
                 task.worker_pref
-                FROM task
+                FROM task LEFT OUTER JOIN
+                (SELECT task_id, n_task_runs AS ct, finish_time AS ft
+                FROM task_rollup WHERE project_id=:project_id) AS log_counts
+                ON task.id=log_counts.task_id
                 WHERE task.project_id =:project_id"""
 
         params["assign_user"] = args["sql_params"]["assign_user"]
@@ -228,6 +228,7 @@ def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwar
 
         # Get all saved task IDs from Redis for the current user
         task_id_map = get_user_saved_partial_tasks(sentinel, project_id, user_id)
+        matcher = TaskMatcher(user_profile)
 
         for row in all_available_tasks:
             score = 0
@@ -237,14 +238,12 @@ def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwar
                 score = sys.maxsize - task_id_map.get(row.id)  # earliest timestamp first
                 has_saved_answer = True
             else:
-                w_pref = row.worker_pref or {}
-                w_filter = row.worker_filter or {}
                 # validate worker_filter and compute preference score
-                if not user_meet_task_requirement(row.id, w_filter, user_profile):
+                if not matcher.meets_requirement(row.id, row.worker_filter):
                     continue
                 if not args.get('order_by'):
                     # if there is no sort defined, sort task by preference scores
-                    score = get_task_preference_score(w_pref, user_profile)
+                    score = matcher.preference_score(row.worker_pref)
 
             task = format_task(row, in_progress=has_saved_answer)
 
@@ -267,18 +266,17 @@ def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwar
 
     else:
         # construct task browse page for owners/admins
-        session.execute("SET LOCAL enable_indexscan = OFF;")
-        sql = """
+        sql_select = """
             SELECT task.id,
             coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
             priority_0, task.created, task.calibration,
             task.user_pref, task.worker_filter, task.worker_pref
             FROM task LEFT OUTER JOIN
-            (SELECT task_id, COUNT(id) AS ct,
-            MAX(finish_time) as ft FROM task_run
-            WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+            (SELECT task_id, n_task_runs AS ct, finish_time AS ft
+            FROM task_rollup WHERE project_id=:project_id) AS log_counts
             ON task.id=log_counts.task_id
-            WHERE task.project_id=:project_id""" + filters
+            WHERE task.project_id=:project_id"""
+        sql = sql_select + filters
 
         locked_task_ids = [lock["task_id"] for lock in get_locked_tasks_project(project_id)]
         sql_lock_filter = " AND id IN ({})".format(",".join(locked_task_ids))
@@ -294,18 +292,23 @@ def browse_tasks(project_id, args, filter_user_prefs=False, user_id=None, **kwar
             # sort by the column "order_by"
             order_by =  args.get('order_by') or "id ASC"
             order_by = order_by.replace("assigned_users", "task.user_pref->>'assign_user'")
-            sql_order = f" ORDER BY {order_by} "
-            sql_query = sql + sql_order + sql_limit_offset
+            sort_keys = get_sort_keys(order_by)
+            if sort_keys:
+                tasks = browse_tasks_page(
+                    sql_select, filters, params, sort_keys, limit, offset,
+                    lambda row: format_task(row, locked_tasks_in_project.get(row.id, [])))
+            else:
+                sql_order = f" ORDER BY {order_by} "
+                sql_query = sql + sql_order + sql_limit_offset
 
-            results = session.execute(text(sql_query), params)
-            tasks = [format_task(row, locked_tasks_in_project.get(row.id, [])) for row in results]
+                results = session.execute(text(sql_query), params)
+                tasks = [format_task(row, locked_tasks_in_project.get(row.id, [])) for row in results]
 
         # format first 100 task dates utc to est
         # this is to obtain 10x better response time
         num_tasks = min(len(tasks), 100)
         for i in range(num_tasks):
             format_current_page(tasks[i])
-        session.execute("RESET enable_indexscan;")
 
     return total_count, tasks
 
@@ -341,6 +344,49 @@ def select_available_tasks(task_rank_info, locked_tasks, user_id, num_tasks_need
     return result
 
 
+def browse_tasks_page(sql_select, filters, params, sort_keys, limit, offset,
+                      format_row):
+    """
+    Return a page of the task browse view for owners with keyset pagination.
+    When the tasks are sorted by a column of task indexed with the project
+    and the task id, the task ending the previous pages is read from the
+    index alone and the page seeks past it, instead of joining and discarding
+    offset tasks. Other sorts and filtered views fall back to OFFSET.
+    """
+    sql_order = ' ORDER BY {} '.format(', '.join(
+        '{} {}'.format(expr, 'DESC' if descending else 'ASC')
+        for expr, descending in sort_keys))
+    sql = sql_select + filters
+    seek_key = get_seek_key(sort_keys)
+    if not offset or filters or seek_key is None:
+        params = dict(params, limit=limit, offset=offset)
+        sql_query = sql + sql_order + " LIMIT :limit OFFSET :offset "
+        rows = session.execute(text(sql_query), params).fetchall()
+        return [format_row(row) for row in rows]
+
+    column, descending = seek_key
+    sql_boundary = text('''
+        SELECT task.id, {0} AS value FROM task
+        WHERE task.project_id=:project_id
+        ORDER BY {0} {1}, task.id {1}
+        LIMIT 1 OFFSET :offset'''.format(column, 'DESC' if descending else 'ASC'))
+    boundary = session.execute(sql_boundary, dict(project_id=params['project_id'],
+                                                  offset=offset - 1)).first()
+    if boundary is None:
+        return []
+
+    rows = []
+    params = dict(params, seek_id=boundary.id, seek_value=boundary.value)
+    for seek_filter, seek_order in get_seek_filters(column, descending,
+                                                    boundary.value):
+        params['limit'] = limit - len(rows)
+        sql_query = sql + seek_filter + seek_order + " LIMIT :limit "
+        rows.extend(session.execute(text(sql_query), params).fetchall())
+        if len(rows) == limit:
+            break
+    return [format_row(row) for row in rows]
+
+
 def task_count(project_id, args):
     """Return the count of tasks in a project matching the given filters."""
     filters, filter_params = get_task_filters(args)
@@ -350,9 +396,9 @@ def task_count(project_id, args):
                 (
                 SELECT task.id FROM task LEFT OUTER JOIN
                     (
-                    SELECT task_id, COUNT(id) AS ct,
-                    MAX(finish_time) as ft FROM task_run
-                    WHERE project_id=:project_id GROUP BY task_id
+                    SELECT task_id, n_task_runs AS ct,
+                    finish_time as ft FROM task_rollup
+                    WHERE project_id=:project_id
                     ) AS log_counts
                     ON task.id=log_counts.task_id
                     WHERE task.project_id=:project_id {}
@@ -458,7 +504,8 @@ def n_registered_volunteers(project_id):
                AS n_registered_volunteers FROM task_run
                WHERE task_run.user_id IS NOT NULL AND
                task_run.user_ip IS NULL AND
-               task_run.project_id=:project_id;''')
+               task_run.project_id=:project_id AND {};'''.format(
+                   PROJECT_TASK_IDS))
 
     results = session.execute(sql, dict(project_id=project_id))
     n_registered_volunteers = 0
@@ -474,7 +521,8 @@ def n_anonymous_volunteers(project_id):
                AS n_anonymous_volunteers FROM task_run
                WHERE task_run.user_ip IS NOT NULL AND
                task_run.user_id IS NULL AND
-               task_run.project_id=:project_id;''')
+               task_run.project_id=:project_id AND {};'''.format(
+                   PROJECT_TASK_IDS))
 
     results = session.execute(sql, dict(project_id=project_id))
     n_anonymous_volunteers = 0
@@ -495,7 +543,8 @@ def n_volunteers(project_id):
 def n_task_runs(project_id):
     """Return number of task_runs of a project."""
     sql = text('''SELECT COUNT(task_run.id) AS n_task_runs FROM task_run
-                  WHERE task_run.project_id=:project_id''')
+                  WHERE task_run.project_id=:project_id
+                  AND {}'''.format(PROJECT_TASK_IDS))
 
     results = session.execute(sql, dict(project_id=project_id))
     n_task_runs = 0
@@ -511,11 +560,12 @@ def n_remaining_task_runs(project_id):
                   FROM task
                   LEFT JOIN (SELECT task_id, COUNT(id) AS actual_answers
                              FROM task_run WHERE project_id=:project_id
+                             AND {}
                              GROUP BY task_id) AS t
                   ON task.id = t.task_id
                   WHERE task.project_id=:project_id
                   AND calibration = 0
-                  AND task.state = 'ongoing';''')
+                  AND task.state = 'ongoing';'''.format(PROJECT_TASK_IDS))
     return session.execute(sql, dict(project_id=project_id)).scalar() or 0
 
 
@@ -542,7 +592,8 @@ def overall_progress(project_id):
 def last_activity(project_id):
     """Return last activity, date, from a project."""
     sql = text('''SELECT finish_time FROM task_run WHERE project_id=:project_id
-               ORDER BY finish_time DESC LIMIT 1''')
+               AND {} ORDER BY finish_time DESC LIMIT 1'''.format(
+                   PROJECT_TASK_IDS))
 
     results = session.execute(sql, dict(project_id=project_id))
     for row in results:
@@ -558,7 +609,7 @@ def average_contribution_time(project_id):
         AVG(to_timestamp(finish_time, 'YYYY-MM-DD"T"HH24-MI-SS.US') -
             to_timestamp(created, 'YYYY-MM-DD"T"HH24-MI-SS.US')) AS average_time
         FROM task_run
-        WHERE project_id=:project_id;''')
+        WHERE project_id=:project_id AND {};'''.format(PROJECT_TASK_IDS))
 
     results = session.execute(sql, dict(project_id=project_id)).fetchall()
     for row in results:
@@ -596,7 +647,7 @@ def _n_featured():
 
 
 # This function does not change too much, so cache it for a longer time
-@memoize(timeout=timeouts.get('STATS_FRONTPAGE_TIMEOUT'))
+@memoize(timeout=timeouts.get('STATS_FRONTPAGE_TIMEOUT'), codec='msgpack')
 def get_all_featured(category=None):
     """Return a list of featured projects with a pagination."""
     sql = text(
@@ -719,7 +770,8 @@ def n_count(category):
     return count
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'), cache_group_keys=[[0]])
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), cache_group_keys=[[0]],
+         codec='msgpack')
 def get_all(category):
     """Return a list of published projects for a given category.
     """
@@ -869,7 +921,7 @@ def n_total_tasks():
     return n_total_tasks
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), local_timeout=ONE_MINUTE)
 def get_project_scheduler(project_id):
     """Return type of scheduler for a given project"""
     sql = text('''SELECT info->'sched' FROM project
@@ -879,7 +931,7 @@ def get_project_scheduler(project_id):
     return session.scalar(sql, dict(project_id=project_id)) or 'default'
 
 
-@memoize(timeout=timeouts.get('APP_TIMEOUT'))
+@memoize(timeout=timeouts.get('APP_TIMEOUT'), local_timeout=ONE_MINUTE)
 def get_project_data(project_id):
     """Return the short_name for a given project"""
     sql = text('''SELECT id, short_name, info, owners_ids FROM project
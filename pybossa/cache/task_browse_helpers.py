@@ -1,4 +1,5 @@
 from collections import defaultdict
+import heapq
 import json
 import operator
 import re
@@ -221,6 +222,99 @@ allowed_fields = {
 }
 
 
+def _split_order_by(order_by):
+    # split on the commas outside of parentheses and quoted strings
+    terms, depth, quoted, start = [], 0, False, 0
+    for i, char in enumerate(order_by):
+        if char == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and not depth:
+            terms.append(order_by[start:i])
+            start = i + 1
+    terms.append(order_by[start:])
+    return [term.strip() for term in terms if term.strip()]
+
+
+def get_sort_keys(order_by):
+    """
+    Return the (expression, descending) keys of an ORDER BY clause, ending
+    with the task id, in the direction of the last key, so that the order is
+    total. Returns None when the clause is not made of plain ascending or
+    descending keys.
+    """
+    keys = []
+    for term in _split_order_by(order_by):
+        parts = term.rsplit(None, 1)
+        if len(parts) != 2 or parts[1].lower() not in ('asc', 'desc'):
+            return None
+        keys.append((parts[0], parts[1].lower() == 'desc'))
+    if keys and not any(expr in ('id', 'task.id') for expr, _ in keys):
+        keys.append(('task.id', keys[-1][1]))
+    return keys
+
+
+# Sort expressions of the columns of task served by a
+# (project_id, column, id) index
+SEEK_COLUMNS = {
+    'id': 'task.id',
+    'task.id': 'task.id',
+    'priority_0': 'task.priority_0',
+    'task.priority_0': 'task.priority_0',
+    'task.created': 'task.created'
+}
+
+
+def get_seek_key(sort_keys):
+    """
+    Return the (column, descending) of a sort on a single column of task,
+    then on the task id in the same direction, which an index can seek in.
+    Returns None for any other sort.
+    """
+    if not sort_keys or len(sort_keys) > 2:
+        return None
+    column, descending = sort_keys[0]
+    column = SEEK_COLUMNS.get(column)
+    if column is None:
+        return None
+    if len(sort_keys) == 2 and (SEEK_COLUMNS.get(sort_keys[1][0]) != 'task.id' or
+                                sort_keys[1][1] != descending):
+        return None
+    return column, descending
+
+
+def get_seek_filters(column, descending, value):
+    """
+    Return the (condition, ORDER BY) pairs reading, one after the other, the
+    tasks sorted after the task with the given column value and the task id
+    bound to :seek_id. The value is bound to :seek_value. As postgres does,
+    NULLs sort after any value in ascending order and before any value in
+    descending order, and row value comparisons skip them.
+    """
+    direction = 'DESC' if descending else 'ASC'
+    by_column = ' ORDER BY {0} {1}, task.id {1} '.format(column, direction)
+    by_id = ' ORDER BY task.id {} '.format(direction)
+    after = '<' if descending else '>'
+    if column == 'task.id':
+        return [(' AND task.id {} :seek_id'.format(after), by_id)]
+    nulls = (' AND {} IS NULL AND task.id {} :seek_id'.format(column, after),
+             by_id)
+    if value is None:
+        if descending:
+            return [nulls, (' AND {} IS NOT NULL'.format(column), by_column)]
+        return [nulls]
+    values = (' AND ({}, task.id) {} (:seek_value, :seek_id)'.format(column, after),
+              by_column)
+    if descending:
+        return [values]
+    return [values, (' AND {} IS NULL'.format(column), by_id)]
+
+
 def parse_tasks_browse_args(args):
     """
     Parse querystring arguments
@@ -432,6 +526,60 @@ def get_task_preference_score(task_pref, user_profile):
     return score
 
 
+class TaskMatcher(object):
+    """
+    Evaluate the worker_filter and worker_pref of a batch of tasks against
+    a single user profile.
+
+    Candidate tasks usually share a handful of distinct filters and
+    preferences, so each distinct one is evaluated once and the outcome is
+    reused for every other task carrying it.
+    """
+
+    def __init__(self, user_profile):
+        self.user_profile = user_profile or {}
+        self._requirements = {}
+        self._scores = {}
+
+    @staticmethod
+    def _key(value):
+        return json.dumps(value, sort_keys=True, default=str)
+
+    def meets_requirement(self, task_id, user_filter):
+        if not user_filter:
+            return True
+        key = self._key(user_filter)
+        met = self._requirements.get(key)
+        if met is None:
+            met = user_meet_task_requirement(task_id, user_filter, self.user_profile)
+            self._requirements[key] = met
+        return met
+
+    def preference_score(self, task_pref):
+        if not task_pref:
+            return 0
+        key = self._key(task_pref)
+        score = self._scores.get(key)
+        if score is None:
+            score = get_task_preference_score(task_pref, self.user_profile)
+            self._scores[key] = score
+        return score
+
+    def rank(self, tasks, limit=None, score=True):
+        """
+        Return (item, score) for the tasks meeting the user requirements,
+        highest preference score first and in the given order for equal
+        scores. tasks is an iterable of (task_id, worker_filter, worker_pref,
+        item); only the top limit tasks are returned when limit is set.
+        """
+        eligible = [(item, self.preference_score(w_pref) if score else 0)
+                    for task_id, w_filter, w_pref, item in tasks
+                    if self.meets_requirement(task_id, w_filter)]
+        if limit is not None and limit < len(eligible):
+            return heapq.nlargest(limit, eligible, key=operator.itemgetter(1))
+        return sorted(eligible, key=operator.itemgetter(1), reverse=True)
+
+
 def get_user_fullname_from_email(email_addr):
     # search user by email address in local
     # cache users_emails_to_fullnames first
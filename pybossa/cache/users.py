@@ -20,7 +20,7 @@ from sqlalchemy.sql import text
 from sqlalchemy.exc import ProgrammingError
 from pybossa.core import db, timeouts
 from pybossa.cache import cache, memoize, delete_memoized, FIVE_MINUTES, \
-    ONE_DAY, ONE_WEEK, memoize_with_l2_cache
+    ONE_DAY, ONE_WEEK, ONE_MINUTE, memoize_with_l2_cache
 from pybossa.util import pretty_date, exists_materialized_view
 from pybossa.model.user import User
 from pybossa.cache.projects import overall_progress, n_tasks, n_volunteers
@@ -30,6 +30,7 @@ from pybossa.leaderboard.data import get_leaderboard as gl
 from pybossa.leaderboard.jobs import leaderboard as lb
 import json
 from pybossa.util import get_user_pref_db_clause, get_user_filter_db_clause, map_locations
+from pybossa.util import get_worker_pref_score_db_expr
 from pybossa.data_access import data_access_levels
 from pybossa.util import get_taskrun_date_range_sql_clause_params
 from flask import current_app
@@ -38,7 +39,7 @@ from pybossa.cache import ONE_HOUR
 session = db.slave_session
 
 
-@memoize_with_l2_cache(timeout=timeouts.get('USER_TIMEOUT'))
+@memoize_with_l2_cache(timeout=timeouts.get('USER_TIMEOUT'), codec='msgpack')
 def get_leaderboard(n, user_id=None, window=0, info=None):
     """Return the top n users with their rank."""
     try:
@@ -392,7 +393,8 @@ def delete_taskbrowse_bookmarks(user):
 
 def get_user_preferences(user_id):
     user = get_user_by_id(user_id)
-    user_pref = user.user_pref or {} if user else {}
+    # copied, as the cached user is shared with other callers
+    user_pref = dict(user.user_pref or {}) if user else {}
     user_email = user.email_addr if user else None
     if 'locations' in user_pref:
         map_locations_upref_mdata(user_pref)
@@ -405,7 +407,13 @@ def get_user_filters(user_id):
     return get_user_filter_db_clause(user_profile)
 
 
-@memoize(timeout=ONE_DAY)
+def get_worker_pref_score(user_id):
+    user_profile = get_user_profile_metadata(user_id)
+    user_profile = json.loads(user_profile) if user_profile else {}
+    return get_worker_pref_score_db_expr(user_profile)
+
+
+@memoize(timeout=ONE_DAY, local_timeout=ONE_MINUTE)
 def get_user_by_id(user_id):
     assert user_id is not None or user_id > 0
     user = User.query.get(user_id)
@@ -232,6 +232,8 @@ class BaseClientKeyAdapter:
         self.content_type = kwargs.get("ContentType")
         self.content_encoding = kwargs.get("ContentEncoding")
         self.content_language = kwargs.get("ContentLanguage")
+        self.size = kwargs.get("ContentLength")
+        self._body = kwargs.get("Body")
 
     def get_contents_as_string(self, encoding=None, **kwargs):  # pylint: disable=W0613
         """Returns contents as bytes or string, depending on encoding parameter.
@@ -246,6 +248,25 @@ class BaseClientKeyAdapter:
             bucket=self.bucket, path=self.name, encoding=encoding
         )
 
+    def get_range(self, byte_range):
+        """Returns the streaming body of the bytes in byte_range, e.g.
+        "bytes=0-", and sets the size of the key from the response.
+
+        The body of the GET made by get_key is reused for the whole key.
+        """
+        if byte_range == "bytes=0-" and self._body is not None:
+            body, self._body = self._body, None
+            return body
+        response = self.base_client.get_key(
+            self.bucket, self.name, Range=byte_range
+        )
+        content_range = response.get("ContentRange")
+        if content_range:
+            self.size = int(content_range.split("/")[-1])
+        else:
+            self.size = response.get("ContentLength")
+        return response["Body"]
+
     def set_contents_from_string(self, content, **kwargs):
         self.base_client.set_contents(
             bucket=self.bucket, path=self.name, content=content, **kwargs
@@ -1,6 +1,9 @@
+from collections import defaultdict
 from copy import deepcopy
+import os
 import ssl
 import sys
+import threading
 import time
 
 from flask import current_app
@@ -57,7 +60,10 @@ def create_connection(**kwargs):
             aws_secret_access_key=kwargs.get("aws_secret_access_key"),
             endpoint=kwargs.get("endpoint"),
             cert=kwargs.get("cert", False),
-            proxy_url=kwargs.get("proxy_url")
+            proxy_url=kwargs.get("proxy_url"),
+            max_pool_connections=kwargs.get(
+                "max_pool_connections",
+                current_app.config.get("S3_MAX_POOL_CONNECTIONS"))
         )
     if 'object_service' in kwargs:
         current_app.logger.info("Calling ProxiedConnection")
@@ -68,6 +74,67 @@ def create_connection(**kwargs):
     return conn
 
 
+class ConnectionRegistry(object):
+    """Connections to the object stores, created once per conn_name and
+    reused so that their pools keep warm connections.
+
+    boto3 clients are thread safe and shared by the threads of a process,
+    while boto connections are kept per thread. The registry starts over in
+    a forked process, e.g. an RQ work horse, so that it never shares the
+    sockets of its parent.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._pid = os.getpid()
+            self._shared = {}
+            self._local = threading.local()
+            self._stats = defaultdict(lambda: dict(created=0, reused=0))
+
+    def _connections(self):
+        if self._pid != os.getpid():
+            self.clear()
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._shared, self._local.connections
+
+    def get(self, conn_name, conn_kwargs, create=None):
+        """Return the connection of conn_name, created with create (by
+        default create_connection) from conn_kwargs when there is none yet or
+        when conn_kwargs changed."""
+        fingerprint = repr(sorted(conn_kwargs.items()))
+        shared, local = self._connections()
+        for connections in (shared, local):
+            cached = connections.get(conn_name)
+            if cached and cached[0] == fingerprint:
+                with self._lock:
+                    self._stats[conn_name]['reused'] += 1
+                return cached[1]
+
+        conn = (create or create_connection)(**conn_kwargs)
+        connections = shared if isinstance(conn, CustomConnectionV2) else local
+        with self._lock:
+            connections[conn_name] = (fingerprint, conn)
+            self._stats[conn_name]['created'] += 1
+        return conn
+
+    def stats(self):
+        """Return, by conn_name, the number of connections created and
+        reused by this process and the use of the pools of its boto3
+        client: the connections checked out, the connections opened and the
+        size of each pool."""
+        shared, _ = self._connections()
+        with self._lock:
+            stats = {name: dict(stat) for name, stat in self._stats.items()}
+        for conn_name, (_, conn) in list(shared.items()):
+            stats[conn_name]['pools'] = conn.pool_stats()
+        return stats
+
+
 class CustomProvider(Provider):
     """Extend Provider to carry information about the end service provider, in
        case the service is being proxied.
@@ -120,7 +187,8 @@ class CustomConnectionV2(BaseConnection):
         aws_secret_access_key,
         endpoint,
         cert,
-        proxy_url
+        proxy_url,
+        max_pool_connections=None
     ):
         self.client = Session().client(
             service_name="s3",
@@ -131,10 +199,34 @@ class CustomConnectionV2(BaseConnection):
             endpoint_url=endpoint,
             config=Config(
                 proxies={"https": proxy_url, "http": proxy_url},
+                max_pool_connections=max_pool_connections or 10,
+                tcp_keepalive=True,
             ),
         )
 
 
+    def pool_stats(self):
+        try:
+            http_session = self.client._endpoint.http_session
+            managers = [http_session._manager]
+            managers.extend(http_session._proxy_managers.values())
+        except AttributeError:
+            return []
+        stats = []
+        for manager in managers:
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                stats.append(dict(host=pool.host, size=pool.pool.maxsize,
+                                  in_use=pool.pool.maxsize - pool.pool.qsize(),
+                                  opened=pool.num_connections))
+        return stats
+
+
+connections = ConnectionRegistry()
+
+
 class CustomBucket(Bucket):
     """Handle both 200 and 204 as response code"""
 
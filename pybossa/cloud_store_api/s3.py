@@ -1,6 +1,7 @@
 import io
 import os
 import re
+from itertools import chain
 from tempfile import NamedTemporaryFile
 from urllib.parse import urlparse
 import boto
@@ -8,8 +9,10 @@ from flask import current_app as app
 from werkzeug.utils import secure_filename
 import magic
 from werkzeug.exceptions import BadRequest
-from pybossa.cloud_store_api.connection import create_connection
-from pybossa.encryption import AESWithGCM
+from pybossa.cloud_store_api.base_conn import BaseClientKeyAdapter
+from pybossa.cloud_store_api.connection import create_connection, connections
+from pybossa.encryption import AESWithGCM, SEGMENTED_HEADER, SegmentedReader, \
+    is_segmented
 import json
 from time import perf_counter
 import time
@@ -40,6 +43,14 @@ allowed_mime_types = ['application/pdf',
 
 
 DEFAULT_CONN = 'S3_DEFAULT'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def get_connection(conn_name=DEFAULT_CONN):
+    """Return the connection configured by conn_name, reused by the later
+    calls of the process."""
+    conn_kwargs = app.config.get(conn_name, {})
+    return connections.get(conn_name, conn_kwargs, create_connection)
 
 
 def check_type(filename):
@@ -121,7 +132,11 @@ def s3_upload_tmp_file(s3_bucket, tmp_file, filename,
         if with_encryption:
             secret = app.config.get('FILE_ENCRYPTION_KEY')
             cipher = AESWithGCM(secret)
-            content = cipher.encrypt(content)
+            segment_size = app.config.get('ENCRYPTED_FILE_SEGMENT_SIZE')
+            if segment_size:
+                content = cipher.encrypt_segmented(content, segment_size)
+            else:
+                content = cipher.encrypt(content)
 
         # make sure content is a bytes string
         if type(content) == str:
@@ -164,8 +179,7 @@ def s3_upload_file(s3_bucket, source_file, target_file_name,
     """
     filename = secure_filename(target_file_name)
     upload_key = form_upload_directory(directory, filename, upload_root_dir)
-    conn_kwargs = app.config.get(conn_name, {})
-    conn = create_connection(**conn_kwargs)
+    conn = get_connection(conn_name)
     bucket = conn.get_bucket(s3_bucket, validate=False)
 
     assert(len(upload_key) < 256)
@@ -182,8 +196,7 @@ def s3_upload_file(s3_bucket, source_file, target_file_name,
 
 
 def get_s3_bucket_key(s3_bucket, s3_url, conn_name=DEFAULT_CONN):
-    conn_kwargs = app.config.get(conn_name, {})
-    conn = create_connection(**conn_kwargs)
+    conn = get_connection(conn_name)
     bucket = conn.get_bucket(s3_bucket, validate=False)
     obj = urlparse(s3_url)
     path = obj.path
@@ -229,6 +242,88 @@ def get_content_and_key_from_s3(s3_bucket, path, conn_name=DEFAULT_CONN,
     return content, key
 
 
+def iter_key_range(key, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield the bytes start to end, end included, of a key as they are
+    downloaded. The size of the key is set once the first chunk is read.
+    """
+    byte_range = 'bytes={}-{}'.format(start, '' if end is None else end)
+    if isinstance(key, BaseClientKeyAdapter):
+        body = key.get_range(byte_range)
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+        finally:
+            body.close()
+        return
+    key.open_read(headers={'Range': byte_range})
+    try:
+        data = key.read(chunk_size)
+        while data:
+            yield data
+            data = key.read(chunk_size)
+    finally:
+        key.close(fast=True)
+
+
+class DecryptedKeyStream(object):
+
+    """
+    Decrypted content of an encrypted key, read while it is downloaded.
+
+    Content encrypted in segments is only downloaded and decrypted for the
+    range being read, one segment at a time. Content in the legacy format is
+    downloaded and decrypted at once. The download starts when the stream is
+    created, so errors of the object store are raised by the constructor.
+    """
+
+    def __init__(self, key, secret, chunk_size=STREAM_CHUNK_SIZE):
+        self.key = key
+        self.chunk_size = chunk_size
+        self.cipher = AESWithGCM(secret)
+        self.reader = None
+        self._chunks = iter_key_range(key, chunk_size=chunk_size)
+        head = b''
+        for chunk in self._chunks:
+            head += chunk
+            if len(head) >= SEGMENTED_HEADER.size:
+                break
+        self._head = head
+        if is_segmented(head):
+            self.reader = SegmentedReader(self.cipher, head, key.size)
+            self.size = self.reader.size
+        else:
+            content = self.cipher.decrypt(head + b''.join(self._chunks))
+            if type(content) == str:
+                content = content.encode()
+            self._content = content
+            self.size = len(content)
+
+    def iter_range(self, start=0, stop=None):
+        """Yield the decrypted bytes start to stop, stop excluded."""
+        stop = self.size if stop is None else stop
+        if self.reader is None:
+            yield self._content[start:stop]
+            return
+        offset, end = self.reader.encrypted_range(start, stop)
+        if offset == self.reader.header_length:
+            # keep reading the download started by the constructor
+            chunks = chain([self._head[offset:]], self._chunks)
+        else:
+            self.close()
+            self._chunks = iter_key_range(self.key, offset, end - 1,
+                                          self.chunk_size)
+            chunks = self._chunks
+        try:
+            for data in self.reader.decrypt(chunks, start, stop):
+                yield data
+        finally:
+            self.close()
+
+    def close(self):
+        self._chunks.close()
+
+
 def get_content_from_s3(s3_bucket, path, conn_name=DEFAULT_CONN, decrypt=False):
     return get_content_and_key_from_s3(s3_bucket, path, conn_name, decrypt)[0]
 
@@ -272,8 +367,7 @@ def upload_email_attachment(content, filename, user_email, project_id=None):
     if not bucket_name:
         raise RuntimeError("S3_REQUEST_BUCKET_V2 is not configured")
 
-    conn_kwargs = app.config.get(conn_name, {})
-    conn = create_connection(**conn_kwargs)
+    conn = get_connection(conn_name)
     bucket = conn.get_bucket(bucket_name, validate=False)
 
     # Generate a unique file path using UTC timestamp and secure filename
@@ -71,6 +71,14 @@ class ContributionsGuard(object):
         key = self._create_presented_time_key(task, user)
         self.conn.setex(key, self.STAMP_TTL, make_timestamp())
 
+    def prefetch_presented_timestamps(self, tasks, user):
+        """Queue the reads of the presented times of tasks, when the
+        connection is a request batch (see pybossa.redis_batch)."""
+        if not hasattr(self.conn, 'prefetch'):
+            return
+        for task in tasks:
+            self.conn.prefetch('get', self._create_presented_time_key(task, user))
+
     def check_task_presented_timestamp(self, task, user):
         """Check if a task was presented to a user."""
         key = self._create_presented_time_key(task, user)
@@ -98,7 +106,7 @@ class ContributionsGuard(object):
         if task_presented is not None:
             return self.conn.expire(key, self.STAMP_TTL)
         else:
-            return self.conn.setEx(key, self.STAMP_TTL, make_timestamp())
+            return self.conn.setex(key, self.STAMP_TTL, make_timestamp())
 
     def _create_cancelled_time_key(self, task, user):
         """Create a Redis key for the time when task is
@@ -96,6 +96,10 @@ def create_app(run_as_server=True):
     setup_profiler(app)
     plugin_manager.init_app(app)
     plugin_manager.install_plugins()
+    # tables only written with SQL, registered for db.create_all
+    import pybossa.model.task_rollup
+    import pybossa.model.project_stats_hourly
+    import pybossa.model.project_stats_contributor
     import pybossa.model.event_listeners
     anonymizer.init_app(app)
     setup_task_presenter_editor(app)
@@ -674,6 +678,20 @@ def setup_hooks(app):
             h.add('X-RateLimit-Reset', str(limit.reset))
         return response
 
+    @app.after_request
+    def _flush_redis_batches(response):
+        """Send the Redis commands still queued and report the number of
+        Redis round trips made by the request. The queued writes are best
+        effort: a Redis error sending them is logged, not raised."""
+        from pybossa.redis_batch import flush_batches
+        flush_batches()
+        round_trips = g.get('redis_round_trips', 0)
+        app.logger.debug('%s %s: %d Redis round trips', request.method,
+                         request.path, round_trips)
+        if app.config.get('REDIS_ROUND_TRIPS_HEADER'):
+            response.headers['X-Redis-Round-Trips'] = str(round_trips)
+        return response
+
     @app.before_request
     def _api_authentication():
         """ Attempt API authentication on a per-request basis."""
@@ -18,6 +18,10 @@
 """Dashboard Jobs module for running background tasks in PYBOSSA server."""
 from sqlalchemy import text
 from pybossa.core import db
+from pybossa.model import native_timestamps
+
+# First day of the last week, matching TO_DATE(column) >= NOW() - 1 week
+WEEK_START = "CAST(NOW() - ('1 week')::INTERVAL AS DATE) + 1"
 
 
 def _exists_materialized_view(view):
@@ -41,23 +45,48 @@ def _refresh_materialized_view(view):
     return "Materialized view refreshed"
 
 
+def _last_week(table, column):
+    """Return the day of a TEXT timestamp column of table and the condition
+    selecting the rows of the last week, on its native copy if read."""
+    if native_timestamps.enabled():
+        native = '{}.{}_ts'.format(table, column)
+        return ('CAST({} AS DATE)'.format(native),
+                '{} >= {}'.format(native, WEEK_START))
+    day = r"TO_DATE({}.{}, 'YYYY-MM-DD\THH24:MI:SS.US')".format(table, column)
+    return day, "{} >= NOW() - ('1 week')::INTERVAL".format(day)
+
+
+def _exists_current_materialized_view(view, column):
+    """Return whether a view exists. A view not reading the native copy of
+    column while native timestamps are read, or the other way round, is
+    dropped first so that it is created again."""
+    sql = text('''SELECT definition FROM pg_matviews
+               WHERE schemaname = current_schema() AND matviewname = :view''')
+    definition = db.session.execute(sql, dict(view=view)).scalar()
+    if definition and \
+            ('{}_ts'.format(column) in definition) != native_timestamps.enabled():
+        db.session.execute(text('DROP MATERIALIZED VIEW %s' % view))
+        db.session.commit()
+        return False
+    return _exists_materialized_view(view)
+
+
 def active_users_week():
     """Create or update active users last week materialized view."""
-    if _exists_materialized_view('dashboard_week_users'):
+    if _exists_current_materialized_view('dashboard_week_users', 'finish_time'):
         return _refresh_materialized_view('dashboard_week_users')
     else:
-        sql = text(r'''CREATE MATERIALIZED VIEW dashboard_week_users AS
+        day, last_week = _last_week('task_run', 'finish_time')
+        sql = text('''CREATE MATERIALIZED VIEW dashboard_week_users AS
                    WITH crafters_per_day AS
-                        (select to_date(task_run.finish_time,
-                                        'YYYY-MM-DD\THH24:MI:SS.US') AS day,
+                        (select {} AS day,
                                 user_id, COUNT(task_run.user_id) AS day_crafters
                         FROM task_run
-                        WHERE to_date(task_run.finish_time,
-                                      'YYYY-MM-DD\THH24:MI:SS.US')
-                            >= NOW() - ('1 week'):: INTERVAL
+                        WHERE {}
                         GROUP BY day, task_run.user_id)
                    SELECT day, COUNT(crafters_per_day.user_id) AS n_users
-                   FROM crafters_per_day GROUP BY day ORDER BY day;''')
+                   FROM crafters_per_day GROUP BY day ORDER BY day;'''
+                   .format(day, last_week))
         db.session.execute(sql)
         db.session.commit()
         return "Materialized view created"
@@ -65,21 +94,20 @@ def active_users_week():
 
 def active_anon_week():
     """Create or update active anon last week materialized view."""
-    if _exists_materialized_view('dashboard_week_anon'):
+    if _exists_current_materialized_view('dashboard_week_anon', 'finish_time'):
         return _refresh_materialized_view('dashboard_week_anon')
     else:
-        sql = text(r'''CREATE MATERIALIZED VIEW dashboard_week_anon AS
+        day, last_week = _last_week('task_run', 'finish_time')
+        sql = text('''CREATE MATERIALIZED VIEW dashboard_week_anon AS
                    WITH crafters_per_day AS
-                        (select to_date(task_run.finish_time,
-                                        'YYYY-MM-DD\THH24:MI:SS.US') AS day,
+                        (select {} AS day,
                                 user_ip, COUNT(task_run.user_ip) AS day_crafters
                         FROM task_run
-                        WHERE to_date(task_run.finish_time,
-                                      'YYYY-MM-DD\THH24:MI:SS.US')
-                            >= NOW() - ('1 week'):: INTERVAL
+                        WHERE {}
                         GROUP BY day, task_run.user_ip)
                    SELECT day, COUNT(crafters_per_day.user_ip) AS n_users
-                   FROM crafters_per_day GROUP BY day ORDER BY day;''')
+                   FROM crafters_per_day GROUP BY day ORDER BY day;'''
+                   .format(day, last_week))
         db.session.execute(sql)
         db.session.commit()
         return "Materialized view created"
@@ -154,17 +182,15 @@ def update_projects_week():
 
 def new_tasks_week():
     """Create or update new tasks last week materialized view."""
-    if _exists_materialized_view('dashboard_week_new_task'):
+    if _exists_current_materialized_view('dashboard_week_new_task', 'created'):
         return _refresh_materialized_view('dashboard_week_new_task')
     else:
-        sql = text(r'''CREATE MATERIALIZED VIEW dashboard_week_new_task AS
-                      SELECT TO_DATE(task.created,
-                                     'YYYY-MM-DD\THH24:MI:SS.US') AS day,
+        day, last_week = _last_week('task', 'created')
+        sql = text('''CREATE MATERIALIZED VIEW dashboard_week_new_task AS
+                      SELECT {} AS day,
                       COUNT(task.id) AS day_tasks
-                      FROM task WHERE TO_DATE(task.created,
-                                              'YYYY-MM-DD\THH24:MI:SS.US')
-                                          >= now() - ('1 week'):: INTERVAL
-                      GROUP BY day ORDER BY day ASC;''')
+                      FROM task WHERE {}
+                      GROUP BY day ORDER BY day ASC;'''.format(day, last_week))
         db.session.execute(sql)
         db.session.commit()
         return "Materialized view created"
@@ -172,17 +198,15 @@ def new_tasks_week():
 
 def new_task_runs_week():
     """Create or update new task_runs last week materialized view."""
-    if _exists_materialized_view('dashboard_week_new_task_run'):
+    if _exists_current_materialized_view('dashboard_week_new_task_run', 'finish_time'):
         return _refresh_materialized_view('dashboard_week_new_task_run')
     else:
-        sql = text(r'''CREATE MATERIALIZED VIEW dashboard_week_new_task_run AS
-                      SELECT TO_DATE(task_run.finish_time,
-                                     'YYYY-MM-DD\THH24:MI:SS.US') AS day,
+        day, last_week = _last_week('task_run', 'finish_time')
+        sql = text('''CREATE MATERIALIZED VIEW dashboard_week_new_task_run AS
+                      SELECT {} AS day,
                       COUNT(task_run.id) AS day_task_runs
-                      FROM task_run WHERE TO_DATE(task_run.finish_time,
-                                              'YYYY-MM-DD\THH24:MI:SS.US')
-                                          >= now() - ('1 week'):: INTERVAL
-                      GROUP BY day;''')
+                      FROM task_run WHERE {}
+                      GROUP BY day;'''.format(day, last_week))
         db.session.execute(sql)
         db.session.commit()
         return "Materialized view created"
@@ -209,21 +233,19 @@ def new_users_week():
 
 def returning_users_week():
     """Create or update returning users last week materialized view."""
-    if _exists_materialized_view('dashboard_week_returning_users'):
+    if _exists_current_materialized_view('dashboard_week_returning_users', 'finish_time'):
         return _refresh_materialized_view('dashboard_week_returning_users')
     else:
-        sql = text(r'''CREATE MATERIALIZED VIEW dashboard_week_returning_users AS
+        day, last_week = _last_week('task_run', 'finish_time')
+        sql = text('''CREATE MATERIALIZED VIEW dashboard_week_returning_users AS
                    WITH data AS (
-                    SELECT user_id, TO_DATE(task_run.finish_time,
-                    'YYYY-MM-DD\THH24:MI:SS.US') AS day
+                    SELECT user_id, {} AS day
                    FROM task_run
-                   WHERE TO_DATE(task_run.finish_time,
-                   'YYYY-MM-DD\THH24:MI:SS.US') >= NOW()
-                   - ('1 week')::INTERVAL GROUP BY day, task_run.user_id)
+                   WHERE {} GROUP BY day, task_run.user_id)
                    SELECT user_id, COUNT(user_id) AS n_days
                    FROM data GROUP BY user_id HAVING(count(user_id) > 1)
                    ORDER by n_days;
-                      ''')
+                      '''.format(day, last_week))
         db.session.execute(sql)
         db.session.commit()
         return "Materialized view created"
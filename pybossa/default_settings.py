@@ -155,6 +155,21 @@ UNPUBLISH_PROJECTS = True
 # TTL for ZIP files of personal data
 TTL_ZIP_SEC_FILES = 3
 
+# Tasks inserted per batch by the task importers
+IMPORT_BATCH_SIZE = 1000
+
+# Rows fetched per round trip from the server side cursor of an export
+EXPORT_YIELD_PER = 1000
+
+# Exports with more rows are split into shards of this size, run in parallel.
+# Only once EXPORT_CHUNK_FOLDER is set
+EXPORT_SHARD_SIZE = 250000
+# Times a failed export shard is retried
+EXPORT_SHARD_RETRIES = 3
+# Folder of the export shard chunks, shared by every host running export
+# workers (e.g. a network mount). Exports are not sharded without it
+EXPORT_CHUNK_FOLDER = None
+
 # Default cryptopan key
 CRYPTOPAN_KEY = '32-char-str-for-AES-key-and-pad.'
 
@@ -167,4 +182,52 @@ SPAM = []
 # Task routing batch size
 DB_MAXIMUM_BATCH_SIZE = 10000
 
+# Number of candidate tasks tried per lock acquisition round trip
+LOCK_CANDIDATES_BATCH_SIZE = 100
+
+# Report the Redis round trips of each request in an X-Redis-Round-Trips header
+REDIS_ROUND_TRIPS_HEADER = False
+
+# Seconds the decrypted gold answers of a task are cached, encrypted, in Redis
+GOLD_ANSWERS_CACHE_TIMEOUT = 60 * 60
+
+# Default codec of the cached values ('pickle' or 'msgpack'). Values are
+# written as plain pickles, readable by older releases, while it is None
+CACHE_CODEC = None
+# Compression of the cached values larger than CACHE_COMPRESSION_MIN_SIZE
+# bytes: None, 'zlib', or 'zstd' and 'lz4' when installed
+CACHE_COMPRESSION = None
+CACHE_COMPRESSION_MIN_SIZE = 16 * 1024
+
+# Seconds over which the feed, webhook and notification side effects of task
+# runs are batched per project and run on a worker; None runs them inline
+TASKRUN_EVENTS_WINDOW = None
+# Serve the locked scheduler from a per project Redis queue of available tasks
+AVAILABLE_TASKS_QUEUE = False
+# Seconds after which a project queue is rebuilt from the database
+AVAILABLE_TASKS_RECONCILE_INTERVAL = 60 * 60
+# Queue pages read per request before falling back to the database
+AVAILABLE_TASKS_MAX_PAGES = 10
+
+# Connections each boto3 object store client keeps alive. A client is shared
+# by the threads of a process, so size it to the threads of a worker
+S3_MAX_POOL_CONNECTIONS = 10
+# Plaintext bytes per segment of the encrypted files uploaded in the segmented
+# format, which the file proxy streams and serves ranges of. None uploads them
+# in the legacy format, readable by releases without segmented support
+ENCRYPTED_FILE_SEGMENT_SIZE = None
+
+# Read the native TIMESTAMP copies of task.created, task_run.created and
+# task_run.finish_time in range queries and orderings. Only set it once
+# `python cli.py backfill_native_timestamps` has run
+NATIVE_TIMESTAMPS = False
+
+# task_run is partitioned by ranges of TASK_RUN_PARTITION_SIZE task ids. The
+# maintenance queue keeps TASK_RUN_PARTITIONS_AHEAD of them past the last task
+TASK_RUN_PARTITION_SIZE = 1000000
+TASK_RUN_PARTITIONS_AHEAD = 2
+
+# Maximum number of tasks a project can lock at once for a user (prefetch_tasks)
+MAX_PREFETCH_TASKS = 10
+
 PVF_FORMAT = r"^([A-Z]{1,8}\s\d+)?$"
@@ -1,11 +1,21 @@
 import base64
 from hashlib import sha256
 import os
+import struct
 
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 import six
 
+# Segmented format: a header made of SEGMENTED_MAGIC, the format version, the
+# segment size and a nonce prefix, followed by the segments. Legacy content is
+# base64 encoded, so it never starts with the NUL byte of SEGMENTED_MAGIC
+SEGMENTED_MAGIC = b'\x00PBE'
+SEGMENTED_VERSION = 1
+SEGMENTED_HEADER = struct.Struct('>4sBI7s')
+SEGMENT_TAG_LENGTH = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+
 
 class AESWithGCM(object):
 
@@ -61,6 +71,34 @@ class AESWithGCM(object):
         encrypted = six.int2byte(self.iv_length) + iv + ct + tag
         return base64.b64encode(encrypted).decode()
 
+    def encrypt_segmented(self, string, segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        @param string: a byte string to encrypt
+        @param segment_size: the number of plaintext bytes of a segment
+        Returns a byte string
+
+        The plaintext is split in segments encrypted on their own and followed
+        by their tag, so a range of the content can be decrypted without
+        reading the rest. The IV of a segment is the nonce prefix of the
+        header, the index of the segment and whether it is the last one, so
+        segments cannot be reordered or dropped without failing decryption.
+        """
+        if type(string) == str:
+            string = string.encode()
+        nonce_prefix = os.urandom(7)
+        header = SEGMENTED_HEADER.pack(SEGMENTED_MAGIC, SEGMENTED_VERSION,
+                                       segment_size, nonce_prefix)
+        count = max(1, -(-len(string) // segment_size))
+        encrypted = [header]
+        for index in range(count):
+            segment = string[index * segment_size:(index + 1) * segment_size]
+            iv = segment_iv(nonce_prefix, index, index == count - 1)
+            encryptor = self.get_cipher(iv).encryptor()
+            encryptor.authenticate_additional_data(header)
+            encrypted.append(encryptor.update(segment) + encryptor.finalize() +
+                             encryptor.tag)
+        return b''.join(encrypted)
+
     def _split_ciphertext(self, string):
         """
         @param string: a byte string
@@ -75,18 +113,114 @@ class AESWithGCM(object):
 
     def decrypt(self, string):
         '''
-        @param string: expected to be base64 encoded.
+        @param string: expected to be base64 encoded, or the byte string
+            returned by encrypt_segmented.
         Return a unicode string
 
         The idea to return unicode string is to keep all text in the program as
         Unicode. Reference: https://nedbatchelder.com/text/unipain.html
         '''
-        decoded = base64.b64decode(string)
-        iv, ciphertext, tag = self._split_ciphertext(decoded)
-        decryptor = self.get_cipher(iv, tag).decryptor()
-        decrypted = decryptor.update(ciphertext) + decryptor.finalize()
+        if is_segmented(string):
+            reader = SegmentedReader(self, string, len(string))
+            decrypted = b''.join(reader.decrypt(
+                [string[reader.header_length:]], 0, reader.size))
+        else:
+            decoded = base64.b64decode(string)
+            iv, ciphertext, tag = self._split_ciphertext(decoded)
+            decryptor = self.get_cipher(iv, tag).decryptor()
+            decrypted = decryptor.update(ciphertext) + decryptor.finalize()
         try:
             decrypted = decrypted.decode()
         except (UnicodeDecodeError, AttributeError) as e:
             pass
         return decrypted
+
+
+def segment_iv(nonce_prefix, index, last):
+    return nonce_prefix + struct.pack('>IB', index, last)
+
+
+def is_segmented(string):
+    """Return whether string starts like content encrypted in segments."""
+    return isinstance(string, bytes) and string.startswith(SEGMENTED_MAGIC)
+
+
+class SegmentedReader(object):
+
+    def __init__(self, cipher, header, size):
+        """
+        Decrypt ranges of content written by AESWithGCM.encrypt_segmented.
+
+        @param cipher: the AESWithGCM the content was encrypted with
+        @param header: the first bytes of the encrypted content
+        @param size: the length of the encrypted content
+        """
+        self.header_length = SEGMENTED_HEADER.size
+        if len(header) < self.header_length:
+            raise ValueError('Truncated segmented content')
+        self.header = header[:self.header_length]
+        magic, version, self.segment_size, self.nonce_prefix = \
+            SEGMENTED_HEADER.unpack(self.header)
+        if magic != SEGMENTED_MAGIC:
+            raise ValueError('Not a segmented content')
+        if version != SEGMENTED_VERSION:
+            raise ValueError('Unknown segmented format version %d' % version)
+        self.cipher = cipher
+        self.encrypted_size = size
+        self.stored_segment_size = self.segment_size + SEGMENT_TAG_LENGTH
+        body = size - self.header_length
+        self.segments = max(1, -(-body // self.stored_segment_size))
+        self.size = body - self.segments * SEGMENT_TAG_LENGTH
+        if self.size < 0:
+            raise ValueError('Truncated segmented content')
+
+    def encrypted_range(self, start, stop):
+        """
+        Return the offsets, start included and stop excluded, of the
+        encrypted segments holding the plaintext bytes start to stop.
+        """
+        first = start // self.segment_size
+        last = max(first, (stop - 1) // self.segment_size)
+        return (self.header_length + first * self.stored_segment_size,
+                min(self.encrypted_size,
+                    self.header_length + (last + 1) * self.stored_segment_size))
+
+    def decrypt_segment(self, index, segment):
+        """Decrypt and authenticate one encrypted segment with its tag."""
+        iv = segment_iv(self.nonce_prefix, index, index == self.segments - 1)
+        tag = segment[-SEGMENT_TAG_LENGTH:]
+        decryptor = self.cipher.get_cipher(iv, tag).decryptor()
+        decryptor.authenticate_additional_data(self.header)
+        return (decryptor.update(segment[:-SEGMENT_TAG_LENGTH]) +
+                decryptor.finalize())
+
+    def decrypt(self, chunks, start, stop):
+        """
+        Yield the plaintext bytes start to stop, stop excluded, one segment at
+        a time. Every segment is authenticated before any of its bytes is
+        returned. chunks are the encrypted bytes from the offset returned by
+        encrypted_range, in pieces of any size.
+        """
+        index = start // self.segment_size
+        skip = start - index * self.segment_size
+        remaining = stop - start
+        buffer = bytearray()
+        chunks = iter(chunks)
+        while True:
+            length = min(self.stored_segment_size,
+                         self.encrypted_size - self.header_length -
+                         index * self.stored_segment_size)
+            while len(buffer) < length:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError('Truncated segmented content')
+                buffer += chunk
+            data = self.decrypt_segment(index, bytes(buffer[:length]))
+            del buffer[:length]
+            data = data[skip:skip + remaining]
+            yield data
+            remaining -= len(data)
+            if remaining <= 0:
+                return
+            skip = 0
+            index += 1
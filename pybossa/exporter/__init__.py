@@ -20,8 +20,8 @@
 Exporter module for exporting tasks and tasks results out of PYBOSSA
 """
 
-import copy
 import os
+import pickle
 import tempfile
 import zipfile
 from contextlib import closing, contextmanager
@@ -53,8 +53,15 @@ class Exporter(object):
 
     def _get_data(self, table, project_id, flat=False, info_only=False):
         """Get the data for a given table."""
+        return list(self._gen_data(table, project_id, flat, info_only))
+
+    def _gen_data(self, table, project_id, flat=False, info_only=False):
+        """Yield the rows of a given table, fetching them from the database
+        in batches of EXPORT_YIELD_PER."""
         repo, query = self.repositories[table]
-        data = getattr(repo, query)(project_id=project_id)
+        data = getattr(repo, query)(
+            project_id=project_id, yielded=True,
+            yield_per=current_app.config.get('EXPORT_YIELD_PER'))
         ignore_keys = current_app.config.get('IGNORE_FLAT_KEYS') or []
         if table == 'task':
             csv_export_key = current_app.config.get('TASK_CSV_EXPORT_INFO_KEY')
@@ -62,57 +69,65 @@ class Exporter(object):
             csv_export_key = current_app.config.get('TASK_RUN_CSV_EXPORT_INFO_KEY')
         if table == 'result':
             csv_export_key = current_app.config.get('RESULT_CSV_EXPORT_INFO_KEY')
-        if info_only:
-            if flat:
-                tmp = []
-                for row in data:
-                    inf = copy.deepcopy(row.dictize()['info'])
-                    if inf and type(inf) == dict and csv_export_key and inf.get(csv_export_key):
-                        inf = inf[csv_export_key]
-                    new_key = '%s_id' % table
-                    if inf and type(inf) == dict:
-                        inf[new_key] = row.id
-                        tmp.append(flatten(inf,
-                                           root_keys_to_ignore=ignore_keys))
-                    elif inf and type(inf) == list:
-                        for datum in inf:
-                            if type(datum) == dict:
-                                datum[new_key] = row.id
-                                tmp.append(flatten(datum,
-                                                   root_keys_to_ignore=ignore_keys))
-            else:
-                tmp = []
-                for row in data:
-                    if row.dictize()['info']:
-                        tmp.append(row.dictize()['info'])
-                    else:
-                        tmp.append({})
-        else:
-            if flat:
-                tmp = []
-                for row in data:
-                    cleaned = row.dictize()
-                    fav_user_ids = None
-                    task_run_ids = None
-                    if cleaned.get('fav_user_ids'):
-                        fav_user_ids = cleaned['fav_user_ids']
-                        cleaned.pop('fav_user_ids')
-                    if cleaned.get('task_run_ids'):
-                        task_run_ids = cleaned['task_run_ids']
-                        cleaned.pop('task_run_ids')
-
-                    cleaned = flatten(cleaned,
-                                      root_keys_to_ignore=ignore_keys)
-
-                    if fav_user_ids:
-                        cleaned['fav_user_ids'] = fav_user_ids
-                    if task_run_ids:
-                        cleaned['task_run_ids'] = task_run_ids
-
-                    tmp.append(cleaned)
+        for row in data:
+            if info_only:
+                inf = row.dictize()['info']
+                if not flat:
+                    yield inf or {}
+                    continue
+                if inf and type(inf) == dict and csv_export_key and inf.get(csv_export_key):
+                    inf = inf[csv_export_key]
+                new_key = '%s_id' % table
+                # Copy before tagging with the row id, info belongs to the
+                # session object.
+                if inf and type(inf) == dict:
+                    yield flatten(dict(inf, **{new_key: row.id}),
+                                  root_keys_to_ignore=ignore_keys)
+                elif inf and type(inf) == list:
+                    for datum in inf:
+                        if type(datum) == dict:
+                            yield flatten(dict(datum, **{new_key: row.id}),
+                                          root_keys_to_ignore=ignore_keys)
+            elif flat:
+                cleaned = row.dictize()
+                fav_user_ids = None
+                task_run_ids = None
+                if cleaned.get('fav_user_ids'):
+                    fav_user_ids = cleaned.pop('fav_user_ids')
+                if cleaned.get('task_run_ids'):
+                    task_run_ids = cleaned.pop('task_run_ids')
+
+                cleaned = flatten(cleaned,
+                                  root_keys_to_ignore=ignore_keys)
+
+                if fav_user_ids:
+                    cleaned['fav_user_ids'] = fav_user_ids
+                if task_run_ids:
+                    cleaned['task_run_ids'] = task_run_ids
+
+                yield cleaned
             else:
-                tmp = [row.dictize() for row in data]
-        return tmp
+                yield row.dictize()
+
+    @staticmethod
+    def dump_record(record, datafile):
+        """Append a record to a spill or chunk file."""
+        pickle.dump(record, datafile, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load_records(datafile):
+        """Yield the records of a spill or chunk file."""
+        while True:
+            try:
+                yield pickle.load(datafile)
+            except EOFError:
+                return
+
+    def read_chunks(self, paths):
+        """Yield the records of several chunk files, in order."""
+        for path in paths:
+            with open(path, 'rb') as datafile:
+                yield from self.load_records(datafile)
 
     def _project_name_latin_encoded(self, project):
         """project short name for later HTML header usage"""
@@ -207,22 +222,21 @@ class Exporter(object):
         """
         name = self._project_name_latin_encoded(project)
         if obj_generator is not None:
-            with tempfile.NamedTemporaryFile(mode='w+t') as datafile:
-                for line in obj_generator:
-                    if type(line) == bytes:
-                        line = line.decode()
-                    datafile.write(line)  # accepts only text
-                datafile.flush()
+            zipped_datafile = tempfile.NamedTemporaryFile()
+
+            # Lines are compressed into the archive as they are generated,
+            # so neither the data nor an uncompressed copy is kept around.
+            with self._zip_factory(zipped_datafile.name) as _zip:
+                arcname = secure_filename('{0}_{1}.{2}'
+                                          .format(name, obj, file_format))
+                with _zip.open(arcname, 'w', force_zip64=True) as datafile:
+                    for line in obj_generator:
+                        if type(line) == str:
+                            line = line.encode()
+                        datafile.write(line)
                 obj_generator.close()
+                _zip.content_type = 'application/zip'
 
-                zipped_datafile = tempfile.NamedTemporaryFile()
-
-                with self._zip_factory(zipped_datafile.name) as _zip:
-                    _zip.write(datafile.name,
-                               secure_filename('{0}_{1}.{2}'
-                                               .format(name, obj, file_format)))
-                    _zip.content_type = 'application/zip'
-
-                filename = self.download_name(project, obj)
-                fs = FileStorage(filename=filename, stream=zipped_datafile)
-                return closing(fs)
+            filename = self.download_name(project, obj)
+            fs = FileStorage(filename=filename, stream=zipped_datafile)
+            return closing(fs)
@@ -16,9 +16,11 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 """Exporter module helper functions."""
+from flask import current_app
 from sqlalchemy.sql import text
 from pybossa.core import db
 from pybossa.cache.task_browse_helpers import get_task_filters
+from pybossa.model.task_run_partitions import PROJECT_TASK_IDS
 from itertools import chain
 
 USER_FIELDS = [
@@ -79,10 +81,14 @@ def _field_mapreducer(*fieldsAndPrefixTuples):
 def _field_mapper(fields, prefix=''):
   return (field.format(prefix) for field in fields)
 
-def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold):
+def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold,
+                        after_id=None, to_id=None):
     """Export tasks from the browse tasks view for a project
     using the same filters that are selected by the user
     in the UI.
+
+    When ``after_id`` or ``to_id`` are given only the rows in that ID
+    range are returned, in ID order.
     """
     TASK_FIELDS, TASK_GOLD_FIELD, TASKRUN_FIELDS = (
       (TASK_FIELDS_WITH_GOLD, TASK_GOLD_FIELD_WITH_GOLD, TASKRUN_FIELDS_WITH_GOLD)
@@ -90,17 +96,19 @@ def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold):
       else (TASK_FIELDS_WITHOUT_GOLD, TASK_GOLD_FIELD_WITHOUT_GOLD, TASKRUN_FIELDS_WITHOUT_GOLD)
     )
     conditions, filter_params = get_task_filters(filters)
+    if after_id is not None or to_id is not None:
+        conditions, filter_params = _id_range_conditions(
+            obj, conditions, filter_params, after_id, to_id)
     if obj == 'task':
         sql = text('''
                    SELECT {0}
                      FROM task
                      LEFT OUTER JOIN (
                        SELECT task_id
-                            , CAST(COUNT(id) AS FLOAT) AS ct
-                            , MAX(finish_time) as ft
-                         FROM task_run
+                            , CAST(n_task_runs AS FLOAT) AS ct
+                            , finish_time as ft
+                         FROM task_rollup
                            WHERE project_id = :project_id
-                           GROUP BY task_id
                        ) AS log_counts
                        ON task.id = log_counts.task_id
                      WHERE project_id = :project_id
@@ -120,16 +128,16 @@ def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold):
                           ON task_run.task_id = task.id
                         LEFT OUTER JOIN (
                           SELECT task_id
-                               , CAST(COUNT(id) AS FLOAT) AS ct
-                               , MAX(finish_time) as ft
-                            FROM task_run
+                               , CAST(n_task_runs AS FLOAT) AS ct
+                               , finish_time as ft
+                            FROM task_rollup
                               WHERE project_id = :project_id
-                              GROUP BY task_id
                           ) AS log_counts
                           ON task.id = log_counts.task_id
                         LEFT JOIN "user"
                           ON task_run.user_id = "user".id
                         WHERE task_run.project_id = :project_id
+                          AND {2}
                         {1}
                       '''.format(_field_mapreducer(
                                     (TASKRUN_FIELDS, ''),
@@ -137,7 +145,7 @@ def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold):
                                     (USER_FIELDS, 'user__'),
                                     (TASK_GOLD_FIELD, 'task__')
                                   ),
-                                  conditions)
+                                  conditions, PROJECT_TASK_IDS)
                      )
         else:
            sql = text('''
@@ -147,74 +155,117 @@ def browse_tasks_export(obj, project_id, expanded, filters, disclose_gold):
                           ON task_run.task_id = task.id
                         LEFT OUTER JOIN (
                           SELECT task_id
-                               , CAST(COUNT(id) AS FLOAT) AS ct
-                               , MAX(finish_time) as ft
-                            FROM task_run
+                               , CAST(n_task_runs AS FLOAT) AS ct
+                               , finish_time as ft
+                            FROM task_rollup
                               WHERE project_id = :project_id
-                              GROUP BY task_id
                           ) AS log_counts
                           ON task_run.task_id = log_counts.task_id
                         WHERE task_run.project_id = :project_id
+                          AND {2}
                         {1}
                       '''.format(_field_mapreducer(
                                     (TASKRUN_FIELDS, ''),
                                     (TASK_GOLD_FIELD, 'task__')
                                   ),
-                                  conditions)
+                                  conditions, PROJECT_TASK_IDS)
                      )
     else:
         return
+    # Stream the rows from a server side cursor instead of buffering the
+    # whole result set on the client.
+    sql = sql.execution_options(
+        stream_results=True,
+        max_row_buffer=current_app.config.get('EXPORT_YIELD_PER', 1000))
     return session.execute(sql, dict(project_id=project_id, **filter_params))
 
 
-def browse_tasks_export_count(obj, project_id, expanded, filters):
-    """Returns the count of the tasks from the browse tasks view
-    for a project using the same filters that are selected by
-    the user in the UI.
-    """
-    conditions, filter_params = get_task_filters(filters)
+def _id_range_conditions(obj, conditions, params, after_id, to_id):
+    params = dict(params)
+    if after_id is not None:
+        conditions += ' AND {}.id > :after_id'.format(obj)
+        params['after_id'] = after_id
+    if to_id is not None:
+        conditions += ' AND {}.id <= :to_id'.format(obj)
+        params['to_id'] = to_id
+    conditions += ' ORDER BY {}.id'.format(obj)
+    return conditions, params
+
+
+def _browse_tasks_export_from(obj, conditions):
+    """Return the FROM and WHERE clauses of the rows exported from the
+    browse tasks view."""
     if obj == 'task':
-        sql = text('''
-                   SELECT COUNT(task.id)
+        return '''
                      FROM task
                      LEFT OUTER JOIN (
                        SELECT task_id
-                            , CAST(COUNT(id) AS FLOAT) AS ct
-                            , MAX(finish_time) as ft
-                         FROM task_run
+                            , CAST(n_task_runs AS FLOAT) AS ct
+                            , finish_time as ft
+                         FROM task_rollup
                            WHERE project_id = :project_id
-                           GROUP BY task_id
                        ) AS log_counts
                        ON task.id = log_counts.task_id
                      WHERE project_id = :project_id
                      {0}
                    '''.format(conditions)
-                  )
     elif obj == 'task_run':
-       sql = text('''
-                  SELECT COUNT(task_run.id)
+        return '''
                     FROM task_run
                     LEFT JOIN task
                       ON task_run.task_id = task.id
                     LEFT OUTER JOIN (
                       SELECT task_id
-                           , CAST(COUNT(id) AS FLOAT) AS ct
-                           , MAX(finish_time) as ft
-                        FROM task_run
+                           , CAST(n_task_runs AS FLOAT) AS ct
+                           , finish_time as ft
+                        FROM task_rollup
                           WHERE project_id = :project_id
-                          GROUP BY task_id
                       ) AS log_counts
                       ON task.id = log_counts.task_id
                     WHERE task_run.project_id = :project_id
+                      AND {1}
                     {0}
-                  '''.format(conditions)
-                 )
-    else:
+                  '''.format(conditions, PROJECT_TASK_IDS)
+
+
+def browse_tasks_export_count(obj, project_id, expanded, filters):
+    """Returns the count of the tasks from the browse tasks view
+    for a project using the same filters that are selected by
+    the user in the UI.
+    """
+    conditions, filter_params = get_task_filters(filters)
+    from_clause = _browse_tasks_export_from(obj, conditions)
+    if from_clause is None:
         return
+    sql = text('SELECT COUNT({0}.id) {1}'.format(obj, from_clause))
     return session.execute(
             sql, dict(project_id=project_id, **filter_params)).scalar()
 
 
+def browse_tasks_export_shards(obj, project_id, filters, shard_size):
+    """Split the rows exported from the browse tasks view into ID ranges
+    of ``shard_size`` rows. Returns a list of ``(after_id, to_id)`` pairs,
+    the last range being open ended.
+    """
+    conditions, filter_params = get_task_filters(filters)
+    from_clause = _browse_tasks_export_from(obj, conditions)
+    if from_clause is None:
+        return
+    sql = text('''
+               SELECT id FROM (
+                 SELECT {0}.id, row_number() OVER (ORDER BY {0}.id) AS rn
+                 {1}
+               ) AS export_ids
+               WHERE mod(rn, :shard_size) = 0
+               ORDER BY id
+               '''.format(obj, from_clause))
+    rows = session.execute(sql, dict(project_id=project_id,
+                                     shard_size=shard_size,
+                                     **filter_params))
+    boundaries = [row.id for row in rows]
+    return list(zip([0] + boundaries, boundaries + [None]))
+
+
 def filter_task_info_headers(headers, accepted_task_info_fields=[]):
   new_headers = []
   accepted_task_info_fields_set = set(accepted_task_info_fields)
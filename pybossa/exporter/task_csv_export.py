@@ -17,15 +17,13 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 # Cache global variables for timeouts
 
+import csv
+import io
 import json
 import tempfile
-from contextlib import closing
-
-import pandas as pd
 
 from flask import send_file
-from werkzeug.datastructures import FileStorage
-from werkzeug.utils import safe_join, secure_filename
+from werkzeug.utils import safe_join
 
 from pybossa.core import uploader
 from pybossa.exporter.csv_export import CsvExporter
@@ -141,45 +139,56 @@ class TaskCsvExporter(CsvExporter):
             for kk, vv, in iterator:
                 yield kk, vv
 
-    def _get_all_headers(self, objs, expanded, table=None):
-        """Construct headers to **guarantee** that all headers
-        for all tasks are included, regardless of whether
-        or not all tasks were imported with the same headers.
-
-        :param objs: an iterable of objects or dicts to
-            extract keys from
-        :param expanded: determines if joined objects should
-            be merged
-        :param table: the table that the objects belong to
-        :param from_obj: does ``objs`` iterable contain
-            domain objects. If it does then different methods
-            can be used.
+    def gen_records(self, obj, project_id, expanded=False, filters=None,
+                    disclose_gold=False, after_id=None, to_id=None):
+        """Yield ``(id, row, headers)`` for the rows to export, ``row``
+        being normalized for :meth:`gen_csv` and ``headers`` the columns
+        the row has values for.
         """
-        headers = set()
-
-        for obj in objs:
-            headers.update(self.get_keys(obj, table))
-
-        headers = sorted(list(headers))
-        return headers
+        objs = browse_tasks_export(obj, project_id, expanded, filters,
+                                   disclose_gold, after_id, to_id)
+        if objs is None:
+            return
+        for item in objs:
+            row = dict(item)
+            yield (row['id'], self.process_filtered_row(row),
+                   self.get_keys(row, obj))
 
-    def _respond_csv(self, ty, project_id, expanded=False, filters=None, disclose_gold=False):
-        objs = browse_tasks_export(ty, project_id, expanded, filters, disclose_gold)
-        rows = [obj for obj in objs]
-        headers = self._get_all_headers(objs=rows, expanded=expanded, table=ty)
+    def gen_csv(self, rows, headers, filters=None):
+        """Generate the lines of a CSV with ``headers`` for the rows."""
         if (filters and 'display_info_columns' in filters and \
             len(filters['display_info_columns']) > 0):
             headers = filter_task_info_headers(headers, filters['display_info_columns'])
 
-        formatted_rows = []
+        line = io.StringIO()
+        writer = csv.writer(line, lineterminator='\n')
+        if headers:
+            writer.writerow(headers)
         for row in rows:
-            row = self.process_filtered_row(dict(row))
-            formatted_row = self._format_csv_row(row, headers)
-            formatted_rows.append(formatted_row)
+            writer.writerow(self._format_csv_row(row, headers))
+            if line.tell() >= io.DEFAULT_BUFFER_SIZE:
+                yield line.getvalue()
+                line.seek(0)
+                line.truncate()
+        yield line.getvalue()
 
-        df = pd.DataFrame(formatted_rows, columns=headers)
+    def _respond_csv(self, ty, project_id, expanded=False, filters=None, disclose_gold=False):
+        """Generate the lines of the CSV export.
 
-        return df
+        The headers of all the rows are needed before the first line is
+        written. A first pass collects them while spilling the rows to a
+        temporary file, so that the second pass neither holds the rows in
+        memory nor queries the database again.
+        """
+        headers = set()
+        with tempfile.TemporaryFile() as spill:
+            for _, row, keys in self.gen_records(ty, project_id, expanded,
+                                                 filters, disclose_gold):
+                headers.update(keys)
+                self.dump_record(row, spill)
+            spill.seek(0)
+            yield from self.gen_csv(self.load_records(spill),
+                                    sorted(headers), filters)
 
     def response_zip(self, project, ty, expanded=False):
         return self.get_zip(project, ty, expanded)
@@ -204,25 +213,19 @@ class TaskCsvExporter(CsvExporter):
             return res
 
     def make_zip(self, project, obj, expanded=False, filters=None, disclose_gold=False):
-        dataframe = self._respond_csv(obj, project.id, expanded, filters, disclose_gold)
-
-        if dataframe is None:
+        # nothing is exported for other objects, as before streaming
+        if obj not in ('task', 'task_run'):
             return
-
-        name = self._project_name_latin_encoded(project)
-        with tempfile.NamedTemporaryFile(mode='w+t') as datafile:
-            dataframe.to_csv(datafile, index=False, encoding='utf-8')
-            datafile.flush()
-
-            zipped_datafile = tempfile.NamedTemporaryFile()
-
-            with self._zip_factory(zipped_datafile.name) as _zip:
-                _zip.write(datafile.name, secure_filename(f'{name}_{obj}.csv'))
-                _zip.content_type = 'application/zip'
-
-        filename = self.download_name(project, obj)
-        fs = FileStorage(filename=filename, stream=zipped_datafile)
-        return closing(fs)
+        file_format = 'csv'
+        obj_generator = self._respond_csv(obj, project.id, expanded, filters, disclose_gold)
+        return self._make_zipfile(
+                project, obj, file_format, obj_generator, expanded)
+
+    def make_zip_from_chunks(self, project, obj, chunks, headers, filters=None):
+        """Zip the rows spilled to ``chunks`` by a sharded export."""
+        return self._make_zipfile(
+                project, obj, 'csv',
+                self.gen_csv(self.read_chunks(chunks), headers, filters))
 
     def _make_zip(self, project, obj, expanded=False, filters=None):
         self.make_zip(self, project, obj, expanded, filters)
@@ -19,13 +19,13 @@
 
 import json
 
-from flask import send_file
+from flask import current_app, send_file
 from werkzeug.utils import safe_join
 
 from pybossa.core import uploader, task_repo
 from pybossa.exporter.json_export import JsonExporter
 from pybossa.uploader import local
-from .export_helpers import browse_tasks_export, browse_tasks_export_count
+from .export_helpers import browse_tasks_export
 
 TASK_GOLD_FIELDS = [
     'calibration',
@@ -103,7 +103,20 @@ class TaskJsonExporter(JsonExporter):
 
         return new_row
 
-    def gen_json(self, obj, project_id, expanded=False, disclose_gold=False):
+    def gen_records(self, obj, project_id, expanded=False, filters=None,
+                    disclose_gold=False, after_id=None, to_id=None):
+        """Yield ``(id, item, headers)`` for the items to export, in ID
+        order when ``after_id`` or ``to_id`` are given. JSON items have no
+        headers.
+        """
+        if filters:
+            objs = browse_tasks_export(obj, project_id, expanded, filters,
+                                       disclose_gold, after_id, to_id)
+            for item in objs or ():
+                row = dict(item)
+                yield row['id'], self.process_filtered_row(row), ()
+            return
+
         if obj == 'task':
             query_filter = task_repo.filter_tasks_by
             remove_gold = remove_task_gold_fields
@@ -113,11 +126,12 @@ class TaskJsonExporter(JsonExporter):
         else:
             return
 
-        n = getattr(task_repo, 'count_%ss_with' % obj)(project_id=project_id)
-        sep = ", "
-        yield "["
-
-        for i, tr in enumerate(query_filter(project_id=project_id, yielded=True), 1):
+        rows = query_filter(project_id=project_id, last_id=after_id,
+                            yielded=True,
+                            yield_per=current_app.config.get('EXPORT_YIELD_PER'))
+        for tr in rows:
+            if to_id is not None and tr.id > to_id:
+                break
             if expanded:
                 item = self.merge_objects(tr)
             else:
@@ -126,29 +140,28 @@ class TaskJsonExporter(JsonExporter):
             if not disclose_gold:
                 remove_gold(item)
 
-            item = json.dumps(item)
-
-            if (i == n):
-                sep = ""
-            yield item + sep
-        yield "]"
-
-    def gen_json_with_filters(self, obj, project_id, expanded, filters, disclose_gold):
-        objs = browse_tasks_export(obj, project_id, expanded, filters, disclose_gold)
-        n = browse_tasks_export_count(obj, project_id, expanded, filters)
+            yield tr.id, item, ()
 
-        sep = ", "
+    @staticmethod
+    def gen_json_array(items):
+        """Generate a JSON array of the items. Separators lead each item so
+        that the items are only read once, without counting them first."""
+        sep = ""
         yield "["
+        for item in items:
+            yield sep + json.dumps(item)
+            sep = ", "
+        yield "]"
 
-        count = 0
-        for obj in objs:
-            item = json.dumps(self.process_filtered_row(dict(obj)))
-            count += 1
+    def gen_json(self, obj, project_id, expanded=False, disclose_gold=False):
+        records = self.gen_records(obj, project_id, expanded,
+                                   disclose_gold=disclose_gold)
+        yield from self.gen_json_array(item for _, item, _ in records)
 
-            if count == n:
-                sep = ""
-            yield item + sep
-        yield "]"
+    def gen_json_with_filters(self, obj, project_id, expanded, filters, disclose_gold):
+        records = self.gen_records(obj, project_id, expanded, filters,
+                                   disclose_gold)
+        yield from self.gen_json_array(item for _, item, _ in records)
 
     def _respond_json(self, ty, project_id, expanded=False, filters=None, disclose_gold=False):
         if filters:
@@ -184,5 +197,11 @@ class TaskJsonExporter(JsonExporter):
         return self._make_zipfile(
                 project, obj, file_format, obj_generator, expanded)
 
+    def make_zip_from_chunks(self, project, obj, chunks, headers, filters=None):
+        """Zip the items spilled to ``chunks`` by a sharded export."""
+        return self._make_zipfile(
+                project, obj, 'json',
+                self.gen_json_array(self.read_chunks(chunks)))
+
     def _make_zip(self, project, obj, expanded=False):
         self.make_zip(self, project, obj, expanded)
@@ -17,6 +17,7 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import defaultdict
+from itertools import islice
 from flask import current_app
 from flask_babel import gettext
 from .csv import BulkTaskCSVImport, BulkTaskGDImport, BulkTaskLocalCSVImport
@@ -200,13 +201,82 @@ class Importer(object):
             current_app.logger.error(msg)
             return ImportReport(message=msg, metadata=None, total=0)
 
+    def _make_task(self, project, task_data, n_answers):
+        """Build a new task of the project from imported task data."""
+        from pybossa.model.task import Task
+
+        # As tasks are getting created, pass current date as create_date
+        create_date = make_timestamp()
+        task_data['expiration'] = get_task_expiration(task_data.get('expiration'), create_date)
+
+        # Extract task contents once for both checksum and filter fields (optimization)
+        task_contents, _ = get_task_contents_for_processing(project_id=project.id, task=task_data)
+        dup_checksum = generate_checksum(project_id=project.id, task=task_data, task_contents=task_contents)
+        set_task_filter_fields(project=project, task=task_data, task_contents=task_contents)
+
+        self.upload_private_data(task_data, project.id)
+        task = Task(project_id=project.id, n_answers=n_answers, dup_checksum=dup_checksum)
+        [setattr(task, k, v) for k, v in task_data.items()]
+
+        gold_answers = task_data.pop('gold_answers', None)
+        set_gold_answers(task, gold_answers)
+        return task
+
+    def _new_valid_tasks(self, task_repo, project, tasks, validator,
+                         completed_tasks, imported):
+        """Drop the duplicate and invalid tasks of a batch. Duplicates are
+        looked up with one query per batch, and ``imported`` holds the keys
+        of the tasks accepted so far to catch duplicates within the import.
+        """
+        checksums = set(task.dup_checksum for task in tasks if task.dup_checksum)
+        found_checksums = task_repo.find_duplicate_checksums(
+            project.id, checksums, completed_tasks)
+        found_infos = task_repo.find_duplicate_infos(
+            project.id, [task.info for task in tasks if not task.dup_checksum])
+
+        new_tasks = []
+        for task in tasks:
+            if task.dup_checksum:
+                key = ('dup_checksum', task.dup_checksum)
+                found = task.dup_checksum in found_checksums
+            else:
+                key = ('info', json.dumps(task.info, sort_keys=True))
+                found = json.dumps(task.info, allow_nan=False) in found_infos
+            if found or key in imported:
+                current_app.logger.info("Project %d, task checksum %s. Duplicate task found", project.id, task.dup_checksum)
+                continue
+            if not validator.validate(task):
+                continue
+            imported.add(key)
+            new_tasks.append(task)
+        return new_tasks
+
+    def _save_tasks(self, task_repo, project, tasks, validator):
+        """Insert a batch of tasks at once, falling back to one by one
+        inserts to isolate the failing tasks. Returns the number of tasks
+        saved."""
+        try:
+            task_repo.bulk_save_tasks(project.id, tasks)
+            return len(tasks)
+        except Exception:
+            current_app.logger.exception("Project %d, bulk task import failed. Importing tasks one by one", project.id)
+        num = 0
+        for task in tasks:
+            try:
+                task_repo.save(task, clean_project=False)
+                num += 1
+            except Exception as e:
+                current_app.logger.exception(str(e))
+                validator.add_error(str(e))
+        return num
+
     def create_tasks(self, task_repo, project, importer=None, **form_data):
         """Create tasks."""
-        from pybossa.model.task import Task
         from pybossa.cache import projects as cached_projects
 
         """Create tasks from a remote source using an importer object and
-        avoiding the creation of repeated tasks"""
+        avoiding the creation of repeated tasks. Tasks are processed in
+        batches of IMPORT_BATCH_SIZE."""
         num = 0
         importer = importer or self._create_importer_for(**form_data)
         tasks = importer.tasks()
@@ -218,40 +288,19 @@ class Importer(object):
         validator = TaskImportValidator(get_enrichment_output_fields(project))
         n_answers = project.get_default_n_answers()
         completed_tasks = project.info.get("duplicate_task_check", {}).get("completed_tasks", False)
+        batch_size = current_app.config.get('IMPORT_BATCH_SIZE', 1000)
+        imported = set()
         try:
-            for task_data in tasks:
-                # As tasks are getting created, pass current date as create_date
-                create_date = make_timestamp()
-                task_data['expiration'] = get_task_expiration(task_data.get('expiration'), create_date)
-
-                # Extract task contents once for both checksum and filter fields (optimization)
-                task_contents, _ = get_task_contents_for_processing(project_id=project.id, task=task_data)
-                dup_checksum = generate_checksum(project_id=project.id, task=task_data, task_contents=task_contents)
-                set_task_filter_fields(project=project, task=task_data, task_contents=task_contents)
-
-                self.upload_private_data(task_data, project.id)
-                task = Task(project_id=project.id, n_answers=n_answers, dup_checksum=dup_checksum)
-                [setattr(task, k, v) for k, v in task_data.items()]
-
-                gold_answers = task_data.pop('gold_answers', None)
-                set_gold_answers(task, gold_answers)
-
-                found = task_repo.find_duplicate(project_id=project.id,
-                    info=task.info,
-                    dup_checksum=task.dup_checksum,
-                    completed_tasks=completed_tasks
-                )
-                if found is not None:
-                    current_app.logger.info("Project %d, task checksum %s. Duplicate task found with task id %d", project.id, task.dup_checksum, found)
-                    continue
-                if not validator.validate(task):
-                    continue
-                try:
-                    num += 1
-                    task_repo.save(task, clean_project=False)
-                except Exception as e:
-                    current_app.logger.exception(msg)
-                    validator.add_error(str(e))
+            tasks = iter(tasks)
+            batch = list(islice(tasks, batch_size))
+            while batch:
+                batch = [self._make_task(project, task_data, n_answers)
+                         for task_data in batch]
+                batch = self._new_valid_tasks(task_repo, project, batch,
+                                              validator, completed_tasks,
+                                              imported)
+                num += self._save_tasks(task_repo, project, batch, validator)
+                batch = list(islice(tasks, batch_size))
         finally:
             cached_projects.clean_project(project.id)
 
@@ -21,21 +21,26 @@ import logging
 import math
 import os
 import time
+import uuid
 from collections import OrderedDict
 from datetime import datetime, timedelta
+from functools import partial
 from io import BytesIO
+from itertools import chain
 from zipfile import ZipFile
 
 import pandas as pd
 import requests
 from flask import current_app, render_template
 from flask_mail import Message, Attachment
+from rq import Retry, get_current_job
 from rq.timeouts import JobTimeoutException
 from sqlalchemy.sql import text
 
 import pybossa.app_settings as app_settings
 import pybossa.cache.users as cached_users
 import pybossa.dashboard.jobs as dashboard
+from pybossa import available_tasks
 from pybossa.auditlogger import AuditLogger
 from pybossa.cache import site_stats
 from pybossa.cache.helpers import n_available_tasks
@@ -55,6 +60,13 @@ MINUTE = 60
 IMPORT_TASKS_TIMEOUT = (20 * MINUTE)
 TASK_DELETE_TIMEOUT = (60 * MINUTE)
 EXPORT_TASKS_TIMEOUT = (20 * MINUTE)
+EXPORT_SHARDS_TTL = (24 * 60 * MINUTE)
+EXPORT_SHARDS_KEY = 'pybossa:export:{}'
+EXPORT_SHARDS_DONE_KEY = 'pybossa:export:{}:done'
+EXPORT_SHARDS_FAILED_KEY = 'pybossa:export:{}:failed'
+TASKRUN_EVENTS_TIMEOUT = (10 * MINUTE)
+TASKRUN_EVENTS_KEY = 'pybossa:taskrun_events:project:{}'
+TASKRUN_EVENTS_PENDING_KEY = 'pybossa:taskrun_events:project:{}:pending'
 MAX_RECIPIENTS = 50
 BATCH_DELETE_TASK_DELAY = 2 # seconds
 BATCH_SIZE_BULK_DELETE_TASKS = 100
@@ -131,9 +143,83 @@ def enqueue_job(job):
     queue.enqueue_call(func=job['name'],
                        args=job['args'],
                        kwargs=job['kwargs'],
-                       timeout=job['timeout'])
+                       timeout=job['timeout'],
+                       retry=job.get('retry'))
     return True
 
+def enqueue_job_in(job, seconds):
+    """Enqueues a job to run after the given number of seconds."""
+    from pybossa.core import sentinel
+    from rq_scheduler import Scheduler
+    redis_conn = sentinel.master
+    scheduler = Scheduler(queue_name=job['queue'], connection=redis_conn)
+    scheduler.enqueue_in(timedelta(seconds=seconds), job['name'],
+                         *job['args'], timeout=job['timeout'],
+                         **job['kwargs'])
+    return True
+
+
+def enqueue_taskrun_events(events):
+    """Queue the side effects of committed task runs and task updates.
+
+    Events are appended to a Redis list per project. The first event of a
+    project within TASKRUN_EVENTS_WINDOW seconds schedules a single
+    process_taskrun_events job, which handles every event queued meanwhile.
+    """
+    from pybossa.core import sentinel
+    redis_conn = sentinel.master
+    window = current_app.config.get('TASKRUN_EVENTS_WINDOW') or 0
+    project_ids = sorted(set(event['project_id'] for event in events))
+    pipeline = redis_conn.pipeline(transaction=False)
+    for project_id in project_ids:
+        pipeline.rpush(TASKRUN_EVENTS_KEY.format(project_id),
+                       *[json.dumps(event) for event in events
+                         if event['project_id'] == project_id])
+        pipeline.set(TASKRUN_EVENTS_PENDING_KEY.format(project_id), 1,
+                     nx=True, ex=int(window) + TASKRUN_EVENTS_TIMEOUT)
+    results = pipeline.execute()
+    for project_id, scheduled in zip(project_ids, results[1::2]):
+        if not scheduled:
+            continue
+        job = dict(name=process_taskrun_events,
+                   args=[project_id],
+                   kwargs={},
+                   timeout=TASKRUN_EVENTS_TIMEOUT,
+                   queue='high')
+        if window:
+            enqueue_job_in(job, window)
+        else:
+            enqueue_job(job)
+
+
+def process_taskrun_events(project_id):
+    """Run the queued side effects of task runs and task updates of a
+    project, once per batch."""
+    from pybossa.core import db, sentinel
+    from pybossa.model.event_listeners import apply_taskrun_events
+    redis_conn = sentinel.master
+    key = TASKRUN_EVENTS_KEY.format(project_id)
+    # Clear the pending flag first, so events queued from now on schedule
+    # a new job instead of being left behind.
+    pipeline = redis_conn.pipeline(transaction=True)
+    pipeline.delete(TASKRUN_EVENTS_PENDING_KEY.format(project_id))
+    pipeline.lrange(key, 0, -1)
+    pipeline.delete(key)
+    _, events, _ = pipeline.execute()
+    if not events:
+        return
+    apply_taskrun_events(db.session, project_id,
+                         [json.loads(event) for event in events])
+
+
+def refresh_cached_value(function_path, *args, **kwargs):
+    """Recompute the cached value of a function decorated with
+    early_refresh, given by its import path."""
+    from rq.utils import import_attribute
+    function = import_attribute(function_path)
+    function.refresh(*args, **kwargs)
+
+
 def enqueue_periodic_jobs(queue_name):
     """Enqueue all PYBOSSA periodic jobs."""
     from pybossa.core import sentinel
@@ -197,6 +283,9 @@ def get_default_jobs():  # pragma: no cover
                timeout=timeout, queue='low')
     yield dict(name=send_email_notifications, args=[], kwargs={},
                timeout=timeout, queue='super')
+    if available_tasks.is_enabled():
+        yield dict(name=reconcile_available_tasks, args=[], kwargs={},
+                   timeout=timeout, queue='low')
 
 
 def get_maintenance_jobs():
@@ -204,6 +293,8 @@ def get_maintenance_jobs():
     timeout = current_app.config.get('TIMEOUT')
     yield dict(name=check_failed, args=[], kwargs={},
                timeout=timeout, queue='maintenance')
+    yield dict(name=create_task_run_partitions, args=[], kwargs={},
+               timeout=timeout, queue='maintenance')
 
 
 def get_export_task_jobs(queue):
@@ -519,6 +610,33 @@ def warm_cache():  # pragma: no cover
         return True
 
 
+def build_available_tasks(project_id):
+    """Build the queue of available tasks of a project on its first use."""
+    available_tasks.build(project_id)
+
+
+def reconcile_available_tasks():
+    """Rebuild the queues of available tasks still in use from the database."""
+    from pybossa.core import sentinel
+    for project_id in available_tasks.get_projects():
+        if not sentinel.master.exists(available_tasks.get_built_key(project_id)):
+            # Not used since its last rebuild, it will be built on demand
+            available_tasks.forget_project(project_id)
+            continue
+        current_app.logger.info('reconcile_available_tasks - project %s', project_id)
+        available_tasks.rebuild(project_id)
+
+
+def create_task_run_partitions():
+    """Create the task_run partitions of the next task ids."""
+    from pybossa.core import task_repo
+    created = task_repo.create_task_run_partitions(
+        current_app.config.get('TASK_RUN_PARTITION_SIZE'),
+        current_app.config.get('TASK_RUN_PARTITIONS_AHEAD'))
+    for name in created:
+        current_app.logger.info('create_task_run_partitions - %s', name)
+
+
 def get_non_updated_projects():
     """Return a list of non updated projects excluding completed ones."""
     from sqlalchemy.sql import text
@@ -667,10 +785,14 @@ def cleanup_task_records(task_ids, force_reset):
 
     from pybossa.core import db
     from pybossa.cache.task_browse_helpers import get_task_filters
+    from pybossa.cache.project_stats import remove_task_runs_sql
 
     tables = ["result", "task_run", "task"] if force_reset else ["task"]
     current_app.logger.info("Task ids staged for deletion: %s", task_ids)
     task_ids_tuple = tuple(task_ids)
+    # raw deletes are not seen by the listeners keeping the project stats
+    db.session.execute(remove_task_runs_sql('task_id IN :taskids'),
+                       {"taskids": task_ids_tuple})
     for table in tables:
         sql = f"DELETE FROM {table} "
         sql += "WHERE id IN :taskids;" if table == "task" else "WHERE task_id IN :taskids;"
@@ -689,9 +811,9 @@ def get_tasks_to_delete(project_id, task_filter_args):
                 coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                 priority_0, task.created
                 FROM task LEFT OUTER JOIN
-                (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                MAX(finish_time) as ft FROM task_run
-                WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                finish_time as ft FROM task_rollup
+                WHERE project_id=:project_id) AS log_counts
                 ON task.id=log_counts.task_id
                 WHERE task.project_id=:project_id {}
                 ORDER BY task.id;
@@ -733,6 +855,7 @@ def delete_bulk_tasks_in_batches(project_id, force_reset, task_filter_args):
 def delete_bulk_tasks_with_session_repl(project_id, force_reset, task_filter_args):
     from pybossa.core import db
     from pybossa.cache.task_browse_helpers import get_task_filters
+    from pybossa.cache.project_stats import remove_task_runs_sql
 
     # bulkdel db conn is with db user having session_replication_role
     # when bulkdel is not configured, make explict sql query to set
@@ -763,13 +886,18 @@ def delete_bulk_tasks_with_session_repl(project_id, force_reset, task_filter_arg
                     GROUP BY result.task_id)
                 );
 
+                {}
                 DELETE FROM task_run WHERE project_id=:project_id
                         AND task_id IN (SELECT id FROM to_delete);
+                DELETE FROM task_rollup WHERE project_id=:project_id
+                        AND task_id IN (SELECT id FROM to_delete);
                 DELETE FROM task WHERE project_id=:project_id
                         AND id IN (SELECT id FROM to_delete);
 
                 COMMIT;
-                '''.format(sql_session_repl))
+                '''.format(sql_session_repl, remove_task_runs_sql(
+                    'project_id=:project_id '
+                    'AND task_id IN (SELECT id FROM to_delete)')))
     else:
         conditions, params = get_task_filters(task_filter_args)
         sql = text('''
@@ -785,24 +913,39 @@ def delete_bulk_tasks_with_session_repl(project_id, force_reset, task_filter_arg
                     coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                     priority_0, task.created
                     FROM task LEFT OUTER JOIN
-                    (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                    MAX(finish_time) as ft FROM task_run
-                    WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                    (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                    finish_time as ft FROM task_rollup
+                    WHERE project_id=:project_id) AS log_counts
                     ON task.id=log_counts.task_id
                     WHERE task.project_id=:project_id {}
                 );
 
                 DELETE FROM result WHERE project_id=:project_id
                        AND task_id in (SELECT id FROM to_delete);
+                {}
                 DELETE FROM task_run WHERE project_id=:project_id
                        AND task_id in (SELECT id FROM to_delete);
+                DELETE FROM task_rollup WHERE project_id=:project_id
+                       AND task_id in (SELECT id FROM to_delete);
                 DELETE FROM task WHERE task.project_id=:project_id
                        AND id in (SELECT id FROM to_delete);
 
                 COMMIT;
-                '''.format(sql_session_repl, conditions))
+                '''.format(sql_session_repl, conditions, remove_task_runs_sql(
+                    'project_id=:project_id '
+                    'AND task_id in (SELECT id FROM to_delete)')))
     db.bulkdel_session.execute(sql, dict(project_id=project_id, **params))
 
+def prune_saved_partial_answers(project_id):
+    """Remove the partial answers saved for deleted tasks of a project."""
+    from pybossa.core import sentinel, task_repo
+    from pybossa.util import prune_partial_answers
+
+    n_users = prune_partial_answers(sentinel, project_id, task_repo)
+    current_app.logger.info("Pruned saved partial answers of project %d, "
+                            "%d users have some left", project_id, n_users)
+
+
 def delete_bulk_tasks(data):
     """Delete tasks in bulk from project."""
     import pybossa.cache.projects as cached_projects
@@ -823,6 +966,9 @@ def delete_bulk_tasks(data):
         delete_bulk_tasks_with_session_repl(project_id, force_reset, task_filter_args)
 
     cached_projects.clean_project(project_id)
+    if available_tasks.is_enabled():
+        available_tasks.invalidate(project_id)
+    prune_saved_partial_answers(project_id)
     if not force_reset:
         msg = ("Tasks and taskruns with no associated results have been "
             "deleted from project {0} by {1}"
@@ -956,20 +1102,225 @@ def import_tasks(project_id, current_user_fullname, from_auto=False, **form_data
     return msg
 
 
+def _get_task_exporter(filetype):
+    from pybossa.core import task_csv_exporter, task_json_exporter
+    return dict(csv=task_csv_exporter, json=task_json_exporter)[filetype]
+
+
+def _export_chunk_path(export_id, shard):
+    folder = current_app.config['EXPORT_CHUNK_FOLDER']
+    return os.path.join(folder, 'export_{}_{}.chunk'.format(export_id, shard))
+
+
+def start_sharded_export(current_user_email_addr, project, ty, expanded,
+                         filetype, filters=None, disclose_gold=False):
+    """Split an export larger than EXPORT_SHARD_SIZE rows into ID ranges
+    exported in parallel by export_tasks_shard jobs. Returns the number of
+    shards, 0 when the export runs as a single job."""
+    from pybossa.exporter.export_helpers import (browse_tasks_export_count,
+                                                 browse_tasks_export_shards)
+    shard_size = current_app.config.get('EXPORT_SHARD_SIZE')
+    # the shards may run on any host, which must all see the chunk files
+    if (not shard_size or not current_app.config.get('EXPORT_CHUNK_FOLDER') or
+            ty not in ('task', 'task_run') or filetype not in ('csv', 'json')):
+        return 0
+    if browse_tasks_export_count(ty, project.id, expanded,
+                                 filters) <= shard_size:
+        return 0
+
+    shards = browse_tasks_export_shards(ty, project.id, filters, shard_size)
+    export_id = uuid.uuid4().hex
+    retry = Retry(max=current_app.config.get('EXPORT_SHARD_RETRIES', 3))
+    for shard in range(len(shards)):
+        job = dict(name=export_tasks_shard,
+                   args=[export_id, shard, shards, current_user_email_addr,
+                         project.short_name, ty, expanded, filetype],
+                   kwargs=dict(filters=filters, disclose_gold=disclose_gold),
+                   timeout=EXPORT_TASKS_TIMEOUT,
+                   queue='low',
+                   retry=retry)
+        enqueue_job(job)
+    current_app.logger.info("Task export project id %s: %d shards enqueued "
+                            "for export %s", project.id, len(shards),
+                            export_id)
+    return len(shards)
+
+
+def export_tasks_shard(export_id, shard, shards, current_user_email_addr,
+                       short_name, ty, expanded, filetype, filters=None,
+                       disclose_gold=False):
+    """Export one ID range of a sharded export to its chunk file.
+
+    The chunk offset and the last exported ID are checkpointed every
+    EXPORT_YIELD_PER rows so that a retried shard resumes where it failed.
+    The last shard to finish enqueues the merge of the chunks.
+    """
+    from pybossa.core import sentinel, project_repo
+    project = project_repo.get_by_shortname(short_name)
+    exporter = _get_task_exporter(filetype)
+    redis_conn = sentinel.master
+    key = EXPORT_SHARDS_KEY.format(export_id)
+    field = 'shard:{}'.format(shard)
+    after_id, to_id = shards[shard]
+    checkpoint = redis_conn.hget(key, field)
+    if checkpoint:
+        checkpoint = json.loads(checkpoint)
+    else:
+        checkpoint = dict(last_id=after_id, offset=0, headers=[])
+    headers = set(checkpoint['headers'])
+    batch_size = current_app.config.get('EXPORT_YIELD_PER') or 1000
+
+    def save_checkpoint(last_id, offset):
+        checkpoint.update(last_id=last_id, offset=offset,
+                          headers=sorted(headers))
+        pipeline = redis_conn.pipeline()
+        pipeline.hset(key, field, json.dumps(checkpoint))
+        pipeline.expire(key, EXPORT_SHARDS_TTL)
+        pipeline.execute()
+
+    if redis_conn.exists(EXPORT_SHARDS_FAILED_KEY.format(export_id)):
+        return 'Export {} failed'.format(export_id)
+
+    path = _export_chunk_path(export_id, shard)
+    try:
+        with open(path, 'r+b' if checkpoint['offset'] else 'wb') as chunk:
+            chunk.seek(checkpoint['offset'])
+            chunk.truncate()
+            last_id = checkpoint['last_id']
+            records = exporter.gen_records(ty, project.id, expanded, filters,
+                                           disclose_gold, last_id, to_id)
+            for n_rows, (last_id, record, keys) in enumerate(records, 1):
+                exporter.dump_record(record, chunk)
+                headers.update(keys)
+                if n_rows % batch_size == 0:
+                    chunk.flush()
+                    save_checkpoint(last_id, chunk.tell())
+            chunk.flush()
+            save_checkpoint(last_id, chunk.tell())
+    except Exception:
+        job = get_current_job()
+        if job is None or not job.retries_left:
+            fail_sharded_export(export_id, len(shards),
+                                current_user_email_addr, project)
+        raise
+
+    if redis_conn.exists(EXPORT_SHARDS_FAILED_KEY.format(export_id)):
+        # another shard failed meanwhile, this chunk is not merged
+        delete_export_shards(export_id, len(shards))
+        return 'Export {} failed'.format(export_id)
+
+    done_key = EXPORT_SHARDS_DONE_KEY.format(export_id)
+    pipeline = redis_conn.pipeline()
+    pipeline.sadd(done_key, shard)
+    pipeline.expire(done_key, EXPORT_SHARDS_TTL)
+    pipeline.scard(done_key)
+    n_done = pipeline.execute()[-1]
+    publish_channel(sentinel, short_name,
+                    dict(export_id=export_id, ty=ty, filetype=filetype,
+                         n_shards=len(shards), n_done=n_done),
+                    'export_progress')
+
+    if n_done == len(shards) and redis_conn.hsetnx(key, 'merging', 1):
+        job = dict(name=export_tasks,
+                   args=[current_user_email_addr, short_name, ty, expanded,
+                         filetype],
+                   kwargs=dict(filters=filters, disclose_gold=disclose_gold,
+                               export_id=export_id, n_shards=len(shards)),
+                   timeout=EXPORT_TASKS_TIMEOUT,
+                   queue='low')
+        enqueue_job(job)
+    return 'Shard {0}/{1} of export {2} done'.format(shard + 1, len(shards),
+                                                     export_id)
+
+
+def merge_export_shards(export_id, n_shards, filetype, project, ty,
+                        expanded, filters=None, disclose_gold=False):
+    """Zip the chunk files of a sharded export."""
+    from pybossa.core import sentinel
+    key = EXPORT_SHARDS_KEY.format(export_id)
+    fields = ['shard:{}'.format(shard) for shard in range(n_shards)]
+    checkpoints = [json.loads(checkpoint)
+                   for checkpoint in sentinel.master.hmget(key, fields)]
+    headers = sorted(set(chain.from_iterable(
+        checkpoint['headers'] for checkpoint in checkpoints)))
+    chunks = [_export_chunk_path(export_id, shard)
+              for shard in range(n_shards)]
+    return _get_task_exporter(filetype).make_zip_from_chunks(
+        project, ty, chunks, headers, filters)
+
+
+def delete_export_shards(export_id, n_shards):
+    """Delete the chunk files and checkpoints of a sharded export."""
+    from pybossa.core import sentinel
+    for shard in range(n_shards):
+        path = _export_chunk_path(export_id, shard)
+        if os.path.exists(path):
+            os.remove(path)
+    sentinel.master.delete(EXPORT_SHARDS_KEY.format(export_id),
+                           EXPORT_SHARDS_DONE_KEY.format(export_id))
+
+
+def fail_sharded_export(export_id, n_shards, current_user_email_addr,
+                        project):
+    """Delete the chunks of a sharded export one of whose shards ran out of
+    retries, and tell the user the export failed, once."""
+    from pybossa.core import sentinel
+    failed_key = EXPORT_SHARDS_FAILED_KEY.format(export_id)
+    if not sentinel.master.set(failed_key, 1, nx=True, ex=EXPORT_SHARDS_TTL):
+        return
+    current_app.logger.error("Task export project id %s: export %s failed",
+                             project.id, export_id)
+    delete_export_shards(export_id, n_shards)
+    send_export_failed_email(current_user_email_addr, project)
+
+
+def send_export_failed_email(current_user_email_addr, project):
+    """Send the email of a failed export."""
+    brand = current_app.config.get('BRAND')
+    mail_dict = dict(recipients=[current_user_email_addr],
+                     subject='Data export failed for your project: {0}'
+                     .format(project.name))
+    msg = ('<p>There was an issue with your export. '
+           'Please try again or report this issue '
+           'to a {0} administrator.</p>'.format(brand))
+    if email_service.enabled:
+        mail_dict["body"] = f'\nHello,\n{msg}\nThe {brand} team\n'
+        email_service.send(mail_dict)
+    else:
+        mail_dict['html'] = '<p>Hello,</p>' + msg + '<p>The {0} team.</p>'.format(brand)
+        mail.send(Message(**mail_dict))
+
+
 def export_tasks(current_user_email_addr, short_name,
-                 ty, expanded, filetype, filters=None, disclose_gold=False):
-    """Export tasks/taskruns from a project."""
+                 ty, expanded, filetype, filters=None, disclose_gold=False,
+                 export_id=None, n_shards=None):
+    """Export tasks/taskruns from a project.
+
+    Large exports are split into shards, in which case this job is run
+    again with their ``export_id`` once all of them are done."""
     from pybossa.core import (task_csv_exporter, task_json_exporter,
                               project_repo)
     import pybossa.exporter.consensus_exporter as export_consensus
     project = project_repo.get_by_shortname(short_name)
     current_app.logger.info(f"exporting tasks for project {project.id}")
 
+    if export_id is None:
+        n_shards = start_sharded_export(current_user_email_addr, project, ty,
+                                        expanded, filetype, filters,
+                                        disclose_gold)
+        if n_shards:
+            job_response = '{0} {1} export for {2} was split into {3} shards'
+            return job_response.format(
+                    ty.capitalize(), filetype.upper(), project.name, n_shards)
+
     try:
         # Export data and upload .zip file locally
         if ty == 'consensus':
             export_fn = getattr(export_consensus,
                                 'export_consensus_{}'.format(filetype))
+        elif export_id is not None:
+            export_fn = partial(merge_export_shards, export_id, n_shards,
+                                filetype)
         elif filetype == 'json':
             export_fn = task_json_exporter.make_zip
         elif filetype == 'csv':
@@ -985,6 +1336,8 @@ def export_tasks(current_user_email_addr, short_name,
             with export_fn(project, ty, expanded, filters, disclose_gold) as fp:
                 filename = fp.filename
                 content = fp.read()
+            if export_id is not None:
+                delete_export_shards(export_id, n_shards)
 
             bucket_name = current_app.config.get('EXPORT_BUCKET')
             max_email_size = current_app.config.get('EXPORT_MAX_EMAIL_SIZE', float('Inf'))
@@ -1047,6 +1400,8 @@ def export_tasks(current_user_email_addr, short_name,
         current_app.logger.exception(
                 'Export email failed - Project: %s, exception: %s',
                 project.name, str(e))
+        if export_id is not None:
+            delete_export_shards(export_id, n_shards)
         subject = 'Email delivery failed for your project: {0}'.format(project.name)
         msg = 'There was an error when attempting to deliver your data export via email.'
         body = 'Hello,\n\n' + msg + '\n\nThe {0} team.'
@@ -1244,13 +1599,12 @@ def get_weekly_stats_update_projects():
 
 
 def send_weekly_stats_project(project_id):
-    from pybossa.cache.project_stats import update_stats, get_stats
+    from pybossa.cache.project_stats import get_stats
     from pybossa.core import project_repo
     from datetime import datetime
     project = project_repo.get(project_id)
     if project.owner.subscribed is False or project.owner.restrict:
         return "Owner does not want updates by email"
-    update_stats(project_id)
     dates_stats, hours_stats, users_stats = get_stats(project_id,
                                                       period='1 week')
     subject = "Weekly Update: %s" % project.name
@@ -20,6 +20,8 @@ from flask import current_app
 
 from rq import Queue
 from sqlalchemy import event, text
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.orm.attributes import get_history
 
 from flask import url_for
 
@@ -34,10 +36,13 @@ from pybossa.model.webhook import Webhook
 from pybossa.model.user import User
 from pybossa.model.result import Result
 from pybossa.core import result_repo, db, task_repo
-from pybossa.jobs import webhook, notify_blog_users, check_and_send_task_notifications
+from pybossa.jobs import webhook, notify_blog_users, check_and_send_task_notifications, \
+    enqueue_taskrun_events
 from pybossa.cache import projects as cached_projects
 from pybossa.cache import users as cached_users
+from pybossa.cache import project_stats
 from pybossa import sched
+from pybossa import available_tasks
 
 from pybossa.core import sentinel
 from pybossa.sched import Schedulers
@@ -46,6 +51,11 @@ webhook_queue = Queue('high', connection=sentinel.master)
 mail_queue = Queue('email', connection=sentinel.master)
 webpush_queue = Queue('webpush', connection=sentinel.master)
 
+# Session.info entries holding side effects to run once the session commits
+TASKRUN_EVENTS = 'taskrun_events'
+TASK_LOCKS = 'task_locks'
+PROJECT_CONTRIBUTORS = 'project_contributors'
+
 
 @event.listens_for(Project, 'after_insert')
 def add_project_event(mapper, conn, target):
@@ -67,27 +77,26 @@ def add_project_event(mapper, conn, target):
     conn.execute(sql_query)
 
 
-@event.listens_for(Task, 'before_insert')
-def before_add_task_event(mapper, conn, target):
+def flag_updated_project(project_id):
+    """Flag a project receiving new tasks in updated_project_ids."""
     redis_conn = sentinel.master
-    if cached_projects.get_project_scheduler(target.project_id) in [Schedulers.user_pref, Schedulers.task_queue]:
-        if not redis_conn.hget('updated_project_ids', target.project_id):
-            redis_conn.hset('updated_project_ids', target.project_id, make_timestamp())
+    if cached_projects.get_project_scheduler(project_id) in [Schedulers.user_pref, Schedulers.task_queue]:
+        if not redis_conn.hget('updated_project_ids', project_id):
+            redis_conn.hset('updated_project_ids', project_id, make_timestamp())
     else:
-        if cached_projects.overall_progress(target.project_id) == 100:
-            redis_conn.hset('updated_project_ids', target.project_id, make_timestamp())
+        if cached_projects.overall_progress(project_id) == 100:
+            redis_conn.hset('updated_project_ids', project_id, make_timestamp())
 
 
-@event.listens_for(Task, 'after_insert')
-def add_task_event(mapper, conn, target):
-    """Update PYBOSSA feed with new task."""
-    sql_query = ('select name, short_name, info from project \
-                 where id=%s') % target.project_id
-    results = conn.execute(sql_query)
+def add_new_tasks_to_feed(conn, project_id):
+    """Update PYBOSSA feed with new tasks of a project."""
+    sql_query = text('''select name, short_name, info from project
+                     where id=:project_id''')
+    results = conn.execute(sql_query, dict(project_id=project_id))
     obj = dict(action_updated='Task')
     tmp = dict()
     for r in results:
-        tmp['id'] = target.project_id
+        tmp['id'] = project_id
         tmp['name'] = r.name
         tmp['short_name'] = r.short_name
         tmp['info'] = r.info
@@ -96,12 +105,59 @@ def add_task_event(mapper, conn, target):
     update_feed(obj)
 
 
+def after_bulk_insert_tasks(conn, project_id):
+    """Side effects of the Task insert listeners for a batch of tasks
+    inserted by TaskRepository.bulk_save_tasks, run once per batch."""
+    add_new_tasks_to_feed(conn, project_id)
+    sql_query = text('''update project set updated=:updated
+                     where id=:project_id''')
+    conn.execute(sql_query, dict(updated=make_timestamp(),
+                                 project_id=project_id))
+    if available_tasks.is_enabled():
+        available_tasks.invalidate(project_id)
+
+
+@event.listens_for(Task, 'before_insert')
+def before_add_task_event(mapper, conn, target):
+    flag_updated_project(target.project_id)
+
+
+@event.listens_for(Task, 'after_insert')
+def add_task_event(mapper, conn, target):
+    """Update PYBOSSA feed with new task."""
+    add_new_tasks_to_feed(conn, target.project_id)
+    if available_tasks.is_enabled():
+        available_tasks.add_task(target)
+
+
 @event.listens_for(Task, 'after_update')
 @event.listens_for(Task, 'after_delete')
 def calculate_and_send_progress_after_update_task(mapper, conn, target):
+    if defer_until_commit(target, TASKRUN_EVENTS,
+                          dict(type='task_update',
+                               project_id=target.project_id)):
+        return
     check_and_send_task_notifications(target.project_id, conn)
 
 
+@event.listens_for(Task, 'after_update')
+def update_available_task(mapper, conn, target):
+    """Keep the project queue of available tasks up to date."""
+    if not available_tasks.is_enabled():
+        return
+    added, _, deleted = get_history(target, 'n_answers')
+    n_answers_delta = 0
+    if added and deleted:
+        n_answers_delta = (added[0] or 0) - (deleted[0] or 0)
+    available_tasks.update_task(target, n_answers_delta, conn)
+
+
+@event.listens_for(Task, 'after_delete')
+def remove_available_task(mapper, conn, target):
+    if available_tasks.is_enabled():
+        available_tasks.remove_task(target.project_id, target.id)
+
+
 @event.listens_for(User, 'after_insert')
 def add_user_event(mapper, conn, target):
     """Update PYBOSSA feed with new user."""
@@ -112,23 +168,28 @@ def add_user_event(mapper, conn, target):
 
 def add_user_contributed_to_feed(conn, user_id, project_obj):
     if user_id is not None:
-        sql_query = ('select fullname, name, info from "user" \
-                     where id=%s and restrict=false') % user_id
-        results = conn.execute(sql_query)
-        tmp = None
-        for r in results:
-            tmp = dict(id=user_id,
-                       name=r.name,
-                       fullname=r.fullname,
-                       info=r.info)
-            tmp = User().to_public_json(tmp)
-            tmp['project_id'] = project_obj['id']
-            tmp['project_name'] = project_obj['name']
-            tmp['project_short_name'] = project_obj['short_name']
-            tmp['category_id'] = project_obj['category_id']
-            tmp['action_updated'] = 'UserContribution'
-        if tmp:
-            update_feed(tmp)
+        add_users_contributed_to_feed(conn, [user_id], project_obj)
+
+
+def add_users_contributed_to_feed(conn, user_ids, project_obj):
+    """Update PYBOSSA feed with the users contributing to a project."""
+    if not user_ids:
+        return
+    sql_query = text('''select id, fullname, name, info from "user"
+                     where id = ANY(:user_ids) and restrict=false''')
+    results = conn.execute(sql_query, dict(user_ids=list(user_ids)))
+    for r in results:
+        tmp = dict(id=r.id,
+                   name=r.name,
+                   fullname=r.fullname,
+                   info=r.info)
+        tmp = User().to_public_json(tmp)
+        tmp['project_id'] = project_obj['id']
+        tmp['project_name'] = project_obj['name']
+        tmp['project_short_name'] = project_obj['short_name']
+        tmp['category_id'] = project_obj['category_id']
+        tmp['action_updated'] = 'UserContribution'
+        update_feed(tmp)
 
 
 def is_task_completed(conn, task_id, project_id):
@@ -166,49 +227,104 @@ def push_webhook(project_obj, task_id, result_id):
 
 def create_result(conn, project_id, task_id):
     """Create a result for the given project and task."""
-    sql_query = ("SELECT id FROM task_run WHERE project_id=%s \
-                 AND task_id=%s") % (project_id, task_id)
-    results = conn.execute(sql_query)
-    task_run_ids = ", ".join(str(tr.id) for tr in results)
-
-    sql_query = ("""SELECT id FROM result WHERE project_id=%s \
-                   AND task_id=%s;""") % (project_id, task_id)
-
-    results = conn.execute(sql_query)
-
-    for r in results:
-        if r:
-            # Update result
-            sql_query = ("""UPDATE result SET last_version=false \
-                           WHERE id=%s;""") % (r.id)
-            conn.execute(sql_query)
-
-    sql_query = """INSERT INTO result
-                   (created, project_id, task_id, task_run_ids, last_version)
-                   VALUES ('%s', %s, %s, '{%s}', %s);""" % (make_timestamp(),
-                                                  project_id,
-                                                  task_id,
-                                                  task_run_ids,
-                                                  True)
-    conn.execute(sql_query)
-
-    sql_query = """SELECT id FROM result \
-                WHERE project_id=%s \
-                AND task_id=%s \
-                AND last_version=true""" % (project_id, task_id)
-
-    results = conn.execute(sql_query)
-    for r in results:
-        return r.id
+    params = dict(project_id=project_id, task_id=task_id)
+    sql_query = text('''UPDATE result SET last_version=false
+                     WHERE project_id=:project_id AND task_id=:task_id
+                     AND last_version=true''')
+    conn.execute(sql_query, params)
+
+    sql_query = text('''INSERT INTO result
+                     (created, project_id, task_id, task_run_ids, last_version)
+                     VALUES (:created, :project_id, :task_id,
+                             ARRAY(SELECT id FROM task_run
+                                   WHERE project_id=:project_id
+                                   AND task_id=:task_id ORDER BY id),
+                             true)
+                     RETURNING id''')
+    return conn.execute(sql_query, dict(params, created=make_timestamp())).scalar()
+
+
+def defer_until_commit(target, name, item, always=False):
+    """Record a side effect of a flush to run after its session commits.
+
+    Returns False, leaving the caller to run the side effect inline, unless
+    TASKRUN_EVENTS_WINDOW is set or always is True.
+    """
+    if not always and current_app.config.get('TASKRUN_EVENTS_WINDOW') is None:
+        return False
+    session = object_session(target)
+    if session is None:
+        return False
+    session.info.setdefault(name, []).append(item)
+    return True
+
+
+@event.listens_for(Session, 'after_commit')
+def run_deferred_side_effects(session):
+    """Release the locks of the committed task runs, count their
+    contributors and hand the rest of their side effects to
+    process_taskrun_events, batched per project. The session is committed,
+    so only Redis is used here."""
+    for lock in session.info.pop(TASK_LOCKS, []):
+        sched.release_task_locks(**lock)
+    for contributor in session.info.pop(PROJECT_CONTRIBUTORS, []):
+        project_stats.add_contributor(**contributor)
+    events = session.info.pop(TASKRUN_EVENTS, None)
+    if events:
+        enqueue_taskrun_events(events)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_deferred_side_effects(session):
+    session.info.pop(TASK_LOCKS, None)
+    session.info.pop(TASKRUN_EVENTS, None)
+    session.info.pop(PROJECT_CONTRIBUTORS, None)
+
+
+def apply_taskrun_events(conn, project_id, events):
+    """Run the side effects of a batch of task runs and task updates of a
+    project: one feed update per contributor, one completion feed update,
+    a webhook per completed task and a single notification check."""
+    project_obj = None
+    user_ids = []
+    completed = []
+    check_notifications = False
+    for ev in events:
+        if ev['type'] != 'task_run':
+            check_notifications = True
+            continue
+        project_obj = ev['project']
+        if ev['user_id'] is not None and ev['user_id'] not in user_ids:
+            user_ids.append(ev['user_id'])
+        if ev['completed']:
+            check_notifications = True
+            if ev['published']:
+                completed.append(ev)
+
+    if project_obj:
+        add_users_contributed_to_feed(conn, user_ids, project_obj)
+    if completed:
+        update_feed(project_obj)
+        for ev in completed:
+            project_private = dict(project_obj, webhook=ev['webhook'])
+            push_webhook(project_private, ev['task_id'], ev['result_id'])
+    if check_notifications:
+        check_and_send_task_notifications(project_id)
 
 
 @event.listens_for(TaskRun, 'after_insert')
 def on_taskrun_submit(mapper, conn, target):
-    """Update the task.state when n_answers condition is met."""
+    """Update the task.state when n_answers condition is met.
+
+    With TASKRUN_EVENTS_WINDOW set, only the database writes run within the
+    flush. Locks are released once the session commits and the feed,
+    webhook and notification side effects run on a worker, batched per
+    project.
+    """
     # Get project details
-    sql_query = ('select name, short_name, published, webhook, info, category_id \
-                 from project where id=%s') % target.project_id
-    results = conn.execute(sql_query)
+    sql_query = text('''select name, short_name, published, webhook, info,
+                     category_id from project where id=:project_id''')
+    results = conn.execute(sql_query, dict(project_id=target.project_id))
     tmp = dict()
     for r in results:
         tmp['name'] = r.name
@@ -223,12 +339,36 @@ def on_taskrun_submit(mapper, conn, target):
     project_public.update(Project().to_public_json(tmp))
     project_public['action_updated'] = 'TaskCompleted'
 
-    sched.after_save(target, conn)
-    add_user_contributed_to_feed(conn, target.user_id, project_public)
+    task = task_repo.get_task(id=target.task_id)
+    deferred = current_app.config.get('TASKRUN_EVENTS_WINDOW') is not None
+    if deferred:
+        scheduler = (tmp.get('info') or {}).get('sched') or 'default'
+        if sched.is_locking_scheduler(scheduler):
+            # no SQL can be emitted after the commit, so the reservation
+            # category of the task is found now
+            reserve_key = sched.get_task_reserve_key(tmp.get('info'),
+                                                     task.info)
+            defer_until_commit(target, TASK_LOCKS,
+                               dict(project_id=target.project_id,
+                                    task_id=target.task_id,
+                                    uid=sched.get_task_run_uid(target),
+                                    reserve_key=reserve_key))
+        taskrun_event = dict(type='task_run',
+                             project_id=target.project_id,
+                             project=project_public,
+                             user_id=target.user_id,
+                             task_id=target.task_id,
+                             completed=False,
+                             published=_published,
+                             webhook=_webhook,
+                             result_id=None)
+        defer_until_commit(target, TASKRUN_EVENTS, taskrun_event)
+    else:
+        sched.after_save(target, conn)
+        add_user_contributed_to_feed(conn, target.user_id, project_public)
 
     # golden tasks never complete; bypass update to task.state
     # mark task as exported false for each task run submissions
-    task = task_repo.get_task(id=target.task_id)
     if task.calibration:
         if task.exported and _published:
             sql_query = ("""UPDATE task SET exported=False \
@@ -236,18 +376,26 @@ def on_taskrun_submit(mapper, conn, target):
             conn.execute(sql_query)
         return
 
+    if available_tasks.is_enabled():
+        available_tasks.add_answer(target.project_id, target.task_id)
     is_completed = is_task_completed(conn, target.task_id, target.project_id)
     if is_completed:
         update_task_state(conn, target.task_id)
-        check_and_send_task_notifications(target.project_id, conn)
+        if deferred:
+            taskrun_event['completed'] = True
+        else:
+            check_and_send_task_notifications(target.project_id, conn)
 
     if is_completed and _published:
-        update_feed(project_public)
         result_id = create_result(conn, target.project_id, target.task_id)
-        project_private = dict()
-        project_private.update(project_public)
-        project_private['webhook'] = _webhook
-        push_webhook(project_private, target.task_id, result_id)
+        if deferred:
+            taskrun_event['result_id'] = result_id
+        else:
+            update_feed(project_public)
+            project_private = dict()
+            project_private.update(project_public)
+            project_private['webhook'] = _webhook
+            push_webhook(project_private, target.task_id, result_id)
 
 
 @event.listens_for(TaskRun, 'after_update')
@@ -257,6 +405,113 @@ def on_taskrun_resubmit(mapper, conn, target):
     conn.execute(sql_query, dict(task_id=target.task_id))
 
 
+@event.listens_for(TaskRun, 'after_insert')
+def add_task_run_to_rollup(mapper, conn, target):
+    """Count the new task run in the rollup of its task."""
+    contributor = (str(target.user_id) if target.user_id is not None
+                   else target.user_ip)
+    sql_query = text('''
+        INSERT INTO task_rollup (task_id, project_id, n_task_runs, finish_time,
+                                 n_contributors)
+        VALUES (:task_id, :project_id, 1, :finish_time,
+                CASE WHEN CAST(:contributor AS TEXT) IS NULL THEN 0 ELSE 1 END)
+        ON CONFLICT (task_id) DO UPDATE
+        SET n_task_runs = task_rollup.n_task_runs + 1,
+        finish_time = GREATEST(task_rollup.finish_time, EXCLUDED.finish_time),
+        n_contributors = task_rollup.n_contributors +
+            CASE WHEN CAST(:contributor AS TEXT) IS NULL OR EXISTS (
+                SELECT 1 FROM task_run
+                WHERE task_id=:task_id AND id != :task_run_id
+                AND coalesce(user_id::text, user_ip) = :contributor)
+            THEN 0 ELSE 1 END''')
+    conn.execute(sql_query, dict(task_id=target.task_id,
+                                 task_run_id=target.id,
+                                 project_id=target.project_id,
+                                 finish_time=target.finish_time,
+                                 contributor=contributor))
+
+
+@event.listens_for(TaskRun, 'after_update')
+@event.listens_for(TaskRun, 'after_delete')
+def refresh_task_rollup(mapper, conn, target):
+    """Recompute the rollup of the task of an updated or deleted task run."""
+    sql_query = text('''
+        UPDATE task_rollup SET n_task_runs = agg.n_task_runs,
+        finish_time = agg.finish_time, n_contributors = agg.n_contributors
+        FROM (SELECT COUNT(id) AS n_task_runs, MAX(finish_time) AS finish_time,
+              COUNT(DISTINCT coalesce(user_id::text, user_ip))
+              AS n_contributors
+              FROM task_run WHERE task_id=:task_id) AS agg
+        WHERE task_rollup.task_id=:task_id''')
+    conn.execute(sql_query, dict(task_id=target.task_id))
+
+
+@event.listens_for(TaskRun, 'after_insert')
+def add_task_run_to_project_stats(mapper, conn, target):
+    """Count the new task run in the hourly and contributor stats of its
+    project. The contributor is added to the HyperLogLogs once the task run
+    is committed."""
+    params = dict(task_run_id=target.id)
+    sql_query = text('''
+        INSERT INTO project_stats_hourly (project_id, hour, n_task_runs,
+                                          n_auth, n_anon)
+        SELECT project_id, DATE_TRUNC('hour', CAST(finish_time AS TIMESTAMP)),
+        1, CASE WHEN user_ip IS NULL THEN 1 ELSE 0 END,
+        CASE WHEN user_id IS NULL THEN 1 ELSE 0 END
+        FROM task_run WHERE id=:task_run_id AND finish_time IS NOT NULL
+        ON CONFLICT (project_id, hour) DO UPDATE
+        SET n_task_runs = project_stats_hourly.n_task_runs + 1,
+        n_auth = project_stats_hourly.n_auth + EXCLUDED.n_auth,
+        n_anon = project_stats_hourly.n_anon + EXCLUDED.n_anon''')
+    conn.execute(sql_query, params)
+    sql_query = text('''
+        INSERT INTO project_stats_contributor (project_id, day, user_id,
+                                               user_ip, n_task_runs)
+        SELECT project_id, CAST(finish_time AS DATE), user_id, user_ip, 1
+        FROM task_run WHERE id=:task_run_id AND finish_time IS NOT NULL
+        AND (user_id IS NULL) != (user_ip IS NULL)
+        ON CONFLICT (project_id, day, coalesce(user_id, 0),
+                     coalesce(user_ip, '')) DO UPDATE
+        SET n_task_runs = project_stats_contributor.n_task_runs + 1
+        RETURNING day''')
+    day = conn.execute(sql_query, params).scalar()
+    if day is not None:
+        contributor = dict(project_id=target.project_id, day=day,
+                           user_id=target.user_id, user_ip=target.user_ip)
+        if not defer_until_commit(target, PROJECT_CONTRIBUTORS, contributor,
+                                  always=True):
+            project_stats.add_contributor(**contributor)
+
+
+@event.listens_for(TaskRun, 'after_delete')
+def remove_task_run_from_project_stats(mapper, conn, target):
+    """Uncount a deleted task run from the stats of its project. The
+    distinct contributors counted by the HyperLogLogs are left as they are."""
+    if target.finish_time is None:
+        return
+    params = dict(project_id=target.project_id, user_id=target.user_id,
+                  user_ip=target.user_ip, finish_time=target.finish_time)
+    sql_query = text('''
+        UPDATE project_stats_hourly SET n_task_runs = n_task_runs - 1,
+        n_auth = n_auth -
+            CASE WHEN CAST(:user_ip AS TEXT) IS NULL THEN 1 ELSE 0 END,
+        n_anon = n_anon -
+            CASE WHEN CAST(:user_id AS INTEGER) IS NULL THEN 1 ELSE 0 END
+        WHERE project_id=:project_id
+        AND hour = DATE_TRUNC('hour', CAST(:finish_time AS TIMESTAMP))''')
+    conn.execute(sql_query, params)
+    contributor = '''
+        WHERE project_id=:project_id AND day = CAST(:finish_time AS DATE)
+        AND coalesce(user_id, 0) = coalesce(CAST(:user_id AS INTEGER), 0)
+        AND coalesce(user_ip, '') = coalesce(CAST(:user_ip AS TEXT), '')'''
+    sql_query = text('''DELETE FROM project_stats_contributor {}
+                     AND n_task_runs <= 1'''.format(contributor))
+    conn.execute(sql_query, params)
+    sql_query = text('''UPDATE project_stats_contributor
+                     SET n_task_runs = n_task_runs - 1 {}'''.format(contributor))
+    conn.execute(sql_query, params)
+
+
 @event.listens_for(Blogpost, 'after_insert')
 @event.listens_for(Blogpost, 'after_update')
 @event.listens_for(Task, 'after_insert')
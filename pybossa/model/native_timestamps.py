@@ -0,0 +1,132 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2015 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Native copies of the TEXT timestamps of tasks and task runs.
+
+task.created, task_run.created and task_run.finish_time hold ISO formatted
+UTC strings, which range queries can only compare after parsing every row.
+Each of them is copied to a TIMESTAMP column named after it with a _ts
+suffix, indexed with project_id:
+
+1. a trigger writes the copies whenever a row is inserted or its TEXT
+   timestamps are updated,
+2. `python cli.py backfill_native_timestamps` copies the rows written before
+   the trigger existed, in batches,
+3. once it is done, setting NATIVE_TIMESTAMPS makes the range queries and
+   orderings read the copies.
+
+The copies are not mapped by the ORM, so they do not show up in the API or
+in exports; the TEXT columns remain the ones read and written by the code.
+"""
+from datetime import datetime, timezone
+
+from flask import current_app, has_app_context
+from sqlalchemy import DDL, event, literal_column
+from sqlalchemy.types import TIMESTAMP
+
+COLUMNS = {
+    'task': ('created',),
+    'task_run': ('created', 'finish_time'),
+}
+
+INDEXES = {
+    'task': ('task_created_ts_idx ON task (created_ts)',
+             'task_project_id_created_ts_idx ON task (project_id, created_ts)'),
+    'task_run': ('task_run_finish_time_ts_idx ON task_run (finish_time_ts)',
+                 'task_run_project_id_finish_time_ts_idx '
+                 'ON task_run (project_id, finish_time_ts)',
+                 'task_run_project_id_created_ts_idx '
+                 'ON task_run (project_id, created_ts)'),
+}
+
+# NULL for the values that are not timestamps instead of failing the write
+PARSE_FUNCTION = '''
+CREATE OR REPLACE FUNCTION text_to_timestamp(value TEXT)
+RETURNS TIMESTAMP AS $$
+BEGIN
+    RETURN CAST(value AS TIMESTAMP);
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE;
+'''
+
+
+def trigger_sql(table):
+    """Return the statements creating the trigger of a table."""
+    columns = COLUMNS[table]
+    assignments = ''.join('NEW.{0}_ts := text_to_timestamp(NEW.{0});\n'
+                          .format(column) for column in columns)
+    return ['''
+            CREATE OR REPLACE FUNCTION {0}_native_timestamps()
+            RETURNS TRIGGER AS $$
+            BEGIN
+                {1}RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            '''.format(table, assignments),
+            'DROP TRIGGER IF EXISTS {0}_native_timestamps ON {0};'.format(table),
+            '''
+            CREATE TRIGGER {0}_native_timestamps
+            BEFORE INSERT OR UPDATE OF {1} ON {0}
+            FOR EACH ROW EXECUTE PROCEDURE {0}_native_timestamps();
+            '''.format(table, ', '.join(columns))]
+
+
+def create_sql(table):
+    """Return the statements adding the native copies to a new table."""
+    statements = [PARSE_FUNCTION]
+    statements += ['ALTER TABLE {} ADD COLUMN {}_ts TIMESTAMP;'.format(
+        table, column) for column in COLUMNS[table]]
+    statements += trigger_sql(table)
+    statements += ['CREATE INDEX {};'.format(index)
+                   for index in INDEXES[table]]
+    return statements
+
+
+def listen(table):
+    """Add the native copies to table when the ORM creates it."""
+    for statement in create_sql(table.name):
+        event.listen(table, 'after_create', DDL(statement))
+
+
+def enabled():
+    """Return whether queries read the native copies."""
+    return has_app_context() and bool(
+        current_app.config.get('NATIVE_TIMESTAMPS'))
+
+
+def native_column(model, name):
+    """Return the native copy of a TEXT timestamp of a Task or TaskRun
+    model, or None when it has none or it is not read yet."""
+    table = model.__tablename__
+    if name not in COLUMNS.get(table, ()) or not enabled():
+        return None
+    return literal_column('{}.{}_ts'.format(table, name), TIMESTAMP)
+
+
+def parse_timestamp(value):
+    """Return a naive datetime for an ISO formatted value, or None."""
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            return None
+    if value.tzinfo:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
@@ -0,0 +1,51 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import Date, Integer, Index, Text, func
+from sqlalchemy.schema import Column, ForeignKey
+
+from pybossa.core import db
+from pybossa.model import DomainObject
+
+
+class ProjectStatsContributor(db.Model, DomainObject):
+    '''Number of task runs each user (or IP for anonymous users) finished in
+    a project per day, kept up to date by the task run event listeners.
+    '''
+
+    __tablename__ = 'project_stats_contributor'
+
+    #: ID
+    id = Column(Integer, primary_key=True)
+    #: Project ID
+    project_id = Column(Integer, ForeignKey('project.id', ondelete='CASCADE'),
+                        nullable=False)
+    #: Day the task runs were finished
+    day = Column(Date, nullable=False)
+    #: User ID of an authenticated contributor
+    user_id = Column(Integer)
+    #: IP of an anonymous contributor
+    user_ip = Column(Text)
+    #: Number of task runs
+    n_task_runs = Column(Integer, nullable=False, default=0)
+
+
+Index('project_stats_contributor_key', ProjectStatsContributor.project_id,
+      ProjectStatsContributor.day,
+      func.coalesce(ProjectStatsContributor.user_id, 0),
+      func.coalesce(ProjectStatsContributor.user_ip, ''), unique=True)
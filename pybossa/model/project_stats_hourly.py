@@ -0,0 +1,45 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import TIMESTAMP
+from sqlalchemy.schema import Column, ForeignKey
+
+from pybossa.core import db
+from pybossa.model import DomainObject
+
+
+class ProjectStatsHourly(db.Model, DomainObject):
+    '''Number of task runs of a project finished within each hour, kept up to
+    date by the task run event listeners so that the project stats don't
+    aggregate task_run on read.
+    '''
+
+    __tablename__ = 'project_stats_hourly'
+
+    #: Project ID
+    project_id = Column(Integer, ForeignKey('project.id', ondelete='CASCADE'),
+                        primary_key=True)
+    #: Finish time of the task runs, truncated to the hour
+    hour = Column(TIMESTAMP, primary_key=True)
+    #: Number of task runs
+    n_task_runs = Column(Integer, nullable=False, default=0)
+    #: Number of task runs of authenticated users
+    n_auth = Column(Integer, nullable=False, default=0)
+    #: Number of task runs of anonymous users
+    n_anon = Column(Integer, nullable=False, default=0)
@@ -25,6 +25,7 @@ from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.ext.mutable import MutableList
 from pybossa.core import db
 from pybossa.model import DomainObject, make_timestamp
+from pybossa.model import native_timestamps
 from pybossa.model.task_run import TaskRun
 
 
@@ -88,3 +89,8 @@ class Task(db.Model, DomainObject):
     # }
 
 Index('task_project_id_idx', Task.project_id)
+Index('task_project_id_id_idx', Task.project_id, Task.id)
+Index('task_project_id_priority_0_id_idx', Task.project_id, Task.priority_0, Task.id)
+Index('task_project_id_created_id_idx', Task.project_id, Task.created, Task.id)
+Index('task_worker_filter_idx', Task.worker_filter, postgresql_using='gin')
+native_timestamps.listen(Task.__table__)
@@ -0,0 +1,47 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from sqlalchemy import Integer, Text, Index
+from sqlalchemy.schema import Column, ForeignKey
+
+from pybossa.core import db
+from pybossa.model import DomainObject
+
+
+class TaskRollup(db.Model, DomainObject):
+    '''Aggregates of the task runs of a task, kept up to date by the task run
+    event listeners so that task lists don't aggregate task_run on read.
+    '''
+
+    __tablename__ = 'task_rollup'
+
+    #: Task ID
+    task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'),
+                     primary_key=True)
+    #: Project ID
+    project_id = Column(Integer, nullable=False)
+    #: Number of task runs
+    n_task_runs = Column(Integer, nullable=False, default=0)
+    #: Finish time of the last task run
+    finish_time = Column(Text)
+    #: Number of distinct users (or IPs for anonymous users) contributing
+    n_contributors = Column(Integer, nullable=False, default=0)
+
+
+Index('task_rollup_project_id_finish_time_idx', TaskRollup.project_id,
+      TaskRollup.finish_time)
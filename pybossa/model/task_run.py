@@ -22,6 +22,7 @@ from sqlalchemy.dialects.postgresql import JSONB
 
 from pybossa.core import db
 from pybossa.model import DomainObject, make_timestamp
+from pybossa.model import native_timestamps, task_run_partitions
 
 
 
@@ -29,16 +30,20 @@ class TaskRun(db.Model, DomainObject):
     '''A run of a given task by a specific user.
     '''
     __tablename__ = 'task_run'
+    __table_args__ = {
+        'postgresql_partition_by': task_run_partitions.PARTITION_BY
+    }
 
     #: ID of the TaskRun
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     #: UTC timestamp for when TaskRun is delivered to user.
     created = Column(Text, default=make_timestamp)
     #: Project.id of the project associated with this TaskRun.
     project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
     #: Task.id of the task associated with this TaskRun.
+    #: Part of the primary key, as task_run is partitioned by it.
     task_id = Column(Integer, ForeignKey('task.id', ondelete='CASCADE'),
-                     nullable=False)
+                     primary_key=True)
     #: User.id of the user contributing the TaskRun (only if authenticated)
     user_id = Column(Integer, ForeignKey('user.id'))
     #: User.ip of the user contributing the TaskRun (only if anonymous)
@@ -61,7 +66,11 @@ class TaskRun(db.Model, DomainObject):
         }
     '''
 
+    __mapper_args__ = {'primary_key': [id]}
+
 Index('task_run_task_id_idx', TaskRun.task_id)
 Index('task_run_user_id_idx', TaskRun.user_id)
 Index('task_run_project_id_idx', TaskRun.project_id)
 Index('unique_user_id_task_id_idx', TaskRun.task_id, TaskRun.user_id, TaskRun.user_ip, TaskRun.external_uid, unique=True)
+native_timestamps.listen(TaskRun.__table__)
+task_run_partitions.listen(TaskRun.__table__)
@@ -0,0 +1,89 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2015 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Range partitions of task_run by task_id.
+
+Task ids grow with the creation time of the tasks, so each partition holds
+the task runs of the tasks created over a period of time:
+
+1. the create_task_run_partitions job keeps TASK_RUN_PARTITIONS_AHEAD
+   partitions of TASK_RUN_PARTITION_SIZE task ids past the last task, while
+   task_run_default catches the rows out of every range,
+2. the purge of old data archives and drops whole partitions once all their
+   tasks are old enough, instead of deleting their rows one by one,
+3. queries of the task runs of a project add PROJECT_TASK_IDS to their
+   conditions, so that only the partitions holding the tasks of the project
+   are scanned.
+
+The primary key of task_run is (id, task_id), as it has to include the
+partition key; the ORM still identifies task runs by their id.
+"""
+import re
+
+from sqlalchemy import DDL, event
+
+PARTITION_BY = 'RANGE (task_id)'
+
+DEFAULT_PARTITION = 'task_run_default'
+
+# Lets the planner skip the partitions out of the task ids of :project_id,
+# which the condition on task_run.project_id alone does not
+PROJECT_TASK_IDS = '''task_run.task_id BETWEEN
+    (SELECT MIN(id) FROM task WHERE project_id = :project_id) AND
+    (SELECT MAX(id) FROM task WHERE project_id = :project_id)'''
+
+BOUNDS_SQL = '''
+SELECT child.relname AS name,
+       pg_get_expr(child.relpartbound, child.oid) AS bound
+  FROM pg_inherits
+  JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+  JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+ WHERE parent.relname = 'task_run'
+'''
+
+_RANGE = re.compile(r"FROM \('?(\d+)'?\) TO \('?(\d+)'?\)")
+
+
+def partition_name(start):
+    return 'task_run_p{}'.format(start)
+
+
+def create_sql(start, size):
+    """Return the statement creating the partition of the task ids from
+    start up to, but not including, start + size."""
+    return ('CREATE TABLE IF NOT EXISTS {} PARTITION OF task_run '
+            'FOR VALUES FROM ({}) TO ({});'.format(
+                partition_name(start), start, start + size))
+
+
+def ranges(rows):
+    """Return the (name, start, stop) of the range partitions listed by
+    BOUNDS_SQL, ordered by start."""
+    found = []
+    for name, bound in rows:
+        match = _RANGE.search(bound or '')
+        if match:
+            found.append((name, int(match.group(1)), int(match.group(2))))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+def listen(table):
+    """Give task_run its default partition when the ORM creates it."""
+    event.listen(table, 'after_create', DDL(
+        'CREATE TABLE IF NOT EXISTS {} PARTITION OF task_run DEFAULT;'
+        .format(DEFAULT_PARTITION)))
@@ -9,6 +9,7 @@ import sys
 import psycopg2
 
 from pybossa.accessdb import AccessDatabase
+from pybossa.model import native_timestamps, task_run_partitions
 
 root_logger = logging.getLogger()
 hdlr = TimedRotatingFileHandler("../purgedata.log", when="D", backupCount=10)
@@ -161,6 +162,12 @@ def generate_multiple_records(table, records):
 
 
 
+def drop_native_timestamps(table, data):
+    # the archived tables only keep the TEXT timestamps
+    columns = [f"{column}_ts" for column in native_timestamps.COLUMNS[table]]
+    return data.drop(columns=columns, errors="ignore")
+
+
 def purge_task_data(task_id, project_id):
     # make copy of task into respective archived table
     # delete task data from results, task_runs, task table
@@ -169,6 +176,8 @@ def purge_task_data(task_id, project_id):
         task_data = pd.read_sql_query(f"SELECT * FROM task WHERE id={task_id}", db.conn)
         task_run_data = pd.read_sql_query(f"SELECT * FROM task_run WHERE task_id={task_id}", db.conn)
         result_data = pd.read_sql_query(f"SELECT * FROM result WHERE task_id={task_id}", db.conn)
+    task_data = drop_native_timestamps("task", task_data)
+    task_run_data = drop_native_timestamps("task_run", task_run_data)
 
     if task_data.empty:
         logger.info("Missing data for task id", task_id)
@@ -218,6 +227,52 @@ def purge_task_data(task_id, project_id):
         logger.exception("Error purging task data. task_id: %s, project_id: %s", task_id, project_id)
 
 
+TASK_RUN_ARCHIVED_COLUMNS = ("id, created, project_id, task_id, user_id, user_ip, finish_time, "
+                             "timeout, calibration, info, external_uid, media_url")
+
+
+def get_task_run_partitions_to_purge(duration):
+    # task ids grow with their creation time: the partitions below the first
+    # task newer than duration only hold task runs of tasks to purge
+    sql = """
+        SELECT COALESCE(MIN(id), (SELECT COALESCE(MAX(id), 0) + 1 FROM task))
+        FROM task
+        WHERE TO_DATE(created, 'YYYY-MM-DD"T"HH24:MI:SS.US') > NOW() - '%(duration)s months' :: INTERVAL;
+    """
+    params = {"duration": duration}
+    partitions = []
+    try:
+        with AccessDatabase() as db:
+            db.execute_sql(sql, params)
+            first_task_id = db.cursor.fetchone()[0]
+            db.execute_sql(task_run_partitions.BOUNDS_SQL)
+            ranges = task_run_partitions.ranges(db.cursor.fetchall())
+        partitions = [name for name, _, stop in ranges if stop <= first_task_id]
+    except (Exception, psycopg2.DatabaseError):
+        logger.error("params %s", str(params))
+        logger.exception("Error obtaining task_run partitions to purge.")
+    return partitions
+
+
+def purge_task_run_partition(name):
+    # archive the task runs of the partition and drop it as a whole, instead
+    # of deleting its rows one task at a time
+    logger.info(f"Purging task_run partition {name}")
+    sql = f"""
+        BEGIN;
+        ALTER TABLE task_run DETACH PARTITION {name};
+        INSERT INTO task_run_archived({TASK_RUN_ARCHIVED_COLUMNS}, updated)
+        SELECT {TASK_RUN_ARCHIVED_COLUMNS}, NOW() AT TIME ZONE 'UTC' FROM {name};
+        DROP TABLE {name};
+        COMMIT;
+    """
+    try:
+        with AccessDatabase() as db:
+            db.execute_sql(sql)
+    except (Exception, psycopg2.DatabaseError):
+        logger.exception("Error purging task_run partition %s", name)
+
+
 def purge_data(data, duration):
     # get all projects from data
     project_ids = data["project_id"].tolist()
@@ -262,6 +317,12 @@ def main():
         logger.info("End purge data script")
         return
 
+    if not (num_projects or project_id):
+        # every project is purged: drop the task_run partitions first, the
+        # tasks then only have their results left to archive
+        for name in get_task_run_partitions_to_purge(duration):
+            purge_task_run_partition(name)
+
     data = data.head(num_projects) if num_projects else data
     logger.info(f"Purge data for top {num_projects} projects")
     purge_data(data, duration=duration)
@@ -0,0 +1,163 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request scoped batching of Redis commands.
+
+The Redis reads and writes of a request are queued on a RedisBatch and sent
+together in one pipeline once the value of a read is needed, or when the
+request ends. An early step of a request can prefetch() the reads a later
+step makes, so both go in the same round trip. Writes made through the batch
+discard the prefetched reads of their key, while code writing to a key
+directly must call discard(). Outside of a request every write is sent right
+away.
+
+A RedisBatch can stand in for a Redis connection for the commands it knows:
+write commands return None, as their replies are only known after a flush.
+
+Writes still queued when the request ends are best effort: the response is
+already built, so a Redis error flushing them is logged and not raised.
+"""
+from functools import partial
+
+from flask import current_app, g, has_request_context
+from redis.exceptions import RedisError
+
+from pybossa.core import sentinel
+
+READ_COMMANDS = frozenset(['exists', 'get', 'hexists', 'hget', 'hgetall',
+                           'hlen', 'lrange', 'mget', 'pfcount', 'smembers',
+                           'ttl', 'zcard', 'zrangebyscore', 'zscore'])
+
+
+class Reply(object):
+
+    """Reply to a queued command, known once its batch is flushed."""
+
+    def __init__(self, batch):
+        self._batch = batch
+        self._resolved = False
+        self._value = None
+
+    @property
+    def value(self):
+        if not self._resolved:
+            self._batch.flush()
+        if isinstance(self._value, Exception):
+            raise self._value
+        return self._value
+
+    def resolve(self, value):
+        self._resolved = True
+        self._value = value
+
+
+class RedisBatch(object):
+
+    """Redis commands queued to be sent in a single pipeline."""
+
+    def __init__(self, conn, autoflush=False):
+        self.conn = conn
+        self.autoflush = autoflush
+        self._commands = []
+        self._prefetched = {}
+
+    def queue(self, command, *args):
+        """Queue a command and return its Reply."""
+        reply = Reply(self)
+        self._commands.append((command, args, reply))
+        return reply
+
+    @staticmethod
+    def _read_key(command, args):
+        # list arguments, e.g. the keys of mget, are made hashable
+        return (command,) + tuple(tuple(arg) if isinstance(arg, list) else arg
+                                  for arg in args)
+
+    def prefetch(self, command, *args):
+        """Queue a read to be consumed by the next identical read()."""
+        self._prefetched[self._read_key(command, args)] = self.queue(command, *args)
+
+    def is_prefetched(self, command, *args):
+        return self._read_key(command, args) in self._prefetched
+
+    def read(self, command, *args):
+        reply = self._prefetched.pop(self._read_key(command, args), None)
+        if reply is None:
+            reply = self.queue(command, *args)
+        return reply.value
+
+    def write(self, command, *args):
+        if args:
+            self.discard(args[0])
+        self.queue(command, *args)
+        if self.autoflush:
+            self.flush()
+
+    def discard(self, key):
+        """Forget the prefetched reads of a key about to be changed."""
+        for prefetched in [p for p in self._prefetched if p[1] == key]:
+            del self._prefetched[prefetched]
+
+    def flush(self):
+        """Send the queued commands. Raises the first failed write."""
+        commands, self._commands = self._commands, []
+        if not commands:
+            return
+        pipeline = self.conn.pipeline(transaction=False)
+        for command, args, _ in commands:
+            getattr(pipeline, command)(*args)
+        results = pipeline.execute(raise_on_error=False)
+        error = None
+        for (command, _, reply), result in zip(commands, results):
+            reply.resolve(result)
+            if (error is None and isinstance(result, Exception) and
+                    command not in READ_COMMANDS):
+                error = result
+        if error is not None:
+            raise error
+
+    def __getattr__(self, command):
+        if command.startswith('_'):
+            raise AttributeError(command)
+        if command in READ_COMMANDS:
+            return partial(self.read, command)
+        return partial(self.write, command)
+
+
+def get_batch(conn=None):
+    """Return the batch of the current request on conn, the master by
+    default. Outside of a request, writes of the batch are not deferred."""
+    if isinstance(conn, RedisBatch):
+        return conn
+    conn = conn or sentinel.master
+    if not has_request_context():
+        return RedisBatch(conn, autoflush=True)
+    batches = g.setdefault('redis_batches', {})
+    if id(conn) not in batches:
+        batches[id(conn)] = RedisBatch(conn)
+    return batches[id(conn)]
+
+
+def flush_batches():
+    """Send the commands still queued by the current request. Redis errors
+    are logged, so that a failed batch does not fail the response."""
+    for batch in g.pop('redis_batches', {}).values():
+        try:
+            batch.flush()
+        except RedisError:
+            current_app.logger.exception('Cannot flush deferred Redis writes')
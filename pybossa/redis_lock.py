@@ -17,10 +17,11 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
-from datetime import timedelta, datetime
+import re
+from datetime import datetime
+from fnmatch import fnmatchcase
 from time import time
 
-from pybossa.contributions_guard import ContributionsGuard
 from pybossa.core import sentinel
 from werkzeug.exceptions import BadRequest
 import os
@@ -28,10 +29,134 @@ import os
 TASK_USERS_KEY_PREFIX = 'pybossa:project:task_requested:timestamps:{0}'
 USER_TASKS_KEY_PREFIX = 'pybossa:user:task_acquired:timestamps:{0}'
 TASK_ID_PROJECT_ID_KEY_PREFIX = 'pybossa:task_id:project_id:{0}'
-ACTIVE_USER_KEY = 'pybossa:active_users_in_project:{}'
+ACTIVE_USER_KEY = 'pybossa:project:{}:active_users'
+LOCKED_TASKS_KEY = 'pybossa:project:{}:locked_tasks'
 EXPIRE_LOCK_DELAY = 5
 EXPIRE_RESERVE_TASK_LOCK_DELAY = 30*60
 USER_EXPORTED_REPORTS_KEY = 'pybossa:user:exported:reports:{}'
+PREFETCHED_TASKS_KEY = 'pybossa:project:{}:user:{}:prefetched_tasks'
+RESERVE_TASK_INDEX_KEY = 'pybossa:reserve_task:project:{}'
+RESERVE_TASK_CATEGORY_KEY = 'pybossa:reserve_task:project:{}:category:{}'
+RESERVE_TASK_KEY_REGEX = re.compile(r'^reserve_task:project:(\d+):category:(.+?):user:')
+
+NO_LIMIT = float('inf')
+
+# Tries to lock each candidate resource in order and stops at the first one
+# acquired. Expired locks are pruned before counting, a client already holding
+# a lock keeps it and a limit of 'none', sent for NO_LIMIT, means no
+# concurrency limit. When an extra key is passed after the candidates, the won
+# resource is recorded in it.
+#   KEYS: candidate resource hashes [, client resources hash]
+#   ARGV: client_id, now, expiration, ttl, n, limit_1..limit_n, key_1..key_n
+# Returns the 1-based index of the acquired candidate or 0.
+ACQUIRE_LOCK_SCRIPT = """
+local function release_expired(key, now)
+    local locks = redis.call('HGETALL', key)
+    for i = 1, #locks, 2 do
+        if now > tonumber(locks[i + 1]) then
+            redis.call('HDEL', key, locks[i])
+        end
+    end
+end
+
+local client_id = ARGV[1]
+local now = tonumber(ARGV[2])
+local expiration = ARGV[3]
+local ttl = tonumber(ARGV[4])
+local n = tonumber(ARGV[5])
+local client_key = KEYS[n + 1]
+
+for i = 1, n do
+    local key = KEYS[i]
+    local limit = ARGV[5 + i]
+    release_expired(key, now)
+    local acquired = redis.call('HEXISTS', key, client_id) == 1
+    if not acquired and (limit == 'none' or
+                         redis.call('HLEN', key) < tonumber(limit)) then
+        redis.call('HSET', key, client_id, expiration)
+        redis.call('EXPIRE', key, ttl)
+        acquired = true
+    end
+    if acquired then
+        if client_key then
+            local member = ARGV[5 + n + i]
+            release_expired(client_key, now)
+            if redis.call('HEXISTS', client_key, member) == 0 then
+                redis.call('HSET', client_key, member, expiration)
+                redis.call('EXPIRE', client_key, ttl)
+            end
+        end
+        return i
+    end
+end
+return 0
+"""
+
+# Task reservations of a project are indexed in a sorted set scored by
+# expiration and in one hash per task category. Both index keys expire with
+# the reservation that expires last.
+#   KEYS: project index, category hash
+#   ARGV: reservation key, expiration, only update an existing reservation
+SET_RESERVATION_SCRIPT = """
+if ARGV[3] == '1' and not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+local expire_at = math.ceil(tonumber(last[2]))
+redis.call('EXPIREAT', KEYS[1], expire_at)
+redis.call('EXPIREAT', KEYS[2], expire_at)
+return 1
+"""
+
+# Records the expiration of a lock in the locked tasks index of a project. The
+# index is shared by all the locks of the project, so its TTL is only extended.
+#   KEYS: locked tasks index
+#   ARGV: member, expiration, ttl (0 to keep the current one)
+INDEX_TASK_LOCK_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local ttl = tonumber(ARGV[3])
+if ttl > 0 and redis.call('TTL', KEYS[1]) < ttl then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+"""
+
+# Removes expired reservations from a project index and its category hashes.
+#   KEYS: project index
+#   ARGV: now, category hash key prefix
+TRIM_RESERVATIONS_SCRIPT = """
+local max = '(' .. ARGV[1]
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', max)
+for _, member in ipairs(expired) do
+    local category = string.match(member, ':category:(.-):user:')
+    if category then
+        redis.call('HDEL', ARGV[2] .. category, member)
+    end
+end
+if #expired > 0 then
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', max)
+end
+return #expired
+"""
+
+def get_reserve_task_index_key(project_id):
+    return RESERVE_TASK_INDEX_KEY.format(project_id)
+
+def get_reserve_task_category_key(project_id, category):
+    return RESERVE_TASK_CATEGORY_KEY.format(project_id, category)
+
+def parse_reserve_task_key(resource_id):
+    """Returns the project id and category of a reservation key."""
+    if type(resource_id) == bytes:
+        resource_id = resource_id.decode()
+    match = RESERVE_TASK_KEY_REGEX.match(resource_id)
+    if not match:
+        return None, None
+    return int(match.group(1)), match.group(2)
+
+def get_prefetched_tasks_key(project_id, user_id):
+    return PREFETCHED_TASKS_KEY.format(project_id, user_id)
 
 def get_active_user_key(project_id):
     return ACTIVE_USER_KEY.format(project_id)
@@ -50,82 +175,73 @@ def get_user_tasks_key(user_id):
 def get_task_id_project_id_key(task_id):
     return TASK_ID_PROJECT_ID_KEY_PREFIX.format(task_id)
 
+def get_locked_tasks_key(project_id):
+    return LOCKED_TASKS_KEY.format(project_id)
+
+def prefetch_active_user_count(project_id, conn):
+    """Queue the removal of the expired active users of a project and the
+    count of the remaining ones on the batch of conn."""
+    # Imported here as pybossa.redis_batch needs pybossa.core to be loaded
+    from pybossa.redis_batch import get_batch
+    batch = get_batch(conn)
+    key = get_active_user_key(project_id)
+    batch.zremrangebyscore(key, '-inf', '({}'.format(time()))
+    batch.prefetch('zcard', key)
+
+
 def get_active_user_count(project_id, conn):
-    now = time()
+    from pybossa.redis_batch import get_batch
+    batch = get_batch(conn)
     key = get_active_user_key(project_id)
-    to_delete = [user for user, expiration in conn.hgetall(key).items()
-                 if float(expiration) < now]
-    if to_delete:
-        conn.hdel(key, *to_delete)
-    return conn.hlen(key)
+    if not batch.is_prefetched('zcard', key):
+        prefetch_active_user_count(project_id, batch)
+    return batch.zcard(key)
 
 
 def register_active_user(project_id, user_id, conn, ttl=2*60*60):
     now = time()
     key = get_active_user_key(project_id)
-    conn.hset(key, user_id, now + ttl)
+    conn.zadd(key, {user_id: now + ttl})
     conn.expire(key, ttl)
 
 
 def unregister_active_user(project_id, user_id, conn):
     now = time()
     key = get_active_user_key(project_id)
-    conn.hset(key, user_id, now + EXPIRE_LOCK_DELAY)
+    conn.zadd(key, {user_id: now + EXPIRE_LOCK_DELAY})
+
+
+def index_task_lock(project_id, task_id, user_id, expiration, conn, ttl=None):
+    """
+    Record in the locked tasks index of a project when the lock of a user on
+    a task expires. When ttl is given, the index key expires no sooner than
+    ttl seconds from now.
+    """
+    key = get_locked_tasks_key(project_id)
+    conn.eval(INDEX_TASK_LOCK_SCRIPT, 1, key,
+              '{}:{}'.format(task_id, user_id), expiration, int(ttl or 0))
 
 
 def get_locked_tasks_project(project_id):
     """Returns a list of locked tasks for a given project."""
-    tasks = []
-    redis_conn = sentinel.master
-    timeout = ContributionsGuard.STAMP_TTL
-    lock_manager = LockManager(sentinel.master, timeout)
-
-    # Get the active users key for this project.
-    key = get_active_user_key(project_id)
+    key = get_locked_tasks_key(project_id)
+    now = time()
+    pipeline = sentinel.master.pipeline(transaction=False)
+    pipeline.zremrangebyscore(key, '-inf', '({}'.format(now))
+    pipeline.zrangebyscore(key, '({}'.format(now), '+inf', withscores=True)
+    _, locks = pipeline.execute()
 
-    # Get the users for each locked task.
-    for user_key in redis_conn.hgetall(key).items():
-        user_id = user_key[0]
-
-        # Redis client in Python returns bytes string
-        if type(user_id) == bytes:
-            user_id = user_id.decode()
-
-        # Get locks by user.
-        user_tasks_key = get_user_tasks_key(user_id)
-        user_tasks = lock_manager.get_locks(user_tasks_key)
-        # Get task ids for the locks.
-        user_task_ids = user_tasks.keys()
-        # Get project ids for the task ids.
-        results = []
-        keys = [get_task_id_project_id_key(t) for t in user_task_ids]
-        if keys:
-            results = sentinel.master.mget(keys)
-
-        # For each locked task, check if the lock is still active.
-        for task_id, task_project_id in zip(user_task_ids, results):
-            if not task_project_id:
-                # Import at runtime due to order of execution for global initialization of task_repo.
-                from pybossa.core import task_repo
-                task = task_repo.get_task(task_id)
-                if task:
-                    task_project_id = task.project_id
-                else:
-                    # Locked task has been deleted.
-                    task_users_key = get_task_users_key(task_id)
-                    lock_manager.release_lock(task_users_key, user_id)
-                    lock_manager.release_lock(user_tasks_key, task_id)
-            # Match the requested project id.
-            if task_project_id and int(task_project_id) == project_id:
-                # Calculate seconds remaining.
-                seconds_remaining = LockManager.seconds_remaining(user_tasks[task_id])
-                if seconds_remaining > 0:
-                    # This lock has not yet expired.
-                    tasks.append({
-                        "user_id": user_id,
-                        "task_id": task_id,
-                        "seconds_remaining": seconds_remaining
-                    })
+    tasks = []
+    for member, expiration in locks:
+        # Members are task_id:user_id, where the user id may be an IP address
+        task_id, user_id = member.decode().split(':', 1)
+        seconds_remaining = LockManager.seconds_remaining(expiration)
+        if seconds_remaining > 0:
+            tasks.append({
+                "user_id": user_id,
+                "task_id": task_id,
+                "seconds_remaining": seconds_remaining
+            })
     return tasks
 
 def get_user_exported_reports_key(user_id):
@@ -174,39 +290,48 @@ class LockManager(object):
         Acquire a lock on a resource.
         :param resource_id: resource on which lock is needed
         :param client_id: id of client needing the lock
-        :param limit: how many clients can access the resource concurrently
+        :param limit: how many clients can access the resource concurrently,
+            NO_LIMIT for any number of them
         :return: True if lock was successfully acquired, else False
         """
+        return self.acquire_first_lock([(resource_id, limit, None)],
+                                       client_id) is not None
+
+    def acquire_first_lock(self, candidates, client_id, client_resource_id=None):
+        """
+        Acquire a lock on the first available resource out of a list of
+        candidates. Expired locks are pruned, existing locks are honoured and
+        the lock is claimed atomically on the Redis server, so all candidates
+        are tried in a single round trip and no mutex is needed.
+        :param candidates: ordered list of (resource_id, limit, key) tuples,
+            where limit is how many clients can access the resource
+            concurrently, NO_LIMIT for any number of them, and key identifies the resource in
+            client_resource_id
+        :param client_id: id of client needing the lock
+        :param client_resource_id: optional hash recording the resources locked
+            by the client. The key of the acquired resource is added to it.
+        :return: the candidate tuple on which the lock was acquired, else None
+        """
+        if not candidates:
+            return None
+
+        keys = [resource_id for resource_id, _, _ in candidates]
+        # A limit below 0, as left by a task with more runs than answers,
+        # locks nothing; only NO_LIMIT lifts the limit
+        limits = ['none' if limit == NO_LIMIT else max(0, int(limit))
+                  for _, limit, _ in candidates]
+        members = ['' if key is None else key for _, _, key in candidates]
+        if client_resource_id is not None:
+            keys.append(client_resource_id)
+
         timestamp = time()
-        expiration = timestamp + self._duration
-        self._release_expired_locks(resource_id, timestamp)
-        if self._redis.hexists(resource_id, client_id):
-            return True
-
-        pipeline = self._redis.pipeline()
-        if limit == float('inf'):
-            pipeline.hset(resource_id, client_id, expiration)
-            pipeline.expire(resource_id, timedelta(seconds=self._duration))
-            pipeline.execute()
-            return True
-
-        # Get a mutex lock for updating redis hash with default TTL 3s
-        lock_name = f"{resource_id}_update_mutex"
-        result = False
-
-        try:
-            with self._redis.lock(lock_name, timeout=3, blocking_timeout=1) as mutex:
-                if not mutex.locked():
-                    return False
-
-                num_acquired = self._redis.hlen(resource_id)
-                if num_acquired < limit:
-                    pipeline.hset(resource_id, client_id, expiration)
-                    pipeline.expire(resource_id, timedelta(seconds=self._duration))
-                    pipeline.execute()
-                    result = True
-        finally:
-            return result
+        args = [client_id, timestamp, timestamp + self._duration,
+                int(self._duration), len(candidates)] + limits + members
+        script = self._redis.register_script(ACQUIRE_LOCK_SCRIPT)
+        index = script(keys=keys, args=args)
+        if not index:
+            return None
+        return candidates[int(index) - 1]
 
     def has_lock(self, resource_id, client_id):
         """
@@ -237,6 +362,17 @@ class LockManager(object):
         cache = pipeline or self._redis
         cache.hset(resource_id, client_id, time() + EXPIRE_LOCK_DELAY)
 
+    def refresh_lock(self, resource_id, client_id, pipeline=None):
+        """
+        Extend a lock so that it expires after the lock duration from now.
+        :param resource_id: resource on which lock is being held
+        :param client_id: id of client holding the lock
+        :param pipeline: object that can queue multiple commands for later execution
+        """
+        cache = pipeline or self._redis
+        cache.hset(resource_id, client_id, time() + self._duration)
+        cache.expire(resource_id, int(self._duration))
+
     def get_locks(self, resource_id):
         """
         Get all locks associated with a particular resource.
@@ -249,38 +385,37 @@ class LockManager(object):
         decoded_locks = {k.decode(): v.decode() for k, v in locks.items()}
         return decoded_locks
 
-    def get_reservation_keys(self, resource_id):
+    def get_reservation_keys(self, project_id, category=None):
         """
-        Get all reservation key/resource_id associated with partial resource information.
-        :param resource_id: resource on project/task/user
+        Get all active reservation keys of a project from its reservation index.
+        :param project_id: project id
+        :param category: optional exact task category; reservations of that
+            category only are read from the per-category hash
         """
-        reservations = self._redis.keys(resource_id) or []
-        decoded_reservation_keys = [k.decode() for k in reservations]
-        return decoded_reservation_keys
-
-    def _release_expired_locks(self, resource_id, now):
-        locks = self.get_locks(resource_id)
-        to_delete = []
-        for key, expiration in locks.items():
-            expiration = float(expiration)
-            if now > expiration:
-                to_delete.append(key)
-        if to_delete:
-            self._redis.hdel(resource_id, *to_delete)
+        if category and '*' not in category:
+            reservations = self._redis.hgetall(
+                get_reserve_task_category_key(project_id, category))
+            now = time()
+            return [k.decode() for k, expiration in reservations.items()
+                    if float(expiration) >= now]
+        reservations = self._redis.zrangebyscore(
+            get_reserve_task_index_key(project_id), time(), '+inf') or []
+        return [k.decode() for k in reservations]
 
     def _release_expired_reserve_for_project(self, project_id):
-        resource_id = "reserve_task:project:{}:category:*:user:*:task:*".format(project_id)
-        timestamp = time()
-
-        reservation_keys = self.get_reservation_keys(resource_id)
-        for k in reservation_keys:
-            self._release_expired_reserve_task_locks(k, timestamp)
-
-    def _release_expired_reserve_task_locks(self, resource_id, now):
-        expiration = self._redis.get(resource_id) or 0
-        if now > float(expiration):
-            self._redis.delete(resource_id)
+        script = self._redis.register_script(TRIM_RESERVATIONS_SCRIPT)
+        script(keys=[get_reserve_task_index_key(project_id)],
+               args=[time(), get_reserve_task_category_key(project_id, '')])
 
+    def _set_reserve_task_lock(self, resource_id, expiration, only_existing=False):
+        project_id, category = parse_reserve_task_key(resource_id)
+        if project_id is None:
+            return False
+        script = self._redis.register_script(SET_RESERVATION_SCRIPT)
+        keys = [get_reserve_task_index_key(project_id),
+                get_reserve_task_category_key(project_id, category)]
+        return bool(script(keys=keys,
+                           args=[resource_id, expiration, int(only_existing)]))
 
     @staticmethod
     def seconds_remaining(expiration):
@@ -313,7 +448,8 @@ class LockManager(object):
             "*" if not task_id else task_id
         )
 
-        category_keys = self.get_reservation_keys(resource_id)
+        category_keys = [key for key in self.get_reservation_keys(project_id, category)
+                         if fnmatchcase(key, resource_id)]
 
         # if key present but for different user, with redundancy = 1, return false
         # TODO: for redundancy > 1, check if additional task run
@@ -331,15 +467,17 @@ class LockManager(object):
         # check task category reserved by user
         resource_id = "reserve_task:project:{}:category:{}:user:{}:task:{}".format(project_id, category, user_id, task_id)
 
-        timestamp = time()
-        self._release_expired_reserve_task_locks(resource_id, timestamp)
-        expiration = timestamp + self._duration + EXPIRE_RESERVE_TASK_LOCK_DELAY
-        return self._redis.set(resource_id, expiration)
+        expiration = time() + self._duration + EXPIRE_RESERVE_TASK_LOCK_DELAY
+        return self._set_reserve_task_lock(resource_id, expiration)
 
     def release_reserve_task_lock(self, resource_id, expiry):
-        #cache = pipeline or self._redis # https://pythonrepo.com/repo/andymccurdy-redis-py-python-connecting-and-operating-databases#locks
-        cache = self._redis
-        cache.expire(resource_id, expiry)
+        """
+        Release a task reservation, expiring it after expiry seconds. Nothing
+        happens when the reservation does not exist.
+        """
+        self._set_reserve_task_lock(resource_id, time() + expiry,
+                                    only_existing=True)
 
-    def scan_keys(self, pattern):
-        return self._redis.scan_iter(pattern)
+    def index_reserve_task_lock(self, resource_id, expiration):
+        """Add a reservation with a given expiration timestamp to the index."""
+        return self._set_reserve_task_lock(resource_id, expiration)
@@ -42,6 +42,7 @@ import re
 from pybossa.model.project import Project, TaskRun, Task
 from pybossa.model.announcement import Announcement
 from pybossa.model.project_stats import ProjectStats
+from pybossa.model.native_timestamps import native_column, parse_timestamp
 from sqlalchemy import text
 from sqlalchemy.sql import and_, or_
 from sqlalchemy import cast, Text, func, desc, text
@@ -213,13 +214,13 @@ class Repository(object):
             n_favs = func.coalesce(func.array_length(model.fav_user_ids, 1), 0).label('n_favs')
             query = query.add_column(n_favs)
         if orderby in ['created', 'updated', 'finish_time']:
+            column = native_column(model, orderby)
+            if column is None:
+                column = cast(getattr(model, orderby), TIMESTAMP)
             if descending:
-                query = query.order_by(desc(
-                                            cast(getattr(model,
-                                                         orderby),
-                                                 TIMESTAMP)))
+                query = query.order_by(desc(column))
             else:
-                query = query.order_by(cast(getattr(model, orderby), TIMESTAMP))
+                query = query.order_by(column)
         else:
             if orderby != 'fav_user_ids':
                 if descending:
@@ -239,7 +240,7 @@ class Repository(object):
 
     def _filter_by(self, model, limit=None, offset=0, yielded=False,
                   last_id=None, fulltextsearch=None, desc=False,
-                  orderby='id', **filters):
+                  orderby='id', yield_per=None, **filters):
         """Filter by using several arguments and ordering items."""
 
         from_finish_time = filters.pop('from_finish_time', None) or \
@@ -251,8 +252,14 @@ class Repository(object):
             if from_finish_time:
                 if not to_finish_time:
                     to_finish_time = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
-                query = query.filter(and_(model.finish_time >= from_finish_time,
-                                          model.finish_time <= to_finish_time))
+                column = native_column(model, 'finish_time')
+                start = parse_timestamp(from_finish_time)
+                stop = parse_timestamp(to_finish_time)
+                if column is not None and start and stop:
+                    query = query.filter(column.between(start, stop))
+                else:
+                    query = query.filter(and_(model.finish_time >= from_finish_time,
+                                              model.finish_time <= to_finish_time))
 
         if last_id:
             query = query.filter(model.id > last_id)
@@ -262,8 +269,7 @@ class Repository(object):
             query = self._set_orderby_desc(query, model, limit,
                                            last_id, offset, desc, orderby)
         if yielded:
-            limit = limit or 1
-            return query.yield_per(limit)
+            return query.yield_per(yield_per or limit or 1)
         return query.all()
 
 
@@ -16,12 +16,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
-from sqlalchemy import or_, func
+from sqlalchemy import or_, func, text
 from sqlalchemy.exc import IntegrityError
 
 from pybossa.repositories import Repository
 from pybossa.model.project_stats import ProjectStats
 from pybossa.exc import WrongObjectError, DBIntegrityError
+from pybossa.cache.project_stats import add_contributor, \
+    get_contributors_key, reset_contributors, SEEDED_KEY
+from pybossa.core import sentinel
+from pybossa.redis_batch import RedisBatch
 
 
 class ProjectStatsRepository(Repository):
@@ -41,3 +45,65 @@ class ProjectStatsRepository(Repository):
         return self._filter_by(ProjectStats, limit, offset, yielded,
                                last_id, fulltextsearch, desc, orderby,
                                **filters)
+
+    def refresh_project_stats(self, project_id=None, batch_size=1000):
+        """Rebuild the hourly and contributor stats of a project (or of every
+        project) from task_run and seed the HyperLogLogs counting its
+        contributors. Returns the number of contributor rows written."""
+        where = 'AND project_id=:project_id' if project_id else ''
+        params = dict(project_id=project_id)
+        sql = text('''
+                   DELETE FROM project_stats_hourly WHERE true {0};
+                   DELETE FROM project_stats_contributor WHERE true {0};
+                   INSERT INTO project_stats_hourly (project_id, hour,
+                                                     n_task_runs, n_auth,
+                                                     n_anon)
+                   SELECT project_id,
+                   DATE_TRUNC('hour', CAST(finish_time AS TIMESTAMP)) AS hour,
+                   COUNT(id), COUNT(id) FILTER (WHERE user_ip IS NULL),
+                   COUNT(id) FILTER (WHERE user_id IS NULL)
+                   FROM task_run WHERE finish_time IS NOT NULL {0}
+                   GROUP BY project_id, hour;
+                   '''.format(where))
+        self.db.session.execute(sql, params)
+        sql = text('''
+                   INSERT INTO project_stats_contributor (project_id, day,
+                                                          user_id, user_ip,
+                                                          n_task_runs)
+                   SELECT project_id, CAST(finish_time AS DATE) AS day,
+                   user_id, user_ip, COUNT(id)
+                   FROM task_run WHERE finish_time IS NOT NULL
+                   AND (user_id IS NULL) != (user_ip IS NULL) {}
+                   GROUP BY project_id, day, user_id, user_ip
+                   '''.format(where))
+        n_rows = self.db.session.execute(sql, params).rowcount
+        self.db.session.commit()
+
+        # Every key is deleted before the first contributor is added to it,
+        # so the HyperLogLogs only count the rows written above
+        batch = RedisBatch(sentinel.master)
+        projects, days = set(), set()
+        if project_id:
+            reset_contributors(project_id, conn=batch)
+            projects.add(project_id)
+        sql = text('''
+                   SELECT project_id, day, user_id, user_ip
+                   FROM project_stats_contributor WHERE true {}
+                   '''.format(where)).execution_options(stream=True)
+        for n, row in enumerate(self.db.session.execute(sql, params), 1):
+            if row.project_id not in projects:
+                reset_contributors(row.project_id, conn=batch)
+                projects.add(row.project_id)
+            if (row.project_id, row.day) not in days:
+                for kind in ('auth', 'anon'):
+                    batch.delete(get_contributors_key(row.project_id, kind,
+                                                      row.day))
+                days.add((row.project_id, row.day))
+            add_contributor(row.project_id, row.day, row.user_id, row.user_ip,
+                            conn=batch)
+            if n % batch_size == 0:
+                batch.flush()
+        for seeded in projects:
+            batch.set(SEEDED_KEY.format(seeded), 1)
+        batch.flush()
+        return n_rows
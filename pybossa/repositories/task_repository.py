@@ -22,12 +22,14 @@ from sqlalchemy import cast, Date
 from pybossa.repositories import Repository
 from pybossa.model.task import Task
 from pybossa.model.task_run import TaskRun
-from pybossa.model import make_timestamp
+from pybossa.model import make_timestamp, native_timestamps, task_run_partitions
 from pybossa.model.user import User
 from pybossa.exc import WrongObjectError, DBIntegrityError
 from pybossa.cache import projects as cached_projects
+from pybossa.cache.project_stats import reset_contributors, remove_task_runs_sql
 from pybossa.core import uploader
-from sqlalchemy import text
+from pybossa import available_tasks
+from sqlalchemy import text, null
 from pybossa.cache.task_browse_helpers import get_task_filters
 import json
 from datetime import datetime, timedelta
@@ -233,8 +235,10 @@ class TaskRepository(Repository):
             # with session_replication_role disabled, follow regular path of data cleanup
             # from child tables via ON CASCADE DELETE configured on task table
             sql = text('''
+                {}
                 DELETE FROM task WHERE project_id=:project_id AND id=:task_id;
-                ''')
+                '''.format(remove_task_runs_sql(
+                    'project_id=:project_id AND task_id=:task_id')))
         else:
             # expedite the deletion process that cleans up data from child tables
             # using set session_replication_role within db transaction. 'bulkdel'
@@ -248,10 +252,13 @@ class TaskRepository(Repository):
                 BEGIN;
                 {}
                 DELETE FROM result WHERE project_id=:project_id AND task_id=:task_id;
+                {}
                 DELETE FROM task_run WHERE project_id=:project_id AND task_id=:task_id;
+                DELETE FROM task_rollup WHERE task_id=:task_id;
                 DELETE FROM task WHERE project_id=:project_id AND id=:task_id;
                 COMMIT;
-                '''.format(sql_session_repl))
+                '''.format(sql_session_repl, remove_task_runs_sql(
+                    'project_id=:project_id AND task_id=:task_id')))
 
         tstart = time.perf_counter()
         self.db.bulkdel_session.execute(sql, dict(project_id=project_id, task_id=task_id))
@@ -265,6 +272,7 @@ class TaskRepository(Repository):
 
         tstart = time.perf_counter()
         cached_projects.clean_project(project_id)
+        self._remove_available_task(project_id, task_id)
         tend = time.perf_counter()
         time_clean_project = tend - tstart
 
@@ -279,6 +287,8 @@ class TaskRepository(Repository):
         self.db.session.execute(text('''
                    DELETE FROM result WHERE project_id=:project_id
                                       AND task_id=:task_id;'''), args)
+        self.db.session.execute(text(remove_task_runs_sql(
+            'project_id=:project_id AND task_id=:task_id')), args)
         self.db.session.execute(text('''
                    DELETE FROM task_run WHERE project_id=:project_id
                                         AND task_id=:task_id;'''), args)
@@ -287,18 +297,24 @@ class TaskRepository(Repository):
                                     AND id=:task_id;'''), args)
         self.db.session.commit()
         cached_projects.clean_project(project_id)
+        self._remove_available_task(project_id, task_id)
         check_and_send_task_notifications(project_id)
 
     def delete_valid_from_project(self, project, force_reset=False, filters=None):
         if not force_reset:
             """Delete only tasks that have no results associated."""
             params = {}
+            # the task runs go with their tasks by ON DELETE CASCADE
             sql = text('''
+                {}
                 DELETE FROM task WHERE task.project_id=:project_id
                 AND task.id NOT IN
                 (SELECT task_id FROM result
                 WHERE result.project_id=:project_id GROUP BY result.task_id);
-                ''')
+                '''.format(remove_task_runs_sql(
+                    'project_id=:project_id AND task_id NOT IN '
+                    '(SELECT task_id FROM result '
+                    'WHERE result.project_id=:project_id)')))
         else:
             """force reset, remove all results."""
             filters = filters or {}
@@ -321,45 +337,154 @@ class TaskRepository(Repository):
                     coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                     priority_0, task.created
                     FROM task LEFT OUTER JOIN
-                    (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                    MAX(finish_time) as ft FROM task_run
-                    WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                    (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                    finish_time as ft FROM task_rollup
+                    WHERE project_id=:project_id) AS log_counts
                     ON task.id=log_counts.task_id
                     WHERE task.project_id=:project_id {}
                 );
                 DELETE FROM result WHERE project_id=:project_id
                        AND task_id in (SELECT id FROM to_delete);
+                {}
                 DELETE FROM task_run WHERE project_id=:project_id
                        AND task_id in (SELECT id FROM to_delete);
+                DELETE FROM task_rollup WHERE project_id=:project_id
+                       AND task_id in (SELECT id FROM to_delete);
                 DELETE FROM task WHERE task.project_id=:project_id
                        AND id in (SELECT id FROM to_delete);
                 COMMIT;
-                '''.format(sql_session_repl, conditions))
+                '''.format(sql_session_repl, conditions, remove_task_runs_sql(
+                    'project_id=:project_id '
+                    'AND task_id in (SELECT id FROM to_delete)')))
         self.db.bulkdel_session.execute(sql, dict(project_id=project.id, **params))
         self.db.bulkdel_session.commit()
         cached_projects.clean_project(project.id)
+        self._invalidate_available_tasks(project.id)
         self._delete_zip_files_from_store(project)
 
     def delete_taskruns_from_project(self, project):
+        sql = text('''SELECT DISTINCT day FROM project_stats_contributor
+                   WHERE project_id=:project_id''')
+        days = [row.day for row in
+                self.db.session.execute(sql, dict(project_id=project.id))]
         sql = text('''
                    DELETE FROM task_run WHERE project_id=:project_id;
+                   DELETE FROM task_rollup WHERE project_id=:project_id;
+                   DELETE FROM project_stats_hourly WHERE project_id=:project_id;
+                   DELETE FROM project_stats_contributor WHERE project_id=:project_id;
                    UPDATE task SET state='ongoing', exported=false WHERE project_id=:project_id;
                    UPDATE task SET exported=true WHERE project_id=:project_id AND calibration=1
                    ''')
         self.db.session.execute(sql, dict(project_id=project.id))
         self.db.session.commit()
+        reset_contributors(project.id, days)
         cached_projects.clean_project(project.id)
+        self._invalidate_available_tasks(project.id)
         self._delete_zip_files_from_store(project)
 
+    _task_rollup_aggregates = '''
+        SELECT task_id, project_id, COUNT(id) AS n_task_runs,
+        MAX(finish_time) AS finish_time,
+        COUNT(DISTINCT coalesce(user_id::text, user_ip)) AS n_contributors
+        FROM task_run {} GROUP BY task_id, project_id'''
+
+    def refresh_task_rollup(self, project_id=None):
+        """Rebuild the task_rollup rows of a project (or of every project)
+        from task_run. Returns the number of rows written."""
+        where = 'WHERE project_id=:project_id' if project_id else 'WHERE true'
+        sql = text('''
+                   DELETE FROM task_rollup {0} AND task_id NOT IN
+                   (SELECT task_id FROM task_run {0})
+                   '''.format(where))
+        self.db.session.execute(sql, dict(project_id=project_id))
+        aggregates = self._task_rollup_aggregates.format(where)
+        sql = text('''
+                   INSERT INTO task_rollup (task_id, project_id, n_task_runs,
+                                            finish_time, n_contributors)
+                   {}
+                   ON CONFLICT (task_id) DO UPDATE
+                   SET n_task_runs = EXCLUDED.n_task_runs,
+                   finish_time = EXCLUDED.finish_time,
+                   n_contributors = EXCLUDED.n_contributors
+                   '''.format(aggregates))
+        result = self.db.session.execute(sql, dict(project_id=project_id))
+        self.db.session.commit()
+        return result.rowcount
+
+    def find_task_rollup_mismatches(self, project_id=None):
+        """Return the ids of the tasks whose task_rollup row disagrees with
+        their task runs."""
+        where = 'WHERE project_id=:project_id' if project_id else 'WHERE true'
+        sql = text('''
+                   SELECT coalesce(agg.task_id, task_rollup.task_id) AS task_id
+                   FROM ({}) AS agg FULL OUTER JOIN
+                   (SELECT * FROM task_rollup {}) AS task_rollup
+                   ON agg.task_id = task_rollup.task_id
+                   WHERE agg.task_id IS NULL OR task_rollup.task_id IS NULL
+                   OR agg.n_task_runs != task_rollup.n_task_runs
+                   OR agg.finish_time IS DISTINCT FROM task_rollup.finish_time
+                   OR agg.n_contributors != task_rollup.n_contributors
+                   ORDER BY 1
+                   '''.format(self._task_rollup_aggregates.format(where),
+                              where))
+        rows = self.db.session.execute(sql, dict(project_id=project_id))
+        return [row.task_id for row in rows]
+
+    def backfill_native_timestamps(self, batch_size=10000):
+        """Copy the TEXT timestamps of the tasks and task runs written before
+        their native copies existed, committing one batch of ids at a time.
+        Returns the number of rows updated per table."""
+        updated = {}
+        for table, columns in native_timestamps.COLUMNS.items():
+            max_id = self.db.session.execute(
+                text('SELECT MAX(id) FROM {}'.format(table))).scalar() or 0
+            sql = text('''
+                       UPDATE {} SET {} WHERE id > :start AND id <= :stop
+                       AND ({})
+                       '''.format(table,
+                                  ', '.join('{0}_ts = text_to_timestamp({0})'
+                                            .format(c) for c in columns),
+                                  ' OR '.join('{0}_ts IS NULL'.format(c)
+                                              for c in columns)))
+            updated[table] = 0
+            for start in range(0, max_id, batch_size):
+                result = self.db.session.execute(
+                    sql, dict(start=start, stop=start + batch_size))
+                self.db.session.commit()
+                updated[table] += result.rowcount
+        return updated
+
+    def create_task_run_partitions(self, size, ahead):
+        """Create the task_run partitions of size task ids needed for ahead
+        partitions past the last task. Returns the names of the created
+        partitions."""
+        rows = self.db.session.execute(text(task_run_partitions.BOUNDS_SQL))
+        ranges = task_run_partitions.ranges(rows)
+        start = ranges[-1][2] if ranges else 0
+        # A new range cannot take rows already in the default partition
+        sql = text('SELECT MAX(task_id) FROM {}'.format(
+            task_run_partitions.DEFAULT_PARTITION))
+        start = max(start, (self.db.session.execute(sql).scalar() or -1) + 1)
+        last_task = self.db.session.execute(
+            text('SELECT MAX(id) FROM task')).scalar() or 0
+        created = []
+        while start <= last_task + ahead * size:
+            self.db.session.execute(
+                text(task_run_partitions.create_sql(start, size)))
+            created.append(task_run_partitions.partition_name(start))
+            start += size
+        self.db.session.commit()
+        return created
+
     def get_tasks_by_filters(self, project, filters=None):
         filters = filters or {}
         conditions, params = get_task_filters(filters)
 
         sql = ''' SELECT task.id
                 from task LEFT OUTER JOIN
-                (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                MAX(finish_time) as ft FROM task_run
-                WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                finish_time as ft FROM task_rollup
+                WHERE project_id=:project_id) AS log_counts
                 ON task.id=log_counts.task_id
                 WHERE task.project_id=:project_id {}
         '''.format(conditions)
@@ -392,9 +517,9 @@ class TaskRepository(Repository):
                         coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                         priority_0, task.created
                         FROM task LEFT OUTER JOIN
-                        (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                        MAX(finish_time) as ft FROM task_run
-                        WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                        (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                        finish_time as ft FROM task_rollup
+                        WHERE project_id=:project_id) AS log_counts
                         ON task.id=log_counts.task_id
                         WHERE task.project_id=:project_id {}
                    ),
@@ -425,6 +550,7 @@ class TaskRepository(Repository):
         self.update_task_state(project.id)
         self.db.session.commit()
         cached_projects.clean_project(project.id)
+        self._invalidate_available_tasks(project.id)
         check_and_send_task_notifications(project.id)
         return tasks_not_updated
 
@@ -478,9 +604,9 @@ class TaskRepository(Repository):
                         coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                         priority_0, task.created
                         FROM task LEFT OUTER JOIN
-                        (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                        MAX(finish_time) as ft FROM task_run
-                        WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                        (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                        finish_time as ft FROM task_rollup
+                        WHERE project_id=:project_id) AS log_counts
                         ON task.id=log_counts.task_id
                         WHERE task.project_id=:project_id {}
                    )
@@ -494,6 +620,7 @@ class TaskRepository(Repository):
                                           **params))
         self.db.session.commit()
         cached_projects.clean_project(project_id)
+        self._invalidate_available_tasks(project_id)
 
     def find_duplicate(self, project_id, info, dup_checksum=None, completed_tasks=False):
         """
@@ -528,6 +655,97 @@ class TaskRepository(Repository):
         if row:
             return row[0]
 
+    def find_duplicate_checksums(self, project_id, dup_checksums,
+                                 completed_tasks=False):
+        """Return which of the ``dup_checksums`` already belong to a task of
+        the project, with one query for the whole batch."""
+        if not dup_checksums:
+            return set()
+        task_state_cond = "AND task.state='ongoing'" if not completed_tasks else ""
+        sql = text('''
+                SELECT DISTINCT task.dup_checksum
+                FROM task
+                WHERE task.project_id=:project_id
+                AND task.dup_checksum = ANY(:dup_checksums)
+                AND task.expiration > (now() at time zone 'utc')::timestamp
+                {};'''.format(task_state_cond))
+        rows = self.db.session.execute(
+            sql, dict(project_id=project_id, dup_checksums=list(dup_checksums)))
+        return set(row.dup_checksum for row in rows)
+
+    def find_duplicate_infos(self, project_id, infos):
+        """Return the JSON dumps of the ``infos`` matching the info of an
+        ongoing task of the project, with one query for the whole batch."""
+        if not infos:
+            return set()
+        sql = text('''
+                SELECT batch.info
+                FROM unnest(CAST(:infos AS text[])) AS batch(info)
+                WHERE EXISTS (
+                    SELECT 1 FROM task
+                    WHERE task.project_id=:project_id
+                    AND task.state='ongoing'
+                    AND md5(task.info::text)=md5(((batch.info)::jsonb)::text));
+                ''')
+        infos = [json.dumps(info, allow_nan=False) for info in infos]
+        rows = self.db.session.execute(
+            sql, dict(infos=infos, project_id=project_id))
+        return set(row.info for row in rows)
+
+    def _task_row(self, task):
+        """Return the column values of a new task, filling in the column
+        defaults the ORM would apply on flush."""
+        row = {}
+        for column in Task.__table__.columns:
+            if column.primary_key:
+                continue
+            value = getattr(task, column.key)
+            if value is None and column.default is not None:
+                value = (column.default.arg(None) if column.default.is_callable
+                         else column.default.arg)
+                setattr(task, column.key, value)
+            row[column.key] = null() if value is None else value
+        return row
+
+    def bulk_save_tasks(self, project_id, tasks):
+        """Insert new tasks of a project with a single multi-row INSERT,
+        setting their ids.
+
+        The ids are drawn from the task id sequence before the insert, as
+        the rows of a multi-row INSERT ... RETURNING come in no guaranteed
+        order to map them back to the tasks.
+
+        The per row Task insert listeners are bypassed; their side effects
+        run once for the whole batch instead.
+        """
+        from pybossa.model.event_listeners import (flag_updated_project,
+                                                   after_bulk_insert_tasks)
+        if not tasks:
+            return tasks
+        for task in tasks:
+            self._validate_can_be(self.SAVE_ACTION, task)
+        table = Task.__table__
+        try:
+            flag_updated_project(project_id)
+            ids = self.db.session.execute(text(
+                "SELECT nextval(pg_get_serial_sequence('task', 'id')) "
+                "FROM generate_series(1, :n_tasks)"),
+                dict(n_tasks=len(tasks))).scalars().all()
+            rows = []
+            for task, task_id in zip(tasks, ids):
+                task.id = task_id
+                rows.append(dict(self._task_row(task), id=task_id))
+            self.db.session.execute(table.insert().values(rows))
+            after_bulk_insert_tasks(self.db.session, project_id)
+            self.db.session.commit()
+        except IntegrityError as e:
+            self.db.session.rollback()
+            raise DBIntegrityError(e)
+        except Exception:
+            self.db.session.rollback()
+            raise
+        return tasks
+
     def _validate_can_be(self, action, element):
         from flask import current_app
         from pybossa.core import project_repo
@@ -536,6 +754,15 @@ class TaskRepository(Repository):
             msg = '%s cannot be %s by %s' % (name, action, self.__class__.__name__)
             raise WrongObjectError(msg)
 
+    def _remove_available_task(self, project_id, task_id):
+        if available_tasks.is_enabled():
+            available_tasks.remove_task(project_id, task_id)
+
+    def _invalidate_available_tasks(self, project_id):
+        # Raw SQL bypasses the event listeners maintaining the queue
+        if available_tasks.is_enabled():
+            available_tasks.invalidate(project_id)
+
     def _delete_zip_files_from_store(self, project):
         from pybossa.core import json_exporter, csv_exporter
         global uploader
@@ -563,9 +790,9 @@ class TaskRepository(Repository):
                         coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                         priority_0, task.created
                         FROM task LEFT OUTER JOIN
-                        (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                        MAX(finish_time) as ft FROM task_run
-                        WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                        (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                        finish_time as ft FROM task_rollup
+                        WHERE project_id=:project_id) AS log_counts
                         ON task.id=log_counts.task_id
                         WHERE task.project_id=:project_id
                         AND task.state='completed'
@@ -604,9 +831,9 @@ class TaskRepository(Repository):
                         coalesce(ct, 0) as n_task_runs, task.n_answers, ft,
                         priority_0, task.created
                         FROM task LEFT OUTER JOIN
-                        (SELECT task_id, CAST(COUNT(id) AS FLOAT) AS ct,
-                        MAX(finish_time) as ft FROM task_run
-                        WHERE project_id=:project_id GROUP BY task_id) AS log_counts
+                        (SELECT task_id, CAST(n_task_runs AS FLOAT) AS ct,
+                        finish_time as ft FROM task_rollup
+                        WHERE project_id=:project_id) AS log_counts
                         ON task.id=log_counts.task_id
                         WHERE task.project_id=:project_id {}
                    )
@@ -644,6 +871,7 @@ class TaskRepository(Repository):
         tasks.update({Task.priority_0: sqlalchemy_case(formatted_payload, value=Task.id)}, synchronize_session=False)
         self.db.session.commit()
         cached_projects.clean_project(project_id)
+        self._invalidate_available_tasks(project_id)
 
 
     def bulk_query(self, task_ids, return_only_task_id=False):
@@ -18,6 +18,7 @@
 """Scheduler module for PYBOSSA tasks."""
 import sys
 from functools import wraps
+from itertools import groupby
 from sqlalchemy.sql import func, desc, text
 from sqlalchemy.sql import and_, or_
 from pybossa.model import DomainObject
@@ -27,20 +28,25 @@ from pybossa.core import db, sentinel, project_repo, task_repo
 from .redis_lock import (LockManager, get_active_user_key, get_user_tasks_key,
                          get_task_users_key, get_task_id_project_id_key,
                          register_active_user, unregister_active_user,
-                         get_active_user_count,
-                         EXPIRE_RESERVE_TASK_LOCK_DELAY, EXPIRE_LOCK_DELAY)
+                         get_active_user_count, get_prefetched_tasks_key,
+                         prefetch_active_user_count, index_task_lock,
+                         EXPIRE_RESERVE_TASK_LOCK_DELAY, EXPIRE_LOCK_DELAY,
+                         NO_LIMIT)
 from .contributions_guard import ContributionsGuard
 from werkzeug.exceptions import BadRequest, Forbidden
 import random
 import json
+from time import time
 from pybossa.cache import users as cached_users
 from pybossa.cache import task_browse_helpers as cached_task_browse_helpers
 from flask import current_app
 from pybossa import data_access
+from pybossa import available_tasks
 from datetime import datetime
 import re
 
 from pybossa.util import SavedTaskPositionEnum, get_user_saved_partial_tasks
+from pybossa.redis_batch import get_batch
 
 session = db.slave_session
 
@@ -122,15 +128,27 @@ def can_post(project_id, task_id, user_id_or_ip):
         return True
 
 
+def get_task_run_uid(task_run):
+    return task_run.user_id or \
+           task_run.external_uid or \
+           task_run.user_ip or \
+           '127.0.0.1'
+
+
+def release_task_locks(project_id, task_id, uid, reserve_key=None):
+    """Release the lock and the category reservation of a user on a task.
+    With reserve_key given, e.g. once the session has committed, no SQL is
+    emitted."""
+    release_lock(task_id, uid, TIMEOUT, project_id=project_id)
+    release_reserve_task_lock_by_id(project_id, task_id, uid, TIMEOUT,
+                                    reserve_key=reserve_key)
+
+
 def after_save(task_run, conn):
     scheduler = get_project_scheduler(task_run.project_id, conn)
-    uid = task_run.user_id or \
-          task_run.external_uid or \
-          task_run.user_ip or \
-          '127.0.0.1'
     if is_locking_scheduler(scheduler):
-        release_lock(task_run.task_id, uid, TIMEOUT)
-        release_reserve_task_lock_by_id(task_run.project_id, task_run.task_id, uid, TIMEOUT)
+        release_task_locks(task_run.project_id, task_run.task_id,
+                           get_task_run_uid(task_run))
 
 
 def locked_scheduler(query_factory):
@@ -166,13 +184,24 @@ def locked_scheduler(query_factory):
         if not filter_user_prefs and scheduler_type in [Schedulers.user_pref, Schedulers.task_queue]:
             filter_user_prefs = True
 
+        prefetch = 1 if saved_task_position else get_prefetch_size(project)
+        prefetched_task_ids = get_prefetched_task_ids(project_id, user_id) if prefetch > 1 else []
+
         # "first" or "last" value of saved_task_position will result tasks retrieving from DB
-        task_id, lock_seconds = (None, 0) if saved_task_position else get_task_id_and_duration_for_project_user(project_id, user_id)
+        task_id, lock_seconds = (None, 0) if saved_task_position else \
+            get_task_id_and_duration_for_project_user(project_id, user_id, exclude=prefetched_task_ids)
 
         if lock_seconds > 10:
             task = session.query(Task).get(task_id)
             if task:
                 return [task]
+
+        if prefetched_task_ids:
+            # Serve the next task reserved by an earlier request, without querying for tasks
+            task_id = pop_prefetched_task(project_id, user_id, timeout)
+            if task_id:
+                current_app.logger.info("locked_scheduler. Prefetched task served for project %s, task %s, user %s", project_id, task_id, user_id)
+                return _lock_task_for_user(task_id, project_id, user_id, timeout)
         user_count = get_active_user_count(project_id, sentinel.master)
         assign_user = json.dumps({'assign_user': [cached_users.get_user_email(user_id)]}) if user_id else None
         current_app.logger.info(
@@ -195,14 +224,25 @@ def locked_scheduler(query_factory):
                 )
                 current_app.logger.info("SQL filter excuding task categories reserved by other users. sql filter %s", sql_filters)
 
-        limit = current_app.config.get('DB_MAXIMUM_BATCH_SIZE') if filter_user_prefs else user_count + 5 + current_app.config.get('MAX_SAVED_ANSWERS', 30)
-        sql = query_factory(project_id, user_id=user_id, limit=limit,
-                            rand_within_priority=rand_within_priority,
-                            task_type=task_type, task_category_filters=sql_filters)
-        rows = session.execute(sql, dict(project_id=project_id,
-                                         user_id=user_id,
-                                         assign_user=assign_user,
-                                         limit=limit))
+        # Tasks other users may be holding locks on, plus enough to pick from. The
+        # worker filters are applied and the preference score sorted by the query.
+        max_candidates = prefetch * user_count + 5 + current_app.config.get('MAX_SAVED_ANSWERS', 30)
+        limit = current_app.config.get('DB_MAXIMUM_BATCH_SIZE') if filter_user_prefs and saved_task_position else max_candidates
+        rows = None
+        if available_tasks.is_enabled() and not (filter_user_prefs or sql_filters or saved_task_position):
+            # Pop candidates from the project queue of available tasks instead of scanning task_run
+            rows = available_tasks.get_candidates(project_id, user_id, limit,
+                                                  task_type=task_type,
+                                                  rand_within_priority=rand_within_priority,
+                                                  timeout=project.info.get('timeout'))
+        if rows is None:
+            sql = query_factory(project_id, user_id=user_id, limit=limit,
+                                rand_within_priority=rand_within_priority,
+                                task_type=task_type, task_category_filters=sql_filters)
+            rows = session.execute(sql, dict(project_id=project_id,
+                                             user_id=user_id,
+                                             assign_user=assign_user,
+                                             limit=limit))
 
         if task_queue_scheduler and reserve_task_config and rows and not rows.rowcount and not exclude_user:
             # With task category reserved by user and no records returned,
@@ -237,10 +277,10 @@ def locked_scheduler(query_factory):
         # validate user qualification and calculate task preference score
         user_profile = json.loads(user_profile) if user_profile else {}
         task_rank_info = []
-        for task_id, taskcount, n_answers, calibration, w_filter, w_pref, timeout in rows:
-            score = 0
-            # Check the dictionary task_id_map for the saved task and set the score for sorting
-            if task_id_map:
+        if task_id_map:
+            for task_id, taskcount, n_answers, calibration, w_filter, w_pref, timeout in rows:
+                # Check the dictionary task_id_map for the saved task and set the score for sorting
+                score = 0
                 ttl = task_id_map.get(task_id, -1)
                 if ttl > 0 and saved_task_position == SavedTaskPositionEnum.LAST:
                     score = -ttl  # Saved tasks sink to the bottom, but with earliest saved task first
@@ -251,33 +291,40 @@ def locked_scheduler(query_factory):
                     project_id, task_id, user_id, ttl, score
                 )
                 task_rank_info.append((task_id, taskcount, n_answers, calibration, score, None, timeout))
-            elif filter_user_prefs:  # Only include when filter requirement is met
-                w_pref = w_pref or {}
-                w_filter = w_filter or {}
-                meet_requirement = cached_task_browse_helpers.user_meet_task_requirement(task_id, w_filter, user_profile)
-                if meet_requirement:
-                    score = cached_task_browse_helpers.get_task_preference_score(w_pref, user_profile)
-                    current_app.logger.info("locked_scheduler. User met worker filter requirement for project %s, task %s, user_id %s, worker_filter: %s, user_profile: %s, score=%s",
-                                            project_id, task_id, user_id, w_filter, user_profile, score)
-                    task_rank_info.append((task_id, taskcount, n_answers, calibration, score, None, timeout))
-            else:  # Default/locker schedulers
-                current_app.logger.info(
-                    "locked_scheduler. Task %s added via DEFAULT path (no worker_filter check). "
-                    "User %s, project %s, filter_user_prefs=%s, w_filter=%s",
-                    task_id, user_id, project_id, filter_user_prefs, w_filter
-                )
-                task_rank_info.append((task_id, taskcount, n_answers, calibration, score, None, timeout))
+        elif filter_user_prefs:  # Only include when filter requirement is met
+            matcher = cached_task_browse_helpers.TaskMatcher(user_profile)
+            ranked = matcher.rank(((row[0], row[4], row[5], row) for row in rows),
+                                  limit=max_candidates)
+            task_rank_info = [(task_id, taskcount, n_answers, calibration, score, None, timeout)
+                              for (task_id, taskcount, n_answers, calibration, _, _, timeout), score in ranked]
+            current_app.logger.info("locked_scheduler. User met worker filter requirement for project %s, user_id %s, tasks: %s, user_profile: %s",
+                                    project_id, user_id, [(task[0], task[4]) for task in task_rank_info], user_profile)
+        else:  # Default/locker schedulers
+            task_rank_info = [(task_id, taskcount, n_answers, calibration, 0, None, timeout)
+                              for task_id, taskcount, n_answers, calibration, _, _, timeout in rows]
+            current_app.logger.info(
+                "locked_scheduler. Tasks %s added via DEFAULT path (no worker_filter check). "
+                "User %s, project %s, filter_user_prefs=%s",
+                [task[0] for task in task_rank_info], user_id, project_id, filter_user_prefs
+            )
         rows = sorted(task_rank_info, key=lambda tup: tup[4], reverse=True)
 
-        # Iterate a list of tasks but only lock one task and return the locked task
-        for task_id, taskcount, n_answers, calibration, _, _, timeout in rows:
-            timeout = timeout or TIMEOUT
-            remaining = float('inf') if calibration else n_answers - taskcount
-            if acquire_locks(task_id, user_id, remaining, timeout):
-                # reserve tasks
-                acquire_reserve_task_lock(project_id, task_id, user_id, timeout)
-                current_app.logger.info("locked_scheduler. User acquired lock for project %s, task %s, user %s", project_id, task_id, user_id)
-                return _lock_task_for_user(task_id, project_id, user_id, timeout, calibration)
+        # Try to lock the ranked tasks in batches but only lock one task and return the locked task
+        candidates = [(task_id,
+                       NO_LIMIT if calibration else max(0, n_answers - taskcount),
+                       timeout or TIMEOUT,
+                       calibration)
+                      for task_id, taskcount, n_answers, calibration, _, _, timeout in rows]
+        locked = acquire_first_available_lock(candidates, user_id)
+        if locked:
+            task_id, _, timeout, calibration = locked
+            # reserve tasks
+            acquire_reserve_task_lock(project_id, task_id, user_id, timeout)
+            current_app.logger.info("locked_scheduler. User acquired lock for project %s, task %s, user %s", project_id, task_id, user_id)
+            if prefetch > 1:
+                remaining_candidates = candidates[candidates.index(locked) + 1:]
+                prefetch_tasks(project_id, user_id, remaining_candidates, prefetch - 1)
+            return _lock_task_for_user(task_id, project_id, user_id, timeout, calibration)
         return []
 
     return template_get_locked_task
@@ -333,23 +380,33 @@ def reserve_task_sql_filters(project_id, reserve_task_keys, exclude):
 
 
 def get_reserve_task_key(task_id):
-    reserve_key = ""
     task = task_repo.get_task(task_id)
     if not task:
-        return reserve_key
+        return ""
 
     project = project_repo.get(task.project_id)
-    if not (project and project.info.get("sched", "default") in [Schedulers.task_queue]):
+    if not project:
+        return ""
+    return get_task_reserve_key(project.info, task.info)
+
+
+def get_task_reserve_key(project_info, task_info):
+    """Return the reservation category of a task out of the info of its
+    project and its own, or an empty string."""
+    reserve_key = ""
+    project_info = project_info or {}
+    if project_info.get("sched", "default") not in [Schedulers.task_queue]:
         return reserve_key
 
-    reserve_task_config = project.info.get("reserve_tasks", {}).get("category", [])
+    reserve_task_config = project_info.get("reserve_tasks", {}).get("category", [])
     if not reserve_task_config:
         return reserve_key
 
-    if not all(field in task.info for field in reserve_task_config):
+    task_info = task_info if isinstance(task_info, dict) else {}
+    if not all(field in task_info for field in reserve_task_config):
         return reserve_key
 
-    reserve_key = ":".join(["{}:{}".format(field, task.info[field]) for field in sorted(reserve_task_config)])
+    reserve_key = ":".join(["{}:{}".format(field, task_info[field]) for field in sorted(reserve_task_config)])
     return reserve_key
 
 
@@ -400,6 +457,9 @@ def locked_task_sql(project_id, user_id=None, limit=1, rand_within_priority=Fals
         filters.append('AND task.calibration != 1')
 
     order_by = []
+    if filter_user_prefs:
+        # tasks best matching the user preferences first
+        order_by.append('{} DESC'.format(cached_users.get_worker_pref_score(user_id)))
     if task_type == 'gold_last':
         order_by.append('task.calibration')
     elif task_type == 'gold_first':
@@ -412,13 +472,13 @@ def locked_task_sql(project_id, user_id=None, limit=1, rand_within_priority=Fals
         order_by.append('id ASC')
 
     sql = '''
-           SELECT task.id, COUNT(task_run.task_id) AS taskcount, n_answers, task.calibration,
+           SELECT task.id, coalesce(task_rollup.n_task_runs, 0) AS taskcount, n_answers, task.calibration,
            worker_filter, worker_pref,
               (SELECT info->'timeout'
                FROM project
                WHERE id=:project_id) as timeout
            FROM task
-           LEFT JOIN task_run ON (task.id = task_run.task_id)
+           LEFT JOIN task_rollup ON (task.id = task_rollup.task_id)
            WHERE NOT EXISTS
            (SELECT 1 FROM task_run WHERE project_id=:project_id AND
            user_id=:user_id AND task_id=task.id)
@@ -428,7 +488,6 @@ def locked_task_sql(project_id, user_id=None, limit=1, rand_within_priority=Fals
            AND task.state !='enrich'
            {}
            {}
-           group by task.id
            ORDER BY {}
            LIMIT :limit;
            '''.format(' '.join(filters), task_category_filters,
@@ -504,23 +563,126 @@ def acquire_locks(task_id, user_id, limit, timeout):
     lock_manager = LockManager(sentinel.master, timeout)
     task_users_key = get_task_users_key(task_id)
     user_tasks_key = get_user_tasks_key(user_id)
-    if lock_manager.acquire_lock(task_users_key, user_id, limit):
-        lock_manager.acquire_lock(user_tasks_key, task_id, float('inf'))
-        return True
-    return False
+    acquired = lock_manager.acquire_first_lock(
+        [(task_users_key, limit, task_id)], user_id, user_tasks_key)
+    return acquired is not None
+
 
+def acquire_first_available_lock(candidates, user_id):
+    """Lock the first task out of candidates that the user can obtain.
 
-def release_reserve_task_lock_by_id(project_id, task_id, user_id, timeout, expiry=EXPIRE_RESERVE_TASK_LOCK_DELAY, release_all_task=False):
-    reserve_key = get_reserve_task_key(task_id)
+    candidates is an ordered list of (task_id, limit, timeout, calibration)
+    tuples. Consecutive candidates sharing a timeout are sent to Redis in
+    batches of LOCK_CANDIDATES_BATCH_SIZE, so each batch costs one round trip.
+    Returns the candidate tuple of the locked task or None.
+    """
+    batch_size = current_app.config.get('LOCK_CANDIDATES_BATCH_SIZE', 100)
+    user_tasks_key = get_user_tasks_key(user_id)
+    get_batch().discard(user_tasks_key)
+    for timeout, group in groupby(candidates, key=lambda c: c[2]):
+        lock_manager = LockManager(sentinel.master, timeout)
+        group = list(group)
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            locks = [(get_task_users_key(task_id), limit, task_id)
+                     for task_id, limit, _, _ in batch]
+            acquired = lock_manager.acquire_first_lock(locks, user_id,
+                                                       user_tasks_key)
+            if acquired:
+                return batch[locks.index(acquired)]
+    return None
+
+
+def get_prefetch_size(project):
+    """Number of tasks locked at once for a user of the project."""
+    prefetch = int(project.info.get('prefetch_tasks') or 1)
+    return max(1, min(prefetch, current_app.config.get('MAX_PREFETCH_TASKS', 10)))
+
+
+def prefetch_tasks(project_id, user_id, candidates, n_tasks):
+    """
+    Lock up to n_tasks more tasks out of candidates for the user and queue them
+    to be served by the next requests for a new task.
+    """
+    task_ids, ttl = [], 0
+    while candidates and len(task_ids) < n_tasks:
+        locked = acquire_first_available_lock(candidates, user_id)
+        if not locked:
+            break
+        task_id, _, timeout, _ = locked
+        acquire_reserve_task_lock(project_id, task_id, user_id, timeout)
+        batch = get_batch()
+        save_task_id_project_id(task_id, project_id, 2 * timeout, conn=batch)
+        index_task_lock(project_id, task_id, user_id, time() + timeout,
+                        batch, ttl=timeout)
+        task_ids.append(task_id)
+        ttl = max(ttl, timeout)
+        candidates = candidates[candidates.index(locked) + 1:]
+
+    if task_ids:
+        key = get_prefetched_tasks_key(project_id, user_id)
+        pipeline = sentinel.master.pipeline(transaction=True)
+        pipeline.rpush(key, *task_ids)
+        pipeline.expire(key, ttl)
+        pipeline.execute()
+        current_app.logger.info("Project %s - user %s prefetched tasks %s", project_id, user_id, task_ids)
+    return task_ids
+
+
+def get_prefetched_task_ids(project_id, user_id):
+    key = get_prefetched_tasks_key(project_id, user_id)
+    return [task_id.decode() for task_id in get_batch().lrange(key, 0, -1)]
+
+
+def pop_prefetched_task(project_id, user_id, timeout):
+    """
+    Pop the next prefetched task whose lock is still held by the user and
+    extend that lock by timeout. Returns None when no such task is left.
+    """
+    key = get_prefetched_tasks_key(project_id, user_id)
+    user_tasks = get_user_tasks(user_id, timeout)
+    while True:
+        task_id = sentinel.master.lpop(key)
+        if task_id is None:
+            return None
+        task_id = task_id.decode()
+        expiration = user_tasks.get(task_id)
+        if expiration and LockManager.seconds_remaining(expiration) > EXPIRE_LOCK_DELAY:
+            refresh_lock(task_id, user_id, timeout, project_id)
+            return int(task_id)
+
+
+def release_prefetched_tasks(project_id, user_id, timeout):
+    """Release the locks on the tasks prefetched but not served to the user."""
+    key = get_prefetched_tasks_key(project_id, user_id)
+    pipeline = sentinel.master.pipeline(transaction=True)
+    pipeline.lrange(key, 0, -1)
+    pipeline.delete(key)
+    task_ids, _ = pipeline.execute()
+    lock_manager = LockManager(sentinel.master, timeout)
+    pipeline = sentinel.master.pipeline(transaction=True)
+    for task_id in task_ids:
+        lock_manager.release_lock(get_task_users_key(task_id), user_id, pipeline=pipeline)
+        lock_manager.release_lock(get_user_tasks_key(user_id), task_id.decode(), pipeline=pipeline)
+        index_task_lock(project_id, task_id.decode(), user_id,
+                        time() + EXPIRE_LOCK_DELAY, pipeline)
+    pipeline.execute()
+    return [int(task_id) for task_id in task_ids]
+
+
+def release_reserve_task_lock_by_id(project_id, task_id, user_id, timeout, expiry=EXPIRE_RESERVE_TASK_LOCK_DELAY, release_all_task=False,
+                                    reserve_key=None):
+    if reserve_key is None:
+        reserve_key = get_reserve_task_key(task_id)
     if not reserve_key:
         return
 
     redis_conn = sentinel.master
     lock_manager = LockManager(redis_conn, timeout)
     if release_all_task:
-        pattern = "reserve_task:project:{}:category:{}:user:{}:task:*".format(
-            project_id, reserve_key, user_id)
-        resource_ids = lock_manager.scan_keys(pattern)
+        user_key = ":user:{}:task:".format(user_id)
+        resource_ids = [k for k in lock_manager.get_reservation_keys(project_id, reserve_key)
+                        if user_key in k]
 
         # get_user_tasks contains task_id and time_stamp pair. Filter out non expired tasks
         tasks_locked_by_user = {task_id: time_stamp for task_id, time_stamp
@@ -528,7 +690,7 @@ def release_reserve_task_lock_by_id(project_id, task_id, user_id, timeout, expir
                                 if LockManager.seconds_remaining(time_stamp) > EXPIRE_LOCK_DELAY}
 
         for k in resource_ids:
-            task_id_in_key = int(k.decode().split(":")[-1])
+            task_id_in_key = int(k.split(":")[-1])
             # If a task is locked by the user(in other tab), then the category lock should not be released
             if task_id_in_key == task_id or str(task_id_in_key) not in tasks_locked_by_user:
                 lock_manager.release_reserve_task_lock(k, expiry)
@@ -582,12 +744,12 @@ def acquire_reserve_task_lock(project_id, task_id, user_id, timeout, pipeline=No
 
 def lock_task_for_user(task_id, project_id, user_id):
     sql = '''
-        SELECT task.id, COUNT(task_run.task_id) AS taskcount, n_answers, task.calibration,
+        SELECT task.id, coalesce(task_rollup.n_task_runs, 0) AS taskcount, n_answers, task.calibration,
             (SELECT info->'timeout'
             FROM project
             WHERE id=:project_id) as timeout
         FROM task
-        LEFT JOIN task_run ON (task.id = task_run.task_id)
+        LEFT JOIN task_rollup ON (task.id = task_rollup.task_id)
         WHERE NOT EXISTS
         (SELECT 1 FROM task_run WHERE project_id=:project_id AND
         user_id=:user_id AND task_id=task.id)
@@ -596,7 +758,6 @@ def lock_task_for_user(task_id, project_id, user_id):
         AND ((task.expiration IS NULL) OR (task.expiration > (now() at time zone 'utc')::timestamp))
         AND task.state !='completed'
         AND task.state !='enrich'
-        group by task.id
         '''
 
     rows = session.execute(sql, dict(project_id=project_id,
@@ -618,7 +779,7 @@ def lock_task_for_user(task_id, project_id, user_id):
                 return []
             remaining = n_answers - actual_count
         else:
-            remaining = float('inf')
+            remaining = NO_LIMIT
         if acquire_locks(task_id, user_id, remaining, timeout):
             # reserve tasks
             acquire_reserve_task_lock(project_id, task_id, user_id, timeout)
@@ -626,8 +787,11 @@ def lock_task_for_user(task_id, project_id, user_id):
 
 
 def _lock_task_for_user(task_id, project_id, user_id, timeout, calibration=False):
-    save_task_id_project_id(task_id, project_id, 2 * timeout)
-    register_active_user(project_id, user_id, sentinel.master, ttl=timeout)
+    batch = get_batch()
+    save_task_id_project_id(task_id, project_id, 2 * timeout, conn=batch)
+    register_active_user(project_id, user_id, batch, ttl=timeout)
+    index_task_lock(project_id, task_id, user_id, time() + timeout, batch,
+                    ttl=timeout)
 
     task_type = 'gold task' if calibration else 'task'
     current_app.logger.info(
@@ -636,6 +800,17 @@ def _lock_task_for_user(task_id, project_id, user_id, timeout, calibration=False
     return [session.query(Task).get(task_id)]
 
 
+def refresh_lock(task_id, user_id, timeout, project_id=None):
+    lock_manager = LockManager(sentinel.master, timeout)
+    pipeline = sentinel.master.pipeline(transaction=True)
+    lock_manager.refresh_lock(get_task_users_key(task_id), user_id, pipeline=pipeline)
+    lock_manager.refresh_lock(get_user_tasks_key(user_id), task_id, pipeline=pipeline)
+    if project_id:
+        index_task_lock(project_id, task_id, user_id, time() + timeout,
+                        pipeline, ttl=timeout)
+    pipeline.execute()
+
+
 def release_user_locks_for_project(user_id, project_id):
     user_tasks = get_user_tasks(user_id, TIMEOUT)
     user_task_ids = list(user_tasks.keys())
@@ -645,13 +820,14 @@ def release_user_locks_for_project(user_id, project_id):
         if not task_project_id:
             task_project_id = task_repo.get_task(task_id).project_id
         if int(task_project_id) == project_id:
-            release_lock(task_id, user_id, TIMEOUT)
+            release_lock(task_id, user_id, TIMEOUT, project_id=project_id)
             task_ids.append(task_id)
     current_app.logger.info('released user id {} locks on tasks {}'.format(user_id, task_ids))
     return task_ids
 
 
-def release_lock(task_id, user_id, timeout, pipeline=None, execute=True):
+def release_lock(task_id, user_id, timeout, pipeline=None, execute=True,
+                 project_id=None):
     redis_conn = sentinel.master
     pipeline = pipeline or redis_conn.pipeline(transaction=True)
     lock_manager = LockManager(redis_conn, timeout)
@@ -660,11 +836,20 @@ def release_lock(task_id, user_id, timeout, pipeline=None, execute=True):
     lock_manager.release_lock(task_users_key, user_id, pipeline=pipeline)
     lock_manager.release_lock(user_tasks_key, task_id, pipeline=pipeline)
 
-    project_ids = get_task_ids_project_id([task_id])
-    remaining_user_tasks_id = [t for t in get_user_tasks(user_id, timeout).keys() if t != str(task_id)]
-    if project_ids:
-        if project_ids[0] not in get_task_ids_project_id(remaining_user_tasks_id):
-            unregister_active_user(project_ids[0], user_id, sentinel.master)
+    if project_id is None:
+        # the task to project map may have expired before the lock
+        project_id = get_task_ids_project_id([task_id])[0]
+        if not project_id:
+            task = task_repo.get_task(task_id)
+            project_id = task.project_id if task else None
+    if project_id:
+        project_id = int(project_id)
+        index_task_lock(project_id, task_id, user_id,
+                        time() + EXPIRE_LOCK_DELAY, pipeline)
+        remaining_user_tasks_id = [t for t in get_user_tasks(user_id, timeout).keys() if t != str(task_id)]
+        remaining_project_ids = [int(p) for p in get_task_ids_project_id(remaining_user_tasks_id) if p]
+        if project_id not in remaining_project_ids:
+            unregister_active_user(project_id, user_id, sentinel.master)
 
     if execute:
         pipeline.execute()
@@ -677,27 +862,40 @@ def get_locks(task_id, timeout):
 
 
 def get_user_tasks(user_id, timeout):
-    lock_manager = LockManager(sentinel.master, timeout)
+    lock_manager = LockManager(get_batch(), timeout)
     user_tasks_key = get_user_tasks_key(user_id)
     return lock_manager.get_locks(user_tasks_key)
 
 
-def save_task_id_project_id(task_id, project_id, timeout):
+def prefetch_user_state(project_id, user_id):
+    """Queue the Redis reads the locked scheduler makes first for a user,
+    to send them with the next flush of the request batch."""
+    batch = get_batch()
+    batch.prefetch('hgetall', get_user_tasks_key(user_id))
+    prefetch_active_user_count(project_id, batch)
+    batch.prefetch('lrange', get_prefetched_tasks_key(project_id, user_id), 0, -1)
+
+
+def save_task_id_project_id(task_id, project_id, timeout, conn=None):
     task_id_project_id_key = get_task_id_project_id_key(task_id)
-    sentinel.master.setex(task_id_project_id_key, timeout, project_id)
+    (conn or sentinel.master).setex(task_id_project_id_key, timeout, project_id)
 
 
 def get_task_ids_project_id(task_ids):
     keys = [get_task_id_project_id_key(t) for t in task_ids]
     if keys:
-        return sentinel.master.mget(keys)
+        return get_batch().mget(*keys)
     return []
 
 
-def get_task_id_and_duration_for_project_user(project_id, user_id):
-    """Returns the max seconds remaining locked task for a user and project."""
+def get_task_id_and_duration_for_project_user(project_id, user_id, exclude=None):
+    """
+    Returns the max seconds remaining locked task for a user and project.
+    Tasks in exclude, e.g. prefetched tasks not served yet, are ignored.
+    """
     user_tasks = get_user_tasks(user_id, TIMEOUT)
-    user_task_ids = list(user_tasks.keys())
+    exclude = set(str(t) for t in exclude or [])
+    user_task_ids = [t for t in user_tasks.keys() if t not in exclude]
     project_ids = get_task_ids_project_id(user_task_ids)
     max_seconds_task_id = -1
     max_seconds_remaining = float('-inf')
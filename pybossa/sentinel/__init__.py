@@ -19,6 +19,40 @@
 from redis import sentinel, StrictRedis
 import os
 from dns import resolver
+from flask import g, has_request_context
+
+
+def count_round_trip():
+    """Count a Redis round trip made by the current request."""
+    if has_request_context():
+        g.redis_round_trips = g.get('redis_round_trips', 0) + 1
+
+
+def count_round_trips(client):
+    """Make a Redis client count each command it sends and each pipeline
+    it executes as a round trip of the current request."""
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def counted_execute_command(*args, **options):
+        count_round_trip()
+        return execute_command(*args, **options)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*args, **kwargs):
+            if pipe.command_stack:
+                count_round_trip()
+            return execute(*args, **kwargs)
+        pipe.execute = counted_execute
+        return pipe
+
+    client.execute_command = counted_execute_command
+    client.pipeline = counted_pipeline
+    return client
+
 
 class Sentinel(object):
 
@@ -68,3 +102,6 @@ class Sentinel(object):
             redis_master = app.config.get('REDIS_MASTER') or 'mymaster'
             self.master = self.connection.master_for(redis_master)
             self.slave = self.connection.slave_for(redis_master)
+        count_round_trips(self.master)
+        if self.slave is not self.master:
+            count_round_trips(self.slave)
@@ -25,15 +25,18 @@ import json
 import time
 from six import string_types
 from boto.exception import S3ResponseError
+from redis.exceptions import RedisError
 from werkzeug.exceptions import InternalServerError, NotFound
 from pybossa.util import get_time_plus_delta_ts
 from pybossa.cloud_store_api.s3 import upload_json_data, get_content_from_s3
 from pybossa.cloud_store_api.s3 import get_content_and_key_from_s3
+from pybossa.cloud_store_api.s3 import get_s3_bucket_key, DecryptedKeyStream
 from pybossa.encryption import AESWithGCM
 
 
 TASK_PRIVATE_GOLD_ANSWER_FILE_NAME = 'task_private_gold_answer.json'
 TASK_GOLD_ANSWER_URL_KEY = 'gold_ans__upload_url'
+GOLD_ANSWERS_CACHE_KEY = 'pybossa:gold_answers:{}:{}'
 
 
 def encrypted():
@@ -80,6 +83,7 @@ def set_gold_answers(task, gold_answers):
                             task.project_id, str(task.info), str(gold_answers))
     if encrypted():
         url = upload_files_priv(task, task.project_id, gold_answers, TASK_PRIVATE_GOLD_ANSWER_FILE_NAME)['externalUrl']
+        cache_gold_answers(url, gold_answers)
         gold_answers = dict([(TASK_GOLD_ANSWER_URL_KEY, url)])
 
     task.gold_answers = gold_answers
@@ -123,6 +127,51 @@ def upload_files_priv(task, project_id, data, file_name):
     return {'externalUrl': file_url, 'internalUrl': internal_url}
 
 
+def get_gold_answers_cache_key(url):
+    """Return the cache key of the gold answers uploaded to url.
+
+    The upload path holds the project id and a hash of the uploaded content,
+    so a new upload never reads the answers cached for a previous one.
+    """
+    parts = url.split('/')
+    return GOLD_ANSWERS_CACHE_KEY.format(parts[-3], parts[-2])
+
+
+def cache_gold_answers(url, gold_answers):
+    """Keep the gold answers uploaded to url in Redis, encrypted with
+    FILE_ENCRYPTION_KEY, for GOLD_ANSWERS_CACHE_TIMEOUT seconds."""
+    from pybossa.core import sentinel
+
+    timeout = current_app.config.get('GOLD_ANSWERS_CACHE_TIMEOUT')
+    secret = current_app.config.get('FILE_ENCRYPTION_KEY')
+    if not timeout or not secret:
+        return
+    cipher = AESWithGCM(secret)
+    try:
+        sentinel.master.setex(get_gold_answers_cache_key(url), timeout,
+                              cipher.encrypt(json.dumps(gold_answers)))
+    except RedisError:
+        current_app.logger.exception('Cannot cache gold answers %s', url)
+
+
+def get_cached_gold_answers(url):
+    """Return the cached gold answers uploaded to url, or None."""
+    from pybossa.core import sentinel
+
+    secret = current_app.config.get('FILE_ENCRYPTION_KEY')
+    if not current_app.config.get('GOLD_ANSWERS_CACHE_TIMEOUT') or not secret:
+        return None
+    try:
+        cached = sentinel.slave.get(get_gold_answers_cache_key(url))
+    except RedisError:
+        current_app.logger.exception('Cannot read cached gold answers %s', url)
+        return None
+    if not cached:
+        return None
+    cipher = AESWithGCM(secret)
+    return json.loads(cipher.decrypt(cached))
+
+
 def get_gold_answers(task):
     gold_answers = task.gold_answers
 
@@ -133,6 +182,10 @@ def get_gold_answers(task):
     if not url:
         raise Exception('Cannot retrieve Private Gigwork gold answers for task id {}. URL is missing.'.format(task.id))
 
+    cached = get_cached_gold_answers(url)
+    if cached is not None:
+        return cached
+
     # The task instance here is not the same as the one that was used to generate the hash
     # in the upload url. So we can't regenerate that hash here, and instead we have to parse it
     # from the url.
@@ -143,7 +196,9 @@ def get_gold_answers(task):
     key_name = '/{}/{}/{}'.format(*parts[-3:])
     current_app.logger.info("gold_answers url %s, store %s, conn_name %s, key %s", url, store, conn_name, key_name)
     decrypted = get_content_from_s3(s3_bucket=parts[-4], path=key_name, conn_name=conn_name, decrypt=True)
-    return json.loads(decrypted)
+    gold_answers = json.loads(decrypted)
+    cache_gold_answers(url, gold_answers)
+    return gold_answers
 
 
 def get_path(dict_, path):
@@ -189,26 +244,47 @@ def get_encryption_key(project):
     return get_secret_from_env(project_encryption)
 
 
-def read_encrypted_file(store, project, bucket, key_name):
+def get_encrypted_file_access(store, project, bucket):
+    """Return the connection name and the secret of the encrypted task files
+    in a store and bucket."""
     conn_name = "S3_TASK_REQUEST_V2" if store == current_app.config.get("S3_CONN_TYPE_V2") else "S3_TASK_REQUEST"
-    ## download file
     if bucket not in [current_app.config.get("S3_REQUEST_BUCKET"), current_app.config.get("S3_REQUEST_BUCKET_V2")]:
         secret = get_encryption_key(project)
     else:
         secret = current_app.config.get('FILE_ENCRYPTION_KEY')
+    return conn_name, secret
+
+
+def raise_encrypted_file_error(project, key_name, error):
+    current_app.logger.exception('Project id {} get task file {} {}'.format(project.id, key_name, error))
+    if error.error_code == 'NoSuchKey':
+        raise NotFound('File Does Not Exist')
+    raise InternalServerError('An Error Occurred')
+
 
+def read_encrypted_file(store, project, bucket, key_name):
+    conn_name, secret = get_encrypted_file_access(store, project, bucket)
+    ## download file
     try:
         decrypted, key = get_content_and_key_from_s3(
             bucket, key_name, conn_name, decrypt=secret, secret=secret)
     except S3ResponseError as e:
-        current_app.logger.exception('Project id {} get task file {} {}'.format(project.id, key_name, e))
-        if e.error_code == 'NoSuchKey':
-            raise NotFound('File Does Not Exist')
-        else:
-            raise InternalServerError('An Error Occurred')
+        raise_encrypted_file_error(project, key_name, e)
     return decrypted, key
 
 
+def open_encrypted_file(store, project, bucket, key_name):
+    """Return a DecryptedKeyStream of an encrypted task file and its key.
+    The file is decrypted as the stream is read."""
+    conn_name, secret = get_encrypted_file_access(store, project, bucket)
+    try:
+        _, key = get_s3_bucket_key(bucket, key_name, conn_name)
+        stream = DecryptedKeyStream(key, secret)
+    except S3ResponseError as e:
+        raise_encrypted_file_error(project, key_name, e)
+    return stream, key
+
+
 def generate_checksum(project_id, task, task_contents=None):
     """
     Generate a checksum for duplicate task detection.
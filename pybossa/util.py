@@ -33,7 +33,7 @@ from datetime import timedelta, datetime, date
 from enum import Enum
 from functools import update_wrapper
 from functools import wraps
-from math import ceil
+from math import ceil, isfinite
 from tempfile import NamedTemporaryFile
 
 from pybossa import app_settings
@@ -53,9 +53,9 @@ from sqlalchemy import text
 from sqlalchemy.exc import ProgrammingError
 from yacryptopan import CryptoPAn
 
-from pybossa.cloud_store_api.connection import create_connection
 from pybossa.cloud_store_api.s3 import get_file_from_s3, delete_file_from_s3
-from pybossa.cloud_store_api.s3 import s3_upload_file_storage
+from pybossa.cloud_store_api.s3 import s3_upload_file_storage, get_connection
+from pybossa.model import native_timestamps
 
 from bs4 import BeautifulSoup
 import shutil
@@ -67,6 +67,11 @@ TP_COMPONENT_TAGS = ["text-input", "dropdown-input", "radio-group-input",
 PARTIAL_ANSWER_PREFIX = "partial_answer:project:{project_id}:user:{user_id}"
 PARTIAL_ANSWER_KEY = PARTIAL_ANSWER_PREFIX + ":task:{task_id}"
 PARTIAL_ANSWER_POSITION_KEY = PARTIAL_ANSWER_PREFIX + ":position"
+# Sorted set of the tasks a user saved partial answers for, scored by the
+# expiration of the answers, and set of the users having one, or a saved task
+# position, in a project
+PARTIAL_ANSWER_INDEX_KEY = PARTIAL_ANSWER_PREFIX + ":tasks"
+PARTIAL_ANSWER_USERS_KEY = "partial_answer:project:{project_id}:users"
 
 # Configure csv.reader() for max file size. Reference: https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072/15063941#15063941
 MAX_SIGNED_LONG = (1 << (8 * ctypes.sizeof(ctypes.c_long) - 1)) - 1
@@ -1002,7 +1007,7 @@ def s3_get_file_contents(s3_bucket, s3_path,
     :return: File contents as a string with the
         specified encoding
     """
-    conn = create_connection(**current_app.config.get(conn, {}))
+    conn = get_connection(conn)
     bucket = conn.get_bucket(s3_bucket, validate=False)
     key = bucket.get_key(s3_path)
     return key.get_contents_as_string(
@@ -1048,16 +1053,115 @@ def get_user_pref_db_clause(user_pref, user_email=None):
     return user_pref_sql + email_sql if user_email else user_pref_sql
 
 
+# SQL counterparts of the worker_filter operators
+worker_filter_sql_operators = {
+    "<": ("less_than", "<"),
+    "<=": ("less_than_equal", "<="),
+    ">": ("greater_than", ">"),
+    ">=": ("greater_than_equal", ">="),
+    "=": ("equal", "=="),
+    "!=": ("not_equal", "!="),
+}
+
+
+def _sql_string(value):
+    # quote a string literal, escaping colons as the clause is passed to text()
+    return "'{}'".format(str(value).replace("'", "''").replace(':', '\\:'))
+
+
+def _worker_filter_value(value):
+    # profile value as compared by user_meet_task_requirement
+    value = value or 0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def _worker_filter_field_clause(field, user_data):
+    # Mirrors user_meet_task_requirement for a single profile field. CASE
+    # guards the casts, as postgres does not evaluate AND operands in order.
+    w_filter = 'task.worker_filter->{}'.format(_sql_string(field))
+    op = '{}->>1'.format(w_filter)
+    require = '{}->0'.format(w_filter)
+
+    def compare(user_value, required):
+        whens = ' '.join("WHEN {} IN ('{}', '{}') THEN {} {} {}".format(op, *names, user_value, sql_op, required)
+                         for sql_op, names in worker_filter_sql_operators.items())
+        return 'CASE {} ELSE FALSE END'.format(whens)
+
+    if isinstance(user_data, float):
+        user_value = "'{!r}'::numeric".format(user_data)
+        same_type = """WHEN jsonb_typeof({0}) = 'number' THEN {1}
+                WHEN jsonb_typeof({0}) = 'boolean' THEN {2}""".format(
+            require,
+            compare(user_value, '({}->>0)::numeric'.format(w_filter)),
+            compare(user_value, '({}->>0)::boolean::int'.format(w_filter)))
+    else:
+        user_value = '{} COLLATE "C"'.format(_sql_string(user_data))
+        same_type = """WHEN jsonb_typeof({}) = 'string' THEN {}""".format(
+            require, compare(user_value, '({}->>0) COLLATE "C"'.format(w_filter)))
+
+    # values of different types are never equal, nor can they be ordered
+    return """CASE WHEN NOT task.worker_filter ? {field} THEN TRUE
+                WHEN jsonb_typeof({w_filter}) != 'array' THEN FALSE
+                WHEN jsonb_array_length({w_filter}) < 2 THEN FALSE
+                {same_type}
+                ELSE COALESCE({op} IN ('not_equal', '!='), FALSE) END""".format(
+        field=_sql_string(field), w_filter=w_filter, same_type=same_type, op=op)
+
+
 def get_user_filter_db_clause(user_profile):
-    # expand task filter as per sql format and (partially) match user profiles
-    # still need further validation to filter good tasks out
+    """
+    Return the SQL condition matching the tasks whose worker_filter is met by
+    the user profile, with the semantics of user_meet_task_requirement.
+    """
     sql = """task.worker_filter IS NULL OR task.worker_filter = '{}'""".format("{}")
-    if user_profile:
-        user_profile_keys = [str(key) for key in user_profile.keys()]
-        sql += """ OR task.worker_filter ?| ARRAY{}::text[]""".format(user_profile_keys)
+    profile = {}
+    for field, value in (user_profile or {}).items():
+        if value is None or isinstance(value, (list, dict)):
+            continue
+        value = _worker_filter_value(value)
+        if isinstance(value, float) and not isfinite(value):
+            continue
+        profile[str(field)] = value
+    if not profile:
+        return sql
+
+    fields = 'ARRAY[{}]::text[]'.format(', '.join(_sql_string(field) for field in profile))
+    field_clauses = ' AND '.join('({})'.format(_worker_filter_field_clause(field, value))
+                                 for field, value in profile.items())
+    # ?| narrows the candidates through the worker_filter index, then every
+    # filter key must be in the profile and every filter must be met
+    sql += """ OR (task.worker_filter ?| {fields} AND CASE
+                WHEN jsonb_typeof(task.worker_filter) != 'object' THEN FALSE
+                WHEN task.worker_filter - {fields} != '{{}}'::jsonb THEN FALSE
+                ELSE {field_clauses} END)""".format(fields=fields, field_clauses=field_clauses)
     return sql
 
 
+def get_worker_pref_score_db_expr(user_profile):
+    """
+    Return the SQL expression of the task worker_pref score for the user
+    profile, with the semantics of get_task_preference_score.
+    """
+    values = []
+    for key, value in (user_profile or {}).items():
+        try:
+            value = float(value or 0)
+        except (TypeError, ValueError):
+            continue
+        if isfinite(value) and value:
+            values.append("({}, '{!r}'::numeric)".format(_sql_string(key), value))
+    if not values:
+        return '0'
+    return """(SELECT COALESCE(SUM((pref.value #>> '{{}}')::numeric * profile.value), 0)
+               FROM jsonb_each(CASE WHEN jsonb_typeof(task.worker_pref) = 'object'
+                               THEN task.worker_pref ELSE '{{}}'::jsonb END) AS pref
+               JOIN (VALUES {}) AS profile(key, value) ON pref.key = profile.key
+               WHERE jsonb_typeof(pref.value) = 'number')""".format(', '.join(values))
+
+
 def is_int(s):
     try:
         value = float(str(s))
@@ -1131,11 +1235,15 @@ def get_taskrun_date_range_sql_clause_params(start_date, end_date):
     """Generate date cause and sql params for queriying db."""
     sql_params = {}
     date_clause = ""
+    if native_timestamps.enabled():
+        column, param = "task_run.finish_time_ts", "CAST(:{} AS TIMESTAMP)"
+    else:
+        column, param = "task_run.finish_time", ":{}"
     if start_date:
-        date_clause = " AND task_run.finish_time >=:start_date"
+        date_clause = " AND {} >={}".format(column, param.format('start_date'))
         sql_params['start_date'] = start_date
     if end_date:
-        date_clause += " AND task_run.finish_time <=:end_date"
+        date_clause += " AND {} <={}".format(column, param.format('end_date'))
         sql_params['end_date'] = end_date
     return date_clause, sql_params
 
@@ -1382,41 +1490,121 @@ def extract_task_info_data(task, task_info_str):
         request_fields = request_fields.get(attribute, {})
     return json.dumps(request_fields)
 
-def get_user_saved_partial_tasks(sentinel, project_id, user_id, task_repo=None):
+def save_partial_answer(sentinel, project_id, user_id, task_id, answer, ttl):
     """
-    Get the user saved task id list from Redis keys;
-    When "task_repo" is passed, it will do a cleanup of keys if tasks
-    have been deleted
+    Save a partial answer of a user and register it in the index of the
+    user, scored by its expiration
     """
-    pattern = PARTIAL_ANSWER_KEY.format(project_id=project_id,
-                                        user_id=user_id,
-                                        task_id="*")
-    batch_size = 10000
-    keys = list(sentinel.slave.scan_iter(match=pattern, count=batch_size))
+    key = PARTIAL_ANSWER_KEY.format(project_id=project_id, user_id=user_id,
+                                    task_id=task_id)
+    index_key = PARTIAL_ANSWER_INDEX_KEY.format(project_id=project_id,
+                                                user_id=user_id)
+    users_key = PARTIAL_ANSWER_USERS_KEY.format(project_id=project_id)
+    pipeline = sentinel.master.pipeline(transaction=False)
+    pipeline.setex(key, ttl, answer)
+    pipeline.zadd(index_key, {task_id: time.time() + ttl})
+    pipeline.expire(index_key, ttl)
+    pipeline.sadd(users_key, user_id)
+    pipeline.expire(users_key, ttl)
+    pipeline.execute()
+
+
+def save_partial_answer_position(sentinel, project_id, user_id, position, ttl):
+    """
+    Save where the tasks with partial answers of a user are presented and
+    register the user, so that the position is deleted with the answers
+    """
+    key = PARTIAL_ANSWER_POSITION_KEY.format(project_id=project_id,
+                                             user_id=user_id)
+    users_key = PARTIAL_ANSWER_USERS_KEY.format(project_id=project_id)
+    pipeline = sentinel.master.pipeline(transaction=False)
+    pipeline.setex(key, ttl, position)
+    pipeline.sadd(users_key, user_id)
+    pipeline.ttl(users_key)
+    remaining = pipeline.execute()[-1]
+    # the users set lives as long as the last key registered in it
+    if remaining < ttl:
+        sentinel.master.expire(users_key, ttl)
+
+
+def delete_partial_answers(sentinel, project_id, user_ids=None, task_ids=None):
+    """
+    Delete the partial answers saved for the given tasks, all of them by
+    default, by the given users of a project, or by all of its users.
+    Deleting all of them also deletes the saved task position of the users
+    """
+    users_key = PARTIAL_ANSWER_USERS_KEY.format(project_id=project_id)
+    if user_ids is None:
+        user_ids = [int(user_id) for user_id in sentinel.slave.smembers(users_key)]
+    pipeline = sentinel.master.pipeline(transaction=False)
+    for user_id in user_ids:
+        index_key = PARTIAL_ANSWER_INDEX_KEY.format(project_id=project_id,
+                                                    user_id=user_id)
+        user_task_ids = task_ids
+        if user_task_ids is None:
+            user_task_ids = [int(task_id) for task_id
+                             in sentinel.slave.zrange(index_key, 0, -1)]
+            pipeline.delete(index_key)
+            pipeline.delete(PARTIAL_ANSWER_POSITION_KEY.format(
+                project_id=project_id, user_id=user_id))
+            pipeline.srem(users_key, user_id)
+        elif user_task_ids:
+            pipeline.zrem(index_key, *user_task_ids)
+        for task_id in user_task_ids:
+            pipeline.delete(PARTIAL_ANSWER_KEY.format(project_id=project_id,
+                                                      user_id=user_id,
+                                                      task_id=task_id))
+    pipeline.execute()
 
-    result = dict()
-    redis_key_map = dict()
-    for k in keys:
-        try:
-            k = k.decode('utf-8')
-            task_id = int(k.split(':')[-1])
-            ttl = sentinel.slave.ttl(k)
-            result[task_id] = ttl
-            redis_key_map[task_id] = k
-        except Exception as e:
-            error_msg = 'Parsing get_user_saved_partial_tasks error: {}'
-            current_app.logger.error(error_msg.format(str(e)))
+
+def get_user_saved_partial_tasks(sentinel, project_id, user_id, task_repo=None):
+    """
+    Get the user saved task ids, mapped to the seconds left before their
+    partial answers expire, from the index of the user;
+    When "task_repo" is passed, it will do a cleanup of the index and of
+    the keys if tasks have been deleted
+    """
+    index_key = PARTIAL_ANSWER_INDEX_KEY.format(project_id=project_id,
+                                                user_id=user_id)
+    now = time.time()
+    saved_tasks = sentinel.slave.zrangebyscore(index_key, now, '+inf',
+                                               withscores=True)
+    result = {int(task_id): int(expiration - now)
+              for task_id, expiration in saved_tasks}
 
     # Filter existing tasks
     if task_repo:
+        sentinel.master.zremrangebyscore(index_key, '-inf', now)
         task_ids = task_repo.bulk_query(list(result.keys()), return_only_task_id=True)
+        deleted_task_ids = [task_id for task_id in result if task_id not in task_ids]
+        if deleted_task_ids:
+            delete_partial_answers(sentinel, project_id, [user_id],
+                                   deleted_task_ids)
         result = {task_id : ttl for task_id, ttl in result.items() if task_id in task_ids}
-        for task_id, k in redis_key_map.items():
-            if task_id not in task_ids:
-                sentinel.master.delete(k)
 
     return result
 
+
+def prune_partial_answers(sentinel, project_id, task_repo):
+    """
+    Remove the partial answers saved for deleted tasks from the index of
+    every user of a project. Returns the number of users left with saved
+    partial answers
+    """
+    users_key = PARTIAL_ANSWER_USERS_KEY.format(project_id=project_id)
+    n_users = 0
+    for user_id in sentinel.slave.smembers(users_key):
+        user_id = int(user_id)
+        position_key = PARTIAL_ANSWER_POSITION_KEY.format(
+            project_id=project_id, user_id=user_id)
+        if get_user_saved_partial_tasks(sentinel, project_id, user_id,
+                                        task_repo):
+            n_users += 1
+        elif not sentinel.slave.exists(position_key):
+            sentinel.master.srem(users_key, user_id)
+    return n_users
+
+
 def delete_redis_keys(sentinel, pattern):
     """
     Delete keys in Redis per pattern passed
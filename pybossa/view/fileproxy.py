@@ -18,13 +18,15 @@
 
 from urllib.parse import urlparse, parse_qs
 from functools import wraps
-from flask import Blueprint, current_app, Response, request
+from flask import Blueprint, current_app, Response, request, stream_with_context
 from flask_login import current_user, login_required
 
 import six
 import requests
 import json
-from werkzeug.exceptions import Forbidden, BadRequest, InternalServerError, NotFound
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import Forbidden, BadRequest, InternalServerError, NotFound, \
+    RequestedRangeNotSatisfiable
 
 from pybossa.cache.projects import get_project_data
 from boto.exception import S3ResponseError
@@ -33,7 +35,7 @@ from pybossa.core import task_repo, signer
 from pybossa.encryption import AESWithGCM
 # from pybossa.pybhdfs.client import HDFSKerberos
 from pybossa.sched import has_lock
-from pybossa.task_creator_helper import get_encryption_key, read_encrypted_file
+from pybossa.task_creator_helper import get_encryption_key, open_encrypted_file
 
 
 blueprint = Blueprint('fileproxy', __name__)
@@ -93,9 +95,23 @@ def read_encrypted_file_with_signature(store, project_id, bucket, key_name, sign
     task_id = payload['task_id']
 
     check_allowed(current_user.id, task_id, project, lambda v: v == request.path)
-    decrypted, key = read_encrypted_file(store, project, bucket, key_name)
-
-    response = Response(decrypted, content_type=key.content_type)
+    stream, key = open_encrypted_file(store, project, bucket, key_name)
+
+    byte_range = None
+    if request.range and request.range.units == 'bytes' and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(stream.size)
+        if byte_range is None:
+            stream.close()
+            raise RequestedRangeNotSatisfiable(length=stream.size)
+    start, stop = byte_range or (0, stream.size)
+
+    response = Response(stream_with_context(stream.iter_range(start, stop)),
+                        content_type=key.content_type, direct_passthrough=True)
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    if byte_range:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, stream.size)
     if hasattr(key, "content_encoding") and key.content_encoding:
         response.headers.add('Content-Encoding', key.content_encoding)
     if hasattr(key, "content_disposition") and key.content_disposition:
@@ -59,9 +59,9 @@ from pybossa.util import (Pagination, admin_required, get_user_id_or_ip, rank,
                           description_from_long_description,
                           check_annex_response,
                           process_annex_load, process_tp_components,
-                          process_table_component, PARTIAL_ANSWER_POSITION_KEY,
-                          SavedTaskPositionEnum, delete_redis_keys, get_last_name,
-                          PARTIAL_ANSWER_PREFIX, PARTIAL_ANSWER_KEY)
+                          process_table_component, SavedTaskPositionEnum,
+                          get_last_name, delete_partial_answers,
+                          save_partial_answer_position)
 from pybossa.auth import ensure_authorized_to
 from pybossa.cache import projects as cached_projects, ONE_DAY
 from pybossa.cache import users as cached_users
@@ -77,7 +77,8 @@ from pybossa.jobs import (webhook, send_mail,
                           import_tasks, IMPORT_TASKS_TIMEOUT,
                           delete_bulk_tasks, TASK_DELETE_TIMEOUT,
                           export_tasks, EXPORT_TASKS_TIMEOUT,
-                          mail_project_report, check_and_send_task_notifications)
+                          mail_project_report, check_and_send_task_notifications,
+                          prune_saved_partial_answers)
 from pybossa.forms.dynamic_forms import dynamic_project_form, dynamic_clone_project_form
 from pybossa.forms.projects_view_forms import *
 from pybossa.forms.admin_view_forms import SearchForm
@@ -1555,8 +1556,8 @@ def presenter(short_name):
         if saved_task_position:
             saved_task_position = saved_task_position.lower()
             if saved_task_position in list(SavedTaskPositionEnum):
-                position_key = PARTIAL_ANSWER_POSITION_KEY.format(project_id=project.id, user_id=user_id)
-                sentinel.master.setex(position_key, ONE_DAY, saved_task_position)
+                save_partial_answer_position(sentinel, project.id, user_id,
+                                             saved_task_position, ONE_DAY)
 
         return respond('/projects/presenter.html')
 
@@ -2215,11 +2216,8 @@ def delete_selected_tasks(short_name):
         if task_ids:
             for task_id in task_ids:
                 task_repo.delete_task_by_id(project.id, task_id)
-                # delete saved tasks in the project for all users in Redis
-                pattern = PARTIAL_ANSWER_KEY.format(project_id=project.id,
-                                                    user_id='*',
-                                                    task_id=task_id)
-                delete_redis_keys(sentinel=sentinel, pattern=pattern)
+            # delete saved tasks in the project for all users in Redis
+            delete_partial_answers(sentinel, project.id, task_ids=task_ids)
             new_value = json.dumps({
                 'task_ids': task_ids,
             })
@@ -2239,6 +2237,7 @@ def delete_selected_tasks(short_name):
                 task_queue.enqueue(delete_bulk_tasks, data)
             else:
                 task_repo.delete_valid_from_project(project, True, args)
+                task_queue.enqueue(prune_saved_partial_answers, project.id)
 
             new_value = json.dumps({
                 'filters': args
@@ -2288,8 +2287,7 @@ def delete_tasks(short_name):
         delete_memoized(n_available_tasks_for_user)
 
         # delete all user saved tasks for the project in Redis
-        pattern = PARTIAL_ANSWER_PREFIX.format(project_id=project.id, user_id='*')
-        delete_redis_keys(sentinel=sentinel, pattern=pattern)
+        delete_partial_answers(sentinel, project.id)
 
         force_reset = request.form.get("force_reset") == 'true'
         if ps.n_tasks <= MAX_NUM_SYNCHRONOUS_TASKS_DELETE:
@@ -23,6 +23,7 @@ from unittest.mock import MagicMock
 from sqlalchemy import text
 
 from pybossa.core import create_app, sentinel, signer
+from pybossa.cloud_store_api.connection import connections
 from pybossa.core import db
 from pybossa.leaderboard.jobs import leaderboard
 from pybossa.model.category import Category
@@ -111,6 +112,7 @@ class Test(object):
     def setUp(self):
         self.flask_app = flask_app
         self.app = flask_app.test_client()
+        connections.clear()
         with self.flask_app.app_context():
             rebuild_db()
             reset_all_pk_sequences()
@@ -303,7 +305,9 @@ class Test(object):
         db.session.commit()
 
     def redis_flushall(self):
+        from pybossa.cache import local_cache
         sentinel.master.flushall()
+        local_cache.clear()
 
     def set_proj_passwd_cookie(self, project, user=None, username=None):
         from pybossa.core import user_repo
@@ -0,0 +1,124 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+from unittest.mock import patch
+
+from pybossa import available_tasks
+from pybossa.core import project_repo, task_repo, sentinel
+from pybossa.sched import Schedulers, get_locked_task
+from test import with_context_settings
+from test.factories import TaskFactory, ProjectFactory, UserFactory, TaskRunFactory
+from test.helper import sched
+
+
+class TestAvailableTasks(sched.Helper):
+
+    def queue(self, project_id, kind=available_tasks.REGULAR):
+        key = available_tasks.get_queue_key(project_id, kind)
+        return [int(member) for member in sentinel.master.zrange(key, 0, -1)]
+
+    def create_project(self):
+        owner = UserFactory.create(id=500)
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.locked
+        project_repo.save(project)
+        return project
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    def test_rebuild_orders_by_priority_then_id(self):
+        project = self.create_project()
+        low = TaskFactory.create(project=project, priority_0=0.1)
+        high = TaskFactory.create(project=project, priority_0=0.9)
+        other_low = TaskFactory.create(project=project, priority_0=0.1)
+        gold = TaskFactory.create(project=project, calibration=1)
+        TaskFactory.create(project=project, state='completed')
+
+        available_tasks.rebuild(project.id)
+
+        assert self.queue(project.id) == [high.id, low.id, other_low.id]
+        assert self.queue(project.id, available_tasks.GOLD) == [gold.id]
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    def test_listeners_keep_queue_up_to_date(self):
+        project = self.create_project()
+        available_tasks.rebuild(project.id)
+        task = TaskFactory.create(project=project, n_answers=2)
+        assert self.queue(project.id) == [task.id]
+
+        TaskRunFactory.create(task=task, project=project)
+        assert self.queue(project.id) == [task.id]
+        TaskRunFactory.create(task=task, project=project)
+        assert self.queue(project.id) == []
+
+        task = TaskFactory.create(project=project, n_answers=1)
+        task_repo.delete(task)
+        assert self.queue(project.id) == []
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    def test_bulk_update_invalidates_queue(self):
+        project = self.create_project()
+        available_tasks.rebuild(project.id)
+        task_repo.update_priority(project.id, 0.5, {})
+
+        assert not sentinel.master.exists(available_tasks.get_built_key(project.id))
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    def test_update_of_unknown_task_adds_it(self):
+        project = self.create_project()
+        task = TaskFactory.create(project=project, n_answers=1,
+                                  state='completed')
+        available_tasks.rebuild(project.id)
+        assert self.queue(project.id) == []
+
+        task.state = 'ongoing'
+        task.n_answers = 2
+        task_repo.update(task)
+
+        assert self.queue(project.id) == [task.id]
+        assert sentinel.master.exists(available_tasks.get_built_key(project.id))
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    def test_queue_is_built_by_a_job(self):
+        project = self.create_project()
+        user = UserFactory.create()
+        task = TaskFactory.create(project=project)
+
+        with patch('pybossa.jobs.enqueue_job') as enqueue_job:
+            tasks = get_locked_task(project.id, user.id)
+            assert not available_tasks.ensure_built(project.id)
+
+        assert tasks[0].id == task.id, tasks
+        assert enqueue_job.call_count == 1, enqueue_job.call_args_list
+        assert not sentinel.master.exists(available_tasks.get_built_key(project.id))
+        job = enqueue_job.call_args[0][0]
+        job['name'](*job['args'])
+        assert self.queue(project.id) == [task.id]
+
+    @with_context_settings(AVAILABLE_TASKS_QUEUE=True)
+    @patch('pybossa.jobs.enqueue_job',
+           side_effect=lambda job: job['name'](*job['args'], **job['kwargs']))
+    def test_locked_scheduler_uses_queue(self, enqueue_job):
+        project = self.create_project()
+        user = UserFactory.create()
+        answered = TaskFactory.create(project=project, priority_0=0.9, n_answers=2)
+        task = TaskFactory.create(project=project, priority_0=0.5, n_answers=2)
+        TaskRunFactory.create(task=answered, project=project, user=user)
+
+        tasks = get_locked_task(project.id, user.id)
+
+        assert tasks[0].id == task.id, tasks
+        assert sentinel.master.exists(available_tasks.get_built_key(project.id))
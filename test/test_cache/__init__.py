@@ -17,6 +17,7 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 import hashlib
+import json
 import threading
 import time
 from unittest.mock import patch
@@ -24,7 +25,9 @@ from pybossa.cache import (get_key_to_hash, get_hash_key, cache, memoize,
                            delete_cached, delete_memoized, memoize_essentials,
                            delete_memoized_essential, delete_cache_group,
                            get_cache_group_key, memoize_with_l2_cache,
-                           delete_memoize_with_l2_cache)
+                           delete_memoize_with_l2_cache, local_cache,
+                           _on_local_invalidation, get_cache_index_key,
+                           get_memoized_key_prefixes)
 from pybossa.sentinel import Sentinel
 import pybossa.settings_test as settings_test
 
@@ -103,6 +106,12 @@ class TestCacheMemoizeFunctions(object):
 
     def setUp(self):
         test_sentinel.master.flushall()
+        local_cache.clear()
+
+    def cached_keys(self):
+        """Return the keys in Redis, except the key prefix indexes."""
+        return [key for key in test_sentinel.master.keys()
+                if b':memoize_index:' not in key]
 
     def test_cache_stores_function_call_first_time_called(self):
         """Test CACHE cache decorator stores the result of calling a function
@@ -115,7 +124,7 @@ class TestCacheMemoizeFunctions(object):
         key = "%s::%s" % (settings_test.REDIS_KEYPREFIX, 'my_cached_func')
 
         # in redis-py, all responses are returned as bytes in Python 3
-        assert list(test_sentinel.master.keys()) == [key.encode()], list(test_sentinel.master.keys())
+        assert list(self.cached_keys()) == [key.encode()], list(self.cached_keys())
 
     def test_cache_gets_function_from_cache_after_first_call(self):
         """Test CACHE cache retrieves the function value from cache after it has
@@ -295,11 +304,11 @@ class TestCacheMemoizeFunctions(object):
             return 'my_func was called'
         key = "%s::%s" % (settings_test.REDIS_KEYPREFIX, 'my_cached_func')
         my_func()
-        assert list(test_sentinel.master.keys()) == [key.encode()]
+        assert list(self.cached_keys()) == [key.encode()]
 
         delete_succedeed = delete_cached('my_cached_func')
         assert delete_succedeed is True, delete_succedeed
-        assert list(test_sentinel.master.keys()) == [], 'Key was not deleted!'
+        assert list(self.cached_keys()) == [], 'Key was not deleted!'
 
     def test_delete_cached_returns_false_when_delete_fails(self):
         """Test CACHE delete_cached returns False if deletion is not successful"""
@@ -308,7 +317,7 @@ class TestCacheMemoizeFunctions(object):
         def my_func():
             return 'my_func was called'
         key = "%s::%s" % (settings_test.REDIS_KEYPREFIX, 'my_cached_func')
-        assert list(test_sentinel.master.keys()) == []
+        assert list(self.cached_keys()) == []
 
         delete_succedeed = delete_cached('my_cached_func')
         assert delete_succedeed is False, delete_succedeed
@@ -321,11 +330,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 1
+        assert len(list(self.cached_keys())) == 1
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert list(test_sentinel.master.keys()) == [], 'Key was not deleted!'
+        assert list(self.cached_keys()) == [], 'Key was not deleted!'
 
     def test_delete_memoize_with_l2_cache_returns_true_when_delete_succeeds(self):
         """Test CACHE delete_memoize_with_l2_cache deletes a stored key and returns True if
@@ -335,11 +344,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
         delete_succedeed = delete_memoize_with_l2_cache(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert list(test_sentinel.master.keys()) == [], 'Key was not deleted!'
+        assert list(self.cached_keys()) == [], 'Key was not deleted!'
 
     def test_delete_memoized_returns_false_when_delete_fails(self):
         """Test CACHE delete_memoized returns False if deletion is not successful"""
@@ -348,11 +357,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 1
+        assert len(list(self.cached_keys())) == 1
 
         delete_succedeed = delete_memoized(my_func, 'badarg', kwarg='barkwarg')
         assert delete_succedeed is False, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 1, 'Key was unexpectedly deleted'
+        assert len(list(self.cached_keys())) == 1, 'Key was unexpectedly deleted'
 
     def test_delete_memoize_with_l2_cache_returns_false_when_delete_fails(self):
         """Test CACHE delete_memoize_with_l2_cache returns False if deletion is not successful"""
@@ -361,11 +370,11 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
         delete_succedeed = delete_memoized(my_func, 'badarg', kwarg='barkwarg')
         assert delete_succedeed is False, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 2, 'Key was unexpectedly deleted'
+        assert len(list(self.cached_keys())) == 2, 'Key was unexpectedly deleted'
 
     def test_delete_memoized_deletes_only_requested(self):
         """Test CACHE delete_memoized deletes only the values it's asked and
@@ -376,11 +385,11 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
         delete_succedeed = delete_memoized(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 1, 'Everything was deleted!'
+        assert len(list(self.cached_keys())) == 1, 'Everything was deleted!'
 
     def test_delete_memoize_with_l2_cache_deletes_only_requested(self):
         """Test CACHE delete_memoize_with_l2_cache deletes only the values it's asked and
@@ -391,10 +400,10 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
-        assert len(list(test_sentinel.master.keys())) == 4
+        assert len(list(self.cached_keys())) == 4
         delete_succedeed = delete_memoize_with_l2_cache(my_func, 'arg', kwarg='kwarg')
         assert delete_succedeed is True, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 2, 'Everything was deleted!'
+        assert len(list(self.cached_keys())) == 2, 'Everything was deleted!'
 
     def test_delete_memoized_deletes_all_function_calls(self):
         """Test CACHE delete_memoized deletes all the function calls stored if
@@ -409,11 +418,41 @@ class TestCacheMemoizeFunctions(object):
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
         my_other_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 3
+        assert len(list(self.cached_keys())) == 3
 
         delete_succedeed = delete_memoized(my_func)
         assert delete_succedeed is True, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 1
+        assert len(list(self.cached_keys())) == 1
+
+    def test_get_memoized_key_prefixes(self):
+        """Test CACHE memoized keys are mapped to the prefixes they are
+        indexed under"""
+
+        @memoize()
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+
+        @memoize_essentials(essentials=[0, 1])
+        def my_essential_func(*args, **kwargs):
+            return [args, kwargs]
+
+        @memoize_with_l2_cache()
+        def my_l2_func(*args, **kwargs):
+            return [args, kwargs]
+
+        my_func('arg')
+        my_essential_func(1, 2, 3)
+        my_l2_func('arg')
+        for key in test_sentinel.master.scan_iter('*_args:*'):
+            key = key.decode()
+            prefixes = get_memoized_key_prefixes(key)
+            if key.startswith(get_cache_index_key('')):
+                assert prefixes == [], prefixes
+                continue
+            indexed = [prefix for prefix in prefixes
+                       if test_sentinel.master.zscore(
+                           get_cache_index_key(prefix), key) is not None]
+            assert prefixes and indexed == prefixes, (key, prefixes)
 
     def test_delete_memoize_with_l2_cache_deletes_all_function_calls(self):
         """Test CACHE delete_memoize_with_l2_cache deletes all the function calls stored if
@@ -429,11 +468,11 @@ class TestCacheMemoizeFunctions(object):
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='other')
         my_other_func('arg', kwarg='kwarg')
-        assert len(list(test_sentinel.master.keys())) == 6
+        assert len(list(self.cached_keys())) == 6
 
         delete_succedeed = delete_memoize_with_l2_cache(my_func)
         assert delete_succedeed is True, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
     def test_delete_memoized_essentials(self):
         """Test CACHE delete_memoized_essential deletes all the function
@@ -445,11 +484,11 @@ class TestCacheMemoizeFunctions(object):
 
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='kwother')
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
         delete_succedeed = delete_memoized_essential(my_func, 'other')
         assert delete_succedeed is True, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 1
+        assert len(list(self.cached_keys())) == 1
 
     def test_delete_memoized_essentials_no_key(self):
         """Test CACHE delete_memoized_essential no key to delete"""
@@ -463,16 +502,53 @@ class TestCacheMemoizeFunctions(object):
 
         my_func('arg', kwarg='kwarg')
         my_func('other', kwarg='kwother')
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
 
         delete_succedeed = delete_memoized_essential(my_other_func, 'other')
         assert delete_succedeed is False, delete_succedeed
-        assert len(list(test_sentinel.master.keys())) == 2
+        assert len(list(self.cached_keys())) == 2
+
+    def test_delete_memoized_essentials_exact_argument(self):
+        """Test CACHE delete_memoized_essential only deletes the calls whose
+        essential argument equals the given one, not those it prefixes"""
+
+        @memoize_essentials(timeout=300, essentials=[0])
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+
+        my_func(1, 'a')
+        my_func(10, 'a')
+        assert len(self.cached_keys()) == 2
+
+        assert delete_memoized_essential(my_func, 1) is True
+        assert len(self.cached_keys()) == 1
+        assert delete_memoized_essential(my_func) is True
+        assert not self.cached_keys()
+
+    def test_memoize_index_expires_with_its_keys(self):
+        """Test CACHE the key index of a function expires along with the
+        last key it holds, and drops expired keys"""
+
+        @memoize(timeout=300)
+        def my_func(*args, **kwargs):
+            return [args, kwargs]
+
+        index_key = get_cache_index_key(
+            '%s:my_func_args:' % settings_test.REDIS_KEYPREFIX)
+        my_func('arg')
+        ttl = test_sentinel.master.ttl(index_key)
+        assert 300 <= ttl <= 330, ttl
+
+        test_sentinel.master.zadd(index_key, {'expired': time.time() - 1})
+        my_func('other')
+        members = test_sentinel.master.zrange(index_key, 0, -1)
+        assert len(members) == 2, members
+        assert b'expired' not in members, members
 
     def test_delete_cache_group_no_group(self):
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
         delete_cache_group('key')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_cache_group_key_one_group(self):
         @memoize(cache_group_keys=([0],))
@@ -484,11 +560,11 @@ class TestCacheMemoizeFunctions(object):
             return None
         my_func('key')
         my_func2('key')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 3
         assert get_cache_group_key('key').encode() in keys  # keys is a list of bytes string
         delete_cache_group('key')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_memoize_with_l2_cache_group_key_one_group(self):
         @memoize_with_l2_cache(cache_group_keys=([0],))
@@ -500,11 +576,11 @@ class TestCacheMemoizeFunctions(object):
             return None
         my_func('key')
         my_func2('key')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 5
         assert get_cache_group_key('key').encode() in keys  # keys is a list of bytes string
         delete_cache_group('key')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_cache_group_key_two_groups(self):
         @memoize(cache_group_keys=([0],))
@@ -516,17 +592,17 @@ class TestCacheMemoizeFunctions(object):
             return None
         my_func('key1')
         my_func2('key2')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 4
         assert get_cache_group_key('key1').encode() in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key1')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 2
         assert get_cache_group_key('key1').encode() not in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key2')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_memoize_with_l2_cache_group_key_two_groups(self):
         @memoize_with_l2_cache(cache_group_keys=([0],))
@@ -538,51 +614,51 @@ class TestCacheMemoizeFunctions(object):
             return None
         my_func('key1')
         my_func2('key2')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 6
         assert get_cache_group_key('key1').encode() in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key1')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 3
         assert get_cache_group_key('key1').encode() not in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key2')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_cache_group_key_two_groups_one_key(self):
         @memoize(cache_group_keys=([0], [1]))
         def my_func(*args, **kwargs):
             return None
         my_func('key1', 'key2')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 3
         assert get_cache_group_key('key1').encode() in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key1')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 1
         assert get_cache_group_key('key1').encode() not in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key2')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_memoize_with_l2_cache_group_key_two_groups_one_key(self):
         @memoize_with_l2_cache(cache_group_keys=([0], [1]))
         def my_func(*args, **kwargs):
             return None
         my_func('key1', 'key2')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 4
         assert get_cache_group_key('key1').encode() in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key1')
-        keys = list(test_sentinel.master.keys())
+        keys = list(self.cached_keys())
         assert len(keys) == 1
         assert get_cache_group_key('key1').encode() not in keys
         assert get_cache_group_key('key2').encode() in keys
         delete_cache_group('key2')
-        assert not list(test_sentinel.master.keys())
+        assert not list(self.cached_keys())
 
     def test_cache_group_key_callable(self):
         def cache_group_key_fn(*args, **kwargs):
@@ -592,7 +668,7 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return None
         my_func('a')
-        assert get_cache_group_key('a').encode() in test_sentinel.master.keys()
+        assert get_cache_group_key('a').encode() in self.cached_keys()
 
     def test_memoize_with_l2_cache_group_key_callable(self):
         def cache_group_key_fn(*args, **kwargs):
@@ -602,7 +678,7 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return None
         my_func('a')
-        assert get_cache_group_key('a').encode() in test_sentinel.master.keys()
+        assert get_cache_group_key('a').encode() in self.cached_keys()
 
     def test_cache_group_key_invalid(self):
         @memoize(cache_group_keys=(0,))
@@ -629,14 +705,14 @@ class TestCacheMemoizeFunctions(object):
         def my_func(*args, **kwargs):
             return None
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(self.cached_keys()) == 1
 
     def test_memoize_with_l2_cache_group_key_none(self):
         @memoize_with_l2_cache()
         def my_func(*args, **kwargs):
             return None
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 2
+        assert len(self.cached_keys()) == 2
 
     def test_memoized_min_timeout(self):
         """Test CACHE memoize for min timeout value."""
@@ -646,7 +722,7 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
 
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(self.cached_keys()) == 1
 
     def test_memoized_essentials_min_timeout(self):
         """Test CACHE memoize_essentials for min timeout value."""
@@ -656,7 +732,7 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
 
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(self.cached_keys()) == 1
 
     def test_cache_min_timeout(self):
         """Test CACHE cache for min timeout value."""
@@ -666,7 +742,7 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
 
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 1
+        assert len(self.cached_keys()) == 1
 
     def test_memoize_with_l2_cache_min_timeout(self):
         """Test CACHE memoize_with_l2_cache for min timeout value."""
@@ -676,7 +752,7 @@ class TestCacheMemoizeFunctions(object):
             return [args, kwargs]
 
         my_func('a')
-        assert len(test_sentinel.master.keys()) == 2
+        assert len(self.cached_keys()) == 2
 
     def test_memoize_allows_multiple_requests_setting_cache(self):
         """Test memoize allows multiple requests setting cache"""
@@ -712,8 +788,8 @@ class TestCacheMemoizeFunctions(object):
         assert result == 10, "hit simulate_db_query 10 times"
 
         key = b'pybossa_cache:simulate_db_query_args::d41d8cd98f00b204e9800998ecf8427e'
-        assert len(test_sentinel.master.keys()) == 1
-        assert key in test_sentinel.master.keys()
+        assert len(self.cached_keys()) == 1
+        assert key in self.cached_keys()
 
         # simulate cache expires, and all requests are hitting the DB
         test_sentinel.master.expire(key, 0)
@@ -764,8 +840,8 @@ class TestCacheMemoizeFunctions(object):
         assert result == 1, "hit simulate_db_query once"
 
         key = b'pybossa_cache:simulate_db_query_args::d41d8cd98f00b204e9800998ecf8427e'
-        assert len(test_sentinel.master.keys()) == 2
-        assert key in test_sentinel.master.keys()
+        assert len(self.cached_keys()) == 2
+        assert key in self.cached_keys()
 
         # simulate cache expires, and only 1 request is hitting the DB
         test_sentinel.master.expire(key, 0)
@@ -793,4 +869,158 @@ class TestCacheMemoizeFunctions(object):
         key = "%s::%s" % (settings_test.REDIS_KEYPREFIX, 'my_cached_func')
 
         # in redis-py, all responses are returned as bytes in Python 3
-        assert key.encode() in list(test_sentinel.master.keys()), list(test_sentinel.master.keys())
\ No newline at end of file
+        assert key.encode() in list(self.cached_keys()), list(self.cached_keys())
+
+    def test_memoize_local_timeout_serves_value_from_process(self):
+        """Test CACHE memoize with local_timeout does not read Redis again"""
+
+        @memoize(local_timeout=60)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        test_sentinel.master.flushall()
+        assert my_func('arg') == 1
+        assert my_func('other_arg') == 2
+
+    def test_memoize_local_timeout_stores_a_copy(self):
+        """Test CACHE memoize with local_timeout does not keep the object
+        returned to the caller"""
+
+        @memoize(local_timeout=60)
+        def my_func(arg):
+            return dict(value=arg)
+
+        output = my_func('arg')
+        output['value'] = 'changed'
+        test_sentinel.master.flushall()
+        assert my_func('arg') == dict(value='arg')
+
+    def test_memoize_local_timeout_delete_memoized(self):
+        """Test CACHE delete_memoized drops the process local value"""
+
+        @memoize(local_timeout=60)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        delete_memoized(my_func, 'arg')
+        assert my_func('arg') == 2
+        delete_memoized(my_func)
+        assert my_func('arg') == 3
+
+    def test_memoize_local_timeout_invalidation_message(self):
+        """Test CACHE keys deleted by another process are dropped locally"""
+
+        @memoize_with_l2_cache(local_timeout=60)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        test_sentinel.master.flushall()
+        key = get_hash_key('%s:my_func_args:' % settings_test.REDIS_KEYPREFIX,
+                           get_key_to_hash('arg'))
+        _on_local_invalidation(dict(data=json.dumps(dict(keys=[key]))))
+        assert my_func('arg') == 2
+
+    def test_memoize_early_refresh_schedules_background_refresh(self):
+        """Test CACHE memoize with early_refresh enqueues one refresh job"""
+
+        @memoize(timeout=60, early_refresh=True)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        assert my_func('arg') == 1
+        with patch('pybossa.cache._expires_early', return_value=True), \
+                patch('pybossa.jobs.enqueue_job') as enqueue_job:
+            assert my_func('arg') == 1
+            assert my_func('arg') == 1
+        assert enqueue_job.call_count == 1, enqueue_job.call_args_list
+        job = enqueue_job.call_args[0][0]
+        assert job['args'][0].endswith('my_func'), job
+        assert job['args'][1:] == ['arg'], job
+
+        my_func.refresh('arg')
+        assert my_func('arg') == 2
+
+    def test_memoize_early_refresh_serves_stale_value(self):
+        """Test CACHE memoize with stale_ttl serves expired values while
+        they are refreshed"""
+
+        with patch('pybossa.cache.randrange', return_value=0):
+            @memoize(timeout=1, early_refresh=True, stale_ttl=60)
+            def my_func(arg, call_count=[]):
+                call_count.append(1)
+                return len(call_count)
+
+        assert my_func('arg') == 1
+        time.sleep(1.1)
+        with patch('pybossa.jobs.enqueue_job') as enqueue_job:
+            assert my_func('arg') == 1
+        assert enqueue_job.called
+
+    def test_memoize_early_refresh_waits_for_value(self):
+        """Test CACHE memoize with early_refresh waits for the value computed
+        by another process instead of computing it again"""
+
+        @memoize(timeout=60, early_refresh=True)
+        def my_func(arg, call_count=[]):
+            call_count.append(1)
+            return len(call_count)
+
+        key = get_hash_key('%s:my_func_args:' % settings_test.REDIS_KEYPREFIX,
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set('%s:refresh_lock' % key, 1)
+
+        def refresh():
+            time.sleep(0.5)
+            my_func.refresh('arg')
+
+        other_process = threading.Thread(target=refresh)
+        start = time.time()
+        other_process.start()
+        assert my_func('arg') == 1
+        other_process.join()
+        assert time.time() - start < 5
+
+    def test_memoize_early_refresh_bounds_wait_for_value(self):
+        """Test CACHE memoize with early_refresh computes the value itself
+        when no other process sets it shortly"""
+
+        @memoize(timeout=60, early_refresh=True)
+        def my_func(arg):
+            return arg
+
+        key = get_hash_key('%s:my_func_args:' % settings_test.REDIS_KEYPREFIX,
+                           get_key_to_hash('arg'))
+        test_sentinel.master.set('%s:refresh_lock' % key, 1)
+
+        start = time.time()
+        with patch('pybossa.cache.FILL_WAIT_TIMEOUT', 0.2):
+            assert my_func('arg') == 'arg'
+        assert time.time() - start < 2
+
+    def test_delete_memoized_deletes_refresh_locks(self):
+        """Test CACHE delete_memoized deletes the refresh locks of the
+        deleted keys"""
+
+        @memoize(timeout=60, early_refresh=True)
+        def my_func(arg):
+            return arg
+
+        my_func('arg')
+        key = get_hash_key('%s:my_func_args:' % settings_test.REDIS_KEYPREFIX,
+                           get_key_to_hash('arg'))
+        lock_key = '%s:refresh_lock' % key
+        test_sentinel.master.set(lock_key, 1)
+        delete_memoized(my_func, 'arg')
+        assert not test_sentinel.master.exists(lock_key)
+
+        my_func('arg')
+        test_sentinel.master.set(lock_key, 1)
+        delete_memoized(my_func)
+        assert not test_sentinel.master.exists(lock_key)
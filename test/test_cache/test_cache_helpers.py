@@ -20,7 +20,8 @@ from test import Test, with_context, with_request_context
 from test.factories import (ProjectFactory, TaskFactory, TaskRunFactory, UserFactory)
 from pybossa.cache import helpers
 from pybossa.cache.project_stats import update_stats
-from pybossa.cache.task_browse_helpers import parse_tasks_browse_order_by_args, user_meet_task_requirement
+from pybossa.cache.task_browse_helpers import parse_tasks_browse_order_by_args, user_meet_task_requirement, TaskMatcher, \
+    get_sort_keys, get_seek_key, get_seek_filters
 from unittest.mock import patch
 
 class TestHelpersCache(Test):
@@ -815,3 +816,69 @@ class TestHelpersCache(Test):
             # Verify that the mocked comparator function was accessed
             mock_comparator.__contains__.assert_called_with('>=')
             mock_comparator.__getitem__.assert_called_with('>=')
+
+    @with_context
+    def test_task_matcher_rank(self):
+        """Test TaskMatcher.rank keeps eligible tasks ordered by preference score"""
+        user_profile = {'age': 30, 'rating': 2}
+        tasks = [
+            (1, {'age': [40, '>=']}, {'rating': 10}, 'too young'),
+            (2, {'age': [25, '>=']}, {'rating': 1}, 'low'),
+            (3, None, {'rating': 3}, 'high'),
+            (4, {'age': [25, '>=']}, None, 'none'),
+            (5, {'age': [25, '>=']}, {'rating': 1}, 'low again'),
+        ]
+        matcher = TaskMatcher(user_profile)
+
+        ranked = matcher.rank(tasks)
+        assert ranked == [('high', 6), ('low', 2), ('low again', 2), ('none', 0)], ranked
+
+        top = matcher.rank(tasks, limit=2)
+        assert top == [('high', 6), ('low', 2)], top
+
+    @with_context
+    def test_task_matcher_evaluates_each_filter_once(self):
+        """Test TaskMatcher evaluates a worker filter shared by tasks only once"""
+        user_filter = {'age': [25, '>=']}
+        matcher = TaskMatcher({'age': 30})
+        with patch('pybossa.cache.task_browse_helpers.user_meet_task_requirement',
+                   return_value=True) as meet_requirement:
+            assert matcher.meets_requirement(1, user_filter)
+            assert matcher.meets_requirement(2, dict(user_filter))
+            assert meet_requirement.call_count == 1
+
+    def test_get_sort_keys(self):
+        """Test get_sort_keys splits the order by clause and ends with the task id"""
+        keys = get_sort_keys("(coalesce(ct, 0)/float4(task.n_answers)) desc, task.info->>'a,b' asc")
+        assert keys == [("(coalesce(ct, 0)/float4(task.n_answers))", True),
+                        ("task.info->>'a,b'", False),
+                        ("task.id", False)], keys
+        assert get_sort_keys("priority_0 desc") == [("priority_0", True), ("task.id", True)]
+        assert get_sort_keys("id desc, priority_0 asc") == [("id", True), ("priority_0", False)]
+        assert get_sort_keys("priority_0 desc nulls last") is None
+
+    def test_get_seek_key(self):
+        """Test get_seek_key only seeks in sorts on an indexed column of task"""
+        assert get_seek_key([("id", True)]) == ("task.id", True)
+        assert get_seek_key([("priority_0", False), ("task.id", False)]) == ("task.priority_0", False)
+        assert get_seek_key([("task.created", True), ("task.id", True)]) == ("task.created", True)
+        assert get_seek_key([("priority_0", False), ("task.id", True)]) is None
+        assert get_seek_key([("ft", True), ("task.id", True)]) is None
+        assert get_seek_key([("ft", True), ("priority_0", False), ("task.id", False)]) is None
+
+    def test_get_seek_filters(self):
+        """Test get_seek_filters compares row values and reads NULLs apart"""
+        assert get_seek_filters("task.id", True, 10) == [
+            (" AND task.id < :seek_id", " ORDER BY task.id DESC ")]
+        assert get_seek_filters("task.priority_0", False, 0.5) == [
+            (" AND (task.priority_0, task.id) > (:seek_value, :seek_id)",
+             " ORDER BY task.priority_0 ASC, task.id ASC "),
+            (" AND task.priority_0 IS NULL", " ORDER BY task.id ASC ")]
+        assert get_seek_filters("task.priority_0", False, None) == [
+            (" AND task.priority_0 IS NULL AND task.id > :seek_id", " ORDER BY task.id ASC ")]
+        assert get_seek_filters("task.priority_0", True, 0.5) == [
+            (" AND (task.priority_0, task.id) < (:seek_value, :seek_id)",
+             " ORDER BY task.priority_0 DESC, task.id DESC ")]
+        assert get_seek_filters("task.priority_0", True, None) == [
+            (" AND task.priority_0 IS NULL AND task.id < :seek_id", " ORDER BY task.id DESC "),
+            (" AND task.priority_0 IS NOT NULL", " ORDER BY task.priority_0 DESC, task.id DESC ")]
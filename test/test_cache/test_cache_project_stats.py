@@ -19,7 +19,8 @@
 from test import Test, with_context
 from pybossa.cache.project_stats import *
 from test.factories import ProjectFactory, TaskFactory, \
-    TaskRunFactory, AnonymousTaskRunFactory
+    TaskRunFactory, AnonymousTaskRunFactory, UserFactory
+from pybossa.core import task_repo
 import pytz
 from datetime import date, datetime, timedelta
 from unittest.mock import patch
@@ -173,3 +174,59 @@ class TestProjectsStatsCache(Test):
         assert max_hours == 1
         assert max_hours_anon == 0
         assert max_hours_auth == 1
+
+    @with_context
+    def test_stats_users_reads_contributor_rollup(self):
+        """Test CACHE PROJECT STATS user stats sums the task runs per user."""
+        pr = ProjectFactory.create()
+        user = UserFactory.create()
+        TaskRunFactory.create_batch(2, project=pr, user=user)
+        AnonymousTaskRunFactory.create(project=pr, user_ip='127.0.0.2')
+        users, anon_users, auth_users = stats_users(pr.id)
+        assert auth_users == [[user.id, 2]], auth_users
+        assert anon_users == [['127.0.0.2', 1]], anon_users
+        assert users == dict(n_auth=1, n_anon=1), users
+        today = date.today()
+        assert count_contributors(pr.id, 'auth', [today]) == 1
+        assert count_contributors(pr.id, 'auth', [today - timedelta(1)]) == 0
+
+    @with_context
+    def test_deleted_task_run_is_uncounted(self):
+        """Test CACHE PROJECT STATS deleted task runs leave the rollups."""
+        pr = ProjectFactory.create()
+        user = UserFactory.create()
+        task_runs = TaskRunFactory.create_batch(2, project=pr, user=user)
+        task_repo.delete(task_runs[0])
+        _, _, auth_users = stats_users.__wrapped__(pr.id)
+        hours = stats_hours.__wrapped__(pr.id)[0]
+        assert auth_users == [[user.id, 1]], auth_users
+        assert sum(hours.values()) == 1, hours
+        task_repo.delete(task_runs[1])
+        _, _, auth_users = stats_users.__wrapped__(pr.id, '1 week')
+        assert auth_users == [], auth_users
+
+    @with_context
+    def test_deleted_task_is_uncounted(self):
+        """Test CACHE PROJECT STATS task runs deleted with their task by raw
+        SQL leave the rollups."""
+        pr = ProjectFactory.create()
+        user = UserFactory.create()
+        tasks = TaskFactory.create_batch(2, project=pr)
+        TaskRunFactory.create_batch(2, project=pr, task=tasks[0], user=user)
+        TaskRunFactory.create(project=pr, task=tasks[1], user=user)
+        task_repo.delete_task_by_id(pr.id, tasks[0].id)
+        _, _, auth_users = stats_users.__wrapped__(pr.id)
+        hours = stats_hours.__wrapped__(pr.id)[0]
+        assert auth_users == [[user.id, 1]], auth_users
+        assert sum(hours.values()) == 1, hours
+
+    @with_context
+    def test_stats_users_seeds_contributors(self):
+        """Test CACHE PROJECT STATS contributors missing from the HyperLogLogs
+        are counted from the contributor rollup."""
+        from pybossa.core import sentinel
+        pr = ProjectFactory.create()
+        TaskRunFactory.create_batch(2, project=pr)
+        sentinel.master.flushall()
+        users, _, _ = stats_users.__wrapped__(pr.id)
+        assert users['n_auth'] == 2, users
@@ -23,13 +23,15 @@ from test.factories import UserFactory, ProjectFactory, TaskFactory, \
 from unittest.mock import patch, call
 import datetime
 import json
-from pybossa.core import result_repo, task_repo
+import time
+from pybossa.core import result_repo, task_repo, sentinel
 from pybossa.model.project import Project
 from pybossa.cache.project_stats import update_stats
 from nose.tools import nottest, assert_raises
 from pybossa.cache.task_browse_helpers import get_task_filters, parse_tasks_browse_args
 import pybossa.cache.project_stats as stats
-from pybossa.redis_lock import get_locked_tasks_project
+from pybossa.redis_lock import get_locked_tasks_project, get_locked_tasks_key, \
+    index_task_lock
 
 class TestProjectsCache(Test):
 
@@ -443,6 +445,32 @@ class TestProjectsCache(Test):
         assert cached_tasks[0].get('pct_status') == 1.0, cached_tasks[0].get('pct_status')
 
 
+    @with_context
+    def test_browse_tasks_keyset_pages(self):
+        """Test CACHE PROJECTS browse_tasks pages seeking past the previous
+        page match the pages read with an offset"""
+
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(7, project=project, n_answers=2)
+        for i, task in enumerate(tasks):
+            task.priority_0 = (i % 3) / 10.0 if i < 5 else None
+            task_repo.update(task)
+        TaskRunFactory.create(task=tasks[2])
+
+        for order_by in ("priority_0 desc", "priority asc", "created desc",
+                         "finish_time desc, priority asc", None):
+            args = parse_tasks_browse_args({'order_by': order_by} if order_by else {})
+            expected = [task['id'] for task in cached_projects.browse_tasks(
+                project.id, dict(args, records_per_page=10, offset=0))[1]]
+            assert len(expected) == 7, expected
+
+            pages = []
+            for offset in range(0, 7, 3):
+                _, page = cached_projects.browse_tasks(
+                    project.id, dict(args, records_per_page=3, offset=offset))
+                pages.extend(task['id'] for task in page)
+            assert pages == expected, (order_by, pages, expected)
+
     @with_context
     @patch('pybossa.cache.projects.get_locked_tasks_project')
     def test_browse_tasks_sort_by_task_locks(self, locks):
@@ -714,23 +742,23 @@ class TestProjectsCache(Test):
 
 
     @with_context
-    @patch('pybossa.cache.pickle')
+    @patch('pybossa.cache.encode')
     @patch('pybossa.cache.projects._n_draft')
-    def test_n_count_calls_n_draft(self, _n_draft, pickle):
+    def test_n_count_calls_n_draft(self, _n_draft, encode):
         """Test CACHE PROJECTS n_count calls _n_draft when called with argument
         'draft'"""
-        pickle.dumps.return_value = 'str'
+        encode.return_value = 'str'
         cached_projects.n_count('draft')
         _n_draft.assert_called_with()
 
 
     @with_context
-    @patch('pybossa.cache.pickle')
+    @patch('pybossa.cache.encode')
     @patch('pybossa.cache.projects._n_featured')
-    def test_n_count_calls_n_featuredt(self, _n_featured, pickle):
+    def test_n_count_calls_n_featuredt(self, _n_featured, encode):
         """Test CACHE PROJECTS n_count calls _n_featured when called with
         argument 'featured'"""
-        pickle.dumps.return_value = 'str'
+        encode.return_value = 'str'
         cached_projects.n_count('featured')
         _n_featured.assert_called_with()
 
@@ -1243,31 +1271,32 @@ class TestProjectsCache(Test):
 
 
     @with_context
-    @patch('pybossa.redis_lock.get_task_users_key')
-    @patch('pybossa.redis_lock.get_user_tasks_key')
-    @patch('pybossa.core.sentinel.master')
-    @patch('pybossa.redis_lock.LockManager')
-    @patch('pybossa.core.task_repo')
-    def test_deleted_locked_task(self, mock_task_repo, mock_lock_manager, mock_redis, mock_get_user_tasks_key, mock_get_task_users_key):
-        """Test deleting a locked task should clear it from the cache."""
-        project_id = 1
-        user_id = '12'
-        task_id = '123'
-        user_tasks_key = '12_123'
-        task_users_key = '123_12'
-        mock_get_user_tasks_key.return_value = user_tasks_key
-        mock_get_task_users_key.return_value = task_users_key
-        mock_redis.hgetall.return_value = {user_id: user_id}
-        mock_lock_manager.return_value.get_locks.return_value = {task_id: task_id}
-
-        # Simulate deleted task.
-        mock_redis.mget.return_value = [None]
-        mock_task_repo.get_task.return_value = None
-
-        # Execute method.
-        result = get_locked_tasks_project(project_id)
-
-        # Verify no tasks are returned and cache clear has been called.
-        assert result == []
-        calls = [call(task_users_key, user_id), call(user_tasks_key, task_id)]
-        mock_lock_manager.return_value.release_lock.assert_has_calls(calls, any_order=True)
+    def test_locked_tasks_read_from_project_index(self):
+        """Test locked tasks of a project are read from its locked tasks
+        index, and expired locks are removed from it."""
+        now = time.time()
+        key = get_locked_tasks_key(1)
+        index_task_lock(1, 123, 12, now + 60, sentinel.master)
+        index_task_lock(1, 124, '::1', now + 60, sentinel.master)
+        index_task_lock(1, 125, 12, now - 1, sentinel.master)
+        index_task_lock(2, 126, 12, now + 60, sentinel.master)
+
+        result = get_locked_tasks_project(1)
+
+        locks = sorted((lock['task_id'], lock['user_id']) for lock in result)
+        assert locks == [('123', '12'), ('124', '::1')], locks
+        assert all(0 < lock['seconds_remaining'] <= 60 for lock in result)
+        assert sentinel.master.zcard(key) == 2
+
+    @with_context
+    def test_locked_tasks_index_ttl_is_only_extended(self):
+        """Test a short lock does not shorten the TTL of the locked tasks
+        index set by a longer lock of the same project."""
+        now = time.time()
+        key = get_locked_tasks_key(1)
+        index_task_lock(1, 123, 12, now + 3600, sentinel.master, ttl=3600)
+        index_task_lock(1, 124, 13, now + 60, sentinel.master, ttl=60)
+        index_task_lock(1, 125, 14, now + 5, sentinel.master)
+
+        assert sentinel.master.ttl(key) > 3500, sentinel.master.ttl(key)
+        assert sentinel.master.zcard(key) == 3
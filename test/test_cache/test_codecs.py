@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2015 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+import pickle
+from datetime import datetime
+from unittest.mock import patch
+
+from nose.tools import assert_raises
+
+from pybossa.cache import codecs, memoize
+from pybossa.cache.codecs import encode, decode, MAGIC
+from pybossa.model.category import Category
+from test import Test, with_context
+
+
+class TestCacheCodecs(Test):
+
+    value = {'id': 1, 'created': datetime(2020, 1, 2, 3, 4, 5),
+             'pair': (1, 'a'), 1: [b'bytes', None, 1.5]}
+
+    @with_context
+    def test_encode_writes_pickle_without_codec(self):
+        """Test values are plain pickles while CACHE_CODEC is not set."""
+        with patch.dict(self.flask_app.config, {'CACHE_CODEC': None}):
+            data = encode(self.value, 'test')
+
+        assert pickle.loads(data) == self.value
+        assert decode(data, 'test') == self.value
+
+    @with_context
+    def test_msgpack_round_trip(self):
+        """Test msgpack keeps tuples, datetimes and non string keys."""
+        with patch.dict(self.flask_app.config, {'CACHE_CODEC': 'msgpack'}):
+            data = encode(self.value, 'test')
+
+        assert data.startswith(MAGIC)
+        assert data[len(MAGIC) + 1] == codecs.MsgpackCodec.id
+        assert decode(data, 'test') == self.value
+
+    @with_context
+    def test_msgpack_falls_back_to_pickle(self):
+        """Test values msgpack does not support are pickled."""
+        category = Category(name='c', short_name='c')
+        with patch.dict(self.flask_app.config, {'CACHE_CODEC': 'msgpack'}):
+            data = encode([category], 'test')
+
+        assert data[len(MAGIC) + 1] == codecs.PickleCodec.id
+        assert decode(data, 'test')[0].short_name == 'c'
+
+    @with_context
+    def test_large_values_are_compressed(self):
+        """Test values above the size threshold are compressed."""
+        value = ['x' * 100] * 100
+        config = {'CACHE_CODEC': 'msgpack', 'CACHE_COMPRESSION': 'zlib',
+                  'CACHE_COMPRESSION_MIN_SIZE': 1000}
+        with patch.dict(self.flask_app.config, config):
+            data = encode(value, 'test')
+            small = encode(value[:1], 'test')
+
+        assert data[len(MAGIC) + 2] == 1
+        assert len(data) < 1000
+        assert small[len(MAGIC) + 2] == 0
+        assert decode(data, 'test') == value
+        assert decode(small, 'test') == value[:1]
+
+    @with_context
+    def test_unknown_header_version(self):
+        """Test values written by a newer header version are rejected."""
+        assert_raises(ValueError, decode, MAGIC + bytes([99, 1, 0]), 'test')
+
+    @with_context
+    def test_memoize_records_stats_by_prefix(self):
+        """Test memoize records encoded sizes and codec times per function."""
+        @memoize(codec='msgpack')
+        def cached_codec_value():
+            return {'a': 1}
+
+        codecs.stats.reset()
+        with patch.dict(self.flask_app.config, {'CACHE_CODEC': 'pickle'}):
+            assert cached_codec_value() == {'a': 1}
+            assert cached_codec_value() == {'a': 1}
+
+        stats = codecs.stats.get()['cached_codec_value']
+        assert stats['encoded'] == 1, stats
+        assert stats['decoded'] == 1, stats
+        assert stats['encoded_bytes'] > 0, stats
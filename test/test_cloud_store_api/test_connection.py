@@ -18,9 +18,12 @@
 
 import jwt
 import io
+import threading
 from unittest.mock import patch
 from test import Test, with_context
-from pybossa.cloud_store_api.connection import create_connection, CustomAuthHandler, CustomProvider
+from pybossa.cloud_store_api.connection import create_connection, CustomAuthHandler, CustomProvider, \
+    connections
+from pybossa.cloud_store_api.s3 import get_connection
 from nose.tools import assert_raises
 from boto.auth_handler import NotReadyToAuthenticate
 from unittest.mock import patch
@@ -210,6 +213,24 @@ class TestCustomConnectionV2(Test):
             content = key.get_contents_as_string()
             assert mock_client.return_value.get_object.return_value["Body"].read.called
 
+    @with_context
+    @patch("pybossa.cloud_store_api.connection.Session.client")
+    def test_get_range(self, mock_client):
+        with patch.dict(self.flask_app.config, self.default_config):
+            conn = create_connection(aws_access_key_id=self.access_key,
+                                     aws_secret_access_key=self.secret_key,
+                                     store="storev2")
+            bucket_name = "testv2"
+            path = "path/to/key"
+            bucket = conn.get_bucket(bucket_name=bucket_name)
+            key = bucket.get_key(path)
+            mock_client.return_value.get_object.return_value = {
+                "Body": "body", "ContentRange": "bytes 10-19/100"}
+            assert key.get_range("bytes=10-19") == "body"
+            assert key.size == 100
+            mock_client.return_value.get_object.assert_called_with(
+                Bucket=bucket_name, Key=path, Range="bytes=10-19")
+
     @with_context
     @patch("pybossa.cloud_store_api.connection.Session.client")
     def test_set_contents(self, mock_client):
@@ -262,3 +283,54 @@ class TestCustomConnectionV2(Test):
             assert mock_client.return_value.generate_presigned_url.called
             key.get_object_head()
             assert mock_client.return_value.head_object.called
+
+
+class TestConnectionRegistry(Test):
+
+    config = {
+        "S3_CONN_TYPE": "storev1",
+        "S3_CONN_TYPE_V2": "storev2",
+        "S3_TEST_V2": dict(aws_access_key_id="test-access-key",
+                           aws_secret_access_key="test-secret-key",
+                           store="storev2"),
+        "S3_TEST": dict(host="s3.store.com",
+                        auth_headers=[("test", "name")])
+    }
+
+    @with_context
+    @patch("pybossa.cloud_store_api.connection.Session.client")
+    def test_connection_reused(self, mock_client):
+        with patch.dict(self.flask_app.config, self.config):
+            conn = get_connection("S3_TEST_V2")
+            assert get_connection("S3_TEST_V2") is conn
+            assert mock_client.call_count == 1
+            stats = connections.stats()["S3_TEST_V2"]
+            assert stats["created"] == 1, stats
+            assert stats["reused"] == 1, stats
+
+            config = dict(self.config["S3_TEST_V2"], endpoint="s3.other.com")
+            with patch.dict(self.flask_app.config, {"S3_TEST_V2": config}):
+                assert get_connection("S3_TEST_V2") is not conn
+
+    @with_context
+    @patch("pybossa.cloud_store_api.connection.Session.client")
+    def test_connections_not_shared_with_forks(self, mock_client):
+        with patch.dict(self.flask_app.config, self.config):
+            conn = get_connection("S3_TEST_V2")
+            with patch("pybossa.cloud_store_api.connection.os.getpid",
+                       return_value=-1):
+                assert get_connection("S3_TEST_V2") is not conn
+            assert mock_client.call_count == 2
+
+    @with_context
+    def test_boto_connections_per_thread(self):
+        with patch.dict(self.flask_app.config, self.config):
+            conn = get_connection("S3_TEST")
+            assert get_connection("S3_TEST") is conn
+            other = []
+            thread = threading.Thread(
+                target=lambda: other.append(
+                    connections.get("S3_TEST", self.config["S3_TEST"])))
+            thread.start()
+            thread.join()
+            assert other[0] is not conn
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
-from pybossa.encryption import AESWithGCM
+from cryptography.exceptions import InvalidTag
+from nose.tools import assert_raises
+
+from pybossa.encryption import AESWithGCM, SegmentedReader, is_segmented
 
 
 class TestAes(object):
@@ -29,3 +32,26 @@ class TestAes(object):
         encrypted = self.aes.encrypt(text.encode('utf-8'))
         decrypted = self.aes.decrypt(encrypted)  # decrypt() returns a unicode string
         assert text == decrypted
+
+    def test_aes_segmented(self):
+        text = bytes(range(256)) * 10
+        encrypted = self.aes.encrypt_segmented(text, 100)
+        assert is_segmented(encrypted)
+        assert self.aes.decrypt(encrypted) == text
+        assert self.aes.decrypt(self.aes.encrypt_segmented(b'', 100)) == ''
+
+    def test_aes_segmented_range(self):
+        text = bytes(range(256)) * 10
+        encrypted = self.aes.encrypt_segmented(text, 100)
+        reader = SegmentedReader(self.aes, encrypted, len(encrypted))
+        assert reader.size == len(text)
+        start, stop = reader.encrypted_range(250, 1050)
+        chunks = [encrypted[i:i + 7] for i in range(start, stop, 7)]
+        assert b''.join(reader.decrypt(chunks, 250, 1050)) == text[250:1050]
+
+    def test_aes_segmented_tampered(self):
+        encrypted = self.aes.encrypt_segmented(b'x' * 250, 100)
+        tampered = encrypted[:20] + b'y' + encrypted[21:]
+        assert_raises(InvalidTag, self.aes.decrypt, tampered)
+        # dropping the last segment must not go unnoticed
+        assert_raises(InvalidTag, self.aes.decrypt, encrypted[:16 + 2 * 116])
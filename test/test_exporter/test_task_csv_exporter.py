@@ -17,6 +17,9 @@
 # along with PyBossa.  If not, see <http://www.gnu.org/licenses/>.
 """This module tests the TaskCsvExporter class."""
 
+import csv
+import io
+import zipfile
 from unittest.mock import patch
 
 from pybossa.exporter.csv_export import CsvExporter
@@ -109,6 +112,33 @@ class TestTaskCsvExporter(Test):
                          'd__0__nested_z']
         assert keys == expected_keys
 
+    @with_context
+    def test_task_csv_exporter_make_zip_streams_all_headers(self):
+        """Test that TaskCsvExporter make_zip writes the headers of every
+        row to the zipped CSV."""
+        project = ProjectFactory.create()
+        TaskFactory.create(project=project, info={'question': 'a'})
+        TaskFactory.create(project=project, info={'url': 'b'})
+
+        exporter = TaskCsvExporter()
+        with exporter.make_zip(project, 'task', filters={}) as fp:
+            with zipfile.ZipFile(fp.stream) as _zip:
+                content = _zip.read(_zip.namelist()[0]).decode()
+
+        rows = list(csv.DictReader(io.StringIO(content)))
+        assert len(rows) == 2, rows
+        assert 'task__info__question' in rows[0], rows[0]
+        assert 'task__info__url' in rows[0], rows[0]
+        assert sorted(row['task__info__question'] for row in rows) == ['', 'a']
+
+    @with_context
+    def test_task_csv_exporter_make_zip_unknown_object(self):
+        """Test that TaskCsvExporter make_zip exports nothing for objects
+        other than tasks and task runs."""
+        project = ProjectFactory.create()
+
+        assert TaskCsvExporter().make_zip(project, 'result', filters={}) is None
+
 class TestExporters(Test):
 
     """Test PyBossa Csv and Json Exporter module."""
@@ -109,10 +109,28 @@ class TestImporterPublicMethods(Test):
         importer_factory.return_value = mock_importer
         project = ProjectFactory.create()
         form_data = dict(type='flickr', album_id='1234', validate_tp=False)
-        with patch.object(task_repo, 'save', side_effect=Exception('a')):
+        with patch.object(task_repo, 'bulk_save_tasks', side_effect=Exception('a')), \
+                patch.object(task_repo, 'save', side_effect=Exception('a')):
             result = self.importer.create_tasks(task_repo, project, **form_data)
         assert '1 task import failed due to a' in result.message, result.message
 
+    @with_request_context
+    def test_create_tasks_in_batches_skips_duplicates_across_batches(self, importer_factory):
+        mock_importer = Mock()
+        mock_importer.tasks.return_value = iter([{'info': {'question': 'question1'}},
+                                                 {'info': {'question': 'question2'}},
+                                                 {'info': {'question': 'question1'}}])
+        importer_factory.return_value = mock_importer
+        project = ProjectFactory.create()
+        form_data = dict(type='gdocs', googledocs_url='http://ggl.com', validate_tp=False)
+        with patch.dict(self.flask_app.config, {'IMPORT_BATCH_SIZE': 2}):
+            result = self.importer.create_tasks(task_repo, project, **form_data)
+        tasks = task_repo.filter_tasks_by(project_id=project.id)
+
+        assert len(tasks) == 2, len(tasks)
+        assert sorted(task.info['question'] for task in tasks) == ['question1', 'question2']
+        assert result.total == 2, result.total
+
     @with_context
     def test_count_tasks_to_import_returns_number_of_tasks_to_import(self, importer_factory):
         mock_importer = Mock()
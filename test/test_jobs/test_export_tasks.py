@@ -1,3 +1,9 @@
+import csv
+import io
+import json
+import os
+import tempfile
+import zipfile
 from unittest.mock import patch, Mock
 
 from nose.tools import assert_raises
@@ -137,6 +143,81 @@ class TestExport(Test):
         assert message.recipients[0] == user.email_addr, message.recipients
         assert message.subject == 'Data exported for your project: test_project', message.subject
 
+    @with_context
+    @patch('pybossa.jobs.mail')
+    @patch('pybossa.jobs.enqueue_job')
+    def test_export_tasks_sharded(self, enqueue_job, mail):
+        """Test JOB export_tasks splits large exports into shards that are
+        merged into one file."""
+        enqueue_job.side_effect = lambda job: job['name'](*job['args'],
+                                                          **job['kwargs'])
+        user = UserFactory.create(admin=True)
+        project = ProjectFactory.create(name='test_project')
+        tasks = TaskFactory.create_batch(5, project=project)
+
+        for filetype in ('csv', 'json'):
+            with patch.dict(self.flask_app.config, {
+                    'EXPORT_SHARD_SIZE': 2,
+                    'EXPORT_CHUNK_FOLDER': tempfile.gettempdir()}):
+                res = export_tasks(user.email_addr, project.short_name,
+                                   'task', False, filetype)
+            assert 'split into 3 shards' in res, res
+
+            message = mail.send.call_args[0][0]
+            assert message.subject == 'Data exported for your project: test_project', message.subject
+            attachment = message.attachments[0]
+            with zipfile.ZipFile(io.BytesIO(attachment.data)) as _zip:
+                content = _zip.read(_zip.namelist()[0]).decode()
+            if filetype == 'csv':
+                rows = list(csv.DictReader(io.StringIO(content)))
+                ids = [int(row['task__id']) for row in rows]
+            else:
+                ids = [item['id'] for item in json.loads(content)]
+            assert ids == [task.id for task in tasks], ids
+
+    @with_context
+    @patch('pybossa.jobs.mail')
+    @patch('pybossa.jobs.enqueue_job')
+    def test_export_tasks_not_sharded_without_chunk_folder(self, enqueue_job,
+                                                          mail):
+        """Test JOB export_tasks runs as a single job when no folder is
+        shared by the workers."""
+        user = UserFactory.create(admin=True)
+        project = ProjectFactory.create(name='test_project')
+        TaskFactory.create_batch(5, project=project)
+
+        with patch.dict(self.flask_app.config, {'EXPORT_SHARD_SIZE': 2,
+                                                'EXPORT_CHUNK_FOLDER': None}):
+            export_tasks(user.email_addr, project.short_name, 'task', False,
+                         'csv')
+        assert not enqueue_job.called
+        message = mail.send.call_args[0][0]
+        assert message.subject == 'Data exported for your project: test_project', message.subject
+
+    @with_context
+    @patch('pybossa.jobs.mail')
+    @patch('pybossa.jobs._get_task_exporter')
+    @patch('pybossa.jobs.enqueue_job')
+    def test_export_tasks_shard_failure(self, enqueue_job, get_exporter, mail):
+        """Test JOB a shard out of retries deletes the chunks and sends the
+        export failed email once."""
+        enqueue_job.side_effect = lambda job: job['name'](*job['args'],
+                                                          **job['kwargs'])
+        get_exporter.return_value.gen_records.side_effect = IOError
+        user = UserFactory.create(admin=True)
+        project = ProjectFactory.create(name='test_project')
+        TaskFactory.create_batch(5, project=project)
+        folder = tempfile.mkdtemp()
+
+        with patch.dict(self.flask_app.config, {'EXPORT_SHARD_SIZE': 2,
+                                                'EXPORT_CHUNK_FOLDER': folder}):
+            assert_raises(IOError, export_tasks, user.email_addr,
+                          project.short_name, 'task', False, 'csv')
+        assert mail.send.call_count == 1, mail.send.call_args_list
+        message = mail.send.call_args[0][0]
+        assert message.subject == 'Data export failed for your project: test_project', message.subject
+        assert os.listdir(folder) == [], os.listdir(folder)
+
     @with_context
     @patch('pybossa.jobs.mail')
     @patch('pybossa.jobs.create_connection')
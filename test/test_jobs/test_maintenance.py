@@ -18,7 +18,7 @@
 
 from pybossa.core import sentinel
 from pybossa.jobs import (check_failed, get_maintenance_jobs,
-    disable_users_job)
+    disable_users_job, create_task_run_partitions)
 from test import Test, with_context
 from unittest.mock import patch, MagicMock
 from test.factories import UserFactory
@@ -34,8 +34,10 @@ class TestMaintenance(Test):
     @with_context
     def test_get_maintenance_jobs(self):
         """Test get maintenance jobs works."""
-        res = next(get_maintenance_jobs())
-        assert res['queue'] == 'maintenance'
+        res = list(get_maintenance_jobs())
+        assert all(job['queue'] == 'maintenance' for job in res)
+        assert [job['name'] for job in res] == [check_failed,
+                                                create_task_run_partitions]
 
     @with_context
     @patch('pybossa.jobs.send_mail')
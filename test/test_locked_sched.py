@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 import threading
+import time
 
 from nose.tools import assert_equal
 
@@ -25,14 +26,20 @@ from test.factories import TaskFactory, ProjectFactory, UserFactory, TaskRunFact
 from pybossa.sched import (
     Schedulers,
     get_task_users_key,
+    get_user_tasks_key,
     acquire_locks,
+    acquire_first_available_lock,
     has_lock,
     get_task_id_and_duration_for_project_user,
     get_task_id_project_id_key,
     get_locked_task,
-    lock_task_for_user
+    lock_task_for_user,
+    release_lock,
+    release_prefetched_tasks
 )
 from pybossa.core import sentinel
+from pybossa.redis_lock import (NO_LIMIT, EXPIRE_LOCK_DELAY,
+                                get_locked_tasks_key)
 from pybossa.contributions_guard import ContributionsGuard
 from test import with_context
 import json
@@ -140,6 +147,63 @@ class TestLockedSched(sched.Helper):
         t6 = get_locked_task(project.id, 4)
         assert not t6
 
+    @with_context
+    def test_get_locked_task_prefetch(self):
+        owner = UserFactory.create(id=500)
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.locked
+        project.info['prefetch_tasks'] = 2
+        project_repo.save(project)
+
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=1)
+
+        t1 = get_locked_task(project.id, 11)
+        assert t1[0].id == tasks[0].id
+        assert has_lock(tasks[1].id, 11, ContributionsGuard.STAMP_TTL)
+        assert not has_lock(tasks[2].id, 11, ContributionsGuard.STAMP_TTL)
+        # the prefetched task is not handed to other users
+        t2 = get_locked_task(project.id, 12)
+        assert t2[0].id == tasks[2].id
+
+        # same task until it is submitted, then the prefetched one
+        assert get_locked_task(project.id, 11)[0].id == tasks[0].id
+        release_lock(tasks[0].id, 11, ContributionsGuard.STAMP_TTL)
+        t3 = get_locked_task(project.id, 11)
+        assert t3[0].id == tasks[1].id
+
+    @with_context
+    def test_release_lock_indexes_task_without_project_map(self):
+        """Test a released lock is indexed after its task to project map
+        expired."""
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project, n_answers=1)
+        acquire_locks(task.id, 11, 1, 100)
+        sentinel.master.delete(get_task_id_project_id_key(task.id))
+
+        release_lock(task.id, 11, 100)
+
+        key = get_locked_tasks_key(project.id)
+        score = sentinel.master.zscore(key, '{}:11'.format(task.id))
+        assert score is not None
+        assert score <= time.time() + EXPIRE_LOCK_DELAY
+
+    @with_context
+    def test_release_prefetched_tasks(self):
+        owner = UserFactory.create(id=500)
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.locked
+        project.info['prefetch_tasks'] = 3
+        project_repo.save(project)
+
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=1)
+        get_locked_task(project.id, 11)
+
+        released = release_prefetched_tasks(project.id, 11, ContributionsGuard.STAMP_TTL)
+
+        assert released == [tasks[1].id, tasks[2].id], released
+        assert has_lock(tasks[0].id, 11, ContributionsGuard.STAMP_TTL)
+        assert get_locked_task(project.id, 12)[0].id == tasks[1].id
+
     @with_context
     def test_get_locked_task_offset(self):
         owner = UserFactory.create(id=500)
@@ -158,6 +222,29 @@ class TestLockedSched(sched.Helper):
         t3 = get_locked_task(project.id, 1, offset=2)
         assert t3 is None
 
+    @with_context
+    def test_newtask_with_a_locked_task(self):
+        """Test a user already holding a lock gets the locked task again"""
+        owner = UserFactory.create(id=500)
+        user = UserFactory.create(id=501)
+
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.locked
+        project_repo.save(project)
+
+        TaskFactory.create_batch(2, project=project, n_answers=1)
+
+        self.set_proj_passwd_cookie(project, user)
+        res = self.app.get('api/project/{}/newtask?api_key={}'
+                           .format(project.id, user.api_key))
+        assert res.status_code == 200, res.data
+        locked_task = json.loads(res.data)
+
+        res = self.app.get('api/project/{}/newtask?api_key={}'
+                           .format(project.id, user.api_key))
+        assert res.status_code == 200, res.data
+        assert json.loads(res.data)['id'] == locked_task['id']
+
     @with_context
     def test_taskrun_submission(self):
         """ Test submissions with locked scheduler """
@@ -282,6 +369,60 @@ class TestLockedSched(sched.Helper):
                 thread.join()
             assert_equal(sum(results), limit)
 
+    @with_context
+    def test_acquire_first_available_lock(self):
+        """Test the first task with a free slot is locked in one batch"""
+        timeout = 100
+        acquire_locks(1, 10, 1, timeout)
+        candidates = [(1, 1, timeout, False),
+                      (2, 1, timeout, False),
+                      (3, 1, timeout, False)]
+
+        locked = acquire_first_available_lock(candidates, 20)
+
+        assert locked == candidates[1], locked
+        assert has_lock(2, 20, timeout)
+        assert not has_lock(1, 20, timeout)
+        assert not has_lock(3, 20, timeout)
+        user_tasks = sentinel.master.hgetall(get_user_tasks_key(20))
+        assert list(user_tasks.keys()) == [b'2'], user_tasks
+
+    @with_context
+    def test_acquire_first_available_lock_keeps_existing_lock(self):
+        """Test a task already locked by the user is returned again"""
+        timeout = 100
+        acquire_locks(1, 10, 1, timeout)
+        candidates = [(1, 1, timeout, False), (2, 1, timeout, False)]
+
+        assert acquire_first_available_lock(candidates, 10) == candidates[0]
+        assert not has_lock(2, 10, timeout)
+
+    @with_context
+    def test_acquire_first_available_lock_none_available(self):
+        timeout = 100
+        acquire_locks(1, 10, 1, timeout)
+        acquire_locks(2, 10, 1, timeout)
+        candidates = [(1, 1, timeout, False), (2, 1, timeout, False)]
+
+        assert acquire_first_available_lock(candidates, 20) is None
+        assert not sentinel.master.exists(get_user_tasks_key(20))
+
+    @with_context
+    def test_acquire_first_available_lock_negative_limit(self):
+        """Test a task with more runs than answers is not locked"""
+        timeout = 100
+        candidates = [(1, -1, timeout, False), (2, NO_LIMIT, timeout, False)]
+
+        assert acquire_first_available_lock(candidates, 20) == candidates[1]
+        assert not has_lock(1, 20, timeout)
+
+    @with_context
+    def test_acquire_first_available_lock_releases_expired(self):
+        acquire_locks(1, 10, 1, -10)
+        candidates = [(1, 1, 100, False)]
+
+        assert acquire_first_available_lock(candidates, 20) == candidates[0]
+
     @with_context
     def test_get_task_id_and_duration_for_project_user_missing(self):
         user = UserFactory.create()
@@ -22,7 +22,7 @@ from sqlalchemy import func
 
 from pybossa.model.event_listeners import *
 from test import Test, with_context
-from test.factories import TaskFactory, TaskRunFactory
+from test.factories import ProjectFactory, TaskFactory, TaskRunFactory
 
 """Tests for model event listeners."""
 
@@ -144,6 +144,84 @@ class TestModelEventListeners(Test):
         obj_with_webhook['published'] = None
         mock_push.assert_called_with(obj_with_webhook, target.task_id, 1)
 
+    @with_context
+    @patch('pybossa.model.event_listeners.check_and_send_task_notifications')
+    @patch('pybossa.model.event_listeners.push_webhook')
+    @patch('pybossa.jobs.enqueue_job_in')
+    def test_on_taskrun_submit_batches_side_effects(self, mock_enqueue_in,
+                                                    mock_push, mock_check):
+        """Test on_taskrun_submit defers side effects to one job per project."""
+        project = ProjectFactory.create(published=True,
+                                        webhook='http://server.com')
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=1)
+        with patch.dict(self.flask_app.config, {'TASKRUN_EVENTS_WINDOW': 5}):
+            for task in tasks:
+                TaskRunFactory.create(project=project, task=task)
+
+        assert mock_enqueue_in.call_count == 1, mock_enqueue_in.call_count
+        assert not mock_check.called
+        assert not mock_push.called
+        assert all(task_repo.get_task(task.id).state == 'completed'
+                   for task in tasks)
+        assert len(result_repo.filter_by(project_id=project.id)) == 3
+
+        job, seconds = mock_enqueue_in.call_args[0]
+        assert seconds == 5, seconds
+        job['name'](*job['args'], **job['kwargs'])
+        mock_check.assert_called_once_with(project.id)
+        assert sorted(call[0][1] for call in mock_push.call_args_list) == \
+            sorted(task.id for task in tasks)
+
+    @with_context
+    @patch('pybossa.redis_lock.LockManager.release_reserve_task_lock')
+    @patch('pybossa.jobs.enqueue_job_in')
+    def test_on_taskrun_submit_batched_releases_locks(self, mock_enqueue_in,
+                                                      mock_release_reserve):
+        """Test on_taskrun_submit with a locking scheduler releases the locks
+        of the task after the commit without querying the database."""
+        from pybossa.core import sentinel
+        from pybossa.sched import acquire_locks, get_task_users_key
+        from pybossa.redis_lock import EXPIRE_LOCK_DELAY, LockManager
+        project = ProjectFactory.create(info=dict(
+            sched='task_queue_scheduler',
+            reserve_tasks=dict(category=['field_1'])))
+        task = TaskFactory.create(project=project, n_answers=2,
+                                  info=dict(field_1='abc'))
+        acquire_locks(task.id, project.owner.id, 2, 3600)
+
+        with patch.dict(self.flask_app.config, {'TASKRUN_EVENTS_WINDOW': 5}), \
+                patch('pybossa.sched.get_reserve_task_key',
+                      side_effect=AssertionError('SQL after commit')):
+            TaskRunFactory.create(project=project, task=task,
+                                  user=project.owner)
+
+        locks = LockManager(sentinel.master, 3600).get_locks(
+            get_task_users_key(task.id))
+        seconds = LockManager.seconds_remaining(locks[str(project.owner.id)])
+        assert seconds <= EXPIRE_LOCK_DELAY, seconds
+        resource_id = mock_release_reserve.call_args[0][0]
+        assert resource_id.endswith(':category:field_1:abc:user:{}:task:{}'
+                                    .format(project.owner.id, task.id)), resource_id
+
+    @with_context
+    def test_add_task_run_to_project_stats_counts_contributor_on_commit(self):
+        """Test add_task_run_to_project_stats only counts the contributor of
+        a task run once it is committed."""
+        from pybossa.core import db
+        project = ProjectFactory.create()
+        task = TaskFactory.create(project=project)
+        task_run = TaskRunFactory.build(project=project, task=task,
+                                        user=project.owner)
+
+        db.session.add(task_run)
+        db.session.flush()
+        assert project_stats.count_contributors(project.id, 'auth') == 0
+        db.session.rollback()
+        assert project_stats.count_contributors(project.id, 'auth') == 0
+
+        TaskRunFactory.create(project=project, task=task, user=project.owner)
+        assert project_stats.count_contributors(project.id, 'auth') == 1
+
     @with_context
     @patch('pybossa.model.event_listeners.update_feed')
     def test_add_user_event(self, mock_update_feed):
@@ -0,0 +1,104 @@
+# -*- coding: utf8 -*-
+# This file is part of PYBOSSA.
+#
+# Copyright (C) 2018 Scifabric LTD.
+#
+# PYBOSSA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PYBOSSA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest.mock import patch
+
+from flask import current_app, g
+
+from pybossa.core import sentinel
+from pybossa.redis_batch import get_batch, flush_batches
+from test import Test, with_context, with_request_context
+
+
+class TestRedisBatch(Test):
+
+    @with_request_context
+    def test_writes_are_sent_with_the_next_read(self):
+        """Test queued writes and a read go in a single round trip."""
+        batch = get_batch()
+        g.redis_round_trips = 0
+        batch.set('batch:a', 1)
+        batch.hset('batch:b', 'x', 2)
+        assert sentinel.master.get('batch:a') is None
+
+        assert batch.hgetall('batch:b') == {b'x': b'2'}
+        assert batch.get('batch:a') == b'1'
+        assert g.redis_round_trips == 2, g.redis_round_trips
+
+    @with_request_context
+    def test_prefetched_read_is_consumed(self):
+        """Test a prefetched read is sent with the first batch flush."""
+        sentinel.master.set('batch:a', 'old')
+        batch = get_batch()
+        g.redis_round_trips = 0
+        batch.prefetch('get', 'batch:a')
+        batch.set('batch:c', 1)
+        batch.flush()
+        sentinel.master.set('batch:a', 'new')
+
+        assert batch.get('batch:a') == b'old'
+        assert g.redis_round_trips == 2, g.redis_round_trips
+
+    @with_request_context
+    def test_read_with_list_argument(self):
+        """Test a read passed a list is served while prefetches are pending."""
+        sentinel.master.set('batch:a', 1)
+        batch = get_batch()
+        batch.prefetch('get', 'batch:b')
+        batch.prefetch('mget', ['batch:a', 'batch:b'])
+
+        assert batch.mget(['batch:a', 'batch:b']) == [b'1', None]
+        assert batch.mget(['batch:a']) == [b'1']
+
+    @with_request_context
+    def test_write_discards_prefetched_read(self):
+        """Test writing a key drops its prefetched reads."""
+        batch = get_batch()
+        batch.prefetch('get', 'batch:a')
+        batch.set('batch:a', 'new')
+
+        assert batch.get('batch:a') == b'new'
+
+    @with_request_context
+    def test_flush_batches_sends_queued_writes(self):
+        """Test the writes still queued at the end of a request are sent."""
+        get_batch().setex('batch:a', 60, 1)
+        flush_batches()
+
+        assert sentinel.master.get('batch:a') == b'1'
+
+    @with_request_context
+    def test_flush_batches_logs_redis_errors(self):
+        """Test a failed write queued at the end of a request is logged,
+        not raised, and the other writes are still sent."""
+        sentinel.master.set('batch:a', 'string')
+        batch = get_batch()
+        batch.hset('batch:a', 'x', 1)
+        batch.set('batch:b', 1)
+        with patch.object(current_app.logger, 'exception') as log:
+            flush_batches()
+
+        assert log.called
+        assert sentinel.master.get('batch:b') == b'1'
+
+    @with_context
+    def test_writes_outside_request_are_not_deferred(self):
+        """Test a batch used outside of a request writes right away."""
+        get_batch().set('batch:a', 1)
+
+        assert sentinel.master.get('batch:a') == b'1'
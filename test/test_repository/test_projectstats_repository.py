@@ -18,8 +18,11 @@
 # Cache global variables for timeouts
 
 from test import Test, db, with_context, with_request_context
-from test.factories import ProjectFactory, TaskFactory
+from test.factories import ProjectFactory, TaskFactory, TaskRunFactory, \
+    AnonymousTaskRunFactory, UserFactory
+from pybossa.core import sentinel
 from pybossa.repositories import ProjectStatsRepository
+from sqlalchemy import text
 import pybossa.cache.project_stats as stats
 
 
@@ -76,4 +79,27 @@ class TestProjectStatsRepository(Test):
         retrieved_ps = self.projectstats_repo.filter_by(project_id=ps1.project_id,
                                                         n_tasks=3)
         assert len(retrieved_ps) == 1, retrieved_ps
-        assert ps1.dictize() == retrieved_ps[0].dictize(), retrieved_ps
\ No newline at end of file
+        assert ps1.dictize() == retrieved_ps[0].dictize(), retrieved_ps
+
+    @with_context
+    def test_refresh_project_stats(self):
+        """Test refresh_project_stats rebuilds the stats rollups and the
+        contributor counts of a project from its task runs"""
+        project = ProjectFactory.create()
+        user = UserFactory.create()
+        TaskRunFactory.create_batch(2, project=project, user=user)
+        AnonymousTaskRunFactory.create(project=project)
+        db.session.execute(text('''DELETE FROM project_stats_hourly;
+                                DELETE FROM project_stats_contributor;'''))
+        db.session.commit()
+        sentinel.master.flushall()
+
+        n_rows = self.projectstats_repo.refresh_project_stats(project.id)
+
+        assert n_rows == 2, n_rows
+        users, anon_users, auth_users = stats.stats_users(project.id)
+        assert auth_users == [[user.id, 2]], auth_users
+        assert len(anon_users) == 1, anon_users
+        assert users == dict(n_auth=1, n_anon=1), users
+        hours = stats.stats_hours(project.id)[0]
+        assert sum(hours.values()) == 3, hours
@@ -348,6 +348,22 @@ class TestTaskRepositoryForTaskQueries(Test):
         assert count == 1, count
 
 
+    @with_context
+    def test_bulk_save_tasks_sets_ids_of_each_task(self):
+        """Test bulk_save_tasks gives each task the id of its own row"""
+        from pybossa.model.task import Task
+        project = ProjectFactory.create()
+        tasks = [Task(project_id=project.id, info=dict(n=n), n_answers=n + 1)
+                 for n in range(5)]
+
+        self.task_repo.bulk_save_tasks(project.id, tasks)
+
+        assert len(set(task.id for task in tasks)) == 5
+        for n, task in enumerate(tasks):
+            saved = self.task_repo.get_task(task.id)
+            assert saved.info == dict(n=n), (task.id, saved.info)
+            assert saved.n_answers == n + 1
+
     @with_context
     def test_bulk_query_task(self):
         """Test bulk query task"""
@@ -848,6 +864,88 @@ class TestTaskRepositorySaveDeleteUpdate(Test):
         assert taskruns == [], taskruns
 
 
+    @with_context
+    def test_task_rollup_follows_task_runs(self):
+        """Test the task_rollup row of a task is kept up to date by the task
+        run listeners and can be checked and rebuilt"""
+        from pybossa.model.task_rollup import TaskRollup
+
+        task = TaskFactory.create(n_answers=3)
+        first = TaskRunFactory.create(task=task, finish_time='2026-01-01')
+        TaskRunFactory.create(task=task, user=first.user,
+                              finish_time='2026-01-03')
+        last = TaskRunFactory.create(task=task, finish_time='2026-01-02')
+
+        rollup = db.session.query(TaskRollup).get(task.id)
+        assert rollup.n_task_runs == 3, rollup.n_task_runs
+        assert rollup.n_contributors == 2, rollup.n_contributors
+        assert rollup.finish_time == '2026-01-03', rollup.finish_time
+
+        self.task_repo.delete(last)
+        db.session.expire_all()
+        rollup = db.session.query(TaskRollup).get(task.id)
+        assert rollup.n_task_runs == 2, rollup.n_task_runs
+        assert rollup.n_contributors == 1, rollup.n_contributors
+        assert self.task_repo.find_task_rollup_mismatches() == []
+
+        db.session.execute('UPDATE task_rollup SET n_task_runs = 0')
+        db.session.commit()
+        mismatches = self.task_repo.find_task_rollup_mismatches(task.project_id)
+        assert mismatches == [task.id], mismatches
+
+        self.task_repo.refresh_task_rollup(task.project_id)
+        assert self.task_repo.find_task_rollup_mismatches() == []
+
+
+    @with_context
+    def test_native_timestamps(self):
+        """Test the native copies of the task run timestamps are written by
+        the trigger, backfilled, and read once NATIVE_TIMESTAMPS is set"""
+        task = TaskFactory.create()
+        old = TaskRunFactory.create(task=task, finish_time='2026-01-01T10:00:00')
+        new = TaskRunFactory.create(task=task, finish_time='2026-01-03T10:00:00')
+        row = db.session.execute(
+            'SELECT finish_time_ts FROM task_run WHERE id = :id',
+            dict(id=new.id)).first()
+        assert row.finish_time_ts.isoformat() == '2026-01-03T10:00:00', row
+
+        db.session.execute('UPDATE task_run SET finish_time_ts = NULL')
+        db.session.commit()
+        updated = self.task_repo.backfill_native_timestamps(batch_size=1)
+        assert updated['task_run'] == 2, updated
+        row = db.session.execute(
+            'SELECT COUNT(*) AS n FROM task_run WHERE finish_time_ts IS NULL').first()
+        assert row.n == 0, row
+
+        with patch.dict(self.flask_app.config, {'NATIVE_TIMESTAMPS': True}):
+            runs = self.task_repo.filter_task_runs_by(
+                project_id=task.project_id, from_finish_time='2026-01-02',
+                to_finish_time='2026-01-04')
+            assert [run.id for run in runs] == [new.id], runs
+            runs = self.task_repo.filter_task_runs_by(
+                project_id=task.project_id, orderby='finish_time', desc=True)
+            assert [run.id for run in runs] == [new.id, old.id], runs
+
+    @with_context
+    def test_create_task_run_partitions(self):
+        """Test task_run partitions are created past the last task and the
+        task runs are stored in the partition of their task"""
+        task = TaskFactory.create()
+        created = self.task_repo.create_task_run_partitions(size=10, ahead=1)
+
+        last = (task.id + 10) // 10 * 10
+        assert created == ['task_run_p%s' % start
+                           for start in range(0, last + 1, 10)], created
+        assert self.task_repo.create_task_run_partitions(10, 1) == []
+
+        task_run = TaskRunFactory.create(task=task)
+        row = db.session.execute(
+            'SELECT tableoid::regclass::text AS name FROM task_run WHERE id = :id',
+            dict(id=task_run.id)).first()
+        assert row.name == 'task_run_p%s' % (task.id // 10 * 10), row
+        assert self.task_repo.get_task_run(task_run.id).task_id == task.id
+
+
     @with_context
     def test_update_tasks_redundancy_changes_all_project_tasks_redundancy(self):
         """Test update_tasks_redundancy updates the n_answers value for every
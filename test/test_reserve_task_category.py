@@ -21,6 +21,8 @@ from test import with_context
 from test.helper import sched
 from test.factories import TaskFactory, ProjectFactory, UserFactory
 from pybossa.core import project_repo, sentinel
+from pybossa.redis_lock import (LockManager, get_reserve_task_index_key,
+                                get_reserve_task_category_key)
 from pybossa.sched import (
     Schedulers,
     reserve_task_sql_filters,
@@ -37,6 +39,9 @@ from werkzeug.exceptions import BadRequest
 
 class TestReserveTaskCategory(sched.Helper):
 
+    def reservation_keys(self, project_id):
+        return LockManager(sentinel.master, 1).get_reservation_keys(project_id)
+
     @with_context
     def test_task_category_to_sql_filter(self):
         # default behavior; returns null filters, category_keys for no category_keys passed
@@ -186,13 +191,13 @@ class TestReserveTaskCategory(sched.Helper):
         expected_reserve_task_key = "reserve_task:project:{}:category:{}:user:{}:task:{}".format(
             project.id, category_key, user.id, task.id
         )
-        assert expected_reserve_task_key.encode() in sentinel.master.keys(), "reserve task key must exist in redis cache"
+        assert expected_reserve_task_key in self.reservation_keys(project.id), "reserve task key must exist in redis cache"
 
         # release reserve task lock
         expiry = 1
         release_reserve_task_lock_by_keys([expected_reserve_task_key], timeout, expiry=expiry)
         time.sleep(expiry + 0.1)  # add a little time to make sure the ttl expires
-        assert expected_reserve_task_key.encode() not in sentinel.master.keys(), "reserve task key should not exist in redis cache"
+        assert expected_reserve_task_key not in self.reservation_keys(project.id), "reserve task key should not exist in redis cache"
 
 
     @with_context
@@ -284,13 +289,13 @@ class TestReserveTaskCategory(sched.Helper):
         expected_reserve_task_key = "reserve_task:project:{}:category:{}:user:{}:task:{}".format(
             project.id, category_key, user.id, task.id
         )
-        assert expected_reserve_task_key.encode() in sentinel.master.keys(), "reserve task key must exist in redis cache"
+        assert expected_reserve_task_key in self.reservation_keys(project.id), "reserve task key must exist in redis cache"
 
         # release reserve task lock
         expiry = 1
         release_reserve_task_lock_by_id(project.id, task.id, user.id, timeout, expiry=expiry)
         time.sleep(expiry + 0.1)
-        assert expected_reserve_task_key.encode() not in sentinel.master.keys(), "reserve task key should not exist in redis cache"
+        assert expected_reserve_task_key not in self.reservation_keys(project.id), "reserve task key should not exist in redis cache"
 
         # test releasing multiple locks
         batch_number = 10
@@ -302,7 +307,7 @@ class TestReserveTaskCategory(sched.Helper):
             acquire_reserve_task_lock(project.id, task.id, user.id, timeout)
             category_key = ":".join([f"{field}:{task.info[field]}" for field in category_fields])
             expected_reserve_task_key = f"reserve_task:project:{project.id}:category:{category_key}:user:{user.id}:task:{task.id}"
-            assert expected_reserve_task_key.encode() in sentinel.master.keys(), "reserve task key must exist in redis cache"
+            assert expected_reserve_task_key in self.reservation_keys(project.id), "reserve task key must exist in redis cache"
 
         release_reserve_task_lock_by_id(project.id, tasks[0].id, user.id, timeout,
                                         expiry=expiry, release_all_task=True)
@@ -310,7 +315,7 @@ class TestReserveTaskCategory(sched.Helper):
         for task in tasks:
             category_key = ":".join([f"{field}:{task.info[field]}" for field in category_fields])
             expected_reserve_task_key = f"reserve_task:project:{project.id}:category:{category_key}:user:{user.id}:task:{task.id}"
-            assert expected_reserve_task_key.encode() not in sentinel.master.keys(), "reserve task key should not exist in redis cache"
+            assert expected_reserve_task_key not in self.reservation_keys(project.id), "reserve task key should not exist in redis cache"
 
     @with_context
     def test_get_reserve_task_key(self):
@@ -400,3 +405,32 @@ class TestReserveTaskCategory(sched.Helper):
             second_exclude_user = second_call_args.args[4]
         assert second_exclude_user == True, f"Second call exclude_user should be True, got {second_exclude_user}"
 
+    @with_context
+    def test_reservation_index(self):
+        lock_manager = LockManager(sentinel.master, 100)
+        key = "reserve_task:project:1:category:field_1:abc:user:2:task:3"
+        other_key = "reserve_task:project:1:category:field_1:xyz:user:3:task:4"
+        lock_manager.acquire_reserve_task_lock(1, 3, 2, "field_1:abc")
+        lock_manager.acquire_reserve_task_lock(1, 4, 3, "field_1:xyz")
+
+        assert sorted(lock_manager.get_reservation_keys(1)) == [key, other_key]
+        assert lock_manager.get_reservation_keys(1, "field_1:abc") == [key]
+        assert lock_manager.get_task_category_lock(1, 2, "field_1:*") == [key]
+        assert lock_manager.get_task_category_lock(
+            1, 2, "field_1:*", exclude_user=True) == [other_key]
+        assert not sentinel.master.exists(key)
+
+        # expired reservations are trimmed from both indexes
+        lock_manager.index_reserve_task_lock(key, time.time() - 1)
+        assert lock_manager.get_task_category_lock(1) == [other_key]
+        assert not sentinel.master.hexists(
+            get_reserve_task_category_key(1, "field_1:abc"), key)
+        assert sentinel.master.zscore(get_reserve_task_index_key(1), key) is None
+
+    @with_context
+    def test_release_missing_reservation(self):
+        lock_manager = LockManager(sentinel.master, 100)
+        key = "reserve_task:project:1:category:field_1:abc:user:2:task:3"
+        lock_manager.release_reserve_task_lock(key, 1)
+        assert lock_manager.get_reservation_keys(1) == []
+        assert not sentinel.master.exists(get_reserve_task_index_key(1))
@@ -712,6 +712,58 @@ class TestNTaskAvailable(sched.Helper):
         task_repo.save(tasks[1])
         assert n_available_tasks_for_user(project, 500) == 1
 
+    @with_context
+    def test_task_routing_filter_semantics(self):
+        '''
+        Worker filters are evaluated by the database the way
+        user_meet_task_requirement evaluates them
+        '''
+        user_info = dict(metadata={"profile": json.dumps(
+            {"finance": "0.6", "department": "eng'ineering", "level": None})})
+        owner = UserFactory.create(id=500, info=user_info)
+        user_repo.save(owner)
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.user_pref
+        worker_filters = [
+            ({'finance': [0.6, '==']}, True),
+            ({'finance': [1, 'less_than']}, True),
+            ({'department': ["eng'ineering", '==']}, True),
+            ({'department': ['aaa', '>']}, True),
+            ({'department': [1, '!=']}, True),
+            ({'finance': ['0.6', '==']}, False),
+            ({'finance': [0.6, 'like']}, False),
+            ({'finance': [0.6]}, False),
+            ({'level': [1, '>=']}, False),
+            ({'finance': [0.5, '>'], 'geography': [0.5, '>=']}, False),
+        ]
+        tasks = TaskFactory.create_batch(len(worker_filters), project=project, n_answers=10)
+        for task, (worker_filter, _) in zip(tasks, worker_filters):
+            task.worker_filter = worker_filter
+            task_repo.save(task)
+
+        expected = sum(1 for _, met in worker_filters if met)
+        assert n_available_tasks_for_user(project, 500) == expected
+
+    @with_context
+    def test_user_pref_task_sorted_by_preference_score(self):
+        '''
+        Tasks are ordered by the worker_pref score computed by the database
+        '''
+        user_info = dict(metadata={"profile": json.dumps({"finance": 0.6, "marketing": 0.4})})
+        owner = UserFactory.create(id=500, info=user_info)
+        user_repo.save(owner)
+        project = ProjectFactory.create(owner=owner)
+        project.info['sched'] = Schedulers.user_pref
+        project_repo.save(project)
+        tasks = TaskFactory.create_batch(3, project=project, n_answers=10)
+        tasks[1].worker_pref = {'marketing': 1}
+        task_repo.save(tasks[1])
+        tasks[2].worker_pref = {'finance': 1}
+        task_repo.save(tasks[2])
+
+        task = get_user_pref_task(project.id, 500)[0]
+        assert task.id == tasks[2].id, task.id
+
     @with_context
     def test_upref_sched_gold_task(self):
         """ Test gold tasks presented with user pref scheduler """
@@ -35,6 +35,7 @@ from pybossa.importers import BulkImportException
 from pybossa.importers.csv import BulkTaskCSVImport
 from test import with_context, Test, with_request_context
 from test.factories import UserFactory, ProjectFactory, TaskFactory
+from pybossa.core import task_repo
 from pybossa.model.user import User
 from pybossa.model.project import Project
 from unittest.mock import Mock
@@ -1338,7 +1339,8 @@ class TestPybossaUtil(Test):
         assert res == '123', res
 
     @with_request_context
-    def test_get_user_saved_partial_tasks(self):
+    @patch('pybossa.util.time')
+    def test_get_user_saved_partial_tasks(self, mock_time):
         sentinel = MagicMock()
         master = MagicMock()
         slave = MagicMock()
@@ -1346,29 +1348,81 @@ class TestPybossaUtil(Test):
 
         sentinel.master = master
         sentinel.slave = slave
-        slave.scan_iter.return_value = [b'partial_answer:project:1:user:1:task:1',
-                                        b'partial_answer:project:1:user:1:task:2',
-                                        b'partial_answer:project:1:user:1:task:3',
-                                        b'partial_answer:project:1:user:1:task:NAN']
-        slave.ttl.return_value = 111111
+        mock_time.time.return_value = 1000.0
+        slave.zrangebyscore.return_value = [(b'1', 112111.0),
+                                            (b'2', 112111.0),
+                                            (b'3', 112111.5)]
         project_id = 1
         user_id = 1
 
         result = util.get_user_saved_partial_tasks(sentinel, project_id, user_id)
         assert result == {1: 111111, 2: 111111, 3: 111111}
+        slave.zrangebyscore.assert_called_with(
+            'partial_answer:project:1:user:1:tasks', 1000.0, '+inf',
+            withscores=True)
+        assert not master.method_calls
 
         task_repo.bulk_query.return_value = [1, 2, 3]
         result = util.get_user_saved_partial_tasks(sentinel, project_id, user_id, task_repo)
         assert result == {1: 111111, 2: 111111, 3: 111111}
+        master.zremrangebyscore.assert_called_with(
+            'partial_answer:project:1:user:1:tasks', '-inf', 1000.0)
+        assert not master.pipeline.called
 
         task_repo.bulk_query.return_value = [1, 2]
         result = util.get_user_saved_partial_tasks(sentinel, project_id, user_id, task_repo)
         assert result == {1: 111111, 2: 111111}
+        pipeline = master.pipeline.return_value
+        pipeline.zrem.assert_called_with(
+            'partial_answer:project:1:user:1:tasks', 3)
+        pipeline.delete.assert_called_with(
+            'partial_answer:project:1:user:1:task:3')
 
         task_repo.bulk_query.return_value = [4, 5, 6]
         result = util.get_user_saved_partial_tasks(sentinel, project_id, user_id, task_repo)
         assert result == {}
 
+    @with_request_context
+    def test_saved_partial_answers_index(self):
+        """Test partial answers are listed, deleted and pruned through the
+        index of each user."""
+        project = ProjectFactory.create()
+        tasks = TaskFactory.create_batch(3, project=project)
+        util.save_partial_answer(test_sentinel, project.id, 1, tasks[0].id,
+                                 '{}', 100)
+        util.save_partial_answer(test_sentinel, project.id, 1, tasks[1].id,
+                                 '{}', 200)
+        util.save_partial_answer(test_sentinel, project.id, 2, tasks[2].id,
+                                 '{}', 100)
+
+        result = util.get_user_saved_partial_tasks(test_sentinel, project.id, 1)
+        assert sorted(result) == [tasks[0].id, tasks[1].id], result
+        assert 99 <= result[tasks[0].id] <= 100, result
+        assert 199 <= result[tasks[1].id] <= 200, result
+
+        util.delete_partial_answers(test_sentinel, project.id, [1],
+                                    [tasks[0].id])
+        result = util.get_user_saved_partial_tasks(test_sentinel, project.id, 1)
+        assert list(result) == [tasks[1].id], result
+        key = util.PARTIAL_ANSWER_KEY.format(project_id=project.id, user_id=1,
+                                             task_id=tasks[0].id)
+        assert not test_sentinel.master.exists(key)
+
+        task_repo.delete(tasks[2])
+        assert util.prune_partial_answers(test_sentinel, project.id,
+                                          task_repo) == 1
+        users_key = util.PARTIAL_ANSWER_USERS_KEY.format(project_id=project.id)
+        assert test_sentinel.master.smembers(users_key) == {b'1'}
+
+        util.save_partial_answer_position(test_sentinel, project.id, 3,
+                                          'first', 100)
+        assert util.prune_partial_answers(test_sentinel, project.id,
+                                          task_repo) == 1
+        assert test_sentinel.master.smembers(users_key) == {b'1', b'3'}
+
+        util.delete_partial_answers(test_sentinel, project.id)
+        assert not test_sentinel.master.keys('partial_answer:*')
+
     @with_request_context
     def test_delete_redis_keys(self):
         test_sentinel.master.set("test:partial_keys_project:1:user:1", "abc")
@@ -17,6 +17,7 @@
 # along with PYBOSSA.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import io
 import os
 from test import with_context
 from nose.tools import assert_raises
@@ -42,6 +43,17 @@ class TestFileproxy(web.Helper):
         create_connection.return_value = conn
         return key
 
+    def set_contents(self, key, content):
+        if type(content) == str:
+            content = content.encode()
+        key.size = len(content)
+
+        def open_read(headers):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            end = int(end) + 1 if end else len(content)
+            key.read.side_effect = io.BytesIO(content[int(start):end]).read
+        key.open_read.side_effect = open_read
+
     @with_context
     def test_proxy_no_signature(self):
         project = ProjectFactory.create()
@@ -101,7 +113,7 @@ class TestFileproxy(web.Helper):
         encryption_key = 'testkey'
         aes = AESWithGCM(encryption_key)
         key = self.get_key(create_connection)
-        key.get_contents_as_string.return_value = aes.encrypt('the content')
+        self.set_contents(key, aes.encrypt('the content'))
 
         with patch.dict(self.flask_app.config, {
             'FILE_ENCRYPTION_KEY': encryption_key,
@@ -127,7 +139,7 @@ class TestFileproxy(web.Helper):
         encryption_key = 'testkey'
         aes = AESWithGCM(encryption_key)
         key = self.get_key(create_connection)
-        key.get_contents_as_string.return_value = aes.encrypt('the content')
+        self.set_contents(key, aes.encrypt('the content'))
 
         with patch.dict(self.flask_app.config, {
             'FILE_ENCRYPTION_KEY': encryption_key,
@@ -200,7 +212,7 @@ class TestFileproxy(web.Helper):
         encryption_key = 'testkey'
         aes = AESWithGCM(encryption_key)
         key = self.get_key(create_connection)
-        key.get_contents_as_string.return_value = aes.encrypt('the content')
+        self.set_contents(key, aes.encrypt('the content'))
 
         with patch.dict(self.flask_app.config, {
             'FILE_ENCRYPTION_KEY': encryption_key,
@@ -233,7 +245,7 @@ class TestFileproxy(web.Helper):
         encryption_key = 'testkey'
         aes = AESWithGCM(encryption_key)
         key = self.get_key(create_connection)
-        key.get_contents_as_string.return_value = aes.encrypt('the content')
+        self.set_contents(key, aes.encrypt('the content'))
         get_secret.return_value = encryption_key
 
         with patch.dict(self.flask_app.config, {
@@ -260,7 +272,7 @@ class TestFileproxy(web.Helper):
         req_url = '%s?api_key=%s&task-signature=%s' % (url, admin.api_key, signature)
 
         key = self.get_key(create_connection)
-        key.get_contents_as_string.side_effect = S3ResponseError(403, 'Forbidden')
+        key.open_read.side_effect = S3ResponseError(403, 'Forbidden')
 
         res = self.app.get(req_url, follow_redirects=True)
         assert res.status_code == 500, f"Expected 500 Internal Server Error, got {res.status_code}"
@@ -281,11 +293,74 @@ class TestFileproxy(web.Helper):
         key = self.get_key(create_connection)
         exception = S3ResponseError(404, 'NoSuchKey')
         exception.error_code = 'NoSuchKey'
-        key.get_contents_as_string.side_effect = exception
+        key.open_read.side_effect = exception
 
         res = self.app.get(req_url, follow_redirects=True)
         assert res.status_code == 404, res.status_code
 
+    @with_context
+    @patch('pybossa.cloud_store_api.s3.create_connection')
+    def test_proxy_segmented_file_range(self, create_connection):
+        project = ProjectFactory.create()
+        url = '/fileproxy/encrypted/s3/test/%s/file.pdf' % project.id
+        task = TaskFactory.create(project=project, info={
+            'url': url
+        })
+        owner = project.owner
+
+        signature = signer.dumps({'task_id': task.id})
+        req_url = '%s?api_key=%s&task-signature=%s' % (url, owner.api_key, signature)
+
+        encryption_key = 'testkey'
+        aes = AESWithGCM(encryption_key)
+        content = bytes(range(256)) * 10
+        key = self.get_key(create_connection)
+        self.set_contents(key, aes.encrypt_segmented(content, 100))
+
+        with patch.dict(self.flask_app.config, {
+            'FILE_ENCRYPTION_KEY': encryption_key,
+            'S3_REQUEST_BUCKET': 'test'
+        }):
+            res = self.app.get(req_url)
+            assert res.status_code == 200, res.status_code
+            assert res.data == content
+            assert res.headers['Accept-Ranges'] == 'bytes'
+
+            res = self.app.get(req_url, headers={'Range': 'bytes=250-1049'})
+            assert res.status_code == 206, res.status_code
+            assert res.data == content[250:1050]
+            assert res.headers['Content-Range'] == 'bytes 250-1049/2560'
+            key.open_read.assert_called_with(headers={'Range': 'bytes=248-1291'})
+
+            res = self.app.get(req_url, headers={'Range': 'bytes=5000-'})
+            assert res.status_code == 416, res.status_code
+
+    @with_context
+    @patch('pybossa.cloud_store_api.s3.create_connection')
+    def test_proxy_legacy_file_range(self, create_connection):
+        project = ProjectFactory.create()
+        url = '/fileproxy/encrypted/s3/test/%s/file.pdf' % project.id
+        task = TaskFactory.create(project=project, info={
+            'url': url
+        })
+        owner = project.owner
+
+        signature = signer.dumps({'task_id': task.id})
+        req_url = '%s?api_key=%s&task-signature=%s' % (url, owner.api_key, signature)
+
+        encryption_key = 'testkey'
+        aes = AESWithGCM(encryption_key)
+        key = self.get_key(create_connection)
+        self.set_contents(key, aes.encrypt('the content'))
+
+        with patch.dict(self.flask_app.config, {
+            'FILE_ENCRYPTION_KEY': encryption_key,
+            'S3_REQUEST_BUCKET': 'test'
+        }):
+            res = self.app.get(req_url, headers={'Range': 'bytes=4-'})
+            assert res.status_code == 206, res.status_code
+            assert res.data == b'content', res.data
+
 
 class TestEncryptedPayload(web.Helper):
 
@@ -45,7 +45,7 @@ from pybossa.model.user import User
 from pybossa.model.result import Result
 from pybossa.messages import *
 from pybossa.leaderboard.jobs import leaderboard as update_leaderboard
-from pybossa.core import user_repo, project_repo, result_repo, announcement_repo, signer, task_repo
+from pybossa.core import user_repo, project_repo, result_repo, announcement_repo, signer, task_repo, sentinel
 from pybossa.jobs import send_mail, import_tasks
 from pybossa.importers import ImportReport
 from pybossa.cache.project_stats import update_stats
@@ -61,7 +61,7 @@ from datetime import datetime, timedelta
 import six
 from pybossa.view.account import get_user_data_as_form
 from pybossa.cloud_store_api.s3 import upload_json_data
-from pybossa.task_creator_helper import get_gold_answers
+from pybossa.task_creator_helper import get_gold_answers, get_gold_answers_cache_key
 from pybossa.core import setup_error_handlers
 from pybossa.task_creator_helper import generate_checksum
 from pybossa.task_creator_helper import set_task_filter_fields, get_task_contents_for_processing
@@ -8592,7 +8592,8 @@ class TestWeb(web.Helper):
             {
                 'ENABLE_ENCRYPTION': True,
                 "S3_REQUEST_BUCKET": bucket_name,
-                'S3_CONN_TYPE': "STORE"
+                'S3_CONN_TYPE': "STORE",
+                'GOLD_ANSWERS_CACHE_TIMEOUT': None
             }
         ):
             res = self.app_post_json(url,
@@ -8614,6 +8615,40 @@ class TestWeb(web.Helper):
             assert kwargs2['path'] == '/{}/{}'.format(upload_path, file_name)
             assert retrieved_gold_answers == gold_answers, {"retrieved": retrieved_gold_answers, "actual": gold_answers}
 
+    @with_context
+    @patch('pybossa.task_creator_helper.upload_json_data')
+    @patch('pybossa.task_creator_helper.get_content_from_s3')
+    def test_get_private_gold_answers_cached(self, get_content_from_s3_mock, upload_json_data_mock):
+        """Test private gold answers are read from the encrypted cache"""
+        admin = UserFactory.create()
+        self.signin_user(admin)
+        project = ProjectFactory.create(owner=admin)
+        task = Task(project_id=project.id)
+        task_repo.save(task)
+
+        url = "/api/project/1/taskgold"
+        gold_answers = {'ans1': 'secret answer'}
+        payload = {'info': gold_answers, 'task_id': 1, 'project_id': 1}
+
+        with patch.dict(
+            self.flask_app.config,
+            {
+                'ENABLE_ENCRYPTION': True,
+                "S3_REQUEST_BUCKET": "BUCKET",
+                'S3_CONN_TYPE': "STORE",
+                'FILE_ENCRYPTION_KEY': 'testkey',
+                'GOLD_ANSWERS_CACHE_TIMEOUT': 60
+            }
+        ):
+            self.app_post_json(url, data=payload, follow_redirects=False)
+            t = task_repo.get_task(1)
+            retrieved_gold_answers = get_gold_answers(t)
+
+            assert not get_content_from_s3_mock.called
+            assert retrieved_gold_answers == gold_answers, retrieved_gold_answers
+            key = get_gold_answers_cache_key(t.gold_answers['gold_ans__upload_url'])
+            assert b'secret answer' not in sentinel.master.get(key)
+
     @with_context
     def test_missing_private_gold_answers(self):
         admin = UserFactory.create()
@@ -11259,6 +11294,39 @@ class TestWebUserMetadataUpdate(web.Helper):
         assert data.get('success') == True, data
         assert release_lock.call_count == 1, release_lock.call_count
 
+    @with_context
+    @patch('pybossa.api.release_reserve_task_lock_by_id')
+    @patch('pybossa.api.release_prefetched_tasks')
+    @patch('pybossa.api.release_lock')
+    @patch('pybossa.api.has_lock')
+    def test_cancel_task_releases_prefetched_tasks_first(self, has_lock, release_lock,
+                                                         release_prefetched, release_reserve):
+        """Test cancel releases prefetched tasks before category reservations"""
+        has_lock.return_value = True
+        calls = []
+        release_prefetched.side_effect = lambda *args: calls.append('prefetched')
+        release_reserve.side_effect = lambda *args, **kwargs: calls.append('reserve')
+        url = "/api/task/1/canceltask"
+
+        admin = UserFactory.create()
+        self.signin_user(admin)
+        project = ProjectFactory.create(
+            info= {
+                'sched': 'user_pref_scheduler',
+                'data_classification': dict(input_data="L4 - public", output_data="L4 - public")
+            },
+            owner=admin
+        )
+        payload = {'projectname': project.short_name}
+
+        res = self.app_post_json(url,
+                            data=payload,
+                            follow_redirects=False,
+                            )
+        data = json.loads(res.data)
+        assert data.get('success') == True, data
+        assert calls == ['prefetched', 'reserve'], calls
+
     @with_context
     @patch('pybossa.api.release_lock')
     @patch('pybossa.api.has_lock')